@@ -2,6 +2,7 @@ from __future__ import annotations
 import pandas as pd
 import numpy as np
 import os
+import time
 import gymnasium
 import pickle
 import juliacall
@@ -12,6 +13,9 @@ from gymnasium.spaces import Box, Discrete, Dict
 from datetime import datetime
 from copy import copy, deepcopy
 from juliacall import convert as jlconvert
+from TwoStageROProcessEnvironment.env.observation_bounds import observation_bounds
+from utils.profiling import profiler, profiled
+from utils.metrics import metrics
 
 
 
@@ -21,7 +25,7 @@ class TwoStageROProcessEnvironment(ParallelEnv):
     }
 
     # Initialize environment.
-    def __init__(self, save_dir, len_scenario=None, render_mode='text'):
+    def __init__(self, save_dir, len_scenario=None, render_mode='text', n_segments=None, control_dt=None):
 
         # Setup Julia.
         # Default dt value is 1.0 (1 minute). If one needs to change dt, go to "ro_element.jl" file and modify "dt" variale.
@@ -31,6 +35,13 @@ class TwoStageROProcessEnvironment(ParallelEnv):
         julia_path = os.path.join(self.julia_file_path, "pressure_controlled_ro_simple.jl")
         self.jl.seval(f"include(raw\"{julia_path}\")")
         self.pressure_controlled_ro = self.jl.PressureControlledRO.pressure_controlled_2stage_ro_simple
+        self.timed_pressure_controlled_ro = self.jl.PressureControlledRO.timed_pressure_controlled_2stage_ro_simple
+        self.drain_julia_events = self.jl.PressureControlledRO.drain_events_b
+
+        # Fidelity of the vessel model (700 segments by default). Julia-global: applies to every environment of the process.
+        self.n_segments = n_segments
+        if n_segments is not None:
+            self.jl.PressureControlledRO.RO_Element_Simple.set_n_segments_b(int(n_segments))
 
         self.len_scenario = len_scenario
         self.render_mode = render_mode
@@ -39,7 +50,8 @@ class TwoStageROProcessEnvironment(ParallelEnv):
         # Initialize seed state variables and operational variables.
         self.dt = 60.0 * 6
         self.days = 30.0  # Model for 1 month
-        self.control_dt = 60.0 * 6 # Control every 6 hours.
+        self.control_dt = 60.0 * 6 if control_dt is None else float(control_dt) # Control every 6 hours by default.
+        assert self.control_dt % self.dt == 0, f"control_dt ({self.control_dt}) must be a multiple of the model dt ({self.dt})."
         self.control_interval = int(self.control_dt / self.dt)
         self.max_timestep = int(self.days * 24 * 60 / self.dt)
         self.max_control_timestep = int(self.max_timestep / self.control_interval)
@@ -186,21 +198,8 @@ class TwoStageROProcessEnvironment(ParallelEnv):
 
         # Define observation spaces for each agent.
         self.observation_spaces = {
-            "influent_flowrate": Box(
-                low  = np.array([700.0  / self.ro_1st_pvs,  300.0, 100.0  / self.ro_2nd_pvs,  100.0, 100.0, 0.0]),
-                high = np.array([1400.0 / self.ro_1st_pvs, 900.0, 1000.0 / self.ro_2nd_pvs, 300.0, 300.0, 40.0]),
-                dtype=np.float32
-            ),
-            "1st_stage_pump": Box(
-                low  = np.array([0.0,  200.0,  700.0  / self.ro_1st_pvs,  500.0,  100.0,  0.0,   100.0,  0.0,  0.0,  0.0]),
-                high = np.array([40.0, 1000.0, 1400.0 / self.ro_1st_pvs, 2500.0, 1000.0, 100.0, 1000.0, 25.0, 25.0, 1.0]),
-                dtype=np.float32
-            ),
-            "2nd_stage_pump": Box(
-                low  = np.array([0.0,  500.0,  100.0  / self.ro_2nd_pvs,  0.0,  1000.0, 50.0,  50.0,  50.0,  0.0,  0.0,  0.0]),
-                high = np.array([40.0, 2500.0, 1000.0 / self.ro_2nd_pvs, 25.0, 5000.0, 500.0, 250.0, 500.0, 25.0, 25.0, 1.0]),
-                dtype=np.float32
-            ),
+            a: Box(low=low, high=high, dtype=np.float32)
+            for a, (low, high) in observation_bounds(ro_1st_pvs=self.ro_1st_pvs, ro_2nd_pvs=self.ro_2nd_pvs).items()
         }
 
         # Define action spaces for each agent.
@@ -230,6 +229,7 @@ class TwoStageROProcessEnvironment(ParallelEnv):
 
         # atexit.register(self.cleanup)
 
+    @profiled('env reset')
     def reset(self, hard=False, len_scenario=None, initial_action: dict | None = None, seed: int | None = None, feed_concentration: float = None, reward_ws = [1.0, 1.0], production_term=True) -> \
     tuple[dict[AgentID, ObsType], dict[AgentID, dict]]:
         """
@@ -386,6 +386,7 @@ class TwoStageROProcessEnvironment(ParallelEnv):
 
         return observations, infos
 
+    @profiled('env step')
     def step(self, actions: dict[AgentID, ActionType], terminate_if_diverge=True) -> tuple[
         dict[AgentID, ObsType], dict[AgentID, float], dict[AgentID, bool], dict[AgentID, bool], dict[AgentID, dict], dict]:
         """
@@ -483,6 +484,7 @@ class TwoStageROProcessEnvironment(ParallelEnv):
         # Update timestep.
         self.timestep += self.control_interval
         self.control_timestep += 1
+        metrics.counter('env_steps', 'Control steps of the environment').inc()
         
         self.render(mode=self.render_mode)
 
@@ -505,6 +507,14 @@ class TwoStageROProcessEnvironment(ParallelEnv):
             axes[1].set_title(f"2nd Stage RO TMP at timestep {self.timestep}")
             plt.tight_layout()
             plt.show()
+        elif mode == 'metrics':
+            # Gauges instead of one printed line per step. Summarized by the rate-limited report of utils.metrics.
+            metrics.gauge('env_flowrate', 'Influent flowrate').set(self.influent_flowrate)
+            metrics.gauge('env_1st_pressure', '1st stage pump pressure').set(self.ro_1st_pressure)
+            metrics.gauge('env_2nd_pressure', '2nd stage pump pressure').set(self.ro_2nd_pressure)
+            if self.reward_total is not None:
+                metrics.gauge('env_reward', 'Reward of the last step').set(self.reward_total)
+            metrics.report()
         elif mode == 'text':
             simple = True
             if not simple:
@@ -577,6 +587,7 @@ class TwoStageROProcessEnvironment(ParallelEnv):
     def action_space(self, agent: AgentID) -> gymnasium.spaces.Space:
         return self.action_spaces[agent]
 
+    @profiled('env plot')
     def plot_environment(self, save_dir, plot_state = False):
         episode = self.episode_id
         if save_dir is None:
@@ -658,6 +669,7 @@ class TwoStageROProcessEnvironment(ParallelEnv):
         }
         return transition
 
+    @profiled('env process modeling')
     def _process_modeling(self, feed_scenario: np.ndarray, starting_index, modeling_length):
         """
          This method is internal method used to model 2 stage RO process and save the values on attributes.
@@ -670,8 +682,24 @@ class TwoStageROProcessEnvironment(ParallelEnv):
         sliced_feed_scenario = jlconvert(T = self.jl.Array, x = sliced_feed_scenario)
 
         # State variables and action values (flowrate, recovery setpoints) must be configured beforehand calling this method.
+        with profiler.span('julia model'):
+            if profiler.enabled:
+                # The timed variant also reports the Julia-side time and allocations of the call.
+                julia_start = time.perf_counter()
+                model_outputs, julia_time, julia_bytes, julia_allocations, julia_gc_time \
+                    = self.timed_pressure_controlled_ro(sliced_feed_scenario, self.influent_flowrate, self.ro_1st_pressure, self.ro_2nd_pressure, self.state_var_1st_stage, self.state_var_2nd_stage)
+                profiler.add('julia model (julia-side)', julia_time, start=julia_start, bytes=julia_bytes, allocations=julia_allocations, gc_time=julia_gc_time)
+                profiler.count('julia allocations', julia_allocations)
+                profiler.count('julia allocated bytes', julia_bytes)
+            else:
+                model_outputs = self.pressure_controlled_ro(sliced_feed_scenario, self.influent_flowrate, self.ro_1st_pressure, self.ro_2nd_pressure, self.state_var_1st_stage, self.state_var_2nd_stage)
         state_var_updated_1st_stage, state_var_updated_2nd_stage, permeate_1st_log, permeate_2nd_log, brine_1st_log, brine_2nd_log, recovery_1st_log, recovery_2nd_log, op_var_1st_log, op_var_2nd_log, blackbox_1st, blackbox_2nd, SEC_1st_log, SEC_2nd_log, SEC_total_log, converged \
-            = self.pressure_controlled_ro(sliced_feed_scenario, self.influent_flowrate, self.ro_1st_pressure, self.ro_2nd_pressure, self.state_var_1st_stage, self.state_var_2nd_stage)
+            = model_outputs
+        # Divergence and iteration-cap events of the model are counted in Julia instead of printed.
+        metrics.record_julia_events(self.drain_julia_events())
+        metrics.counter('env_model_steps', 'Simulated process timesteps').inc(len(op_var_1st_log))
+        if not converged:
+            metrics.counter('env_divergences', 'Model calls that diverged').inc()
 
         # Save snapshots of state variables.
         self.state_var_1st_stage = copy(state_var_updated_1st_stage)
@@ -914,6 +942,7 @@ class TwoStageROProcessEnvironment(ParallelEnv):
         osmo_p = (2 / 58.44e3) * concentration * 8.3145e3 * (temperature + 273.15)
         return osmo_p
     
+    @profiled('env action mask')
     def _generate_action_mask(self) -> dict[AgentID, np.ndarray]:
         """
          Define action masks.
@@ -969,6 +998,62 @@ class TwoStageROProcessEnvironment(ParallelEnv):
             # "Clean_In_Place": CIP_action_mask
         }
 
+    # Attributes left out of snapshots: Julia handles, identity of the environment and constants set in __init__.
+    _SNAPSHOT_EXCLUDED = ('jl', 'pressure_controlled_ro', 'timed_pressure_controlled_ro', 'drain_julia_events', 'julia_file_path',
+                          'save_dir', 'render_mode', 'episode_id', 'n_segments', 'len_scenario', 'water_temperature', 'concentration',
+                          'influent_pressure', 'feed_scenario_total', 'observation_spaces', 'action_spaces', 'possible_agents')
+    # Julia state variables of the vessels (fouling resistance R_m and the profiles along the vessels) and their logs.
+    _JULIA_STATES = ('state_var_1st_stage', 'state_var_2nd_stage')
+    _JULIA_STATE_LOGS = ('state_var_1st_log', 'state_var_2nd_log')
+
+    def snapshot(self) -> dict:
+        """
+         Picklable copy of the episode in progress: the Python attributes and the Julia state variables of both stages
+        (including the fouling state), converted to numpy. restore() continues the episode from it exactly.
+         The Julia state variable logs are not copied (one set of vessel profiles per step, and only read by the commented
+        out pickling of plot_environment): only their length is kept.
+        """
+        snapshot = {}
+        for name, value in self.__dict__.items():
+            if name in self._SNAPSHOT_EXCLUDED:
+                continue
+            if name in self._JULIA_STATES:
+                snapshot[name] = {key: self._from_julia(item) for key, item in value.items()}
+            elif name in self._JULIA_STATE_LOGS:
+                snapshot[name] = len(value)
+            else:
+                snapshot[name] = deepcopy(value)
+        return snapshot
+
+    def restore(self, snapshot: dict):
+        """
+         Continue the episode from a snapshot() of this environment (or of another one with the same settings).
+        The Julia state variables are rebuilt as Julia dictionaries, and the state variable logs are refilled with None up
+        to their length, followed by the restored state.
+        """
+        for name, value in snapshot.items():
+            if name in self._JULIA_STATES:
+                setattr(self, name, self._to_julia(value))
+            elif name in self._JULIA_STATE_LOGS:
+                continue
+            else:
+                setattr(self, name, deepcopy(value))
+        for name, state_name in zip(self._JULIA_STATE_LOGS, self._JULIA_STATES):
+            length = snapshot[name]
+            setattr(self, name, [None] * (length - 1) + [getattr(self, state_name)] if length > 0 else [])
+
+    @staticmethod
+    def _from_julia(value):
+        if isinstance(value, (bool, int, float, str)) or value is None:
+            return value
+        return np.array(value)
+
+    def _to_julia(self, state: dict):
+        state_var = self.jl.seval("Dict{String, Any}")()
+        for key, value in state.items():
+            state_var[key] = jlconvert(T=self.jl.Array, x=value) if isinstance(value, np.ndarray) else value
+        return state_var
+
     def sample_scenario(self, len_scenario, concentration=None, range=None, noise=False):
         self.start_point = np.random.choice(np.arange(self.total_simulation_time - (len_scenario + 1)))
         if range is None:
@@ -0,0 +1,53 @@
+"""
+ Observation bounds and action sizes of the agents of TwoStageROProcessEnvironment, kept free of Julia and PettingZoo so that
+processes which never simulate the process (learner, deployment runtime, ...) can build agent networks and scale observations.
+"""
+import numpy as np
+
+RO_1ST_PVS = 84.0
+RO_2ND_PVS = 48.0
+
+AGENTS = [
+    "influent_flowrate",
+    "1st_stage_pump",
+    "2nd_stage_pump",
+]
+
+N_ACTIONS = {
+    "influent_flowrate": 5,
+    "1st_stage_pump": 5,
+    "2nd_stage_pump": 5,
+}
+
+
+def observation_bounds(ro_1st_pvs=RO_1ST_PVS, ro_2nd_pvs=RO_2ND_PVS):
+    """
+    Return the (low, high) arrays of the observation space of each agent.
+    """
+    return {
+        "influent_flowrate": (
+            np.array([700.0  / ro_1st_pvs,  300.0, 100.0  / ro_2nd_pvs,  100.0, 100.0, 0.0]),
+            np.array([1400.0 / ro_1st_pvs, 900.0, 1000.0 / ro_2nd_pvs, 300.0, 300.0, 40.0]),
+        ),
+        "1st_stage_pump": (
+            np.array([0.0,  200.0,  700.0  / ro_1st_pvs,  500.0,  100.0,  0.0,   100.0,  0.0,  0.0,  0.0]),
+            np.array([40.0, 1000.0, 1400.0 / ro_1st_pvs, 2500.0, 1000.0, 100.0, 1000.0, 25.0, 25.0, 1.0]),
+        ),
+        "2nd_stage_pump": (
+            np.array([0.0,  500.0,  100.0  / ro_2nd_pvs,  0.0,  1000.0, 50.0,  50.0,  50.0,  0.0,  0.0,  0.0]),
+            np.array([40.0, 2500.0, 1000.0 / ro_2nd_pvs, 25.0, 5000.0, 500.0, 250.0, 500.0, 25.0, 25.0, 1.0]),
+        ),
+    }
+
+
+def observation_shapes():
+    return {a: low.shape[0] for a, (low, _) in observation_bounds().items()}
+
+
+def scale_observation(agent, observation, bounds=None):
+    # Same min-max scaling as TwoStageROProcessEnvironment.scale_observation, for a single agent.
+    if bounds is None:
+        bounds = observation_bounds()
+    low, high = bounds[agent]
+    low, high = low.astype(np.float32), high.astype(np.float32)
+    return (observation - low) / (high - low)
@@ -1,5 +1,5 @@
 module RO_Utils_Module
-    export sherwood, cake_mass, osmo_press, k_CEMT
+    export sherwood, cake_mass, osmo_press, k_CEMT, record_event!, drain_events!
 
     eps = 0.36              # Epsilon(ε), the porosity of cake layer [-]
     tau_c = 1 - log(eps^2)  # Tortuosity of the cake layer [-]
@@ -40,4 +40,24 @@ module RO_Utils_Module
         return k_cemt
     end
 
+    # Model events (divergence, fixed-point iteration cap ...) counted instead of printed.
+    # Drained by the Python side (utils/metrics.py). The lock makes it safe from threaded callers.
+    const EVENT_COUNTS = Dict{String, Int}()
+    const EVENT_LOCK = ReentrantLock()
+
+    function record_event!(name::AbstractString, count::Integer=1)
+        lock(EVENT_LOCK) do
+            EVENT_COUNTS[name] = get(EVENT_COUNTS, name, 0) + count
+        end
+        return nothing
+    end
+
+    function drain_events!()
+        lock(EVENT_LOCK) do
+            events = copy(EVENT_COUNTS)
+            empty!(EVENT_COUNTS)
+            return events
+        end
+    end
+
 end
@@ -0,0 +1,79 @@
+# Constant-setpoint operating map of the two-stage RO process, multi-threaded across grid points.
+# Loaded by utils/operating_map.py. The process model is the one of TwoStageROProcessEnvironment
+# (pressure_controlled_ro_simple.jl), reused if the environment already included it in this Julia session.
+if !isdefined(@__MODULE__, :PressureControlledRO)
+    include(joinpath(@__DIR__, "pressure_controlled_ro_simple.jl"))
+end
+
+module OperatingMap
+
+using ..PressureControlledRO
+
+export operating_map
+
+# Quantities of the map, first axis of the array returned by operating_map.
+const QUANTITIES = ["SEC", "production", "permeate concentration", "recovery", "recovery 1st", "brine concentration",
+                    "brine pressure", "feed pressure 1st", "feed pressure 2nd"]
+
+"""
+Values of the QUANTITIES from the log entries of one model step of pressure_controlled_2stage_ro_simple.
+"""
+function quantities(flowrate, permeate_1st, permeate_2nd, brine_2nd, recovery_1st, op_1st, op_2nd, SEC_total)
+    production = permeate_1st["Q"] + permeate_2nd["Q"]
+    permeate_concentration = (permeate_1st["C"] * permeate_1st["Q"] + permeate_2nd["C"] * permeate_2nd["Q"]) / production
+    return (SEC_total, production, permeate_concentration, production / flowrate, recovery_1st, brine_2nd["C"],
+            brine_2nd["P"], op_1st["P"], op_2nd["P"])
+end
+
+"""
+Simulate one constant setpoint and feed for `maximum(steps)` model steps from a clean membrane, and write the
+QUANTITIES at `steps` to values[:, k]. Steps after a divergence are left NaN.
+"""
+function simulate_point!(values::AbstractMatrix{Float64}, flowrate::Float64, pressure_1st::Float64, pressure_2nd::Float64,
+                         temperature::Float64, concentration::Float64, feed_pressure::Float64, steps::Vector{Int})
+    feed_scenario = repeat([temperature concentration feed_pressure], maximum(steps), 1)
+    state_1st = Dict{String, Any}("timestep" => 1.0)
+    state_2nd = Dict{String, Any}("timestep" => 1.0)
+    outputs = PressureControlledRO.pressure_controlled_2stage_ro_simple(feed_scenario, flowrate, pressure_1st, pressure_2nd,
+                                                                        state_1st, state_2nd)
+    _, _, permeate_1st_log, permeate_2nd_log, _, brine_2nd_log, recovery_1st_log, _, op_1st_log, op_2nd_log, _, _, _, _,
+        SEC_total_log, converged = outputs
+    # The model step that diverged is not a valid operating point.
+    n_valid = converged ? length(op_1st_log) : length(op_1st_log) - 1
+    for (k, step) in enumerate(steps)
+        if step <= n_valid
+            values[:, k] .= quantities(flowrate, permeate_1st_log[step], permeate_2nd_log[step], brine_2nd_log[step],
+                                       recovery_1st_log[step], op_1st_log[step], op_2nd_log[step], SEC_total_log[step])
+        end
+    end
+    return n_valid
+end
+
+"""
+Operating map over the grid flowrates × pressures_1st × pressures_2nd × temperatures × concentrations, the grid points
+running on the Julia threads (Threads.@threads), each with its own membrane state.
+
+Args:
+    steps: Model steps (1-based, dt of the model each) at which the QUANTITIES are recorded, e.g. [1] for the clean
+           membrane, or several steps over a fouling horizon.
+    feed_pressure: Inlet pressure of the feed [bar].
+
+Returns:
+    (length(QUANTITIES), n_flowrates, n_pressures_1st, n_pressures_2nd, n_temperatures, n_concentrations, length(steps))
+    array of the quantities (NaN where the process diverged before the step).
+"""
+function operating_map(flowrates::AbstractVector, pressures_1st::AbstractVector, pressures_2nd::AbstractVector,
+                       temperatures::AbstractVector, concentrations::AbstractVector; steps=[1], feed_pressure=1e-5)
+    steps = sort(Int.(collect(steps)))
+    grid_axes = (Float64.(flowrates), Float64.(pressures_1st), Float64.(pressures_2nd), Float64.(temperatures), Float64.(concentrations))
+    grid = CartesianIndices(Tuple(length.(grid_axes)))
+    values = fill(NaN, length(QUANTITIES), size(grid)..., length(steps))
+    Threads.@threads for i in 1:length(grid)
+        I = grid[i]
+        simulate_point!(view(values, :, I, :), grid_axes[1][I[1]], grid_axes[2][I[2]], grid_axes[3][I[3]],
+                        grid_axes[4][I[4]], grid_axes[5][I[5]], Float64(feed_pressure), steps)
+    end
+    return values
+end
+
+end
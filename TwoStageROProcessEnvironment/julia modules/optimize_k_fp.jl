@@ -15,7 +15,8 @@ using BlackBoxOptim
 using JLD2
 using XLSX
 
-println(Threads.nthreads())
+# Candidates are evaluated on the Julia threads: start Julia with --threads (e.g. julia --threads auto optimize_k_fp.jl).
+println("Julia threads: ", Threads.nthreads())
 
 const ro_1st_pvs = 84.0
 const ro_2nd_pvs = 48.0
@@ -54,174 +55,210 @@ end
 
 global FC = 0
 
-function calculate_RMSE(setpoint)
-    save_fig = false
-    parameter_setpoints_1st = Dict(
-        "k_fp" => setpoint[1],
-        "A" => setpoint[3]  #setpoint[4]
-    )
-    parameter_setpoints_2nd = Dict(
-        "k_fp" => setpoint[2],
-        "A" => setpoint[3]  #setpoint[4]
-    )
-    Daesan_path = "./Data/Daesan_$FC.xlsx"
-    save_root_path = "./Result/simple_RO/Optimizing_k_fp_Daesan$FC"
+const CALIBRATION_DT = 60.0        # [s], sampling interval of the Daesan data (one model step per row).
+const SEARCH_RANGE = [(0.5, 7.5), (0.5, 7.5), (1.0, 15.0)]   # k_fp_1st, k_fp_2nd, A
+const ABORT_CHECK_INTERVAL = 60    # Rows between two comparisons of the partial objective with the incumbent.
+const ABORT_PENALTY = 1.0          # Added to the objective of aborted candidates (one unit of R²).
+const SCREENING_SIZE = 4 * Threads.nthreads()
+
+"""
+Daesan plant history of one fouling case, read once into typed arrays (instead of on every objective evaluation).
+tss is the total sum of squares of the production, the denominator of R².
+"""
+struct PlantData
+    T::Vector{Float64}
+    C::Vector{Float64}
+    Q::Vector{Float64}
+    P::Vector{Float64}
+    C_CF::Vector{Float64}
+    production::Vector{Float64}
+    tss::Float64
+end
 
-    # daesan = CSV.read(Daesan_path, DataFrame)
-    daesan = DataFrame(XLSX.readtable(Daesan_path, "Sheet2"))
+function load_plant_data(fc)
+    daesan = DataFrame(XLSX.readtable("./Data/Daesan_$fc.xlsx", "Sheet2"))
     dropmissing!(daesan)
-    step = nrow(daesan)
-
     feed_scenario = daesan[:, [3,4,5,6]]
     feed_scenario.유입Foulant .= 1e-2
+    columns = [Float64.(feed_scenario[:, j]) for j in 1:5]
+    production = Float64.(daesan.생산유량)
+    return PlantData(columns..., production, sum((production .- mean(production)) .^ 2))
+end
 
-    state_var_1st = Dict(
-        "timestep" => 1.0
-    )
-    state_var_2nd = Dict(
-        "timestep" => 1.0
-    )
-
-    daesan_dt = 60.0
-    # dt = 3.0
-    dt = daesan_dt
-    step_multiplier = Int(daesan_dt/dt)
-
-    permeate_1st_log = Any[]
-    permeate_2nd_log = Any[]
-    brine_1st_log = Any[]
-    brine_2nd_log = Any[]
-    recovery_1st_log = Any[]
-    recovery_2nd_log = Any[]
+"""
+Best objective value completed so far, shared by the threads evaluating candidates.
+"""
+mutable struct Incumbent
+    value::Float64
+    lock::ReentrantLock
+end
 
-    op_var_1st_log = Any[]
-    op_var_2nd_log = Any[]
-    state_1st_log = Any[]
-    state_2nd_log = Any[]
+Incumbent() = Incumbent(Inf, ReentrantLock())
 
-    # Store calculated SEC, in [kWh/m3]
-    SEC_1st_log = Any[]
-    SEC_2nd_log = Any[]
-    SEC_total_log = Any[]
+incumbent_value(incumbent::Incumbent) = lock(() -> incumbent.value, incumbent.lock)
 
-    converged = true
+function update_incumbent!(incumbent::Incumbent, value)
+    lock(incumbent.lock) do
+        incumbent.value = min(incumbent.value, value)
+    end
+end
 
-    for i in 1:step
+"""
+Evaluation counters of a calibration run, updated from every thread.
+"""
+struct CalibrationCounters
+    evaluations::Threads.Atomic{Int}
+    aborted::Threads.Atomic{Int}
+    diverged::Threads.Atomic{Int}
+    rows::Threads.Atomic{Int}
+end
 
+CalibrationCounters() = CalibrationCounters(Threads.Atomic{Int}(0), Threads.Atomic{Int}(0), Threads.Atomic{Int}(0), Threads.Atomic{Int}(0))
+
+"""
+Objective of a (k_fp_1st, k_fp_2nd, A) setpoint: -R² of the simulated total permeate flowrate against the plant
+production. Diverged runs return Inf.
+
+Early abort: the residual sum of squares only grows along the history, so RSS / TSS - 1 over the rows simulated so far
+is a lower bound of the objective. Every `check_interval` rows, once the bound reaches the incumbent (the best completed
+objective), the candidate cannot be better and the simulation is aborted. An aborted candidate does not return its
+bound, which would be optimistic (its true objective is larger, by an unknown amount), but the penalized value
+max(bound, incumbent) + ABORT_PENALTY: it ranks behind the incumbent, aborted candidates keep their order by bound, and
+the optimizer never reports an aborted candidate as the best. Only completed objectives update the incumbent.
+"""
+function calibration_objective(data::PlantData, setpoint, incumbent::Incumbent, counters::CalibrationCounters;
+                               check_interval=ABORT_CHECK_INTERVAL)
+    parameter_setpoints_1st = Dict("k_fp" => setpoint[1], "A" => setpoint[3])
+    parameter_setpoints_2nd = Dict("k_fp" => setpoint[2], "A" => setpoint[3])
+    state_var_1st = Dict{String, Any}("timestep" => 1.0)
+    state_var_2nd = Dict{String, Any}("timestep" => 1.0)
+    Threads.atomic_add!(counters.evaluations, 1)
+
+    rss = 0.0
+    n_rows = length(data.production)
+    for i in 1:n_rows
         op_var_1st = Dict(
-            "T"     => feed_scenario[i, 1],
-            "C"     => feed_scenario[i, 2],
-            "Q"     => feed_scenario[i, 3] / ro_1st_pvs,
-            "P"     => feed_scenario[i, 4],
-            "C_CF"  => feed_scenario[i, 5]
+            "T"     => data.T[i],
+            "C"     => data.C[i],
+            "Q"     => data.Q[i] / ro_1st_pvs,
+            "P"     => data.P[i],
+            "C_CF"  => data.C_CF[i]
         )
+        permeate_1st, brine_1st, state_var_1st = RO_Element_Simple.ro_vessel_simple(;state_vars = state_var_1st, operational_vars = op_var_1st, parameter_setpoints = parameter_setpoints_1st, dt=CALIBRATION_DT)
+
+        op_var_2nd = copy(brine_1st)
+        op_var_2nd["Q"] = brine_1st["Q"] * ro_1st_pvs / ro_2nd_pvs
+        permeate_2nd, brine_2nd, state_var_2nd = RO_Element_Simple.ro_vessel_simple(;state_vars = state_var_2nd, operational_vars = op_var_2nd, parameter_setpoints = parameter_setpoints_2nd, dt=CALIBRATION_DT)
+
+        state_var_1st["timestep"] += 1
+        state_var_2nd["timestep"] += 1
+        if !(all(state_var_1st["converged"]) & all(state_var_2nd["converged"]))
+            record_event!("calibration_diverged")
+            Threads.atomic_add!(counters.diverged, 1)
+            Threads.atomic_add!(counters.rows, i)
+            return Inf
+        end
 
-        for micro_step in 1:step_multiplier
-            push!(op_var_1st_log, op_var_1st)
-            permeate_1st, brine_1st, state_var_1st_updated = RO_Element_Simple.ro_vessel_simple(;state_vars = state_var_1st, operational_vars = op_var_1st, parameter_setpoints = parameter_setpoints_1st, dt=dt)
-
-
-            recovery_1st = permeate_1st["Q"] / op_var_1st["Q"]
-            permeate_1st["Q"] *= ro_1st_pvs
-            brine_1st["Q"] *= ro_1st_pvs
-            sec_1st = calculate_SEC(op_var_1st["Q"]*ro_1st_pvs, op_var_1st["P"]-feed_scenario[i,3], permeate_1st["Q"], 0.8)
-            state_var_1st = state_var_1st_updated
-            
-            push!(recovery_1st_log, recovery_1st)
-            push!(permeate_1st_log, permeate_1st)
-            push!(brine_1st_log, brine_1st)
-            push!(SEC_1st_log, sec_1st)
-            push!(state_1st_log, state_var_1st)
-
-            op_var_2nd = copy(brine_1st)
-            op_var_2nd["Q"] /= ro_2nd_pvs
-            push!(op_var_2nd_log, op_var_2nd)
-
-            permeate_2nd, brine_2nd, state_var_2nd_updated = RO_Element_Simple.ro_vessel_simple(;state_vars = state_var_2nd, operational_vars = op_var_2nd, parameter_setpoints = parameter_setpoints_2nd, dt=dt)
-
-            recovery_2nd = permeate_2nd["Q"] / op_var_2nd["Q"]
-            permeate_2nd["Q"] *= ro_2nd_pvs
-            brine_2nd["Q"] *= ro_2nd_pvs
-            # sec_2nd = calculate_SEC(op_var_2nd["Q"]*ro_2nd_pvs, IBP_2nd, permeate_2nd["Q"], 0.8)
-            state_var_2nd = state_var_2nd_updated
-            
-            push!(recovery_2nd_log, recovery_2nd)
-            push!(permeate_2nd_log, permeate_2nd)
-            push!(brine_2nd_log, brine_2nd)
-            # push!(SEC_2nd_log, sec_2nd)
-            push!(state_2nd_log, state_var_2nd_updated)
-
-            sec_total = sec_1st # * permeate_1st["Q"] + sec_2nd * permeate_2nd["Q"]) / (permeate_1st["Q"] + permeate_2nd["Q"])
-            push!(SEC_total_log, sec_total)
-
-            state_var_1st["timestep"] += 1
-            state_var_2nd["timestep"] += 1
-
-            if !(all(state_var_1st["converged"]) & all(state_var_2nd["converged"]))
-                @printf("Process diverged at timestep %d\n", state_var_1st["timestep"])
-                converged = false
-                break
+        permeate_total_Q = permeate_1st["Q"] * ro_1st_pvs + permeate_2nd["Q"] * ro_2nd_pvs
+        rss += (data.production[i] - permeate_total_Q) ^ 2
+        if i % check_interval == 0 && i < n_rows
+            bound = rss / data.tss - 1.0
+            best = incumbent_value(incumbent)
+            if bound >= best
+                Threads.atomic_add!(counters.aborted, 1)
+                Threads.atomic_add!(counters.rows, i)
+                return max(bound, best) + ABORT_PENALTY
             end
         end
-        if !converged
-            break
-        end
-        # @printf "Step %d done\n" i
     end
+    Threads.atomic_add!(counters.rows, n_rows)
+    objective = rss / data.tss - 1.0
+    update_incumbent!(incumbent, objective)
+    return objective
+end
 
-    save_root_path = save_root_path * @sprintf "/%dmin" Int(dt)
-    mkpath(save_root_path)
-
-    permeate_1st_df = DataFrame(permeate_1st_log)
-    permeate_2nd_df = DataFrame(permeate_2nd_log)
-
-    permeate_total_Q = permeate_1st_df.Q + permeate_2nd_df.Q
-
-    # RMSE = L2dist(permeate_total_Q, daesan.생산유량)
-    # MAPE = MAPE(;y_pred = permeate_total_Q, y_obs = daesan.생산유량)
-    R2 = r2_score(daesan.생산유량, permeate_total_Q)
+"""
+Evaluate a population of setpoints (one per column) in parallel on the Julia threads.
+"""
+function evaluate_population(data::PlantData, candidates::AbstractMatrix, incumbent::Incumbent, counters::CalibrationCounters)
+    objectives = fill(Inf, size(candidates, 2))
+    Threads.@threads for j in 1:size(candidates, 2)
+        objectives[j] = calibration_objective(data, view(candidates, :, j), incumbent, counters)
+    end
+    return objectives
+end
 
-    return -1.0 * R2
+"""
+Structured progress log of a calibration run: one row (NamedTuple) per callback, kept in `rows` and appended to the
+CSV file at `path` as it is recorded.
+"""
+struct ProgressLog
+    path::String
+    rows::Vector{NamedTuple}
+    start::Float64
 end
 
-using BlackBoxOptim: num_func_evals
+ProgressLog(path) = (isfile(path) && rm(path); ProgressLog(path, NamedTuple[], time()))
 
-optimization_log = []
+function record_progress!(progress::ProgressLog, row::NamedTuple)
+    push!(progress.rows, row)
+    CSV.write(progress.path, [row]; append = length(progress.rows) > 1)
+    println(join(["$key=$(value isa AbstractFloat ? @sprintf("%.4g", value) : value)" for (key, value) in pairs(row)], " "))
+end
 
-function callback_record_progress(optcontroller)
-    optim_log = Dict(
-        "N of function evaluation" => num_func_evals(optcontroller),
-        "Best fitness (R2)" => best_fitness(optcontroller),
-        "Best k_fp_1st" => best_candidate(optcontroller)[1],
-        "Best k_fp_2nd" => best_candidate(optcontroller)[2],
-        # "Best K" => best_candidate(optcontroller)[3],
-        "Best A" => best_candidate(optcontroller)[3],
+function progress_row(progress::ProgressLog, counters::CalibrationCounters, fc, evaluations, best_fitness, best_candidate)
+    elapsed = time() - progress.start
+    return (
+        fc = fc,
+        elapsed_s = elapsed,
+        function_evaluations = evaluations,
+        model_evaluations = counters.evaluations[],
+        aborted = counters.aborted[],
+        diverged = counters.diverged[],
+        simulated_rows = counters.rows[],
+        evaluations_per_s = counters.evaluations[] / max(elapsed, 1e-9),
+        best_fitness = best_fitness,
+        best_k_fp_1st = best_candidate[1],
+        best_k_fp_2nd = best_candidate[2],
+        best_A = best_candidate[3],
     )
-    push!(optimization_log, optim_log)
-    for item in optim_log
-        print(item[1] * " : " * @sprintf("%.2f",item[2]) * " | ")
-    end
-    println("")
 end
 
+using BlackBoxOptim: num_func_evals
 
-function optimize_RMSE()
-    # Optimize k_fp_1st, k_fp_2nd, K and A
-    # opt = bbsetup(calculate_RMSE; Method=:xnes, SearchRange = [(0.5, 5.0), (0.5, 5.0), (0.5, 25.0), (1.0, 15.0)]
-    # good_guess = [0.82, 1.55, 6.72]
-    opt = bbsetup(calculate_RMSE; Method=:xnes, SearchRange = [(0.5, 7.5), (0.5, 7.5), (1.0, 15.0)]
-                , MaxSteps=500, NThreads = Threads.nthreads()-1, TraceInterval=1.0, TraceMode=:silent
-                , CallbackFunction = callback_record_progress, CallbackInterval = 0.0)
-    result = bboptimize(opt)
-    return result
+"""
+Calibrate (k_fp_1st, k_fp_2nd, A) on the Daesan history of fouling case `fc`. A first screening population, evaluated
+in parallel, sets the incumbent so that hopeless candidates are aborted from the start. BlackBoxOptim (xNES) then
+evaluates its populations on the worker threads.
+"""
+function optimize_RMSE(fc; max_steps=500, screening_size=SCREENING_SIZE, seed=0)
+    data = load_plant_data(fc)
+    incumbent = Incumbent()
+    counters = CalibrationCounters()
+    progress = ProgressLog(@sprintf("parameter_optimization_progress_daesan%d_fixed_K.csv", fc))
+
+    rng = MersenneTwister(seed)
+    screening = reduce(vcat, [low .+ (high - low) .* rand(rng, 1, screening_size) for (low, high) in SEARCH_RANGE])
+    objectives = evaluate_population(data, screening, incumbent, counters)
+    best = argmin(objectives)
+    record_progress!(progress, progress_row(progress, counters, fc, 0, objectives[best], screening[:, best]))
+
+    callback(optcontroller) = record_progress!(progress, progress_row(progress, counters, fc, num_func_evals(optcontroller),
+                                                                      best_fitness(optcontroller), best_candidate(optcontroller)))
+    # Fixed-point iteration caps and divergences are counted by record_event!, reported once at the end.
+    opt = bbsetup(setpoint -> calibration_objective(data, setpoint, incumbent, counters); Method=:xnes, SearchRange = SEARCH_RANGE
+                , MaxSteps=max_steps, NThreads = max(Threads.nthreads()-1, 1), TraceInterval=1.0, TraceMode=:silent
+                , CallbackFunction = callback, CallbackInterval = 0.0)
+    result = bboptimize(opt, screening[:, best])
+    println("Model events: ", drain_events!())
+    return result, progress
 end
 
 for i in [1,4,6]
     global FC = i
-    result = optimize_RMSE()
-    optimization_df = DataFrame(optimization_log)
+    result, progress = optimize_RMSE(FC)
+    optimization_df = DataFrame(progress.rows)
     CSV.write(@sprintf("parameter_optimization_result_daesan%d_fixed_K.csv", FC), optimization_df)
-    global optimization_log = []
 end
 # optimization_df = CSV.read("parameter_optimization_result_daesan1.csv", DataFrame)
 # optimization_plot = plot(optimization_df[:, "N of function evaluation"], optimization_df[:, "Best fitness (RMSE)"])
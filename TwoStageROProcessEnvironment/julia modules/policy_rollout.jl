@@ -0,0 +1,290 @@
+# Evaluation episodes of frozen agent networks run entirely in Julia, multi-threaded across scenarios.
+# Loaded by utils/julia_rollout.py. The process model is the one of TwoStageROProcessEnvironment
+# (pressure_controlled_ro_simple.jl), reused if the environment already included it in this Julia session.
+if !isdefined(@__MODULE__, :PressureControlledRO)
+    include(joinpath(@__DIR__, "pressure_controlled_ro_simple.jl"))
+end
+
+module PolicyRollout
+
+using Statistics
+using ..PressureControlledRO
+using ..PressureControlledRO.RO_Element_Simple: record_event!
+
+export GRUAgent, rollout_episodes
+
+const ro_1st_pvs = PressureControlledRO.ro_1st_pvs
+
+# Action masking thresholds of TwoStageROProcessEnvironment._generate_action_mask.
+const INFLUENT_FLOWRATE_THRESHOLD = (750.0 / ro_1st_pvs, 1394.0 / ro_1st_pvs)
+const RO_1ST_THRESHOLD = (5.0, 15.0)
+const RO_2ND_THRESHOLD = (0.25, 2.5)
+const N_ACTIONS = 5
+const NO_OP = 3             # Action 2 (No-Op), 1-based.
+
+# Reward of TwoStageROProcessEnvironment._calculate_reward and the production credit of its step.
+const P_DIVERGE = 1.0
+const PRODUCTION_CRITERIA = 1000.0
+const PRODUCTION_LOWER_LIMIT = 700.0
+const CREDIT_FLOWRATE = 787.5
+const CREDIT = (30.0, -90.0)
+
+# Columns of the summary matrix returned by rollout_episodes.
+const SUMMARY_COLUMNS = ["valid", "Reward sum", "mean concentration", "converged", "mean SEC", "mean production", "steps"]
+
+"""
+RNNAgent (Linear-ReLU-GRUCell-Linear) with the min-max scaling of its observations, in Float32 as the torch network.
+Weights are in the torch layout (out_features, in_features), gates in the torch order (reset, update, new). Arrays of
+another element type are converted by the default constructor.
+"""
+struct GRUAgent
+    W1::Matrix{Float32}
+    b1::Vector{Float32}
+    W_ih::Matrix{Float32}
+    W_hh::Matrix{Float32}
+    b_ih::Vector{Float32}
+    b_hh::Vector{Float32}
+    W2::Matrix{Float32}
+    b2::Vector{Float32}
+    low::Vector{Float32}
+    high::Vector{Float32}
+end
+
+n_hidden(agent::GRUAgent) = size(agent.W_hh, 2)
+
+sigmoid(x) = one(x) / (one(x) + exp(-x))
+
+"""
+Q-values and next hidden state of the agent for a raw observation.
+"""
+function forward(agent::GRUAgent, observation::Vector{Float32}, h::Vector{Float32})
+    H = n_hidden(agent)
+    x = max.(agent.W1 * ((observation .- agent.low) ./ (agent.high .- agent.low)) .+ agent.b1, 0.0f0)
+    gi = agent.W_ih * x .+ agent.b_ih
+    gh = agent.W_hh * h .+ agent.b_hh
+    r = sigmoid.(gi[1:H] .+ gh[1:H])
+    z = sigmoid.(gi[H+1:2H] .+ gh[H+1:2H])
+    n = tanh.(gi[2H+1:3H] .+ r .* gh[2H+1:3H])
+    h_next = (1.0f0 .- z) .* n .+ z .* h
+    return agent.W2 * h_next .+ agent.b2, h_next
+end
+
+function greedy(q::Vector{Float32}, mask::Vector{Bool})
+    best, best_q = 0, -Inf32
+    for i in eachindex(q)
+        if mask[i] && (best == 0 || q[i] > best_q)
+            best, best_q = i, q[i]
+        end
+    end
+    best == 0 && throw(ArgumentError("No valid actions available."))
+    return best
+end
+
+# Weighted mean, as numpy.average(x, weights=w).
+weighted_mean(x, w) = sum(x .* w) / sum(w)
+
+"""
+Means of one control step of a stage log (vector of Dicts) over its first n model steps, as
+TwoStageROProcessEnvironment._process_modeling: concentrations weighted by the flowrate, the other variables plain.
+"""
+function stage_means(log, n)
+    Q = [Float64(log[i]["Q"]) for i in 1:n]
+    means = Dict{String, Float64}()
+    for key in keys(log[1])
+        values = [Float64(log[i][key]) for i in 1:n]
+        means[key] = key in ("C", "C_CF") ? weighted_mean(values, Q) : mean(values)
+    end
+    return means
+end
+
+"""
+Process variables of one episode, the attributes of TwoStageROProcessEnvironment read by observations, masks and rewards.
+"""
+mutable struct Process
+    flowrate::Float64
+    pressure_1st::Float64
+    pressure_2nd::Float64
+    state_1st::Dict
+    state_2nd::Dict
+    converged::Bool
+    op_1st::Dict{String, Float64}
+    op_2nd::Dict{String, Float64}
+    permeate_1st::Dict{String, Float64}
+    permeate_2nd::Dict{String, Float64}
+    brine_1st::Dict{String, Float64}
+    brine_2nd::Dict{String, Float64}
+    recovery_1st::Float64
+    total_SEC::Float64
+    production::Float64
+    SEC_sum::Float64
+    production_sum::Float64
+    n_logged::Int
+end
+
+Process(flowrate, pressure_1st, pressure_2nd) = Process(flowrate, pressure_1st, pressure_2nd,
+    Dict{String, Any}("timestep" => 1.0), Dict{String, Any}("timestep" => 1.0), true,
+    Dict{String, Float64}(), Dict{String, Float64}(), Dict{String, Float64}(), Dict{String, Float64}(),
+    Dict{String, Float64}(), Dict{String, Float64}(), 0.0, 0.0, 0.0, 0.0, 0.0, 0)
+
+"""
+Model `modeling_length` timesteps of the feed scenario from `starting_index` (0-based, as in Python) and update the
+process variables. Returns false if the process became invalid (diverged on its first model step).
+"""
+function model!(process::Process, feed_scenario::Matrix{Float64}, starting_index::Int, modeling_length::Int)
+    rows = starting_index+1:min(starting_index + modeling_length, size(feed_scenario, 1))
+    outputs = PressureControlledRO.pressure_controlled_2stage_ro_simple(feed_scenario[rows, :], process.flowrate,
+        process.pressure_1st, process.pressure_2nd, process.state_1st, process.state_2nd)
+    state_1st, state_2nd, permeate_1st_log, permeate_2nd_log, brine_1st_log, brine_2nd_log, recovery_1st_log, _,
+        op_1st_log, op_2nd_log, _, _, _, _, SEC_total_log, converged = outputs
+    process.state_1st, process.state_2nd, process.converged = state_1st, state_2nd, converged
+    if !converged && length(permeate_1st_log) <= 1
+        return false
+    end
+
+    # The model step that diverged is left out of the means.
+    n = converged ? length(op_1st_log) : length(op_1st_log) - 1
+    process.op_1st = stage_means(op_1st_log, n)
+    process.op_2nd = stage_means(op_2nd_log, n)
+    process.permeate_1st = stage_means(permeate_1st_log, n)
+    process.permeate_2nd = stage_means(permeate_2nd_log, n)
+    process.brine_1st = stage_means(brine_1st_log, n)
+    process.brine_2nd = stage_means(brine_2nd_log, n)
+
+    Q_1st = [Float64(permeate_1st_log[i]["Q"]) for i in 1:n]
+    Q_2nd = [Float64(permeate_2nd_log[i]["Q"]) for i in 1:n]
+    process.recovery_1st = weighted_mean([Float64(recovery_1st_log[i]) for i in 1:n], Q_1st)
+    process.total_SEC = weighted_mean([Float64(SEC_total_log[i]) for i in 1:n], Q_1st .+ Q_2nd)
+    process.production = process.permeate_1st["Q"] + process.permeate_2nd["Q"]
+    process.SEC_sum += process.total_SEC
+    process.production_sum += process.production
+    process.n_logged += 1
+    return true
+end
+
+"""
+Observations (Float32, unscaled) and action masks of the agents, as TwoStageROProcessEnvironment.step builds them.
+"""
+function observe(process::Process, feed_pressure::Float64)
+    op_1st, op_2nd = process.op_1st, process.op_2nd
+    permeate_1st, permeate_2nd = process.permeate_1st, process.permeate_2nd
+    brine_1st, brine_2nd = process.brine_1st, process.brine_2nd
+    observations = (
+        Float32[op_1st["Q"], permeate_1st["Q"], op_2nd["Q"], permeate_2nd["Q"], brine_2nd["Q"], op_1st["T"]],
+        Float32[op_1st["T"], op_1st["C"], op_1st["Q"], brine_1st["C"], brine_1st["Q"], permeate_1st["C"], permeate_1st["Q"],
+                brine_1st["P"], op_1st["P"] - feed_pressure, process.recovery_1st],
+        Float32[op_2nd["T"], op_2nd["C"], op_2nd["Q"], brine_1st["P"], brine_2nd["C"], brine_2nd["Q"], permeate_2nd["C"],
+                permeate_2nd["Q"], brine_2nd["P"], op_2nd["P"] - brine_1st["P"], process.recovery_1st],
+    )
+    masks = (mask(op_1st["Q"], INFLUENT_FLOWRATE_THRESHOLD), mask(process.pressure_1st, RO_1ST_THRESHOLD),
+             mask(process.pressure_2nd, RO_2ND_THRESHOLD))
+    return observations, masks
+end
+
+function mask(value, threshold)
+    valid = fill(true, N_ACTIONS)
+    if value < threshold[1]
+        valid[1:2] .= false
+    elseif value > threshold[2]
+        valid[4:end] .= false
+    end
+    return valid
+end
+
+function reward(process::Process, w_SEC, w_eff)
+    if !process.converged
+        return -P_DIVERGE
+    end
+    production_term = min(1.0, (process.production - PRODUCTION_LOWER_LIMIT) / (PRODUCTION_CRITERIA - PRODUCTION_LOWER_LIMIT))
+    return w_SEC * (-3.0 * process.total_SEC) + w_eff * production_term
+end
+
+"""
+One greedy evaluation episode (evaluate_intended_failure.run_timeline): reset with the initial action, then one control
+step per `control_interval` model timesteps, agents hindered (forced to No-Op) where their timeline is false.
+
+Returns:
+    The summary row (SUMMARY_COLUMNS) and the actions taken (0-based, -1 after the episode end).
+"""
+function rollout_episode(agents::Vector{GRUAgent}, feed_scenario::Matrix{Float64}, timeline::AbstractMatrix{Bool},
+                         initial_action::NTuple{3, Float64}, control_interval::Int, max_control_timestep::Int,
+                         reward_weight::NTuple{2, Float64}, production_term::Bool)
+    summary = zeros(length(SUMMARY_COLUMNS))
+    actions_taken = fill(Int8(-1), length(agents), max_control_timestep)
+    process = Process(initial_action...)
+    if !model!(process, feed_scenario, 0, control_interval)
+        return summary, actions_taken
+    end
+    timestep = 1 + control_interval
+    control_timestep = 2
+    # The environment subtracts the mean inlet pressure of the first control interval of the scenario.
+    feed_pressure = mean(feed_scenario[1:control_interval, 3])
+    observations, masks = observe(process, feed_pressure)
+    hiddens = [zeros(Float32, n_hidden(agent)) for agent in agents]
+    reward_sum = 0.0
+
+    for step in 1:max_control_timestep-1
+        actions = zeros(Int, length(agents))
+        for (i, agent) in enumerate(agents)
+            q, hiddens[i] = forward(agent, observations[i], hiddens[i])
+            actions[i] = timeline[i, step] ? greedy(q, masks[i]) : NO_OP
+            actions_taken[i, step] = actions[i] - 1
+        end
+        process.flowrate     += (actions[1] - NO_OP) * 10.0 / 2
+        process.pressure_1st += (actions[2] - NO_OP) * 0.25 / 4
+        process.pressure_2nd += (actions[3] - NO_OP) * 0.25 / 4
+
+        if !model!(process, feed_scenario, timestep, control_interval)
+            return summary, actions_taken
+        end
+        observations, masks = observe(process, feed_pressure)
+        terminated = !process.converged
+        truncated = control_timestep >= max_control_timestep
+        step_reward = reward(process, reward_weight...)
+        if truncated && !terminated && production_term
+            step_reward += process.production_sum / process.n_logged > CREDIT_FLOWRATE ? CREDIT[1] : CREDIT[2]
+        end
+        reward_sum += step_reward
+        timestep += control_interval
+        control_timestep += 1
+
+        if terminated || truncated
+            summary .= [1.0, reward_sum, truncated ? process.op_1st["C"] : 0.0, Float64(truncated),
+                        process.SEC_sum / process.n_logged, process.production_sum / process.n_logged, step]
+            return summary, actions_taken
+        end
+    end
+    return summary, actions_taken
+end
+
+"""
+Run every scenario on the Julia threads (Threads.@threads), each with its own process state and hidden states.
+
+Args:
+    agents: GRUAgent of each agent, in the order of the environment (influent flowrate, 1st stage pump, 2nd stage pump).
+    feed_scenarios: (n_scenarios, len_scenario, 3) feed scenarios (T, C, P_in), as sampled by the environment.
+    timelines: (n_scenarios, n_agents, n_steps) hindering timelines (false: forced No-Op).
+
+Returns:
+    (n_scenarios, length(SUMMARY_COLUMNS)) summary matrix and (n_scenarios, n_agents, max_control_timestep) actions.
+"""
+function rollout_episodes(agents::Vector{GRUAgent}, feed_scenarios::Array{Float64, 3}, timelines::AbstractArray{Bool, 3};
+                          initial_action=(1000.0, 10.0, 0.5), control_interval::Int=1, max_control_timestep::Int=120,
+                          reward_weight=(0.5, 0.5), production_term::Bool=false)
+    n_scenarios = size(feed_scenarios, 1)
+    summaries = zeros(n_scenarios, length(SUMMARY_COLUMNS))
+    actions = fill(Int8(-1), n_scenarios, length(agents), max_control_timestep)
+    initial_action = Tuple(Float64.(initial_action))
+    reward_weight = Tuple(Float64.(reward_weight))
+    Threads.@threads for i in 1:n_scenarios
+        summary, actions_taken = rollout_episode(agents, feed_scenarios[i, :, :], timelines[i, :, :], initial_action,
+                                                 control_interval, max_control_timestep, reward_weight, production_term)
+        summaries[i, :] .= summary
+        actions[i, :, :] .= actions_taken
+        if summary[1] == 0.0
+            record_event!("rollout_invalid")
+        end
+    end
+    return summaries, actions
+end
+
+end
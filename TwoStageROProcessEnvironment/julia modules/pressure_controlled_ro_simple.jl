@@ -1,6 +1,7 @@
 module PressureControlledRO
 
 include("./ro_basic.jl")
+using .RO_Element_Simple: record_event!, drain_events!
 # using .RO_Element_Simple
 using DataFrames
 using Printf
@@ -25,7 +26,7 @@ RO_2nd_setpoints = Dict(
 )
 dt = 60.0 * 6
 
-export pressure_controlled_2stage_ro_simple
+export pressure_controlled_2stage_ro_simple, timed_pressure_controlled_2stage_ro_simple, drain_events!
 
 function calculate_SEC(feed_Q_sum, applied_pressure, product_Q_sum, pump_efficiency)
     power_required = applied_pressure * 1e5 * feed_Q_sum / 60 / 60 / pump_efficiency / 1e3
@@ -134,13 +135,13 @@ function pressure_controlled_2stage_ro_simple(feed_scenario::Matrix, flowrate::F
         # Divergence or model malfunction detection.
 
         if !(all(state_var_1st["converged"]) & all(state_var_2nd["converged"]))
-            @printf("Process diverged at timestep %d\n", state_var_1st["timestep"])
+            record_event!("process_diverged")
             converged = false
             break
         end
 
         if op_var_1st["P"] > 39.0
-            @printf("Model malfunction detected at timestep %d\n", state_var_1st["timestep"])
+            record_event!("model_malfunction")
             converged = false
             break
         end
@@ -153,6 +154,16 @@ function pressure_controlled_2stage_ro_simple(feed_scenario::Matrix, flowrate::F
     return state_var_1st, state_var_2nd, permeate_1st_log, permeate_2nd_log, brine_1st_log, brine_2nd_log, recovery_1st_log, recovery_2nd_log, op_var_1st_log, op_var_2nd_log, blackbox_1st, blackbox_2nd, SEC_1st_log, SEC_2nd_log, SEC_total_log, converged
 end
 
+function timed_pressure_controlled_2stage_ro_simple(feed_scenario::Matrix, flowrate::Float64,
+    pressure_1st::Float64, pressure_2nd::Float64, st_var_1st::Dict, st_var_2nd::Dict)
+    """
+    Same as pressure_controlled_2stage_ro_simple, additionally returning the Julia-side statistics of the call:
+    (outputs, elapsed time [s], allocated bytes, allocation count, GC time [s]).
+    """
+    stats = @timed pressure_controlled_2stage_ro_simple(feed_scenario, flowrate, pressure_1st, pressure_2nd, st_var_1st, st_var_2nd)
+    return stats.value, stats.time, stats.bytes, Base.gc_alloc_count(stats.gcstats), stats.gctime
+end
+
 end
 
 # begin
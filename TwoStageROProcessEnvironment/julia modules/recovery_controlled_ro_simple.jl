@@ -1,6 +1,7 @@
 module RecoveryControlledRO
 
 include("./ro_basic.jl")
+using .RO_Element_Simple: record_event!, drain_events!
 # using .RO_Element_Simple
 using DataFrames
 using Printf
@@ -24,7 +25,7 @@ RO_2nd_setpoints = Dict(
 )
 dt = 6.0
 
-export recovery_controlled_2stage_ro_simple
+export recovery_controlled_2stage_ro_simple, drain_events!
 
 function calculate_SEC(feed_Q_sum, applied_pressure, product_Q_sum, pump_efficiency)
     power_required = applied_pressure * 1e5 * feed_Q_sum / 60 / 60 / pump_efficiency / 1e3
@@ -156,13 +157,13 @@ function recovery_controlled_2stage_ro_simple(feed_scenario::Matrix, flowrate::F
         # Divergence or model malfunction detection.
 
         if !(all(state_var_1st["converged"]) & all(state_var_2nd["converged"]))
-            @printf("Process diverged at timestep %d\n", state_var_1st["timestep"])
+            record_event!("process_diverged")
             converged = false
             break
         end
 
         if op_var_1st["P"] > 39.0
-            @printf("Model malfunction detected at timestep %d\n", state_var_1st["timestep"])
+            record_event!("model_malfunction")
             converged = false
             break
         end
@@ -3,7 +3,7 @@ module RO_Element_Simple
 include("./RO_Utils_Module.jl")
 
 using Printf, Statistics, DataFrames, Plots
-using .RO_Utils_Module: osmo_press
+using .RO_Utils_Module: osmo_press, record_event!, drain_events!
 
 mem_area = 37 * 7
 length = 1.016 * 7
@@ -17,7 +17,17 @@ r = 0.995
 # K = 10.0
 # k_fp = 1.0e9*24*60*60
 
-export ro_vessel_simple
+export ro_vessel_simple, record_event!, drain_events!, set_n_segments!
+
+"""
+Set the number of axial segments of the vessel model (model fidelity). Applies to every later ro_vessel_simple call of
+this Julia session, so set it before the first call of an episode (the fouling state R_m has n_segments entries).
+"""
+function set_n_segments!(segments::Integer)
+    global n_segments = Int(segments)
+    global dx = length / n_segments
+    return nothing
+end
 
 function ro_vessel_simple(;state_vars::Dict, operational_vars::Dict, A_setpoint, K_setpoint, k_fp_setpoint, dt)
     # Process input parameters.
@@ -75,7 +85,7 @@ function ro_vessel_simple(;state_vars::Dict, operational_vars::Dict, A_setpoint,
             err = abs((c_cal - c_guess) / c_cal)
             idx_iter += 1
             if idx_iter > 1e2
-                println("The number of iteration exceeded 100.")
+                record_event!("fixed_point_iteration_cap")
                 converged_temp = false
                 break
             end
@@ -106,7 +116,7 @@ function ro_vessel_simple(;state_vars::Dict, operational_vars::Dict, A_setpoint,
             err = abs((c_cal - c_guess) / c_cal)
             idx_iter += 1
             if idx_iter > 1e2
-                println("The number of iteration exceeded 100.")
+                record_event!("fixed_point_iteration_cap")
                 converged_temp = false
                 break
             end
@@ -212,7 +222,7 @@ function ro_vessel_simple(;state_vars::Dict, operational_vars::Dict, parameter_s
             err = abs((c_cal - c_guess) / c_cal)
             idx_iter += 1
             if idx_iter > 1e2
-                println("The number of iteration exceeded 100.")
+                record_event!("fixed_point_iteration_cap")
                 converged_temp = false
                 break
             end
@@ -251,7 +261,7 @@ function ro_vessel_simple(;state_vars::Dict, operational_vars::Dict, parameter_s
             err = abs((c_cal - c_guess) / c_cal)
             idx_iter += 1
             if idx_iter > 1e2
-                println("The number of iteration exceeded 100.")
+                record_event!("fixed_point_iteration_cap")
                 converged_temp = false
                 break
             end
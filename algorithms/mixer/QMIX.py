@@ -6,6 +6,7 @@ in multi-agent Q-learning, implemented role-based encoding or graph mix mixing a
 """
 from TwoStageROProcessEnvironment.env.RecoveryControlledTwoStageROProcess import Transition
 import sys
+import os
 import numpy as np
 sys.path.append(r'/home/ybang4/research/ROMARL')
 import torch
@@ -13,6 +14,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import Linear, ReLU
 from copy import copy, deepcopy
+from utils.profiling import profiled
+from utils.metrics import metrics
 
 def mask_and_softmax(action_mask, Q):
     Q[action_mask == 0] = -torch.inf
@@ -30,31 +33,22 @@ def mask_and_nothing(action_mask, Q):
     return Q
 
 def centralized_mask_and_nothing(observation, Q):
-    mask = []
+    # Mask the joint Q-values (batch_size, n_actions, ..., n_actions) with every agent's action mask at once.
+    mask = torch.ones(Q.shape[1:], dtype=torch.bool, device=Q.device)
     for i, a in enumerate(observation.keys()):
-        mask.append(observation[a]['action_mask'])
-    Q[0,mask[0] == 0,:,:] = -torch.inf
-    Q[0,:,mask[1] == 0,:] = -torch.inf
-    Q[0,:,:,mask[2] == 0] = -torch.inf
+        shape = [1] * (Q.dim() - 1)
+        shape[i] = -1
+        mask = mask & (torch.as_tensor(observation[a]['action_mask'], device=Q.device) != 0).view(shape)
+    Q[:, ~mask] = -torch.inf
     return Q
 
 def get_action_from_q(q_values, n_actions_list, batch_size):
-    # Flatten the Q-values to find the max
-    q_values_flat = q_values.view(batch_size, -1)  # Shape: (batch_size, total_joint_actions)
-    max_q_values, max_indices = q_values_flat.max(dim=1)  # Shape: (batch_size,)
-
-    # Convert flat indices back to action indices for each agent
-    joint_action_indices = []
-    for idx in max_indices:
-        idx = idx.item()
-        actions = []
-        for n_actions in reversed(n_actions_list):
-            actions.append(idx % n_actions)
-            idx = idx // n_actions
-        joint_action_indices.append(list(reversed(actions)))
-
-    # joint_action_indices: List of lists, each containing the action indices for each agent
-    return np.array(joint_action_indices).squeeze()
+    # Flatten the Q-values to find the max, and convert flat indices back to action indices for each agent
+    max_indices = q_values.reshape(batch_size, -1).argmax(dim=1)  # Shape: (batch_size,)
+    joint_action_indices = torch.stack(torch.unravel_index(max_indices, list(n_actions_list)), dim=-1)
+
+    # joint_action_indices: (batch_size, n_agents), each row containing the action indices for each agent
+    return joint_action_indices.cpu().numpy().squeeze()
 
 class QMixer(nn.Module):
     """
@@ -241,7 +235,7 @@ class ReplayBuffer:
 # Implementing Prioritized Experience Replay
 # To decrease CPU-GPU communication overhead, stores data in GPU memory if available, and has a method to calculate loss over episodes.
 class PrioritizedExperienceReplay(ReplayBuffer):
-    def __init__(self, agents, device, mode = "BSU", prioritize=True, capacity=50000):
+    def __init__(self, agents, device, mode = "BSU", prioritize=True, capacity=50000, store_hidden=False, hidden_interval=1):
         super().__init__(agents)
         self.priority = {}
         self.isweights = {}
@@ -253,7 +247,13 @@ class PrioritizedExperienceReplay(ReplayBuffer):
             torch.set_default_dtype(torch.float32)
         self.memory_cap = capacity
         self.episode_head = 0
+        # R2D2-style stored recurrent state. If store_hidden is True, agent hidden states are kept every hidden_interval
+        # transitions so that sequences can be unrolled from the middle of an episode (with burn-in) instead of from step 0.
+        self.store_hidden = store_hidden
+        self.hidden_interval = hidden_interval
+        self.stacked_episodes = {}
 
+    @profiled('buffer to_device')
     def to_device(self, transition, env):
         transition_copy = deepcopy(transition)
         previous_obs    = (transition_copy["previous_observations"])
@@ -288,10 +288,35 @@ class PrioritizedExperienceReplay(ReplayBuffer):
 
         return new_transition
 
-    def push(self, transition, env):
-        transition_transferred = self.to_device(transition, env)
+    def move_to_device(self, transition):
+        # Move a transition already processed by to_device (e.g. by an actor process on CPU) to self.device.
+        new_transition = dict(transition)
+        for key in ("previous_observations", "observations"):
+            new_transition[key] = {a: dict(transition[key][a], observation=transition[key][a]['observation'].to(self.device)) for a in self.agents}
+        for key in ("previous_state", "state", "rewards"):
+            new_transition[key] = transition[key].to(self.device)
+        return new_transition
+
+    @profiled('buffer push')
+    def push(self, transition, env=None, hiddens=None):
+        """
+        Push a transition to the memory.
+        :param env: Environment used to scale the observations. If None, the transition is assumed to be already processed
+                    by to_device (as done by the actor processes of optimize_pressure_RO_actor_learner.py).
+        :param hiddens: Agent hidden states fed to the agents together with transition["previous_observations"].
+                        Only kept at sampling boundaries (every self.hidden_interval transitions) if self.store_hidden.
+        """
+        if env is None:
+            transition_transferred = self.move_to_device(transition)
+        else:
+            transition_transferred = self.to_device(transition, env)
+        episode_id = transition_transferred["episode_id"]-1
+        index_in_episode = len(self.memory.get(episode_id, []))
+        if self.store_hidden and (hiddens is not None) and (index_in_episode % self.hidden_interval == 0):
+            transition_transferred['hidden'] = {a: hiddens[a].detach().to(self.device) for a in self.agents}
         super().push(transition_transferred)
-        self.priority[transition_transferred["episode_id"]-1] = 1
+        self.priority[episode_id] = 1
+        metrics.gauge('buffer_episodes', 'Episodes in the replay memory').set(len(self.memory))
 
     def empty_head(self):
         # Empty the head of the memory. Called when the capacity is full.
@@ -299,30 +324,93 @@ class PrioritizedExperienceReplay(ReplayBuffer):
         del self.priority[self.episode_head]
         del self.isweights[self.episode_head]
         del self.td_error[self.episode_head]
-        print(f"Deleted episode {self.episode_head} from memory.")
+        self.stacked_episodes.pop(self.episode_head, None)
+        metrics.counter('buffer_evicted_episodes', 'Episodes deleted from the replay memory').inc()
         self.episode_head += 1
 
+    def stack_episode(self, episode_id):
+        """
+         Stack the transitions of an episode as tensors with the timestep as the first axis.
+         Cached per episode, as stored transitions never change once the episode is over.
+        :return: Dictionary of per-agent observations / action masks (dict of Tensor(T, ...)), actions Tensor(T, n_agents),
+                 rewards Tensor(T), previous_state and state Tensor(T, n_state_dim).
+        """
+        episode = self.memory[episode_id]
+        cached = self.stacked_episodes.get(episode_id)
+        if cached is not None and cached['length'] == len(episode):
+            return cached
+
+        stacked = {
+            'length': len(episode),
+            'previous_observations':    {a: torch.stack([tr["previous_observations"][a]['observation'] for tr in episode]).float() for a in self.agents},
+            'observations':             {a: torch.stack([tr["observations"][a]['observation'] for tr in episode]).float() for a in self.agents},
+            'previous_action_masks':    {a: torch.as_tensor(np.stack([tr["previous_observations"][a]['action_mask'] for tr in episode]), device=self.device) for a in self.agents},
+            'action_masks':             {a: torch.as_tensor(np.stack([tr["observations"][a]['action_mask'] for tr in episode]), device=self.device) for a in self.agents},
+            'actions':                  torch.tensor([[int(tr["actions"][a]) for a in self.agents] for tr in episode], dtype=torch.long, device=self.device),
+            'rewards':                  torch.stack([torch.as_tensor(tr["rewards"], device=self.device) for tr in episode]).float(),
+            'previous_state':           torch.cat([tr["previous_state"].reshape(1, -1) for tr in episode]).float(),
+            'state':                    torch.cat([tr["state"].reshape(1, -1) for tr in episode]).float(),
+        }
+        self.stacked_episodes[episode_id] = stacked
+        return stacked
+
+    def _fused_agent_qs(self, agent_nets, target_agent_nets, episode_id):
+        # Chosen and (double Q) target action-values of an episode, shaped (T, 1, n_agents) as in calculate_loss.
+        stacked = self.stack_episode(episode_id)
+        previous_obs    = agent_nets.pack_inputs(stacked['previous_observations'])         # (n_agents, T, max_input_shape)
+        current_obs     = agent_nets.pack_inputs(stacked['observations'])
+        previous_mask   = agent_nets.pack_action_masks(stacked['previous_action_masks'])   # (n_agents, T, max_n_actions)
+        current_mask    = agent_nets.pack_action_masks(stacked['action_masks'])
+
+        agent_hiddens = agent_nets.init_hidden()
+        target_agent_hiddens = target_agent_nets.init_hidden()
+        agent_qs, cur_agent_qs, target_agent_qs = [], [], []
+        for t in range(stacked['length']):
+            q, agent_hiddens = agent_nets(previous_obs[:, t], agent_hiddens)
+            agent_qs.append(q)
+            with torch.no_grad():
+                # DDQN. Select the next actions with the online networks, evaluate them with the target networks.
+                cur_q, _ = agent_nets(current_obs[:, t], agent_hiddens)
+                cur_agent_qs.append(cur_q)
+                target_q, target_agent_hiddens = target_agent_nets(current_obs[:, t], target_agent_hiddens)
+                target_agent_qs.append(target_q)
+
+        agent_qs        = torch.cat(agent_qs, dim=1).masked_fill(~previous_mask, -torch.inf)        # (n_agents, T, max_n_actions)
+        cur_agent_qs    = torch.cat(cur_agent_qs, dim=1).masked_fill(~current_mask, -torch.inf)
+        target_agent_qs = torch.cat(target_agent_qs, dim=1).masked_fill(~current_mask, -torch.inf)
+
+        actions         = stacked['actions'].transpose(0, 1).unsqueeze(-1)                          # (n_agents, T, 1)
+        cur_max_actions = torch.argmax(cur_agent_qs, dim=2, keepdim=True)
+        batch_agent_qs  = torch.gather(agent_qs, dim=2, index=actions).permute(1, 2, 0)              # (T, 1, n_agents)
+        batch_target_qs = torch.gather(target_agent_qs, dim=2, index=cur_max_actions).permute(1, 2, 0)
+
+        return batch_agent_qs, batch_target_qs, stacked['previous_state'], stacked['state']
+
+    @profiled('calculate_loss')
     def calculate_loss(self, mixer, target_mixer, agent_nets:dict, target_agent_nets:dict, episode_id, device, env, gamma, weighted=True, reduction='mean'):
         # Method to calculate loss with the saved episodes. Has too many functionality and definitely needs refactoring. But it works.
 
         episode = self.memory[episode_id]
+        n_state_dim = episode[0]["state"].shape[-1]
 
         if mixer is None:
             assert type(agent_nets) == CentralizedRNNAgent, "If mixer is None, agent network must be CentralizedRNNAgent."
             agent_hiddens = agent_nets.init_hidden()
             target_agent_hiddens = target_agent_nets.init_hidden()
             batch_agent_qs = torch.empty((0, 1, 1), device=device)
-            batch_state = torch.empty((0, env.state().shape[0]), device=device)
+            batch_state = torch.empty((0, n_state_dim), device=device)
             batch_target_qs = torch.empty((0, 1, 1), device=device)
-            batch_previous_state = torch.empty((0, env.state().shape[0]), device=device)
+            batch_previous_state = torch.empty((0, n_state_dim), device=device)
+        elif isinstance(agent_nets, FusedRNNAgents):
+            pass
         else:
             agent_hiddens = {a: agent_nets[a].init_hidden() for a in self.agents}
             target_agent_hiddens = {a: target_agent_nets[a].init_hidden() for a in self.agents}
 
             batch_agent_qs = torch.empty((0, 1, len(self.agents)), device=device)
-            batch_state = torch.empty((0, env.state().shape[0]), device=device)
+            batch_state = torch.empty((0, n_state_dim), device=device)
             batch_target_qs = torch.empty((0, 1, len(self.agents)), device=device)
-            batch_previous_state = torch.empty((0, env.state().shape[0]), device=device)
+            batch_previous_state = torch.empty((0, n_state_dim), device=device)
 
         # _, _, _, _, _, zipped_rewards, _, _ = zip(*episode)
         zipped_rewards = [ep["rewards"] for ep in episode]
@@ -366,6 +454,16 @@ class PrioritizedExperienceReplay(ReplayBuffer):
             total_q  = batch_agent_qs.squeeze()
             target_q = batch_target_qs.squeeze()
 
+        # CTDE, with all agents in one FusedRNNAgents (one batched forward per timestep)
+        elif isinstance(agent_nets, FusedRNNAgents):
+            batch_agent_qs, batch_target_qs, batch_previous_state, batch_state = self._fused_agent_qs(agent_nets, target_agent_nets, episode_id)
+
+            if type(mixer) == VDN:
+                total_q     = mixer(batch_agent_qs).squeeze()
+                target_q    = target_mixer(batch_target_qs).squeeze()
+            else:
+                total_q     = mixer(batch_agent_qs, batch_previous_state).squeeze()
+                target_q    = target_mixer(batch_target_qs, batch_state).squeeze()
         
         # CTDE
         else:
@@ -437,16 +535,91 @@ class PrioritizedExperienceReplay(ReplayBuffer):
             pass  # Debug point.
         self.td_error[episode_id] = loss
 
-    def calculate_batch_loss(self, mixer:QMixer, target_mixer:QMixer, agent_nets:dict, target_agent_nets:dict, episode_id, device, env, gamma, starting_index, batch_size, weighted=True):
-        batch = self.memory[episode_id][starting_index: starting_index + batch_size]
-        agent_hiddens = {a: agent_nets[a].init_hidden() for a in self.agents}
+    def sample_sequences(self, num_samples, len_samples, burn_in=0):
+        """
+         Sample fixed-length windows from anywhere in the stored episodes.
+         The burn-in starting point is moved back from the window start by (at most) burn_in transitions and aligned to
+        the closest transition holding a stored hidden state. Without stored hidden states, burn-in starts from zero state.
+        :param num_samples: The number of windows to sample.
+        :param len_samples: The length of each window.
+        :param burn_in: The number of transitions to unroll (without gradient) before the window.
+        :return: Three lists of the same length (episode ids, window starting indices, burn-in starting indices).
+        """
+        episode_ids = [episode_id for episode_id, episode in self.memory.items() if len(episode) >= len_samples]
+        if len(episode_ids) == 0:
+            # No episode is long enough. Fall back to every stored episode, windows will be truncated.
+            episode_ids = list(self.memory.keys())
+
+        sampled_episodes = []
+        sampled_start_points = []
+        sampled_burn_in_points = []
+        for _ in range(num_samples):
+            episode_id = episode_ids[np.random.randint(0, len(episode_ids))]
+            len_episode = len(self.memory[episode_id])
+            start_point = np.random.randint(0, max(len_episode - len_samples, 0) + 1)
+
+            burn_in_point = max(start_point - burn_in, 0)
+            if self.store_hidden:
+                burn_in_point = burn_in_point - (burn_in_point % self.hidden_interval)
+
+            sampled_episodes.append(episode_id)
+            sampled_start_points.append(start_point)
+            sampled_burn_in_points.append(burn_in_point)
+
+        return sampled_episodes, sampled_start_points, sampled_burn_in_points
+
+    def _initial_hiddens(self, agent_nets:dict, episode_id, index):
+        # Use the stored hidden state at the index if it exists. Otherwise, start from zero state.
+        transition = self.memory[episode_id][index]
+        if 'hidden' in transition:
+            return {a: transition['hidden'][a].clone() for a in self.agents}
+        return {a: agent_nets[a].init_hidden() for a in self.agents}
+
+    def burn_in_hiddens(self, agent_nets:dict, target_agent_nets:dict, episode_id, burn_in_index, starting_index):
+        """
+         Hidden states of the agent and target agent networks at the window start, unrolled without gradient from
+        burn_in_index (R2D2 stored-state burn-in).
+         The stored hidden state at burn_in_index precedes previous_observations[burn_in_index], and seeds both networks.
+        The agent networks read previous_observations, the target networks read observations (one step ahead): from a
+        stored state, the target networks first consume previous_observations[burn_in_index], so that both follow the
+        observation path of the episode. Without stored state, both start from zero state at burn_in_index, as before.
+        :return: Hidden states (dict) of the agent networks before previous_observations[starting_index], and of the
+                 target agent networks before observations[starting_index].
+        """
+        agent_hiddens = self._initial_hiddens(agent_nets, episode_id, burn_in_index)
+        target_agent_hiddens = self._initial_hiddens(target_agent_nets, episode_id, burn_in_index)
+        episode = self.memory[episode_id]
 
-        target_agent_hiddens = {a: target_agent_nets[a].init_hidden() for a in self.agents}
+        # Burn-in. Only refreshes the recurrent state, no gradient flows through it.
+        with torch.no_grad():
+            if 'hidden' in episode[burn_in_index]:
+                for a in self.agents:
+                    _, target_agent_hiddens[a] = target_agent_nets[a](episode[burn_in_index]["previous_observations"][a]['observation'], target_agent_hiddens[a])
+            for transition in episode[burn_in_index: starting_index]:
+                for a in self.agents:
+                    _, agent_hiddens[a] = agent_nets[a](transition["previous_observations"][a]['observation'], agent_hiddens[a])
+                    _, target_agent_hiddens[a] = target_agent_nets[a](transition["observations"][a]['observation'], target_agent_hiddens[a])
+        return agent_hiddens, target_agent_hiddens
+
+    @profiled('calculate_batch_loss')
+    def calculate_batch_loss(self, mixer:QMixer, target_mixer:QMixer, agent_nets:dict, target_agent_nets:dict, episode_id, device, env, gamma, starting_index, batch_size, weighted=True, burn_in_index=None):
+        """
+         Calculate loss over the window [starting_index, starting_index + batch_size) of the episode.
+         If burn_in_index is given, the agent networks are unrolled from burn_in_index up to starting_index without gradient
+        (starting from the stored hidden state if any), and only the window contributes to the loss.
+        """
+        if burn_in_index is None:
+            burn_in_index = starting_index
+        burn_in_index = min(burn_in_index, starting_index)
+
+        batch = self.memory[episode_id][starting_index: starting_index + batch_size]
+        n_state_dim = batch[0]["state"].shape[-1]
+        agent_hiddens, target_agent_hiddens = self.burn_in_hiddens(agent_nets, target_agent_nets, episode_id, burn_in_index, starting_index)
 
         batch_agent_qs = torch.empty((0, 1, len(self.agents)), device=device)
-        batch_state = torch.empty((0, env.state().shape[0]), device=device)
+        batch_state = torch.empty((0, n_state_dim), device=device)
         batch_target_qs = torch.empty((0, 1, len(self.agents)), device=device)
-        batch_previous_state = torch.empty((0, env.state().shape[0]), device=device)
+        batch_previous_state = torch.empty((0, n_state_dim), device=device)
 
         # _, _, _, _, _, zipped_rewards, _, _ = zip(*episode)
         zipped_rewards = [ep["rewards"] for ep in batch]
@@ -459,7 +632,8 @@ class PrioritizedExperienceReplay(ReplayBuffer):
             for a in self.agents:
                 q, h = agent_nets[a](transition["previous_observations"][a]['observation'], agent_hiddens[a])
 
-                target_q, target_h = target_agent_nets[a](transition["observations"][a]['observation'], target_agent_hiddens[a])
+                with torch.no_grad():
+                    target_q, target_h = target_agent_nets[a](transition["observations"][a]['observation'], target_agent_hiddens[a])
 
                 q           = mask_and_nothing(action_mask=transition["previous_observations"][a]['action_mask'], Q=q)
                 target_q    = mask_and_nothing(action_mask=transition["observations"][a]['action_mask'], Q=target_q)
@@ -485,7 +659,7 @@ class PrioritizedExperienceReplay(ReplayBuffer):
                 cur_max_actions[a] = torch.argmax(q)
 
             tensor_target_qs = torch.reshape(
-                torch.stack([torch.gather(input=target_agent_qs[a], dim=0, index=torch.argmax(cur_max_actions[a])) for a in self.agents]), (1, 1, -1)
+                torch.stack([torch.gather(input=target_agent_qs[a], dim=0, index=cur_max_actions[a]) for a in self.agents]), (1, 1, -1)
             ).to(device)
             tensor_state = torch.reshape(transition["state"].to(device).float(), (1, -1)).to(device)
 
@@ -494,25 +668,30 @@ class PrioritizedExperienceReplay(ReplayBuffer):
             batch_target_qs         = torch.cat([batch_target_qs, tensor_target_qs], dim=0).to(device)
             batch_previous_state    = torch.cat([batch_previous_state, tensor_previous_state], dim=0).to(device)
         
-        total_q     = mixer(batch_agent_qs, batch_previous_state).squeeze().float()
-        target_q    = target_mixer(batch_target_qs, batch_state).squeeze().float()
+        if type(mixer) == VDN:
+            total_q     = mixer(batch_agent_qs).squeeze().float()
+            target_q    = target_mixer(batch_target_qs).squeeze().float()
+        else:
+            total_q     = mixer(batch_agent_qs, batch_previous_state).squeeze().float()
+            target_q    = target_mixer(batch_target_qs, batch_state).squeeze().float()
 
         discounted_reward = (batch_rewards.squeeze() + gamma * target_q.detach()).float().to(device)
 
         # self.td_error[episode_id] = F.huber_loss(target=discounted_reward, input=total_q, reduction=reduction).float().to(device)
         return F.huber_loss(discounted_reward, total_q).float().to(device)
     
+    @profiled('buffer prioritize')
     def prioritize(self, mixer, target_mixer, agent_nets:dict, target_agent_nets:dict, device, env, gamma, mode, calculate_for_all = False):
-        print("==== Prioritizing episodes ... ====")
-        
-        if mode == "UNIFORM":
-            print("Uniform mode. Applying uniform priority across the episodes...")
-        else:
+        if mode != "UNIFORM":
             for episode_id in self.memory.keys():
                 if calculate_for_all:
                     self.calculate_loss(mixer, target_mixer, agent_nets, target_agent_nets, episode_id, device, env, gamma)
-                    print(f"| Calculate td error for episode {episode_id:<3} : {self.td_error[episode_id]:.2f} |")
-        
+
+        # Current TD-error distribution of the memory (one device transfer for all the episodes).
+        if self.td_error:
+            td_error_histogram = metrics.histogram('buffer_td_error', 'TD errors of the episodes in the replay memory')
+            td_error_histogram.reset()
+            td_error_histogram.observe_many(torch.stack([torch.as_tensor(value).detach().float().cpu() for value in self.td_error.values()]).abs().numpy())
 
         alpha = 0.7
         beta = 0.5
@@ -554,6 +733,7 @@ class PrioritizedExperienceReplay(ReplayBuffer):
     def sample(self, episode_id):
         return self.td_error[episode_id], self.isweights[episode_id]
     
+    @profiled('buffer select_episodes')
     def select_episodes(self, num_samples):
         episode_ids = list(self.memory.keys())
         priority_values = np.array([value for _, value in self.priority.items()])
@@ -623,6 +803,196 @@ class CentralizedRNNAgent(nn.Module):
         return q_values, h
 
 
+class FusedRNNAgents(nn.Module):
+    """
+     Every RNNAgent of the agents packed into one module, so that a single batched forward runs all agents per timestep.
+     Weights are stacked per agent (grouped, equivalent to block-diagonal weights) and the inputs are zero-padded to the
+    largest observation size. The forward is the same Linear-ReLU-GRUCell-Linear of RNNAgent, and each agent's slice can
+    be read from / written to the state dict of RNNAgent, thus the agent_<name>_params.pt files keep working.
+    """
+
+    def __init__(self, agents, input_shapes: dict, n_hidden_dim, n_actions: dict):
+        """
+        :param agents: List of agent names. The order defines the agent axis of the inputs and outputs.
+        :param input_shapes: Dictionary of observation sizes of agents.
+        :param n_hidden_dim: The number of hidden units (shared by all agents).
+        :param n_actions: Dictionary of the number of actions of agents.
+        """
+        super(FusedRNNAgents, self).__init__()
+
+        self.agents = list(agents)
+        self.n_agents = len(self.agents)
+        self.n_hidden_dim = n_hidden_dim
+        self.input_shapes = {a: int(input_shapes[a]) for a in self.agents}
+        self.n_actions = {a: int(n_actions[a]) for a in self.agents}
+        self.max_input_shape = max(self.input_shapes.values())
+        self.max_n_actions = max(self.n_actions.values())
+
+        n, H = self.n_agents, n_hidden_dim
+        self.fc1_weight     = nn.Parameter(torch.zeros(n, H, self.max_input_shape))
+        self.fc1_bias       = nn.Parameter(torch.zeros(n, H))
+        self.rnn_weight_ih  = nn.Parameter(torch.zeros(n, 3 * H, H))
+        self.rnn_weight_hh  = nn.Parameter(torch.zeros(n, 3 * H, H))
+        self.rnn_bias_ih    = nn.Parameter(torch.zeros(n, 3 * H))
+        self.rnn_bias_hh    = nn.Parameter(torch.zeros(n, 3 * H))
+        self.fc2_weight     = nn.Parameter(torch.zeros(n, self.max_n_actions, H))
+        self.fc2_bias       = nn.Parameter(torch.zeros(n, self.max_n_actions))
+
+        # Valid (not padded) actions of each agent. Padded actions are masked out in forward.
+        action_valid = torch.zeros(n, self.max_n_actions, dtype=torch.bool)
+        for i, a in enumerate(self.agents):
+            action_valid[i, :self.n_actions[a]] = True
+        self.register_buffer('action_valid', action_valid)
+
+        # Initialize each slice the same way as RNNAgent does.
+        for a in self.agents:
+            self.load_agent_state_dict(a, RNNAgent(self.input_shapes[a], n_hidden_dim, self.n_actions[a]).state_dict())
+
+    @classmethod
+    def from_agents(cls, agent_nets: dict):
+        """
+        Build the fused module from a dictionary of RNNAgent, copying their parameters.
+        """
+        agents = list(agent_nets.keys())
+        fused = cls(agents,
+                    input_shapes={a: agent_nets[a].fc1.in_features for a in agents},
+                    n_hidden_dim=agent_nets[agents[0]].n_hidden_dim,
+                    n_actions={a: agent_nets[a].fc2.out_features for a in agents})
+        for a in agents:
+            fused.load_agent_state_dict(a, agent_nets[a].state_dict())
+        return fused.to(agent_nets[agents[0]].fc1.weight.device)
+
+    def init_hidden(self, batch_size=1):
+        # Shape: (n_agents, batch_size, n_hidden_dim), on the same device as the model
+        return torch.zeros(self.n_agents, batch_size, self.n_hidden_dim, device=self.fc1_weight.device)
+
+    def forward(self, inputs, hidden_state):
+        """
+        :param inputs: Tensor of shape (n_agents, batch_size, max_input_shape) or (n_agents, max_input_shape), zero-padded.
+        :param hidden_state: Tensor of shape (n_agents, batch_size, n_hidden_dim)
+        :return: q: Tensor of shape (n_agents, batch_size, max_n_actions), h: Tensor of shape (n_agents, batch_size, n_hidden_dim)
+        """
+        if inputs.dim() == 2:
+            inputs = inputs.unsqueeze(1)
+        h_in = hidden_state.view(self.n_agents, -1, self.n_hidden_dim)
+
+        x = F.relu(torch.baddbmm(self.fc1_bias.unsqueeze(1), inputs.float(), self.fc1_weight.transpose(1, 2)))
+
+        # GRUCell, with the gate order of torch (reset, update, new).
+        gi = torch.baddbmm(self.rnn_bias_ih.unsqueeze(1), x, self.rnn_weight_ih.transpose(1, 2))
+        gh = torch.baddbmm(self.rnn_bias_hh.unsqueeze(1), h_in, self.rnn_weight_hh.transpose(1, 2))
+        i_r, i_z, i_n = gi.chunk(3, dim=2)
+        h_r, h_z, h_n = gh.chunk(3, dim=2)
+        r = torch.sigmoid(i_r + h_r)
+        z = torch.sigmoid(i_z + h_z)
+        n = torch.tanh(i_n + r * h_n)
+        h = (1 - z) * n + z * h_in
+
+        q = torch.baddbmm(self.fc2_bias.unsqueeze(1), h, self.fc2_weight.transpose(1, 2))
+        q = q.masked_fill(~self.action_valid.unsqueeze(1), -torch.inf)
+        return q, h
+
+    def pack_inputs(self, inputs: dict):
+        """
+        Stack per-agent inputs of shape (..., input_shape) into a zero-padded tensor of shape (n_agents, ..., max_input_shape).
+        """
+        packed = []
+        for a in self.agents:
+            x = torch.as_tensor(inputs[a], device=self.fc1_weight.device).float()
+            packed.append(F.pad(x, (0, self.max_input_shape - x.shape[-1])))
+        return torch.stack(packed, dim=0)
+
+    def pack_action_masks(self, action_masks: dict):
+        """
+        Stack per-agent action masks of shape (..., n_actions) into a boolean tensor of shape (n_agents, ..., max_n_actions).
+        """
+        packed = []
+        for a in self.agents:
+            m = torch.as_tensor(action_masks[a], device=self.fc1_weight.device) != 0
+            packed.append(F.pad(m, (0, self.max_n_actions - m.shape[-1]), value=False))
+        return torch.stack(packed, dim=0)
+
+    def mask_q(self, q, action_masks, mask_before_softmax=True):
+        """
+        Mask the Q-values of every agent as the per-agent acting path does: mask_and_nothing if mask_before_softmax, else
+        softmax_and_mask (softmax over the actions of each agent, padded actions included at probability 0).
+        :param q: Tensor of shape (n_agents, ..., max_n_actions), from forward.
+        :param action_masks: Boolean tensor of shape (n_agents, ..., max_n_actions) or (n_agents, max_n_actions), from pack_action_masks.
+        :return: Masked Q-values of the shape of q.
+        """
+        if action_masks.dim() < q.dim():
+            action_masks = action_masks.unsqueeze(1)
+        if not mask_before_softmax:
+            q = F.softmax(q, dim=-1)
+        return q.masked_fill(~action_masks, -torch.inf)
+
+    def split_hidden(self, hidden_state):
+        # Hidden states of each agent, shaped as RNNAgent.init_hidden (batch_size, n_hidden_dim).
+        return {a: hidden_state[i] for i, a in enumerate(self.agents)}
+
+    def agent_state_dict(self, agent):
+        """
+        Return the parameters of the agent as a state dict of RNNAgent.
+        """
+        i = self.agents.index(agent)
+        n_input, n_actions = self.input_shapes[agent], self.n_actions[agent]
+        return {
+            'fc1.weight':       self.fc1_weight[i, :, :n_input].detach().clone(),
+            'fc1.bias':         self.fc1_bias[i].detach().clone(),
+            'rnn.weight_ih':    self.rnn_weight_ih[i].detach().clone(),
+            'rnn.weight_hh':    self.rnn_weight_hh[i].detach().clone(),
+            'rnn.bias_ih':      self.rnn_bias_ih[i].detach().clone(),
+            'rnn.bias_hh':      self.rnn_bias_hh[i].detach().clone(),
+            'fc2.weight':       self.fc2_weight[i, :n_actions].detach().clone(),
+            'fc2.bias':         self.fc2_bias[i, :n_actions].detach().clone(),
+        }
+
+    def load_agent_state_dict(self, agent, state_dict):
+        """
+        Copy a state dict of RNNAgent into the slice of the agent. Padded weights are kept at zero.
+        """
+        i = self.agents.index(agent)
+        n_input, n_actions = self.input_shapes[agent], self.n_actions[agent]
+        with torch.no_grad():
+            self.fc1_weight[i].zero_()
+            self.fc1_weight[i, :, :n_input].copy_(state_dict['fc1.weight'])
+            self.fc1_bias[i].copy_(state_dict['fc1.bias'])
+            self.rnn_weight_ih[i].copy_(state_dict['rnn.weight_ih'])
+            self.rnn_weight_hh[i].copy_(state_dict['rnn.weight_hh'])
+            self.rnn_bias_ih[i].copy_(state_dict['rnn.bias_ih'])
+            self.rnn_bias_hh[i].copy_(state_dict['rnn.bias_hh'])
+            self.fc2_weight[i].zero_()
+            self.fc2_bias[i].zero_()
+            self.fc2_weight[i, :n_actions].copy_(state_dict['fc2.weight'])
+            self.fc2_bias[i, :n_actions].copy_(state_dict['fc2.bias'])
+
+    def to_agents(self, agent_nets: dict):
+        """
+        Copy the parameters back to a dictionary of RNNAgent.
+        """
+        for a in self.agents:
+            agent_nets[a].load_state_dict(self.agent_state_dict(a))
+        return agent_nets
+
+    def save(self, directory):
+        # Same layout as save_model_parameters: agent_<name>_params.pt per agent.
+        for a in self.agents:
+            torch.save(self.agent_state_dict(a), os.path.join(directory, f'agent_{a}_params.pt'))
+
+    def load(self, directory, map_location=None):
+        for a in self.agents:
+            self.load_agent_state_dict(a, torch.load(os.path.join(directory, f'agent_{a}_params.pt'), map_location=map_location))
+
+
+def agent_modules(agent_nets):
+    """
+    List of modules holding the agent parameters, either a dictionary of RNNAgent or a single FusedRNNAgents.
+    """
+    if isinstance(agent_nets, dict):
+        return list(agent_nets.values())
+    return [agent_nets]
+
+
 
 if __name__ == '__main__':
     # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
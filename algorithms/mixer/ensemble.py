@@ -0,0 +1,297 @@
+import os
+from copy import deepcopy
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.func import stack_module_state, functional_call, vmap
+
+from algorithms.mixer.QMIX import QMixerRevised, VDN, RNNAgent
+
+
+class EnsembleMember(nn.Module):
+    """
+    One member of the ensemble: the agent networks of every agent and the mixing network, in one module so that the members
+    can be stacked with torch.func.stack_module_state.
+    """
+
+    def __init__(self, agent_nets: dict, mixer: nn.Module):
+        super(EnsembleMember, self).__init__()
+        self.agent_nets = nn.ModuleDict(agent_nets)
+        self.mixer = mixer
+
+
+def rnn_agent_forward(params, prefix, inputs, hidden_state):
+    """
+     Functional RNNAgent.forward (fc1 -> ReLU -> GRUCell -> fc2) on a (possibly batched) input.
+     Written with the GRU equations (gate order r, z, n as in torch.nn.GRUCell) so that it can be vmapped over the members.
+    :param params: Parameters of the member, keyed as in EnsembleMember.named_parameters().
+    :param prefix: Key prefix of the agent (e.g. 'agent_nets.influent_flowrate.').
+    """
+    x = F.relu(F.linear(inputs, params[prefix + 'fc1.weight'], params[prefix + 'fc1.bias']))
+    gi = F.linear(x, params[prefix + 'rnn.weight_ih'], params[prefix + 'rnn.bias_ih'])
+    gh = F.linear(hidden_state, params[prefix + 'rnn.weight_hh'], params[prefix + 'rnn.bias_hh'])
+    i_r, i_z, i_n = gi.chunk(3, dim=-1)
+    h_r, h_z, h_n = gh.chunk(3, dim=-1)
+    r = torch.sigmoid(i_r + h_r)
+    z = torch.sigmoid(i_z + h_z)
+    n = torch.tanh(i_n + r * h_n)
+    h = (1 - z) * n + z * hidden_state
+    q = F.linear(h, params[prefix + 'fc2.weight'], params[prefix + 'fc2.bias'])
+    return q, h
+
+
+class EnsembleQMIX:
+    """
+     E independent QMIX (or VDN) learners stacked along a leading member axis with torch.func.stack_module_state, and
+    evaluated with vmap (one forward / backward for the whole ensemble instead of E of them).
+     Each member keeps its own parameters, target parameters, learning rate and optimizer state. The members only share
+    the architecture.
+    """
+
+    def __init__(self, members: list, lrs, device, max_grad_norm=10.0, betas=(0.9, 0.999), eps=1e-8):
+        """
+        :param members: List of EnsembleMember with the same architecture (the initial parameters of each member).
+        :param lrs: Learning rate of each member (list of float, or a float for all the members).
+        """
+        self.n_members = len(members)
+        self.agents = list(members[0].agent_nets.keys())
+        self.device = device
+        self.vdn = type(members[0].mixer) == VDN
+        self.n_hidden_dim = members[0].agent_nets[self.agents[0]].n_hidden_dim
+
+        self.params, self.module_buffers = stack_module_state([member.to(device) for member in members])
+        self.target_params = {k: v.detach().clone() for k, v in self.params.items()}
+        # Stateless copy of one member, only used to call the mixer functionally.
+        self.base = deepcopy(members[0]).to('meta')
+
+        if isinstance(lrs, (int, float)):
+            lrs = [lrs] * self.n_members
+        assert len(lrs) == self.n_members, "One learning rate per member is required."
+        self.lrs = torch.tensor(lrs, dtype=torch.float32, device=device)
+        self.max_grad_norm = max_grad_norm
+        self.betas = betas
+        self.eps = eps
+        self.step_count = 0
+        self.exp_avg = {k: torch.zeros_like(v) for k, v in self.params.items()}
+        self.exp_avg_sq = {k: torch.zeros_like(v) for k, v in self.params.items()}
+
+    def _prefix(self, agent):
+        return f'agent_nets.{agent}.'
+
+    def init_hidden(self, batch_size=None):
+        # Hidden states of every agent, shaped (n_members, n_hidden_dim) or (n_members, batch_size, n_hidden_dim).
+        shape = (self.n_members, self.n_hidden_dim) if batch_size is None else (self.n_members, batch_size, self.n_hidden_dim)
+        return {a: torch.zeros(shape, device=self.device) for a in self.agents}
+
+    @torch.no_grad()
+    def act(self, inputs: dict, hidden_states: dict):
+        """
+         Action-values of every member for one timestep.
+        :param inputs: Dictionary of scaled observations, Tensor(n_members, input_shape) per agent.
+        :param hidden_states: Dictionary of Tensor(n_members, n_hidden_dim) per agent.
+        :return: Dictionary of Q Tensor(n_members, n_actions) per agent, and the new hidden states.
+        """
+        agent_qs, new_hiddens = {}, {}
+        for a in self.agents:
+            forward = vmap(lambda p, x, h, prefix=self._prefix(a): rnn_agent_forward(p, prefix, x, h))
+            agent_qs[a], new_hiddens[a] = forward(self.params, inputs[a], hidden_states[a])
+        return agent_qs, new_hiddens
+
+    def _member_loss(self, params, buffers, target_params, batch, gamma):
+        """
+         Loss of one member on a padded batch of its episodes. Same loss as PrioritizedExperienceReplay.calculate_loss
+        (DDQN targets, Huber loss averaged over each episode), weighted by the importance sampling weights as in the
+        episodic training loop of optimize_pressure_RO.py.
+        """
+        valid = batch['valid']                                              # (B, T)
+        n_episodes, n_steps = valid.shape
+
+        hiddens = {a: torch.zeros(n_episodes, self.n_hidden_dim, device=valid.device) for a in self.agents}
+        target_hiddens = {a: torch.zeros(n_episodes, self.n_hidden_dim, device=valid.device) for a in self.agents}
+        agent_qs, target_qs = [], []
+        for t in range(n_steps):
+            chosen_t, target_t = [], []
+            for i, a in enumerate(self.agents):
+                prefix = self._prefix(a)
+                q, hiddens[a] = rnn_agent_forward(params, prefix, batch['previous_observations'][a][:, t], hiddens[a])
+                q = q.masked_fill(~batch['previous_action_masks'][a][:, t], -torch.inf)
+                chosen_t.append(torch.gather(q, 1, batch['actions'][:, t, i:i + 1]))
+
+                # DDQN. Select the next actions with the online parameters, evaluate them with the target parameters.
+                cur_q, _ = rnn_agent_forward(params, prefix, batch['observations'][a][:, t], hiddens[a])
+                cur_q = cur_q.detach().masked_fill(~batch['action_masks'][a][:, t], -torch.inf)
+                target_q, target_hiddens[a] = rnn_agent_forward(target_params, prefix, batch['observations'][a][:, t], target_hiddens[a])
+                target_q = target_q.masked_fill(~batch['action_masks'][a][:, t], -torch.inf)
+                target_t.append(torch.gather(target_q, 1, torch.argmax(cur_q, dim=1, keepdim=True)))
+            agent_qs.append(torch.cat(chosen_t, dim=1))
+            target_qs.append(torch.cat(target_t, dim=1))
+
+        agent_qs = torch.stack(agent_qs, dim=1).reshape(n_episodes * n_steps, 1, -1)      # (B*T, 1, n_agents)
+        target_qs = torch.stack(target_qs, dim=1).reshape(n_episodes * n_steps, 1, -1)
+        previous_state = batch['previous_state'].reshape(n_episodes * n_steps, -1)
+        state = batch['state'].reshape(n_episodes * n_steps, -1)
+
+        mixer_params = {k[len('mixer.'):]: v for k, v in params.items() if k.startswith('mixer.')}
+        target_mixer_params = {k[len('mixer.'):]: v for k, v in target_params.items() if k.startswith('mixer.')}
+        if self.vdn:
+            total_q = agent_qs.sum(dim=2)
+            target_q = target_qs.sum(dim=2)
+        else:
+            total_q = functional_call(self.base.mixer, mixer_params, (agent_qs, previous_state))
+            target_q = functional_call(self.base.mixer, target_mixer_params, (target_qs, state))
+        total_q = total_q.reshape(n_episodes, n_steps)
+        target_q = target_q.reshape(n_episodes, n_steps)
+
+        discounted_reward = (batch['rewards'] + gamma * target_q).detach()
+        loss_raw = F.huber_loss(input=torch.where(valid, total_q, 0.0), target=torch.where(valid, discounted_reward, 0.0), reduction='none')
+        episode_losses = (loss_raw * valid).sum(dim=1) / valid.sum(dim=1).clamp(min=1)       # (B,)
+
+        isweights = batch['isweights']
+        loss = (episode_losses * isweights).sum() / isweights.max() / n_episodes
+        return loss, episode_losses.detach()
+
+    def loss(self, batch, gamma):
+        """
+         Losses of all the members at once.
+        :param batch: Padded batch built with stack_batch, with a leading member axis.
+        :return: Tensor(n_members) of losses (with gradient) and Tensor(n_members, n_episodes) of per-episode losses (TD errors).
+        """
+        return vmap(lambda p, b, tp, x: self._member_loss(p, b, tp, x, gamma))(self.params, self.module_buffers, self.target_params, batch)
+
+    def train_step(self, batch, gamma):
+        """
+         One gradient step of every member (see optimizer_step).
+        :return: Tensor(n_members) of losses and Tensor(n_members, n_episodes) of per-episode losses.
+        """
+        for p in self.params.values():
+            p.grad = None
+        losses, episode_losses = self.loss(batch, gamma)
+        # Members are independent, so the gradient of the sum is the gradient of each member's loss.
+        losses.sum().backward()
+        self.optimizer_step()
+        return losses.detach(), episode_losses
+
+    @torch.no_grad()
+    def optimizer_step(self):
+        """
+         Update every member from the gradients in self.params, as clip_grad_norm_ followed by torch.optim.RAdam (the
+        optimizer of optimize_pressure_RO.py) would for each member alone: per-member gradient-norm clipping, per-member
+        learning rate, and the variance rectification of RAdam (plain bias-corrected momentum while the approximated SMA
+        length rho_t is at most 5).
+        """
+        grad_norms = torch.sqrt(sum(p.grad.pow(2).reshape(self.n_members, -1).sum(dim=1) for p in self.params.values()))
+        clip = (self.max_grad_norm / (grad_norms + 1e-6)).clamp(max=1.0)
+
+        self.step_count += 1
+        beta1, beta2 = self.betas
+        bias_correction1 = 1 - beta1 ** self.step_count
+        bias_correction2 = 1 - beta2 ** self.step_count
+        rho_inf = 2 / (1 - beta2) - 1
+        rho_t = rho_inf - 2 * self.step_count * (beta2 ** self.step_count) / bias_correction2
+        if rho_t > 5.0:
+            rect = ((rho_t - 4) * (rho_t - 2) * rho_inf / ((rho_inf - 4) * (rho_inf - 2) * rho_t)) ** 0.5
+        for k, p in self.params.items():
+            view = (self.n_members,) + (1,) * (p.dim() - 1)
+            grad = p.grad * clip.view(view)
+            self.exp_avg[k].mul_(beta1).add_(grad, alpha=1 - beta1)
+            self.exp_avg_sq[k].mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            update = self.lrs.view(view) * self.exp_avg[k] / bias_correction1
+            if rho_t > 5.0:
+                update = update * rect * bias_correction2 ** 0.5 / self.exp_avg_sq[k].sqrt().add_(self.eps)
+            p.sub_(update)
+
+    @torch.no_grad()
+    def td_errors(self, batch, gamma):
+        # Per-episode losses without gradient, used as the PER TD errors of newly stored episodes.
+        return self.loss(batch, gamma)[1]
+
+    def update_targets(self):
+        # Hard update of the target parameters of every member.
+        with torch.no_grad():
+            for k, v in self.params.items():
+                self.target_params[k].copy_(v)
+
+    def member_state_dicts(self, member):
+        """
+        :return: Mixer state dict and dictionary of agent state dicts of one member, in the layout of QMixerRevised / RNNAgent.
+        """
+        mixer_state_dict = {k[len('mixer.'):]: v[member].detach().clone() for k, v in self.params.items() if k.startswith('mixer.')}
+        agent_state_dicts = {
+            a: {k[len(self._prefix(a)):]: v[member].detach().clone() for k, v in self.params.items() if k.startswith(self._prefix(a))}
+            for a in self.agents
+        }
+        return mixer_state_dict, agent_state_dicts
+
+    def save(self, member, directory):
+        # Same files as save_model_parameters, so that each member loads with load_model_parameters.
+        os.makedirs(directory, exist_ok=True)
+        mixer_state_dict, agent_state_dicts = self.member_state_dicts(member)
+        torch.save(mixer_state_dict, os.path.join(directory, 'mixer_params.pt'))
+        for a, state_dict in agent_state_dicts.items():
+            torch.save(state_dict, os.path.join(directory, f'agent_{a}_params.pt'))
+
+    def load(self, member, directory, map_location=None):
+        with torch.no_grad():
+            mixer_state_dict = torch.load(os.path.join(directory, 'mixer_params.pt'), map_location=map_location)
+            for k, v in mixer_state_dict.items():
+                self.params['mixer.' + k][member].copy_(v)
+            for a in self.agents:
+                agent_state_dict = torch.load(os.path.join(directory, f'agent_{a}_params.pt'), map_location=map_location)
+                for k, v in agent_state_dict.items():
+                    self.params[self._prefix(a) + k][member].copy_(v)
+        self.update_targets()
+
+
+def stack_batch(buffers: list, episode_ids: list, agents, device):
+    """
+     Stack sampled episodes of every member into padded tensors with leading (member, episode, timestep) axes.
+    :param buffers: PrioritizedExperienceReplay of each member.
+    :param episode_ids: List (one per member) of the episode ids to stack. Every member must have the same number of episodes.
+    :return: Dictionary of tensors, with 'valid' marking the real (non-padded) timesteps.
+    """
+    stacked = [[buffer.stack_episode(int(ep)) for ep in ids] for buffer, ids in zip(buffers, episode_ids)]
+    n_steps = max(ep['length'] for member in stacked for ep in member)
+
+    def pad(tensor, value=0):
+        padding = [0, 0] * (tensor.dim() - 1) + [0, n_steps - tensor.shape[0]]
+        return F.pad(tensor, padding, value=value)
+
+    def collect(get, value=0):
+        return torch.stack([torch.stack([pad(get(ep), value) for ep in member]) for member in stacked]).to(device)
+
+    batch = {
+        # Padded timesteps get all actions available, so that every value stays finite.
+        'previous_observations':    {a: collect(lambda ep: ep['previous_observations'][a]) for a in agents},
+        'observations':             {a: collect(lambda ep: ep['observations'][a]) for a in agents},
+        'previous_action_masks':    {a: collect(lambda ep: ep['previous_action_masks'][a].bool(), True) for a in agents},
+        'action_masks':             {a: collect(lambda ep: ep['action_masks'][a].bool(), True) for a in agents},
+        'actions':                  collect(lambda ep: ep['actions']),
+        'rewards':                  collect(lambda ep: ep['rewards'].reshape(-1)),
+        'previous_state':           collect(lambda ep: ep['previous_state']),
+        'state':                    collect(lambda ep: ep['state']),
+        'valid':                    collect(lambda ep: torch.ones(ep['length'], dtype=torch.bool), False),
+    }
+    batch['isweights'] = torch.tensor(
+        np.array([[float(buffer.isweights.get(int(ep), 1.0)) for ep in ids] for buffer, ids in zip(buffers, episode_ids)]),
+        dtype=torch.float32, device=device
+    )
+    return batch
+
+
+def build_members(n_members, agents, input_shapes: dict, n_actions: dict, seeds, mixer='QMixerRevised', n_state_dim=15, n_hidden_dim=64, n_embedding_dim=64):
+    """
+     Initialize the members with their own seeds (same initialization as a single run with that seed).
+    :param mixer: 'QMixerRevised' or 'VDN'.
+    """
+    members = []
+    for e in range(n_members):
+        torch.manual_seed(seeds[e])
+        agent_nets = {a: RNNAgent(input_shape=input_shapes[a], n_hidden_dim=n_hidden_dim, n_actions=n_actions[a]) for a in agents}
+        if mixer == 'VDN':
+            mixer_net = VDN()
+        else:
+            mixer_net = QMixerRevised(n_state_dim=n_state_dim, n_agents=len(agents), n_embedding_dim=n_embedding_dim, device='cpu')
+        members.append(EnsembleMember(agent_nets, mixer_net))
+    return members
@@ -0,0 +1,426 @@
+"""
+ Microbenchmarks of the hot paths of training and evaluation: the Julia process model, the environment overhead around
+it, the prioritized replay buffer, the loss calculation and agent acting.
+ Results (seconds per call) are written to a JSON baseline. `compare` flags benchmarks whose median got slower than the
+baseline by more than a threshold, and exits with status 1 if there is any.
+
+Usage (from the repository root):
+    python -m benchmarks.microbenchmarks run --output benchmarks/baseline.json
+    python -m benchmarks.microbenchmarks run --output current.json --compare benchmarks/baseline.json --threshold 0.15
+    python -m benchmarks.microbenchmarks compare benchmarks/baseline.json current.json --threshold 0.15
+    python -m benchmarks.microbenchmarks list
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import torch
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPOSITORY_ROOT not in sys.path:
+    sys.path.insert(0, REPOSITORY_ROOT)
+
+from TwoStageROProcessEnvironment.env.observation_bounds import AGENTS, N_ACTIONS, observation_bounds, observation_shapes
+
+N_STATE_DIM = 15
+EPISODE_LENGTH = 120    # Control steps of a 30-day episode with 6-hour control interval.
+FILL_LEVELS = (8, 64, 256)
+
+BENCHMARKS = {}
+
+
+def benchmark(name, needs_julia=False):
+    """
+    Register a benchmark. The decorated function receives the parsed arguments and returns the seconds of each call.
+    """
+    def decorator(function):
+        BENCHMARKS[name] = (function, needs_julia)
+        return function
+    return decorator
+
+
+def time_calls(function, n_calls, warmup=3):
+    for _ in range(warmup):
+        function()
+    times = np.empty(n_calls)
+    for i in range(n_calls):
+        start = time.perf_counter()
+        function()
+        times[i] = time.perf_counter() - start
+    return times
+
+
+def summarize(times):
+    times = np.asarray(times, dtype=np.float64)
+    return {
+        'median': float(np.median(times)),
+        'mean': float(np.mean(times)),
+        'p10': float(np.percentile(times, 10)),
+        'p90': float(np.percentile(times, 90)),
+        'n': int(times.size),
+    }
+
+
+# Synthetic inputs, shaped as the environment produces them.
+
+
+class BoundsScaler:
+    # Min-max scaling of TwoStageROProcessEnvironment.scale_observation, without the Julia-backed environment.
+    agents = AGENTS
+
+    def __init__(self):
+        self.bounds = {a: (low.astype(np.float32), high.astype(np.float32)) for a, (low, high) in observation_bounds().items()}
+
+    def scale_observation(self, observations):
+        observations_copy = copy.deepcopy(observations)
+        for a in self.agents:
+            low, high = self.bounds[a]
+            observations_copy[a]['observation'] = (observations[a]['observation'] - low) / (high - low)
+        return observations_copy
+
+
+def random_observations(rng):
+    observations = {}
+    for a, (low, high) in observation_bounds().items():
+        observations[a] = {'observation': rng.uniform(low, high).astype(np.float32),
+                           'action_mask': np.ones(N_ACTIONS[a], dtype=np.int8)}
+    return observations
+
+
+def random_transition(rng, episode_id, done=False):
+    return {
+        'episode_id': episode_id,
+        'previous_state': rng.random(N_STATE_DIM).astype(np.float32),
+        'previous_observations': random_observations(rng),
+        'state': rng.random(N_STATE_DIM).astype(np.float32),
+        'actions': {a: int(rng.integers(N_ACTIONS[a])) for a in AGENTS},
+        'rewards': float(rng.normal()),
+        'observations': random_observations(rng),
+        'done': {a: done for a in AGENTS},
+    }
+
+
+def filled_buffer(n_episodes, device, rng):
+    from algorithms.mixer.QMIX import PrioritizedExperienceReplay
+    buffer = PrioritizedExperienceReplay(AGENTS, device)
+    scaler = BoundsScaler()
+    for episode in range(n_episodes):
+        for step in range(EPISODE_LENGTH):
+            buffer.push(random_transition(rng, episode + 1, done=step == EPISODE_LENGTH - 1), scaler)
+        buffer.td_error[episode] = torch.tensor(float(rng.random()), device=device)
+    return buffer
+
+
+def networks(device, fused=False):
+    from algorithms.mixer.QMIX import RNNAgent, FusedRNNAgents, QMixerRevised
+    input_shapes = observation_shapes()
+    agent_nets = {a: RNNAgent(input_shapes[a], 64, N_ACTIONS[a]).to(device) for a in AGENTS}
+    if fused:
+        agent_nets = FusedRNNAgents.from_agents(agent_nets).to(device)
+    mixer = QMixerRevised(N_STATE_DIM, len(AGENTS), 64, device).to(device)
+    return mixer, agent_nets
+
+
+# Julia process model.
+
+
+_julia = None
+
+
+def julia_benchmarks():
+    global _julia
+    if _julia is None:
+        import juliacall
+        _julia = juliacall.Main
+        _julia.seval(f'include(raw"{os.path.join(REPOSITORY_ROOT, "benchmarks", "ro_benchmarks.jl")}")')
+    return _julia.ROBenchmarks
+
+
+@benchmark('julia.ro_vessel_simple', needs_julia=True)
+def bench_ro_vessel_simple(args):
+    return np.asarray(julia_benchmarks().benchmark_ro_vessel_simple(args.calls))
+
+
+@benchmark('julia.pressure_controlled_step', needs_julia=True)
+def bench_pressure_controlled_step(args):
+    return np.asarray(julia_benchmarks().benchmark_pressure_controlled_step(args.calls))
+
+
+# Environment overhead: wall time of reset / step minus the time spent in the Julia model (measured with utils.profiling).
+
+
+def environment_overhead(args, reset):
+    from TwoStageROProcessEnvironment.env.PressureControlledTwoStageROProcess_simple import TwoStageROProcessEnvironment
+    from utils.profiling import enable_profiling
+
+    profiler = enable_profiling()
+    rng = np.random.default_rng(args.seed)
+    np.random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as save_dir:
+        env = TwoStageROProcessEnvironment(save_dir=save_dir, render_mode='silent')
+        initial_action = {"influent_flowrate": 1000.0, "1st_stage_pump": 10.0, "2nd_stage_pump": 0.5}
+        observations, _ = env.reset(hard=True, initial_action=initial_action, len_scenario=env.max_timestep + 1)
+        overheads = []
+        while len(overheads) < args.calls:
+            physics_before = profiler.total('julia model')
+            start = time.perf_counter()
+            if reset:
+                observations, _ = env.reset(initial_action=initial_action, len_scenario=env.max_timestep + 1)
+                done = False
+            else:
+                actions = {a: int(rng.choice(np.flatnonzero(observations[a]['action_mask']))) for a in AGENTS}
+                observations, _, truncated, terminated, _, _ = env.step(actions=actions, terminate_if_diverge=True)
+                done = any(truncated.values()) or any(terminated.values()) or not env.process_valid
+            overheads.append(time.perf_counter() - start - (profiler.total('julia model') - physics_before))
+            if done:
+                observations, _ = env.reset(initial_action=initial_action, len_scenario=env.max_timestep + 1)
+    enable_profiling(False)
+    return np.asarray(overheads)
+
+
+@benchmark('env.reset_overhead', needs_julia=True)
+def bench_env_reset(args):
+    return environment_overhead(args, reset=True)
+
+
+@benchmark('env.step_overhead', needs_julia=True)
+def bench_env_step(args):
+    return environment_overhead(args, reset=False)
+
+
+# Replay buffer.
+
+
+for _fill in FILL_LEVELS:
+    def _bench_push(args, fill=_fill):
+        rng = np.random.default_rng(args.seed)
+        buffer = filled_buffer(fill, args.device, rng)
+        scaler = BoundsScaler()
+        transitions = [random_transition(rng, fill + 1) for _ in range(args.calls + 3)]
+        iterator = iter(transitions)
+        return time_calls(lambda: buffer.push(next(iterator), scaler), args.calls)
+
+    def _bench_prioritize(args, fill=_fill, mode='RANK-BASED'):
+        rng = np.random.default_rng(args.seed)
+        buffer = filled_buffer(fill, args.device, rng)
+        return time_calls(lambda: buffer.prioritize(None, None, None, None, args.device, None, gamma=0.99, mode=mode, calculate_for_all=False), args.calls)
+
+    def _bench_select(args, fill=_fill):
+        rng = np.random.default_rng(args.seed)
+        np.random.seed(args.seed)
+        buffer = filled_buffer(fill, args.device, rng)
+        buffer.prioritize(None, None, None, None, args.device, None, gamma=0.99, mode='RANK-BASED', calculate_for_all=False)
+        return time_calls(lambda: buffer.select_episodes(num_samples=32), args.calls)
+
+    benchmark(f'buffer.push[fill={_fill}]')(_bench_push)
+    benchmark(f'buffer.prioritize_rank[fill={_fill}]')(_bench_prioritize)
+    benchmark(f'buffer.prioritize_proportional[fill={_fill}]')(lambda args, fill=_fill: _bench_prioritize(args, fill=fill, mode='PROPORTIONAL'))
+    benchmark(f'buffer.select_episodes[fill={_fill}]')(_bench_select)
+
+
+# Learning and acting.
+
+
+def calculate_loss_per_episode(args, fused):
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    buffer = filled_buffer(4, args.device, rng)
+    mixer, agent_nets = networks(args.device, fused=fused)
+    target_mixer, target_agent_nets = copy.deepcopy(mixer), copy.deepcopy(agent_nets)
+    episode_ids = list(buffer.memory.keys())
+
+    def call():
+        buffer.calculate_loss(mixer=mixer, target_mixer=target_mixer, agent_nets=agent_nets, target_agent_nets=target_agent_nets,
+                              episode_id=episode_ids[0], device=args.device, env=None, gamma=0.99, weighted=True)
+        buffer.td_error[episode_ids[0]].backward()
+        mixer.zero_grad(set_to_none=True)
+    return time_calls(call, args.calls)
+
+
+@benchmark('learn.calculate_loss')
+def bench_calculate_loss(args):
+    return calculate_loss_per_episode(args, fused=False)
+
+
+@benchmark('learn.calculate_loss_fused')
+def bench_calculate_loss_fused(args):
+    return calculate_loss_per_episode(args, fused=True)
+
+
+@benchmark('act.per_agent')
+def bench_act_per_agent(args):
+    from algorithms.mixer.QMIX import mask_and_nothing
+    from utils.epsilon_greedy import epsilon_greedy
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    _, agent_nets = networks(args.device)
+    scaler = BoundsScaler()
+    observations = random_observations(rng)
+    hiddens = {a: agent_nets[a].init_hidden() for a in AGENTS}
+
+    def call():
+        scaled = scaler.scale_observation(observations)
+        with torch.no_grad():
+            for a in AGENTS:
+                q, hiddens[a] = agent_nets[a](torch.from_numpy(scaled[a]['observation']).to(args.device), hiddens[a])
+                q = mask_and_nothing(action_mask=scaled[a]['action_mask'], Q=q)
+                epsilon_greedy(q, scaled[a]['action_mask'], 0.05)
+    return time_calls(call, args.calls)
+
+
+@benchmark('act.fused')
+def bench_act_fused(args):
+    from utils.epsilon_greedy import select_actions
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    _, agent_nets = networks(args.device, fused=True)
+    scaler = BoundsScaler()
+    observations = random_observations(rng)
+    hidden = [agent_nets.init_hidden()]
+
+    def call():
+        scaled = scaler.scale_observation(observations)
+        with torch.no_grad():
+            q, hidden[0] = agent_nets(agent_nets.pack_inputs({a: scaled[a]['observation'] for a in AGENTS}), hidden[0])
+        action_masks = agent_nets.pack_action_masks({a: scaled[a]['action_mask'] for a in AGENTS})
+        select_actions(q[:, 0], action_masks, mode='epsilon-greedy', epsilon=0.05, temperature=0.05).tolist()
+    return time_calls(call, args.calls)
+
+
+# Running and comparing.
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu count': os.cpu_count(),
+        'torch threads': torch.get_num_threads(),
+        'device': args.device,
+        'calls': args.calls,
+    }
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    selected = [name for name in BENCHMARKS if not args.only or any(pattern in name for pattern in args.only)]
+    results, skipped = {}, {}
+    for name in selected:
+        function, needs_julia = BENCHMARKS[name]
+        if needs_julia and args.skip_julia:
+            skipped[name] = 'skipped with --skip-julia'
+            continue
+        try:
+            results[name] = summarize(function(args))
+        except ImportError as error:
+            # e.g. juliacall not installed: the other benchmarks still run.
+            skipped[name] = f"{type(error).__name__}: {error}"
+            print(f"{name:<45} skipped ({skipped[name]})")
+            continue
+        print(f"{name:<45} median {results[name]['median'] * 1e3:>10.4f} ms | p90 {results[name]['p90'] * 1e3:>10.4f} ms")
+
+    report = {'metadata': metadata(args), 'results': results, 'skipped': skipped}
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Saved {len(results)} results to {args.output}.")
+
+    if args.compare is not None:
+        return compare_files(args.compare, args.output, args.threshold)
+    return 0
+
+
+def compare(baseline, current, threshold):
+    """
+    Returns:
+        list[dict]: One row per benchmark of the baseline, with the median ratio (current / baseline) and the status
+                    'regression' (slower by more than `threshold`), 'improvement', 'ok' or 'missing'.
+    """
+    rows = []
+    for name, baseline_result in baseline['results'].items():
+        current_result = current['results'].get(name)
+        if current_result is None:
+            rows.append({'benchmark': name, 'baseline': baseline_result['median'], 'current': None, 'ratio': None, 'status': 'missing'})
+            continue
+        ratio = current_result['median'] / baseline_result['median']
+        if ratio > 1.0 + threshold:
+            status = 'regression'
+        elif ratio < 1.0 / (1.0 + threshold):
+            status = 'improvement'
+        else:
+            status = 'ok'
+        rows.append({'benchmark': name, 'baseline': baseline_result['median'], 'current': current_result['median'], 'ratio': ratio, 'status': status})
+    return rows
+
+
+def compare_files(baseline_path, current_path, threshold):
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    with open(current_path) as file:
+        current = json.load(file)
+    rows = compare(baseline, current, threshold)
+
+    print(f"{'benchmark':<45} {'baseline (ms)':>14} {'current (ms)':>14} {'ratio':>8}  status")
+    for row in rows:
+        current_ms = f"{row['current'] * 1e3:>14.4f}" if row['current'] is not None else f"{'-':>14}"
+        ratio = f"{row['ratio']:>8.3f}" if row['ratio'] is not None else f"{'-':>8}"
+        print(f"{row['benchmark']:<45} {row['baseline'] * 1e3:>14.4f} {current_ms} {ratio}  {row['status']}")
+
+    regressions = [row['benchmark'] for row in rows if row['status'] == 'regression']
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    print(f"No regression beyond {threshold:.0%}.")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the training and evaluation hot paths.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks and save the results as JSON.')
+    run_parser.add_argument('--output', type=str, default=os.path.join(REPOSITORY_ROOT, 'benchmarks', 'results.json'))
+    run_parser.add_argument('--only', type=str, nargs='*', help='Run the benchmarks whose name contains one of these strings.')
+    run_parser.add_argument('--calls', type=int, default=50, help='Timed calls per benchmark.')
+    run_parser.add_argument('--device', type=str, default='cpu')
+    run_parser.add_argument('--threads', type=int, default=1, help='Torch intra-op threads (1 gives the most stable timings).')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--skip-julia', action='store_true', help='Skip the benchmarks that need Julia (process model, environment).')
+    run_parser.add_argument('--compare', type=str, help='Baseline JSON to compare the results with.')
+    run_parser.add_argument('--threshold', type=float, default=0.15, help='Relative slowdown of the median counted as a regression.')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two result files.')
+    compare_parser.add_argument('baseline', type=str)
+    compare_parser.add_argument('current', type=str)
+    compare_parser.add_argument('--threshold', type=float, default=0.15)
+
+    subparsers.add_parser('list', help='List the benchmarks.')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        return run(args)
+    if args.command == 'compare':
+        return compare_files(args.baseline, args.current, args.threshold)
+    for name, (_, needs_julia) in BENCHMARKS.items():
+        print(f"{name}{' (Julia)' if needs_julia else ''}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+# Julia-side timings of the process model, used by benchmarks/microbenchmarks.py.
+# Calls are timed inside Julia, so that the Python-Julia call overhead is not included.
+include(joinpath(@__DIR__, "..", "TwoStageROProcessEnvironment", "julia modules", "pressure_controlled_ro_simple.jl"))
+
+module ROBenchmarks
+
+using ..PressureControlledRO
+
+const RO = PressureControlledRO.RO_Element_Simple
+
+# Nominal feed of TwoStageROProcessEnvironment (T [°C], C [ppm], P_in [bar]) and initial action of the trainers.
+const FEED = (20.0, 500.0, 1e-5)
+const FLOWRATE = 1000.0
+const PRESSURE_1ST = 10.0
+const PRESSURE_2ND = 0.5
+
+function time_calls(f, n_calls::Int, warmup::Int)
+    for _ in 1:warmup
+        f()
+    end
+    times = Vector{Float64}(undef, n_calls)
+    for i in 1:n_calls
+        start = time_ns()
+        f()
+        times[i] = (time_ns() - start) / 1e9
+    end
+    return times
+end
+
+"""
+Seconds per ro_vessel_simple call of the 1st stage vessel, marching the fouling state forward between calls.
+"""
+function benchmark_ro_vessel_simple(n_calls::Int; warmup::Int=3)
+    operational_vars = Dict("T" => FEED[1], "C" => FEED[2], "Q" => FLOWRATE / PressureControlledRO.ro_1st_pvs, "P" => FEED[3] + PRESSURE_1ST)
+    state = Ref{Dict}(Dict{String, Any}("timestep" => 1.0))
+    function call()
+        _, _, state_updated = RO.ro_vessel_simple(; operational_vars=operational_vars, state_vars=state[],
+                                                    parameter_setpoints=PressureControlledRO.RO_1st_setpoints, dt=PressureControlledRO.dt)
+        state_updated["timestep"] += 1
+        state[] = state_updated
+    end
+    return time_calls(call, n_calls, warmup)
+end
+
+"""
+Seconds per control step of pressure_controlled_2stage_ro_simple, with `control_interval` model timesteps per step.
+"""
+function benchmark_pressure_controlled_step(n_calls::Int; control_interval::Int=1, warmup::Int=3)
+    feed_scenario = repeat([FEED[1] FEED[2] FEED[3]], control_interval, 1)
+    state_1st = Ref{Dict}(Dict{String, Any}("timestep" => 1.0))
+    state_2nd = Ref{Dict}(Dict{String, Any}("timestep" => 1.0))
+    function call()
+        outputs = PressureControlledRO.pressure_controlled_2stage_ro_simple(feed_scenario, FLOWRATE, PRESSURE_1ST, PRESSURE_2ND, state_1st[], state_2nd[])
+        state_1st[] = outputs[1]
+        state_2nd[] = outputs[2]
+    end
+    return time_calls(call, n_calls, warmup)
+end
+
+end
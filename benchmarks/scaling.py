@@ -0,0 +1,352 @@
+"""
+ End-to-end scaling study of the training pipeline. Runs short, fixed-budget training sessions of optimize_pressure_RO.py
+(or optimize_pressure_RO_actor_learner.py when a run sets n_actors) from the same YAML configuration as real
+runs, varying one or more of:
+    n_actors            Simulation workers (actor processes).
+    n_segments          Axial segments of the vessel model (model fidelity).
+    control_dt          Control interval [s] (a multiple of the 360 s model timestep).
+    replay_batch_size   Episodes (or sequences) per gradient step.
+    torch_threads       Torch intra-op threads of the (learner) process.
+
+ Every run records env steps/s, gradient steps/s, peak RSS of the process tree and the wall time until the rolling mean
+reward of the episodes reaches `reward_threshold`. Results are appended to <output>/scaling_results.csv (finished runs are
+skipped on restart), and <output>/scaling_report.md summarizes them with one plot per factor.
+
+Usage (from the repository root):
+    python -m benchmarks.scaling run benchmarks/scaling_study.yaml
+    python -m benchmarks.scaling report benchmarks/scaling_study.yaml
+
+Study file keys:
+    base_config         YAML configuration of optimize_pressure_RO.py the variants are derived from.
+    output              Directory of the variant runs, the results and the report.
+    budget              Keys overriding the base configuration in every run (e.g. max_episodes, time_budget).
+    reward_threshold    Rolling mean reward sum defining time-to-threshold (optional).
+    reward_window       Episodes of the rolling mean (default 10).
+    repeats             Runs per variant (default 1).
+    mode                'one-at-a-time' (default): each factor is varied alone around the base configuration.
+                        'grid': every combination of the factor values.
+    sweeps              {factor: [values]}.
+    timeout             Seconds after which a run is killed (default: 2 x budget.time_budget + 600, none without a budget).
+"""
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import yaml
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPOSITORY_ROOT not in sys.path:
+    sys.path.insert(0, REPOSITORY_ROOT)
+
+from utils.run_log import read_episode_log
+
+FACTORS = ('n_actors', 'n_segments', 'control_dt', 'replay_batch_size', 'torch_threads')
+# Throughput of these factors is expected to grow linearly with the value: the report adds their parallel efficiency.
+PARALLEL_FACTORS = ('n_actors', 'torch_threads')
+TRAINERS = {
+    'single': 'optimize_pressure_RO.py',
+    'actor_learner': 'optimize_pressure_RO_actor_learner.py',
+}
+RESULTS_NAME = 'scaling_results.csv'
+METRICS = [('env steps / s', 'Environment steps / s'),
+           ('gradient steps / s', 'Gradient steps / s'),
+           ('peak RSS (MB)', 'Peak RSS (MB)'),
+           ('time to threshold (s)', 'Time to reward threshold (s)')]
+
+
+def load_study(path):
+    with open(path) as file:
+        study = yaml.safe_load(file)
+    unknown = set(study.get('sweeps', {})) - set(FACTORS)
+    if unknown:
+        raise ValueError(f"Unknown sweep factor(s) {sorted(unknown)}. Expected a subset of {list(FACTORS)}.")
+    study.setdefault('output', os.path.join('benchmarks', 'scaling_runs'))
+    study.setdefault('budget', {})
+    study.setdefault('reward_threshold', None)
+    study.setdefault('reward_window', 10)
+    study.setdefault('repeats', 1)
+    study.setdefault('mode', 'one-at-a-time')
+    return study
+
+
+def variant_name(overrides):
+    return 'base' if not overrides else ','.join(f"{factor}={overrides[factor]}" for factor in FACTORS if factor in overrides)
+
+
+def variants(study):
+    """
+    Returns:
+        list[tuple]: (varied factor or None, overrides) per variant. The factor is None in grid mode.
+    """
+    sweeps = study.get('sweeps', {})
+    if not sweeps:
+        return [(None, {})]
+    if study['mode'] == 'grid':
+        factors = [factor for factor in FACTORS if factor in sweeps]
+        return [(None, dict(zip(factors, values))) for values in itertools.product(*(sweeps[factor] for factor in factors))]
+    if study['mode'] != 'one-at-a-time':
+        raise ValueError(f"Unknown study mode '{study['mode']}'. Expected 'one-at-a-time' or 'grid'.")
+    return [(factor, {factor: value}) for factor in FACTORS if factor in sweeps for value in sweeps[factor]]
+
+
+def write_variant_config(study, overrides, run_dir):
+    """
+    Write the configuration of one run: the base configuration, the study budget and the variant overrides.
+    """
+    with open(os.path.join(REPOSITORY_ROOT, study['base_config'])) as file:
+        config = yaml.safe_load(file)
+    config.update(study['budget'])
+    config.update(overrides)
+    config['save_dir'] = os.path.join(run_dir, 'run')
+    config['description_experiment'] = f"{config.get('description_experiment', '')} [scaling study: {variant_name(overrides)}]"
+    os.makedirs(run_dir, exist_ok=True)
+    config_path = os.path.join(run_dir, 'configuration.yaml')
+    with open(config_path, 'w') as file:
+        yaml.safe_dump(config, file, sort_keys=False)
+    return config_path, config
+
+
+def _tree_rss(psutil, process):
+    try:
+        processes = [process] + process.children(recursive=True)
+    except psutil.Error:
+        return 0
+    rss = 0
+    for p in processes:
+        try:
+            rss += p.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+
+def run_trainer(script, config_path, log_path, timeout=None, poll_interval=0.5):
+    """
+    Run one training session as a subprocess and measure the peak RSS of its process tree (actors included).
+
+    Without psutil, the peak RSS falls back to the resource usage of the trainer process itself (os.wait4), which
+    misses the actor processes.
+
+    Returns:
+        tuple: (return code, peak RSS in bytes, wall time in seconds)
+    """
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+
+    start = time.perf_counter()
+    with open(log_path, 'w') as log_file:
+        process = subprocess.Popen([sys.executable, script, '--yaml_file', config_path], cwd=REPOSITORY_ROOT,
+                                   stdout=log_file, stderr=subprocess.STDOUT)
+        peak_rss = 0
+        if psutil is not None:
+            tree = psutil.Process(process.pid)
+            while process.poll() is None:
+                peak_rss = max(peak_rss, _tree_rss(psutil, tree))
+                if timeout is not None and time.perf_counter() - start > timeout:
+                    for child in tree.children(recursive=True):
+                        child.kill()
+                    process.kill()
+                    process.wait()
+                    break
+                time.sleep(poll_interval)
+            return_code = process.returncode
+        else:
+            try:
+                _, status, usage = os.wait4(process.pid, 0)
+            except ChildProcessError:
+                process.wait()
+                status, usage = None, None
+            if status is not None:
+                process.returncode = os.waitstatus_to_exitcode(status)
+                peak_rss = usage.ru_maxrss * 1024    # Kilobytes on Linux.
+            return_code = process.returncode
+    return return_code, peak_rss, time.perf_counter() - start
+
+
+def time_to_threshold(save_dir, threshold, window):
+    """
+    Returns:
+        tuple: (wall time in seconds at which the rolling mean reward sum first reached `threshold` (NaN if never),
+                final rolling mean reward sum)
+    """
+    try:
+        episode_log = read_episode_log(save_dir)
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        return float('nan'), float('nan')
+    # Both trainers log the episode reward sum of the environment (env.reward_sum_log[-1]) as 'Reward sum'. The
+    # 'reward sum (without convergence correction)' column of optimize_pressure_RO.py is never filled (always 0).
+    reward_column = 'Reward sum'
+    if episode_log.empty or not {reward_column, 'wall time (s)'} <= set(episode_log.columns):
+        return float('nan'), float('nan')
+    episode_log = episode_log.dropna(subset=[reward_column, 'wall time (s)'])
+    if episode_log.empty:
+        return float('nan'), float('nan')
+    rolling = pd.to_numeric(episode_log[reward_column]).rolling(window, min_periods=min(window, len(episode_log))).mean()
+    final = float(rolling.iloc[-1])
+    if threshold is None:
+        return float('nan'), final
+    reached = np.flatnonzero(rolling.to_numpy() >= threshold)
+    if reached.size == 0:
+        return float('nan'), final
+    return float(episode_log['wall time (s)'].iloc[reached[0]]), final
+
+
+def run_study(study):
+    output = os.path.abspath(os.path.join(REPOSITORY_ROOT, study['output']))
+    os.makedirs(output, exist_ok=True)
+    results_path = os.path.join(output, RESULTS_NAME)
+    finished = set()
+    if os.path.exists(results_path):
+        previous = pd.read_csv(results_path)
+        finished = {(row['variant'], int(row['repeat'])) for _, row in previous.iterrows() if row['return code'] == 0}
+
+    time_budget = study['budget'].get('time_budget')
+    timeout = study.get('timeout', 2 * time_budget + 600 if time_budget is not None else None)
+    planned = variants(study)
+    for index, (factor, overrides) in enumerate(planned):
+        name = variant_name(overrides)
+        for repeat in range(study['repeats']):
+            if (name, repeat) in finished:
+                print(f"[{index + 1}/{len(planned)}] {name} (repeat {repeat}) already done.")
+                continue
+            run_dir = os.path.join(output, 'variants', name, f'repeat {repeat}')
+            config_path, config = write_variant_config(study, overrides, run_dir)
+            trainer = 'actor_learner' if 'n_actors' in config else 'single'
+            print(f"[{index + 1}/{len(planned)}] {name} (repeat {repeat}) with {TRAINERS[trainer]} ...")
+
+            return_code, peak_rss, wall_time = run_trainer(os.path.join(REPOSITORY_ROOT, TRAINERS[trainer]), config_path,
+                                                           os.path.join(run_dir, 'run.log'), timeout=timeout)
+            summary_path = os.path.join(config['save_dir'], 'run_summary.json')
+            summary = {}
+            if os.path.exists(summary_path):
+                with open(summary_path) as file:
+                    summary = json.load(file)
+            threshold_time, final_reward = time_to_threshold(config['save_dir'], study['reward_threshold'], study['reward_window'])
+
+            row = {
+                'variant': name,
+                'factor': factor,
+                'repeat': repeat,
+                'trainer': trainer,
+                **{f: config.get(f) for f in FACTORS},
+                'return code': return_code,
+                'process wall time (s)': wall_time,
+                'wall time (s)': summary.get('wall time (s)'),
+                'episodes': summary.get('episodes'),
+                'env steps': summary.get('env steps'),
+                'gradient steps': summary.get('gradient steps'),
+                'env steps / s': summary.get('env steps / s'),
+                'gradient steps / s': summary.get('gradient steps / s'),
+                'peak RSS (MB)': peak_rss / 2**20,
+                'time to threshold (s)': threshold_time,
+                'final reward (rolling mean)': final_reward,
+            }
+            pd.DataFrame([row]).to_csv(results_path, mode='a', header=not os.path.exists(results_path), index=False)
+            status = 'ok' if return_code == 0 else f'FAILED (return code {return_code}, see {os.path.join(run_dir, "run.log")})'
+            print(f"    {status} | env steps/s {row['env steps / s']} | gradient steps/s {row['gradient steps / s']} "
+                  f"| peak RSS {row['peak RSS (MB)']:.0f} MB | time to threshold {threshold_time:.1f} s")
+    write_report(study)
+
+
+def _factor_table(results, factor):
+    """
+    Mean (and standard deviation over repeats) of every metric per value of `factor`.
+    """
+    subset = results if results['factor'].isna().all() else results[results['factor'] == factor]
+    subset = subset.dropna(subset=[factor])
+    if subset.empty:
+        return None
+    metric_columns = [column for column, _ in METRICS]
+    table = subset.groupby(factor)[metric_columns].agg(['mean', 'std']).sort_index()
+    if factor in PARALLEL_FACTORS and len(table) > 1:
+        values = table.index.to_numpy(dtype=float)
+        for column in ('env steps / s', 'gradient steps / s'):
+            throughput = table[(column, 'mean')].to_numpy()
+            table[(f"{column} efficiency", 'mean')] = (throughput / throughput[0]) / (values / values[0])
+    return table
+
+
+def write_report(study):
+    from matplotlib import pyplot as plt
+
+    output = os.path.abspath(os.path.join(REPOSITORY_ROOT, study['output']))
+    results_path = os.path.join(output, RESULTS_NAME)
+    if not os.path.exists(results_path):
+        print(f"No results in {output}.")
+        return
+    results = pd.read_csv(results_path)
+    failed = results[results['return code'] != 0]
+    results = results[results['return code'] == 0]
+
+    lines = ["# Scaling report", "",
+             f"- Base configuration: `{study['base_config']}`",
+             f"- Budget: {study['budget']}",
+             f"- Reward threshold: {study['reward_threshold']} (rolling mean over {study['reward_window']} episodes)",
+             f"- Mode: {study['mode']}, {study['repeats']} repeat(s), {len(results)} successful run(s), {len(failed)} failed run(s)",
+             ""]
+    if not failed.empty:
+        lines += ["Failed runs: " + ", ".join(f"{row['variant']} (repeat {row['repeat']})" for _, row in failed.iterrows()), ""]
+
+    for factor in FACTORS:
+        if factor not in study.get('sweeps', {}):
+            continue
+        table = _factor_table(results, factor)
+        if table is None:
+            continue
+        lines += [f"## {factor}", "", table.to_markdown(floatfmt='.4g') if _has_tabulate() else f"```\n{table.to_string()}\n```", ""]
+
+        figure, axes = plt.subplots(1, len(METRICS), figsize=(4.5 * len(METRICS), 3.5))
+        for ax, (column, label) in zip(axes, METRICS):
+            ax.errorbar(table.index.to_numpy(dtype=float), table[(column, 'mean')], yerr=table[(column, 'std')].fillna(0.0),
+                        marker='o', capsize=3)
+            ax.set_xlabel(factor)
+            ax.set_ylabel(label)
+            ax.grid(alpha=0.3)
+        figure.tight_layout()
+        figure_name = f"scaling_{factor}.png"
+        figure.savefig(os.path.join(output, figure_name), dpi=120)
+        plt.close(figure)
+        lines += [f"![{factor}]({figure_name})", ""]
+
+    report_path = os.path.join(output, 'scaling_report.md')
+    with open(report_path, 'w') as file:
+        file.write('\n'.join(lines))
+    print(f"Saved the scaling report to {report_path}.")
+
+
+def _has_tabulate():
+    # DataFrame.to_markdown needs the optional tabulate package.
+    try:
+        import tabulate  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='End-to-end scaling study of the training pipeline.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='Run the variants of a study (skipping finished runs) and write the report.')
+    run_parser.add_argument('study', type=str, help='Study YAML file.')
+    report_parser = subparsers.add_parser('report', help='Write the report from the results of a study.')
+    report_parser.add_argument('study', type=str, help='Study YAML file.')
+
+    args = parser.parse_args(argv)
+    study = load_study(args.study)
+    if args.command == 'run':
+        run_study(study)
+    else:
+        write_report(study)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
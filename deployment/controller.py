@@ -0,0 +1,456 @@
+"""
+ Online controller service of many RO trains (plants) sharing one checkpoint.
+
+ The service loads a weight file of deployment/export.py, keeps the GRU hidden states of every plant, and answers
+measurement records sent over a local socket (Unix domain socket, or TCP on localhost) as JSON lines:
+    request   {"id": 17, "plant": "train-3",
+               "observations": {agent: {"observation": [raw observation], "action_mask": [mask]}, ...},
+               "state": [normalized state]          (centralized agent network only)
+               "reset": false                       (true at the start of an episode: zero hidden states)
+               "no_op": ["2nd_stage_pump"]}         (agents held at action 2 (No-Op), as DistributedActionController)
+    response  {"id": 17, "plant": "train-3", "actions": {agent: action}, "latency_ms": 0.41}
+              {"id": 17, "error": "..."}
+    command   {"command": "stats"}                  (decisions, errors, p50/p99 latency, mean batch size, plants)
+The observations are the vectors the environment builds (TwoStageROProcessEnvironment.step), scaled by the service.
+
+ Requests of all connections go to one queue. The batching thread takes the first waiting request, collects the others
+arriving within the latency budget (or up to `max_batch`), and decides for all of them with one forward per agent
+network. A plant appears at most once per batch; its later requests wait for the next batch, so that its hidden state is
+updated in order. Latencies (receipt to decision) are reported as p50/p99, and the hidden states are saved atomically
+to an .npz file every `persist_interval` seconds and at shutdown, and loaded at start, so that a restart keeps the
+recurrent memory of the plants.
+
+ Usage:
+    python -m deployment.controller vdn_49000.npz --socket /tmp/romarl_controller.sock --state_dir controller_state
+"""
+import argparse
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+from deployment.runtime import CentralizedPolicy, centralized_greedy, greedy, load_policy
+
+
+NO_OP_ACTION = 2
+HIDDEN_STATES_NAME = 'hidden_states.npz'
+
+
+class LatencyStats:
+    """Latencies and batch sizes of the latest `window` decisions."""
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.decisions = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def record(self, latencies, batch_size):
+        with self._lock:
+            self.latencies.extend(latencies)
+            self.batch_sizes.append(batch_size)
+            self.decisions += len(latencies)
+
+    def summary(self) -> dict:
+        with self._lock:
+            latencies = np.array(self.latencies) * 1e3
+            batch_sizes = np.array(self.batch_sizes)
+            summary = {'decisions': self.decisions, 'errors': self.errors}
+        if len(latencies):
+            summary.update({'p50 ms': float(np.percentile(latencies, 50)), 'p99 ms': float(np.percentile(latencies, 99)),
+                            'max ms': float(latencies.max()), 'mean batch size': float(batch_sizes.mean())})
+        return summary
+
+
+class HiddenStateStore:
+    """
+    Hidden states of every plant, one (n_hidden_dim,) array per network slot (agent, or 'centralized'). Saved with the
+    checkpoint hash of the weight file: hidden states of another checkpoint are discarded at load.
+    """
+    def __init__(self, path, slots, n_hidden_dim, checkpoint_hash=None):
+        """
+        Args:
+            path (str): Path of the .npz file (memory only if None).
+            slots (list): Names of the recurrent networks.
+            n_hidden_dim (int): Hidden size of the networks.
+            checkpoint_hash (str): Hash of the checkpoint of the hidden states.
+        """
+        self.path = path
+        self.slots = list(slots)
+        self.n_hidden_dim = n_hidden_dim
+        self.checkpoint_hash = checkpoint_hash
+        self.hidden = {}
+        self.decisions = {}
+        self.dirty = False
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def get(self, plant) -> dict:
+        if plant not in self.hidden:
+            self.reset(plant)
+        return self.hidden[plant]
+
+    def set(self, plant, hiddens: dict):
+        self.hidden[plant] = hiddens
+        self.decisions[plant] = self.decisions.get(plant, 0) + 1
+        self.dirty = True
+
+    def reset(self, plant):
+        self.hidden[plant] = {slot: np.zeros(self.n_hidden_dim, dtype=np.float32) for slot in self.slots}
+        self.decisions[plant] = 0
+        self.dirty = True
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        plants = sorted(self.hidden)
+        manifest = {'checkpoint_hash': self.checkpoint_hash, 'plants': plants, 'slots': self.slots,
+                    'decisions': [self.decisions[plant] for plant in plants], 'saved': time.time()}
+        arrays = {slot: np.stack([self.hidden[plant][slot] for plant in plants]) if plants
+                  else np.zeros((0, self.n_hidden_dim), dtype=np.float32) for slot in self.slots}
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            np.savez(file, manifest=np.array(json.dumps(manifest)), **arrays)
+        os.replace(temporary_path, self.path)
+        self.dirty = False
+
+    def load(self):
+        with np.load(self.path, allow_pickle=False) as data:
+            manifest = json.loads(str(data['manifest']))
+            if manifest['checkpoint_hash'] != self.checkpoint_hash or manifest['slots'] != self.slots:
+                print(f"Hidden states of {self.path} belong to another checkpoint: starting from zero hidden states.")
+                return
+            arrays = {slot: data[slot] for slot in self.slots}
+        for i, plant in enumerate(manifest['plants']):
+            self.hidden[plant] = {slot: arrays[slot][i].copy() for slot in self.slots}
+            self.decisions[plant] = manifest['decisions'][i]
+        print(f"Loaded the hidden states of {len(manifest['plants'])} plant(s) from {self.path}.")
+
+
+def parse_request(message: dict, policy) -> dict:
+    """
+    Validate a decision request and convert its vectors to numpy arrays.
+
+    Raises:
+        ValueError: Missing fields, unknown agents, wrong vector sizes, non-finite values or masks without valid action.
+    """
+    if 'plant' not in message:
+        raise ValueError("Missing 'plant'.")
+    observations = message.get('observations')
+    if not isinstance(observations, dict) or set(observations) != set(policy.agents):
+        raise ValueError(f"'observations' must hold the agents {policy.agents}.")
+    request = {'id': message.get('id'), 'plant': str(message['plant']), 'reset': bool(message.get('reset', False)),
+               'observations': {}, 'action_masks': {}}
+    for a in policy.agents:
+        action_mask = np.asarray(observations[a]['action_mask'], dtype=np.int8)
+        if action_mask.shape != (policy.n_actions[a],):
+            raise ValueError(f"Action mask of {a} must have {policy.n_actions[a]} values.")
+        if not action_mask.any():
+            raise ValueError(f"No valid actions available for {a}.")
+        request['action_masks'][a] = action_mask
+        if not isinstance(policy, CentralizedPolicy):
+            observation = np.asarray(observations[a]['observation'], dtype=np.float32)
+            if observation.shape != (policy.agent_nets[a].input_shape,):
+                raise ValueError(f"Observation of {a} must have {policy.agent_nets[a].input_shape} values.")
+            if not np.isfinite(observation).all():
+                raise ValueError(f"Observation of {a} is not finite.")
+            request['observations'][a] = observation
+    for a in message.get('no_op', []):
+        if a not in policy.agents:
+            raise ValueError(f"Unknown agent {a} in 'no_op'.")
+        request['action_masks'][a] = np.eye(policy.n_actions[a], dtype=np.int8)[NO_OP_ACTION]
+    if isinstance(policy, CentralizedPolicy):
+        state = np.asarray(message.get('state', ()), dtype=np.float32)
+        if state.shape != (policy.agent_net.input_shape,):
+            raise ValueError(f"'state' must have {policy.agent_net.input_shape} values.")
+        request['state'] = state
+    return request
+
+
+class PlantController:
+    """Micro-batching greedy controller of many plants, with per-plant hidden states."""
+    def __init__(self, policy, store: HiddenStateStore, latency_budget=0.002, max_batch=256, persist_interval=1.0,
+                 report_interval=60.0):
+        """
+        Args:
+            policy (DecentralizedPolicy | CentralizedPolicy): Policy of deployment.runtime.load_policy.
+            store (HiddenStateStore): Hidden states of the plants.
+            latency_budget (float): Seconds the first request of a batch waits for others.
+            max_batch (int): Requests decided at once.
+            persist_interval (float): Seconds between two saves of the hidden states.
+            report_interval (float): Seconds between two latency reports (printed).
+        """
+        self.policy = policy
+        self.store = store
+        self.latency_budget = latency_budget
+        self.max_batch = max_batch
+        self.persist_interval = persist_interval
+        self.report_interval = report_interval
+        self.stats = LatencyStats()
+        self.queue = queue.Queue()
+        self._deferred = deque()
+        self._running = threading.Event()
+        self._thread = None
+
+    @property
+    def centralized(self) -> bool:
+        return isinstance(self.policy, CentralizedPolicy)
+
+    def submit(self, request: dict) -> Future:
+        """Queue a parsed request. The future resolves to its response."""
+        future = Future()
+        self.queue.put((time.perf_counter(), request, future))
+        return future
+
+    def decide(self, requests: list) -> list:
+        """
+        Greedy actions of a batch of requests (of distinct plants), with one forward per network. Updates the hidden
+        states of the plants.
+
+        Returns:
+            list: Actions of each request ({agent: action}).
+        """
+        agents = self.policy.agents
+        for request in requests:
+            if request['reset']:
+                self.store.reset(request['plant'])
+        hiddens = [self.store.get(request['plant']) for request in requests]
+        action_masks = {a: np.stack([request['action_masks'][a] for request in requests]) for a in agents}
+
+        if self.centralized:
+            net = self.policy.agent_net
+            q, h = net(np.stack([request['state'] for request in requests]), np.stack([h['centralized'] for h in hiddens]))
+            joint_actions = centralized_greedy(q, [action_masks[a] for a in agents])
+            new_hiddens = [{'centralized': h[i]} for i in range(len(requests))]
+            actions = [{a: int(joint_actions[i, j]) for j, a in enumerate(agents)} for i in range(len(requests))]
+        else:
+            new_hiddens = [{} for _ in requests]
+            actions = [{} for _ in requests]
+            for a in agents:
+                x = np.stack([self.policy.scale(a, request['observations'][a]) for request in requests])
+                q, h = self.policy.agent_nets[a](x, np.stack([hidden[a] for hidden in hiddens]))
+                for i, action in enumerate(greedy(q, action_masks[a])):
+                    actions[i][a] = int(action)
+                    new_hiddens[i][a] = h[i]
+
+        for request, hidden in zip(requests, new_hiddens):
+            self.store.set(request['plant'], hidden)
+        return actions
+
+    def _collect(self) -> list:
+        # Deferred requests (plants already in the previous batch) first, then the queue until the budget of the first.
+        batch, plants = [], set()
+
+        def add(item):
+            if item[1]['plant'] in plants:
+                self._deferred.append(item)
+            else:
+                plants.add(item[1]['plant'])
+                batch.append(item)
+
+        deferred, self._deferred = self._deferred, deque()
+        for item in deferred:
+            add(item)
+        if not batch:
+            try:
+                add(self.queue.get(timeout=0.1))
+            except queue.Empty:
+                return batch
+        deadline = batch[0][0] + self.latency_budget
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            add(item)
+        return batch
+
+    def _loop(self):
+        last_persist = last_report = time.monotonic()
+        while self._running.is_set():
+            batch = self._collect()
+            if batch:
+                try:
+                    actions = self.decide([request for _, request, _ in batch])
+                except Exception as error:
+                    # Requests are validated by parse_request: answer the batch with the error rather than leave it waiting.
+                    for _, request, future in batch:
+                        self.stats.record_error()
+                        future.set_result({'id': request['id'], 'plant': request['plant'], 'error': str(error)})
+                else:
+                    done = time.perf_counter()
+                    for (received, request, future), action in zip(batch, actions):
+                        future.set_result({'id': request['id'], 'plant': request['plant'], 'actions': action,
+                                           'latency_ms': (done - received) * 1e3})
+                    self.stats.record([done - received for received, _, _ in batch], len(batch))
+
+            now = time.monotonic()
+            if now - last_persist >= self.persist_interval:
+                self.store.save()
+                last_persist = now
+            if self.report_interval and now - last_report >= self.report_interval:
+                print(format_stats(self.stats.summary()), flush=True)
+                last_report = now
+
+    def start(self):
+        self._running.set()
+        self._thread = threading.Thread(target=self._loop, name='PlantController', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the batching thread once its current batch is decided, and save the hidden states."""
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join()
+        self.store.save()
+
+    def handle(self, message: dict) -> dict:
+        """Response to one JSON message (decision request or command)."""
+        command = message.get('command')
+        if command == 'stats':
+            return dict(self.stats.summary(), plants=len(self.store.hidden))
+        if command is not None:
+            return {'error': f"Unknown command {command}."}
+        try:
+            request = parse_request(message, self.policy)
+        except (ValueError, KeyError, TypeError) as error:
+            self.stats.record_error()
+            return {'id': message.get('id'), 'error': str(error)}
+        return self.submit(request).result()
+
+
+def format_stats(summary: dict) -> str:
+    if 'p50 ms' not in summary:
+        return f"decisions {summary['decisions']} | errors {summary['errors']}"
+    return (f"decisions {summary['decisions']} | errors {summary['errors']} | p50 {summary['p50 ms']:.3f} ms | "
+            f"p99 {summary['p99 ms']:.3f} ms | max {summary['max ms']:.3f} ms | mean batch {summary['mean batch size']:.1f}")
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.controller.handle(json.loads(line))
+            except json.JSONDecodeError as error:
+                response = {'error': f"Invalid JSON: {error}"}
+            self.wfile.write((json.dumps(response) + '\n').encode())
+            self.wfile.flush()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(controller: PlantController, socket_path=None, port=None):
+    """Server of one connection thread per client, on a Unix domain socket or on TCP localhost:port."""
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _UnixServer(socket_path, _Handler)
+    else:
+        server = _TCPServer(('127.0.0.1', port), _Handler)
+    server.controller = controller
+    return server
+
+
+class ControllerClient:
+    """Client of one plant connection (JSON lines, one request at a time)."""
+    def __init__(self, socket_path=None, port=None, timeout=10.0):
+        if socket_path is not None:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(socket_path)
+        else:
+            self.socket = socket.create_connection(('127.0.0.1', port))
+        self.socket.settimeout(timeout)
+        self.file = self.socket.makefile('rwb')
+
+    def request(self, message: dict) -> dict:
+        self.file.write((json.dumps(message) + '\n').encode())
+        self.file.flush()
+        return json.loads(self.file.readline())
+
+    def act(self, plant, observations: dict, state=None, reset=False, no_op=(), request_id=None) -> dict:
+        """
+        Args:
+            observations (dict): {agent: {'observation': raw observation, 'action_mask': mask}}, as the environment.
+
+        Returns:
+            dict: Response of the service.
+        """
+        message = {'id': request_id, 'plant': plant, 'reset': reset, 'no_op': list(no_op),
+                   'observations': {a: {k: np.asarray(v).tolist() for k, v in o.items()} for a, o in observations.items()}}
+        if state is not None:
+            message['state'] = np.asarray(state).tolist()
+        return self.request(message)
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+def serve(weights_path, socket_path=None, port=None, state_dir=None, latency_budget=0.002, max_batch=256,
+          persist_interval=1.0, report_interval=60.0):
+    """Run the service until SIGINT or SIGTERM."""
+    policy = load_policy(weights_path)
+    slots = ['centralized'] if isinstance(policy, CentralizedPolicy) else policy.agents
+    n_hidden_dim = policy.agent_net.n_hidden_dim if isinstance(policy, CentralizedPolicy) else policy.agent_nets[policy.agents[0]].n_hidden_dim
+    if state_dir is not None:
+        os.makedirs(state_dir, exist_ok=True)
+    store = HiddenStateStore(os.path.join(state_dir, HIDDEN_STATES_NAME) if state_dir is not None else None, slots,
+                             n_hidden_dim, checkpoint_hash=policy.manifest.get('checkpoint_hash'))
+    controller = PlantController(policy, store, latency_budget=latency_budget, max_batch=max_batch,
+                                 persist_interval=persist_interval, report_interval=report_interval)
+    server = make_server(controller, socket_path=socket_path, port=port)
+
+    stopping = threading.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: stopping.set())
+    controller.start()
+    server_thread = threading.Thread(target=server.serve_forever, name='ControllerServer', daemon=True)
+    server_thread.start()
+    print(f"Serving {weights_path} on {socket_path or f'127.0.0.1:{port}'}", flush=True)
+    stopping.wait()
+
+    server.shutdown()
+    server.server_close()
+    controller.stop()
+    if socket_path is not None and os.path.exists(socket_path):
+        os.remove(socket_path)
+    print(format_stats(controller.stats.summary()), flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Online controller service of many plants sharing one checkpoint')
+    parser.add_argument('weights', type=str, help='Weight file written by deployment/export.py')
+    parser.add_argument('--socket', type=str, default='/tmp/romarl_controller.sock', help='Unix domain socket path')
+    parser.add_argument('--port', type=int, default=None, help='Serve on TCP 127.0.0.1:PORT instead of the Unix socket')
+    parser.add_argument('--state_dir', type=str, default=None, help='Directory of the persisted hidden states')
+    parser.add_argument('--latency_budget_ms', type=float, default=2.0, help='Wait of the first request of a batch')
+    parser.add_argument('--max_batch', type=int, default=256)
+    parser.add_argument('--persist_interval', type=float, default=1.0, help='Seconds between two saves of the hidden states')
+    parser.add_argument('--report_interval', type=float, default=60.0, help='Seconds between two latency reports')
+    args = parser.parse_args()
+
+    serve(args.weights, socket_path=None if args.port is not None else args.socket, port=args.port,
+          state_dir=args.state_dir, latency_budget=args.latency_budget_ms / 1e3, max_batch=args.max_batch,
+          persist_interval=args.persist_interval, report_interval=args.report_interval)
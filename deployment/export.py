@@ -0,0 +1,166 @@
+"""
+ Exporter of trained checkpoints (e.g. parameters/VDN/49000/*.pt, or a packed checkpoint file) to the flat NumPy weight
+file read by deployment/runtime.py.
+
+ The weight file is one uncompressed .npz holding every parameter as '<network>/<parameter>' (e.g.
+'agent_1st_stage_pump_params/rnn.weight_hh', float32) and a JSON manifest (__manifest__) with the kind and dimensions
+of each network, the agent order and the checkpoint hash. It is read without pickle.
+ After writing, the runtime forward is compared with the torch forward on random inputs and hidden states, so that an
+exported file is known to reproduce the checkpoint.
+
+ Usage:
+    python -m deployment.export parameters/VDN/49000 --output vdn_49000.npz
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+
+from deployment.runtime import FORMAT_VERSION, MANIFEST_KEY, build_network
+from TwoStageROProcessEnvironment.env.observation_bounds import AGENTS, N_ACTIONS
+from utils.checkpoint import load_state_dicts
+from utils.rollout_cache import RolloutCache
+
+
+# The runtime output must satisfy |runtime - torch| <= ATOL + RTOL * |torch| element-wise (np.allclose), so that the
+# check scales with the magnitude of the Q-values instead of failing on large outputs for float32 rounding alone.
+RTOL = 1e-5
+ATOL = 1e-6
+
+
+def compare_outputs(reference, runtime) -> dict:
+    """
+    Compare runtime outputs with the torch outputs.
+
+    Returns:
+        dict: 'max_abs_error', 'max_rel_error' (largest difference over the largest torch output magnitude) and
+              'within_tolerance' (np.allclose with RTOL and ATOL).
+    """
+    reference, runtime = np.asarray(reference, dtype=np.float64), np.asarray(runtime, dtype=np.float64)
+    max_abs_error = float(np.abs(reference - runtime).max())
+    return {'max_abs_error': max_abs_error,
+            'max_rel_error': max_abs_error / max(float(np.abs(reference).max()), np.finfo(np.float32).tiny),
+            'within_tolerance': bool(np.allclose(runtime, reference, rtol=RTOL, atol=ATOL))}
+
+
+def network_spec(name, state_dict, n_actions_list=None) -> dict:
+    """
+    Manifest entry of one state dict, the kind of network being inferred from its parameters.
+    """
+    if not state_dict:
+        return {'kind': 'VDN'}
+    if 'hyper_W1.weight' in state_dict and 'V.0.weight' in state_dict:
+        n_state_dim = state_dict['hyper_W2.weight'].shape[1]
+        n_embedding_dim = state_dict['hyper_W2.weight'].shape[0]
+        return {'kind': 'QMixerRevised', 'n_state_dim': n_state_dim, 'n_embedding_dim': n_embedding_dim,
+                'n_agents': state_dict['hyper_W1.weight'].shape[0] // n_embedding_dim}
+    if 'rnn.weight_ih' in state_dict:
+        spec = {'input_shape': state_dict['fc1.weight'].shape[1], 'n_hidden_dim': state_dict['fc1.weight'].shape[0],
+                'n_actions': state_dict['fc2.weight'].shape[0]}
+        if name == 'centralized_agent_params':
+            n_actions_list = list(n_actions_list or [N_ACTIONS[a] for a in AGENTS])
+            return {'kind': 'CentralizedRNNAgent', 'n_actions_list': n_actions_list, **spec}
+        return {'kind': 'RNNAgent', 'agent': name[len('agent_'):-len('_params')], **spec}
+    raise ValueError(f"Cannot export {name}: only RNNAgent, CentralizedRNNAgent, QMixerRevised and VDN are supported.")
+
+
+def torch_network(spec, state_dict):
+    # The torch module of a manifest entry, to check the export against.
+    from algorithms.mixer.QMIX import CentralizedRNNAgent, QMixerRevised, RNNAgent, VDN
+
+    kind = spec['kind']
+    if kind == 'RNNAgent':
+        net = RNNAgent(spec['input_shape'], spec['n_hidden_dim'], spec['n_actions'])
+    elif kind == 'CentralizedRNNAgent':
+        net = CentralizedRNNAgent(spec['input_shape'], spec['n_hidden_dim'], spec['n_actions_list'])
+    elif kind == 'QMixerRevised':
+        net = QMixerRevised(spec['n_state_dim'], spec['n_agents'], spec['n_embedding_dim'], 'cpu')
+    else:
+        net = VDN()
+    net.load_state_dict(state_dict)
+    return net.eval()
+
+
+@torch.no_grad()
+def check_export(spec, state_dict, network, batch_size=64, seed=0) -> dict:
+    """
+    Returns:
+        dict: Comparison of the torch and runtime outputs over random inputs and hidden states (see compare_outputs).
+    """
+    rng = np.random.default_rng(seed)
+    net = torch_network(spec, state_dict)
+    if spec['kind'] in ('RNNAgent', 'CentralizedRNNAgent'):
+        inputs = rng.uniform(-0.5, 1.5, size=(batch_size, spec['input_shape'])).astype(np.float32)
+        hiddens = rng.uniform(-1.0, 1.0, size=(batch_size, spec['n_hidden_dim'])).astype(np.float32)
+        q, h = net(torch.from_numpy(inputs), torch.from_numpy(hiddens))
+        q_runtime, h_runtime = network(inputs, hiddens)
+        # Q-values and hidden states compared separately, each relative to its own magnitude.
+        q_errors, h_errors = compare_outputs(q.numpy(), q_runtime), compare_outputs(h.numpy(), h_runtime)
+        return {'max_abs_error': max(q_errors['max_abs_error'], h_errors['max_abs_error']),
+                'max_rel_error': max(q_errors['max_rel_error'], h_errors['max_rel_error']),
+                'within_tolerance': q_errors['within_tolerance'] and h_errors['within_tolerance']}
+    if spec['kind'] == 'QMixerRevised':
+        agent_qs = rng.normal(size=(batch_size, spec['n_agents'])).astype(np.float32)
+        states = rng.uniform(0.0, 1.0, size=(batch_size, spec['n_state_dim'])).astype(np.float32)
+        q_total = net(torch.from_numpy(agent_qs), torch.from_numpy(states)).numpy()
+        return compare_outputs(q_total, network(agent_qs, states))
+    return {'max_abs_error': 0.0, 'max_rel_error': 0.0, 'within_tolerance': True}
+
+
+def export_checkpoint(parameters_path, output_path, n_actions_list=None, check=True) -> dict:
+    """
+    Export a checkpoint to a weight file.
+
+    Args:
+        parameters_path (str): Parameter directory (save_model_parameters) or packed checkpoint file.
+        output_path (str): Path of the .npz weight file.
+        n_actions_list (list): Action sizes of the agents of a CentralizedRNNAgent (N_ACTIONS order if None).
+        check (bool): Compare the runtime with torch, and raise ValueError beyond RTOL / ATOL.
+
+    Returns:
+        dict: Manifest of the weight file.
+    """
+    parameters = load_state_dicts(parameters_path, map_location=torch.device('cpu'))
+    manifest = {'format': FORMAT_VERSION, 'source': os.path.abspath(parameters_path), 'agents': list(AGENTS),
+                'checkpoint_hash': RolloutCache.checkpoint_hash(parameters), 'networks': {}}
+    arrays = {}
+    for name in sorted(parameters):
+        spec = network_spec(name, parameters[name], n_actions_list)
+        manifest['networks'][name] = spec
+        for key, tensor in parameters[name].items():
+            arrays[f'{name}/{key}'] = tensor.detach().cpu().numpy().astype(np.float32)
+
+    if check:
+        for name, spec in manifest['networks'].items():
+            weights = {key.split('/', 1)[1]: array for key, array in arrays.items() if key.split('/', 1)[0] == name}
+            errors = check_export(spec, parameters[name], build_network(spec, weights))
+            if not errors['within_tolerance']:
+                raise ValueError(f"Runtime forward of {name} differs from torch by {errors['max_abs_error']:.3g} "
+                                 f"(relative {errors['max_rel_error']:.3g}, tolerance rtol={RTOL}, atol={ATOL}).")
+            spec['max_abs_error'] = errors['max_abs_error']
+            spec['max_rel_error'] = errors['max_rel_error']
+
+    # Written with a file object, so that np.savez does not append '.npz' to the temporary name.
+    temporary_path = output_path + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        np.savez(file, **arrays, **{MANIFEST_KEY: np.array(json.dumps(manifest))})
+    os.replace(temporary_path, output_path)
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a checkpoint to the NumPy weight file of deployment/runtime.py')
+    parser.add_argument('parameters', type=str, help='Parameter directory or packed checkpoint file')
+    parser.add_argument('--output', type=str, required=True, help='Path of the .npz weight file')
+    parser.add_argument('--n_actions_list', type=int, nargs='+', default=None,
+                        help='Action sizes of the agents of a centralized agent network')
+    parser.add_argument('--no_check', action='store_true', help='Skip the comparison with the torch forward')
+    args = parser.parse_args()
+
+    manifest = export_checkpoint(args.parameters, args.output, n_actions_list=args.n_actions_list, check=not args.no_check)
+    for name, spec in manifest['networks'].items():
+        errors = f" (max abs error {spec['max_abs_error']:.2e}, max rel error {spec['max_rel_error']:.2e})" if 'max_abs_error' in spec else ''
+        print(f"{name}: {spec['kind']}" + errors)
+    print(f"Saved to {args.output}")
@@ -0,0 +1,324 @@
+"""
+ NumPy-only inference runtime of the trained networks, for the control loop at the plant.
+
+ Reads the weight files written by deployment/export.py and reproduces the forward of RNNAgent and CentralizedRNNAgent
+(Linear-ReLU-GRUCell-Linear) and of the mixers (QMixerRevised, VDN), with the action masking and greedy selection of the
+evaluation. Only numpy and the observation bounds are imported (no torch, Julia or PettingZoo), so that the runtime loads
+in milliseconds and a decision of the three agents takes about a hundred microseconds on one CPU core.
+
+ Usage:
+    policy = load_policy('vdn_49000.npz')
+    policy.reset()
+    actions = policy.act(observations)      # {agent: {'observation': raw observation, 'action_mask': mask}}
+"""
+import json
+
+import numpy as np
+
+from TwoStageROProcessEnvironment.env.observation_bounds import AGENTS, observation_bounds
+
+
+FORMAT_VERSION = 1
+MANIFEST_KEY = '__manifest__'
+
+
+def _sigmoid(x):
+    # Same value as 1 / (1 + exp(-x)), without overflow for large negative x.
+    return 0.5 * (1.0 + np.tanh(0.5 * x))
+
+
+def _elu(x):
+    return np.where(x > 0, x, np.expm1(np.minimum(x, 0)))
+
+
+class RNNAgentRuntime:
+    """Forward of RNNAgent (and of the recurrent core of CentralizedRNNAgent) with numpy."""
+    def __init__(self, weights: dict):
+        """
+        Args:
+            weights (dict): State dict of the network as numpy arrays (keys of RNNAgent.state_dict()).
+        """
+        # Weights are transposed once, so that every layer is one `x @ W + b`.
+        self.fc1_weight = np.ascontiguousarray(weights['fc1.weight'].T, dtype=np.float32)
+        self.fc1_bias = np.asarray(weights['fc1.bias'], dtype=np.float32)
+        self.rnn_weight_ih = np.ascontiguousarray(weights['rnn.weight_ih'].T, dtype=np.float32)
+        self.rnn_weight_hh = np.ascontiguousarray(weights['rnn.weight_hh'].T, dtype=np.float32)
+        self.rnn_bias_ih = np.asarray(weights['rnn.bias_ih'], dtype=np.float32)
+        self.rnn_bias_hh = np.asarray(weights['rnn.bias_hh'], dtype=np.float32)
+        self.fc2_weight = np.ascontiguousarray(weights['fc2.weight'].T, dtype=np.float32)
+        self.fc2_bias = np.asarray(weights['fc2.bias'], dtype=np.float32)
+        self.input_shape = self.fc1_weight.shape[0]
+        self.n_hidden_dim = self.fc1_weight.shape[1]
+        self.n_actions = self.fc2_weight.shape[1]
+
+    def init_hidden(self, batch_size=1) -> np.ndarray:
+        return np.zeros((batch_size, self.n_hidden_dim), dtype=np.float32)
+
+    def forward(self, inputs, hidden_state):
+        """
+        Args:
+            inputs (np.ndarray): Scaled observations of shape (input_shape,) or (batch_size, input_shape).
+            hidden_state (np.ndarray): Hidden states with batch_size x n_hidden_dim values.
+
+        Returns:
+            tuple: Q-values of shape (..., n_actions) and the next hidden states of shape (..., n_hidden_dim).
+        """
+        inputs = np.asarray(inputs, dtype=np.float32)
+        h_in = np.asarray(hidden_state, dtype=np.float32)
+        if h_in.shape != inputs.shape[:-1] + (self.n_hidden_dim,):
+            h_in = h_in.reshape(inputs.shape[:-1] + (self.n_hidden_dim,))
+        x = np.maximum(inputs @ self.fc1_weight + self.fc1_bias, 0)
+
+        # GRUCell, with the gate order of torch (reset, update, new). Reset and update gates share one sigmoid.
+        H = self.n_hidden_dim
+        gi = x @ self.rnn_weight_ih + self.rnn_bias_ih
+        gh = h_in @ self.rnn_weight_hh + self.rnn_bias_hh
+        gates = _sigmoid(gi[..., :2 * H] + gh[..., :2 * H])
+        r, z = gates[..., :H], gates[..., H:]
+        n = np.tanh(gi[..., 2 * H:] + r * gh[..., 2 * H:])
+        h = n + z * (h_in - n)
+
+        q = h @ self.fc2_weight + self.fc2_bias
+        return q, h
+
+    __call__ = forward
+
+
+class CentralizedRNNAgentRuntime(RNNAgentRuntime):
+    """Forward of CentralizedRNNAgent: the joint Q-values are reshaped to (batch_size, n_actions_agent1, ...)."""
+    def __init__(self, weights: dict, n_actions_list):
+        super().__init__(weights)
+        self.n_actions_list = [int(n) for n in n_actions_list]
+        if int(np.prod(self.n_actions_list)) != self.n_actions:
+            raise ValueError(f"n_actions_list {self.n_actions_list} does not match the {self.n_actions} joint actions of the network.")
+
+    def forward(self, inputs, hidden_state):
+        q, h = super().forward(np.asarray(inputs, dtype=np.float32).reshape(-1, self.input_shape), hidden_state)
+        return q.reshape(-1, *self.n_actions_list), h
+
+    __call__ = forward
+
+
+class QMixerRevisedRuntime:
+    """Forward of QMixerRevised with numpy."""
+    def __init__(self, weights: dict, n_agents):
+        self.hyper_W1_weight = np.ascontiguousarray(weights['hyper_W1.weight'].T, dtype=np.float32)
+        self.hyper_W1_bias = np.asarray(weights['hyper_W1.bias'], dtype=np.float32)
+        self.hyper_W2_weight = np.ascontiguousarray(weights['hyper_W2.weight'].T, dtype=np.float32)
+        self.hyper_W2_bias = np.asarray(weights['hyper_W2.bias'], dtype=np.float32)
+        self.hyper_b1_weight = np.ascontiguousarray(weights['hyper_b1.weight'].T, dtype=np.float32)
+        self.hyper_b1_bias = np.asarray(weights['hyper_b1.bias'], dtype=np.float32)
+        self.V0_weight = np.ascontiguousarray(weights['V.0.weight'].T, dtype=np.float32)
+        self.V0_bias = np.asarray(weights['V.0.bias'], dtype=np.float32)
+        self.V2_weight = np.ascontiguousarray(weights['V.2.weight'].T, dtype=np.float32)
+        self.V2_bias = np.asarray(weights['V.2.bias'], dtype=np.float32)
+        self.n_agents = int(n_agents)
+        self.n_state_dim = self.hyper_W2_weight.shape[0]
+        self.n_embedding_dim = self.hyper_W2_weight.shape[1]
+
+    def forward(self, agent_qs, state) -> np.ndarray:
+        """
+        Args:
+            agent_qs (np.ndarray): Q-values of the chosen actions, of shape (batch_size, n_agents).
+            state (np.ndarray): Normalized states (TwoStageROProcessEnvironment.state()), of shape (batch_size, n_state_dim).
+
+        Returns:
+            np.ndarray: Q_total of shape (batch_size, 1).
+        """
+        agent_qs = np.asarray(agent_qs, dtype=np.float32).reshape(-1, 1, self.n_agents)
+        state = np.asarray(state, dtype=np.float32).reshape(-1, self.n_state_dim)
+        w1 = np.abs(state @ self.hyper_W1_weight + self.hyper_W1_bias).reshape(-1, self.n_agents, self.n_embedding_dim)
+        b1 = (state @ self.hyper_b1_weight + self.hyper_b1_bias).reshape(-1, 1, self.n_embedding_dim)
+        hidden = _elu(agent_qs @ w1 + b1)
+        w2 = np.abs(state @ self.hyper_W2_weight + self.hyper_W2_bias).reshape(-1, self.n_embedding_dim, 1)
+        v = (np.maximum(state @ self.V0_weight + self.V0_bias, 0) @ self.V2_weight + self.V2_bias).reshape(-1, 1, 1)
+        return (hidden @ w2 + v).reshape(agent_qs.shape[0], -1)
+
+    __call__ = forward
+
+
+class VDNRuntime:
+    """VDN: Q_total is the sum of the agent Qs."""
+    def forward(self, agent_qs, state=None) -> np.ndarray:
+        return np.sum(np.asarray(agent_qs, dtype=np.float32), axis=-1, keepdims=True)
+
+    __call__ = forward
+
+
+def greedy(q, action_mask) -> np.ndarray:
+    """
+    Greedy action among the valid actions for each row (same selection as utils.epsilon_greedy.batched_greedy).
+
+    Args:
+        q (np.ndarray): Q-values of shape (..., n_actions).
+        action_mask (np.ndarray): Action masks of shape (..., n_actions), nonzero marking a valid action.
+
+    Returns:
+        np.ndarray: Selected actions of shape (...).
+    """
+    masked = np.where(np.asarray(action_mask) != 0, q, -np.inf)
+    actions = np.argmax(masked, axis=-1)
+    if np.isneginf(np.max(masked, axis=-1)).any():
+        raise ValueError("No valid actions available.")
+    return actions
+
+
+def joint_mask(action_masks) -> np.ndarray:
+    """
+    Mask of the joint actions, valid if every agent's action is valid.
+
+    Args:
+        action_masks (list): Action mask of each agent, of shape (n_actions,) or (batch_size, n_actions).
+
+    Returns:
+        np.ndarray: Joint mask of shape ([batch_size,] n_actions_agent1, n_actions_agent2, ...).
+    """
+    masks = [np.asarray(m) != 0 for m in action_masks]
+    batch_shape = np.broadcast_shapes(*(m.shape[:-1] for m in masks))
+    mask = np.ones(batch_shape + tuple(m.shape[-1] for m in masks), dtype=bool)
+    for i, m in enumerate(masks):
+        mask = mask & m.reshape(m.shape[:-1] + (1,) * i + (-1,) + (1,) * (len(masks) - i - 1))
+    return mask
+
+
+def centralized_greedy(q, action_masks) -> np.ndarray:
+    """
+    Greedy joint action (centralized_mask_and_nothing, then get_action_from_q).
+
+    Args:
+        q (np.ndarray): Joint Q-values of shape (batch_size, n_actions_agent1, ...).
+        action_masks (list): Action mask of each agent, in the order of the joint action axes, shared by the batch
+                             (n_actions,) or per row (batch_size, n_actions).
+
+    Returns:
+        np.ndarray: Actions of shape (batch_size, n_agents).
+    """
+    masked = np.where(joint_mask(action_masks), q, -np.inf).reshape(q.shape[0], -1)
+    if np.isneginf(masked.max(axis=1)).any():
+        raise ValueError("No valid actions available.")
+    return np.stack(np.unravel_index(masked.argmax(axis=1), q.shape[1:]), axis=-1)
+
+
+class DecentralizedPolicy:
+    """
+    Greedy policy of the agent networks (RNNAgent), keeping their hidden states between decisions. The mixer is only
+    needed for Q_total (e.g. monitoring), not for acting.
+    """
+    def __init__(self, agent_nets: dict, mixer=None, bounds=None, manifest=None):
+        """
+        Args:
+            agent_nets (dict): RNNAgentRuntime of each agent, in the order of the mixer inputs.
+            mixer (QMixerRevisedRuntime | VDNRuntime): Mixing network.
+            bounds (dict): Observation bounds of the agents (observation_bounds() if None).
+            manifest (dict): Manifest of the weight file.
+        """
+        self.agent_nets = agent_nets
+        self.agents = list(agent_nets)
+        self.n_actions = {a: net.n_actions for a, net in agent_nets.items()}
+        self.mixer = mixer
+        self.manifest = manifest or {}
+        bounds = observation_bounds() if bounds is None else bounds
+        self.bounds = {a: (low.astype(np.float32), (high - low).astype(np.float32)) for a, (low, high) in bounds.items()}
+        self.reset()
+
+    def reset(self):
+        """Zero hidden states, at the start of an episode."""
+        self.hidden = {a: self.agent_nets[a].init_hidden() for a in self.agents}
+        self.last_q = {}
+
+    def scale(self, agent, observation) -> np.ndarray:
+        low, span = self.bounds[agent]
+        return (np.asarray(observation, dtype=np.float32) - low) / span
+
+    def act(self, observations: dict) -> dict:
+        """
+        Args:
+            observations (dict): {agent: {'observation': raw observation, 'action_mask': mask}}, as returned by the
+                                 environment.
+
+        Returns:
+            dict: Greedy action of each agent.
+        """
+        actions = {}
+        for a in self.agents:
+            q, self.hidden[a] = self.agent_nets[a](self.scale(a, observations[a]['observation']), self.hidden[a])
+            actions[a] = int(greedy(q, observations[a]['action_mask']))
+            self.last_q[a] = q
+        return actions
+
+    def q_total(self, actions: dict, state) -> float:
+        """Q_total of the actions of the last decision, at the normalized state of that decision."""
+        agent_qs = np.array([[self.last_q[a].reshape(-1)[actions[a]] for a in self.agents]], dtype=np.float32)
+        return float(self.mixer(agent_qs, state)[0, 0])
+
+
+class CentralizedPolicy:
+    """Greedy policy of the centralized agent network (CentralizedRNNAgent), fed with the normalized state."""
+    def __init__(self, agent_net: CentralizedRNNAgentRuntime, agents, manifest=None):
+        self.agent_net = agent_net
+        self.agents = list(agents)
+        self.n_actions = dict(zip(self.agents, agent_net.n_actions_list))
+        self.manifest = manifest or {}
+        self.reset()
+
+    def reset(self):
+        self.hidden = self.agent_net.init_hidden()
+        self.last_q = None
+
+    def act(self, observations: dict, state) -> dict:
+        """
+        Args:
+            observations (dict): {agent: {'action_mask': mask, ...}}, as returned by the environment.
+            state (np.ndarray): Normalized state (TwoStageROProcessEnvironment.state()).
+
+        Returns:
+            dict: Greedy action of each agent.
+        """
+        q, self.hidden = self.agent_net(state, self.hidden)
+        joint_action = centralized_greedy(q, [observations[a]['action_mask'] for a in self.agents])[0]
+        self.last_q = q
+        return {a: int(joint_action[i]) for i, a in enumerate(self.agents)}
+
+
+def load_weights(path):
+    """
+    Returns:
+        tuple: Manifest (dict) and weights ({network: {parameter: np.ndarray}}) of a weight file.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        manifest = json.loads(str(data[MANIFEST_KEY]))
+        if manifest.get('format') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported weight file format {manifest.get('format')} of {path} (expected {FORMAT_VERSION}).")
+        weights = {network: {} for network in manifest['networks']}
+        for key in data.files:
+            if key != MANIFEST_KEY:
+                network, parameter = key.split('/', 1)
+                weights[network][parameter] = data[key]
+    return manifest, weights
+
+
+def build_network(spec: dict, weights: dict):
+    """Runtime network of one manifest entry."""
+    kind = spec['kind']
+    if kind == 'RNNAgent':
+        return RNNAgentRuntime(weights)
+    if kind == 'CentralizedRNNAgent':
+        return CentralizedRNNAgentRuntime(weights, spec['n_actions_list'])
+    if kind == 'QMixerRevised':
+        return QMixerRevisedRuntime(weights, spec['n_agents'])
+    if kind == 'VDN':
+        return VDNRuntime()
+    raise ValueError(f"Unknown network kind {kind}.")
+
+
+def load_policy(path, bounds=None):
+    """
+    Greedy policy of a weight file: CentralizedPolicy if it holds a CentralizedRNNAgent, else DecentralizedPolicy.
+    """
+    manifest, weights = load_weights(path)
+    networks = {name: build_network(spec, weights[name]) for name, spec in manifest['networks'].items()}
+    agents = manifest.get('agents', AGENTS)
+    if 'centralized_agent_params' in networks:
+        return CentralizedPolicy(networks['centralized_agent_params'], agents, manifest=manifest)
+    agent_nets = {a: networks[f'agent_{a}_params'] for a in agents}
+    return DecentralizedPolicy(agent_nets, mixer=networks.get('mixer_params'), bounds=bounds, manifest=manifest)
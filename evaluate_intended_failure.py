@@ -1,5 +1,10 @@
 import os
+import sys
 os.chdir("/home/ybang-eai/research/2024/ROMARL/ROMARL")
+# Julia threads are fixed when juliacall is first imported (by the environment): start them here for --julia_rollout.
+from utils.julia_rollout import JuliaRollout, configure_julia_threads, sample_feed_scenarios, episode_summaries
+if '--julia_rollout' in sys.argv:
+    configure_julia_threads()
 from TwoStageROProcessEnvironment.env.PressureControlledTwoStageROProcess_simple import TwoStageROProcessEnvironment
 from algorithms.mixer.QMIX import QMixer, VDN, ReplayBuffer, PrioritizedExperienceReplay, RNNAgent, CentralizedRNNAgent, mask_and_softmax, softmax_and_mask, mask_and_nothing, centralized_mask_and_nothing
 import numpy as np
@@ -13,6 +18,11 @@ from datetime import datetime
 import argparse
 from tqdm import tqdm
 import pickle as pkl
+from utils.checkpoint import load_packed, CheckpointIndex
+from utils.sweep import SweepEngine, expand_grid, aggregate, job_seed
+from utils.trace_store import ScenarioTrace, TraceWriter, trace_store_path
+from utils.rollout_cache import RolloutCache
+from utils.monte_carlo import RunningStats, ConfidenceStopping
 
 def load_model_parameters(mixer, agent_nets, directory):
     """
@@ -21,8 +31,16 @@ def load_model_parameters(mixer, agent_nets, directory):
     Args:
         mixer (torch.nn.Module): The mixing network to which parameters will be loaded.
         agent_nets (dict): Dictionary of agent networks to which parameters will be loaded.
-        directory (str): The directory from where the model parameters should be loaded.
+        directory (str): The directory from where the model parameters should be loaded, or a packed checkpoint file
+                         written by utils.checkpoint.CheckpointStore.
     """
+    if os.path.isfile(directory):
+        packed = load_packed(directory)
+        mixer.load_state_dict(packed['mixer_params'])
+        for agent_id, agent in agent_nets.items():
+            agent.load_state_dict(packed[f'agent_{agent_id}_params'])
+        return
+
     # Load mixer parameters
     mixer_state_dict = torch.load(os.path.join(directory, 'mixer_params.pt'))
     mixer.load_state_dict(mixer_state_dict)
@@ -33,53 +51,31 @@ def load_model_parameters(mixer, agent_nets, directory):
         agent.load_state_dict(agent_state_dict)
 
 
-def load_parameters_at_intervals_sequential(root_path: str, interval: int, device, start_index: int = 0, window = None) -> dict:
+def load_parameters_at_intervals_sequential(root_path: str, interval: int, device, start_index: int = 0, window = None, cache_size: int = 8) -> dict:
     """
-    Loads .pt parameters from directories at specified intervals sequentially.
+    Select the checkpoints at specified intervals. Parameters are loaded lazily (on access) through a CheckpointIndex,
+    with the last `cache_size` loaded checkpoints kept in memory.
 
     Parameters:
-    - root_path (str): The path to the "parameters" directory.
+    - root_path (str): The path to the "parameters" directory (or to the "checkpoints" directory of a CheckpointStore).
     - interval (int): The interval at which to load parameters (e.g., every 10 steps).
 
     Returns:
-    - dict: A dictionary where keys are training steps and values are dictionaries of parameters.
+    - Mapping: Keys are training steps and values are dictionaries of parameters (loaded when accessed).
     """
-    root_path = os.path.abspath(root_path)
-    parameters_dict = {}
-
-    # List all directories in the root path
-    step_dirs = [d for d in os.listdir(root_path) if d.isdigit()]
-
-    # Sort directories numerically
-    step_dirs.sort(key=int)
+    index = CheckpointIndex(root_path, cache_size=cache_size)
+    steps = index.steps()
 
     if window is not None:
-        step_dirs = step_dirs[:window]
-
-    # Iterate over directories at specified intervals
-    for step in tqdm(range(start_index, len(step_dirs)-1, interval)):
-        step_dir_name = step_dirs[step]
-        step_dir_path = os.path.join(root_path, step_dir_name)
-
-        # List all .pt files in the directory
-        pt_files = [os.path.join(step_dir_path, f) for f in os.listdir(step_dir_path) if f.endswith('.pt')]
+        steps = steps[:window]
 
-        # Initialize a dictionary to hold parameters for this step
-        step_parameters = {}
-
-        # Load each .pt file sequentially
-        for file_path in pt_files:
-            parameter_name = os.path.splitext(os.path.basename(file_path))[0]
-            parameter_data = torch.load(file_path, map_location=torch.device(device))
-            step_parameters[parameter_name] = parameter_data
-
-        # Store in the parameters dictionary
-        parameters_dict[int(step_dir_name)] = step_parameters
-
-    return parameters_dict
+    # The last step is skipped, as it may still be being written.
+    selected_steps = [steps[i] for i in range(start_index, len(steps)-1, interval)]
+    return index.lazy(selected_steps, map_location=torch.device(device))
 
 def generate_distributed_control_scenario(agents, max_control_timestep, test_type, hindered_agent = None, period=None, seed=None):
-    distributed_scenario = dict.fromkeys(agents, np.ones(max_control_timestep))
+    # One array per agent: with a shared array, hindering one agent would hinder all of them.
+    distributed_scenario = {a: np.ones(max_control_timestep) for a in agents}
 
     def hinder_one_all(distributed_scenario, hindered_agent):
         if hindered_agent is not None:
@@ -119,24 +115,572 @@ def read_state_dict(agent_networks, parameters_dictionary):
     for a in agent_networks.keys():
         agent_networks[a].load_state_dict(parameters_dictionary[f"agent_{a}_params"])
 
-def main(alg_name, exp_path):
-    save_dir = os.path.join('/home/ybang-eai/research/2024/ROMARL/ROMARL/evaluation', alg_name, datetime.now().strftime("%y.%m.%d.%H.%M"))
+# Settings shared by the evaluation scenarios.
+EVALUATION_SETTINGS = {
+    'days': 120.0,
+    'dt': 60.0 * 6,
+    'reward_weight': [0.5, 0.5],
+    'production_term': False,
+}
 
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
 
-    render_mode = 'silent'
-    print("Environment setup ...")
-    env = TwoStageROProcessEnvironment(render_mode=render_mode, len_scenario=None, save_dir=save_dir)
-    print("Environment setup done.")
+def run_hinder_one_all(env, agent_nets, device, episode, agent_hindered, feed_concentration, trace=None, settings=EVALUATION_SETTINGS,
+                       cache=None, checkpoint_hash=None):
+    """
+    Run one HinderOneAll scenario: greedy control from `feed_concentration` with `agent_hindered` forced to No-Op
+    (nobody if None). The scaled observations, hidden states, agent Qs, actions, rewards and states of every step are
+    recorded in `trace` (utils.trace_store.ScenarioTrace) for the explainability analysis.
+
+    Returns:
+        dict: The evaluation log row of the scenario, or None if the process became invalid before the episode end.
+    """
+    hindered_scenario   = generate_distributed_control_scenario(agents=env.agents, max_control_timestep=env.max_control_timestep+1, test_type='HinderOneAll', hindered_agent=agent_hindered)
+    summary = run_timeline(env, agent_nets, device, hindered_scenario, feed_concentration, trace=trace, settings=settings,
+                           cache=cache, checkpoint_hash=checkpoint_hash)
+    if summary is None:
+        return None
+    evaluation_log_dict = {
+            'episode number': episode,
+            'Reward sum': summary['Reward sum'],
+            'mean concentration': summary['mean concentration'],
+            'feed concentration': feed_concentration,
+            'agent_hindered': agent_hindered,
+            'hinder_type': 'HinderOneAll',
+            'converged': summary['converged']
+    }
+    return evaluation_log_dict
+
+
+def run_hinder_one_all_julia(env, parameters, episode, agents_to_hinder, feed_concentrations, settings=EVALUATION_SETTINGS) -> list:
+    """
+    Run the HinderOneAll scenarios of one checkpoint entirely in Julia (utils/julia_rollout.py), on the Julia threads:
+    every (hindered agent, feed concentration) scenario in one batch. No trace is recorded.
+
+    Returns:
+        list[dict]: Per scenario: its hindered agent and feed concentration, and its evaluation log row (None if the
+                    process became invalid), as evaluate_job.
+    """
+    rollout = JuliaRollout(parameters, agents=env.agents, control_interval=env.control_interval, max_control_timestep=env.max_control_timestep)
+    scenarios = [(agent_hindered, float(feed_concentration)) for agent_hindered in agents_to_hinder for feed_concentration in feed_concentrations]
+    len_scenario = int(24 * settings['days'] * 60.0 / settings['dt']) + 1
+    feed_scenarios = sample_feed_scenarios(env, [feed_concentration for _, feed_concentration in scenarios], len_scenario)
+    timelines = [generate_distributed_control_scenario(agents=env.agents, max_control_timestep=env.max_control_timestep+1, test_type='HinderOneAll', hindered_agent=agent_hindered)
+                 for agent_hindered, _ in scenarios]
+    results = rollout.run(feed_scenarios, timelines, reward_weight=settings['reward_weight'], production_term=settings['production_term'])
+
+    outcomes = []
+    for (agent_hindered, feed_concentration), summary in zip(scenarios, episode_summaries(results)):
+        row = None if summary is None else {
+            'episode number': episode,
+            'Reward sum': summary['Reward sum'],
+            'mean concentration': summary['mean concentration'],
+            'feed concentration': feed_concentration,
+            'agent_hindered': agent_hindered,
+            'hinder_type': 'HinderOneAll',
+            'converged': summary['converged']
+        }
+        outcomes.append({'agent_hindered': agent_hindered, 'feed_concentration': feed_concentration, 'row': row})
+    return outcomes
+
+
+def _episode_summary(env, truncated):
+    return {
+        'Reward sum': copy(env.reward_sum_log[-1]),
+        'mean concentration': np.mean(env.operational_var_1st_stage['C']) if truncated else 0,
+        'converged': True if truncated else None,
+        'mean SEC': np.mean(env.ro_total_SEC_log),
+        # Mean total permeate flowrate, as in the production term of the reward.
+        'mean production': np.mean([permeate['Q'] for permeate in env.permeate_total_log]),
+    }
+
 
+def run_timeline(env, agent_nets, device, timeline, feed_concentration, trace=None, settings=EVALUATION_SETTINGS, cache=None, checkpoint_hash=None):
+    """
+    Greedy control of one episode from `feed_concentration`, with the agents hindered (forced to No-Op) where their
+    `timeline` is False. Steps are recorded in `trace` (utils.trace_store.ScenarioTrace) if given.
+
+    With a cache (utils.rollout_cache.RolloutCache), the steps of the action prefix already simulated for this checkpoint
+    (`checkpoint_hash`) and feed scenario are read from the cache: the agent forwards still run (they decide the actions),
+    but the process model does not. Where the actions branch off the cached prefix, the environment is restored from the
+    deepest cached snapshot and simulated from there, and the new steps are added to the cache. The environment is not
+    advanced past the reset when the whole episode comes from the cache.
+
+    Returns:
+        dict: 'Reward sum', 'mean concentration', 'converged', 'mean SEC' and 'mean production' of the episode, or None
+              if the process became invalid before the episode end.
+    """
     agents = env.agents
-    n_agents = len(agents)
+    action_controller   = DistributedActionController(timeline)
+
+    # 1. Reset the environment. (The feed scenario is sampled here: it is part of the cache key.)
+    initial_action = {"influent_flowrate": 1000.0, "1st_stage_pump": 10.0, "2nd_stage_pump":0.5}
+    previous_observations, _ = env.reset(hard=False, len_scenario=int(24 * settings['days'] * 60.0 / settings['dt'])+1, initial_action=initial_action, feed_concentration=feed_concentration, reward_ws=settings['reward_weight'], production_term=settings['production_term'])
+    # previous_observations = env.scale_observation(previous_observations)
+    agent_hiddens = {a: agent_nets[a].init_hidden() for a in agents}
+    previous_state = env.previous_state
+
+    simulating = cache is None
+    if cache is not None:
+        key = cache.root_key(checkpoint_hash, cache.scenario_hash(env.feed_scenario, dict(settings, control_dt=env.control_dt, n_segments=env.n_segments)))
+        # Deepest cached snapshot passed so far (None: the environment as reset), and the actions taken since.
+        resume_snapshot = None
+        resume_actions = []
+        branch_step = None
+
+    for step in range(1, env.max_control_timestep):
+        # 2. Using the observation from the last timestep, decide which action to take.
+        previous_observations_scaled = env.scale_observation(previous_observations)
+
+        # 2.0. Keep the hiddens fed to the networks. (For explainability analysis)
+        previous_hiddens = dict(agent_hiddens)
+
+        # 2.1. Estimate action-value function with agent networks and observation.
+        agent_qs = {}
+        with torch.no_grad():
+            for a in agents:
+                q, h = agent_nets[a](torch.from_numpy(previous_observations_scaled[a]['observation']).to(device), agent_hiddens[a])
+                q = mask_and_nothing(action_mask=previous_observations_scaled[a]['action_mask'], Q=q)
+
+                agent_qs[a] = q
+                agent_hiddens[a] = h
+
+        # greedy_action_policy overwrites the masked Qs in place: record them as the networks gave them.
+        recorded_qs = {a: agent_qs[a].clone() for a in agents} if trace is not None else None
+
+        # 2.2. Decide actions to take with the hindered greedy policy.
+        actions = action_controller.take_action(agent_qs, {a: previous_observations_scaled[a]['action_mask'] for a in agents})
+
+        # 2.3. Read the step from the cache, or take STEP on the environment with the decided actions.
+        entry = None
+        if cache is not None:
+            key = cache.child_key(key, [actions[a] for a in agents])
+            entry = None if simulating else cache.get(key)
+            if entry is not None and 'snapshot' in entry:
+                resume_snapshot, resume_actions = entry['snapshot'], []
+            elif entry is not None:
+                resume_actions.append(actions)
+            elif not simulating:
+                # Branch point: continue from the deepest cached snapshot, replaying the cached steps taken since.
+                if resume_snapshot is not None:
+                    env.restore(resume_snapshot)
+                for cached_actions in resume_actions:
+                    env.step(actions=cached_actions, terminate_if_diverge=True)
+                simulating = True
+                branch_step = step
+
+        if entry is None:
+            observations, rewards, truncated, terminated, _, transition = env.step(actions=actions, terminate_if_diverge=True)
+            done = any(terminated[a] or truncated[a] for a in agents)
+            entry = {
+                'observations': deepcopy(observations),
+                'reward': env.reward_total,
+                'state': env.previous_state,
+                'truncated': any(truncated.values()),
+                'done': done,
+                'valid': env.process_valid,
+                'summary': _episode_summary(env, any(truncated.values())) if (done and env.process_valid) else None,
+            }
+            if cache is not None:
+                if step == branch_step or step % cache.snapshot_interval == 0 or done or not env.process_valid:
+                    entry['snapshot'] = env.snapshot()
+                cache.put(key, entry)
+                entry.pop('snapshot', None)
+
+        # 2.4. Record the step. (For explainability analysis)
+        if trace is not None:
+            trace.record(step, previous_observations_scaled, previous_hiddens, recorded_qs, actions, entry['reward'], previous_state)
+
+        if not entry['valid']:
+            return None
+
+        previous_observations = deepcopy(entry['observations'])
+        previous_state = entry['state']
+
+        if entry['done']:
+            if trace is not None:
+                trace.completed = True
+            return entry['summary']
+    return None
+
+
+def _batched_agent_forward(agent_net, inputs, hiddens):
+    # RNNAgent squeezes the hidden state: a batch of one row is run unbatched.
+    if inputs.shape[0] == 1:
+        q, h = agent_net(inputs[0], hiddens[0])
+        return q.reshape(1, -1), h.reshape(1, -1)
+    return agent_net(inputs, hiddens)
+
+
+def run_hinder_one_all_lockstep(env, agent_nets, device, episode, scenarios, traces=None, settings=EVALUATION_SETTINGS):
+    """
+    Run N HinderOneAll scenarios in lockstep (see run_timelines_lockstep). Same results and traces as calling
+    run_hinder_one_all for each scenario, up to the random feed noise drawn in a different order.
+
+    Args:
+        env (TwoStageROProcessEnvironment): Environment whose Julia runtime is shared by the N scenarios.
+        scenarios (list[tuple]): (agent_hindered, feed_concentration) of each scenario.
+        traces (list[ScenarioTrace]): Recorder of each scenario (optional).
+
+    Returns:
+        list: Evaluation log row (or None if the process became invalid) of each scenario.
+    """
+    timelines = [generate_distributed_control_scenario(agents=env.agents, max_control_timestep=env.max_control_timestep+1, test_type='HinderOneAll', hindered_agent=agent_hindered)
+                 for agent_hindered, _ in scenarios]
+    summaries = run_timelines_lockstep(env, agent_nets, device, timelines, [feed_concentration for _, feed_concentration in scenarios],
+                                       traces=traces, settings=settings)
+    rows = []
+    for (agent_hindered, feed_concentration), summary in zip(scenarios, summaries):
+        if summary is None:
+            rows.append(None)
+            continue
+        rows.append({
+            'episode number': episode,
+            'Reward sum': summary['Reward sum'],
+            'mean concentration': summary['mean concentration'],
+            'feed concentration': feed_concentration,
+            'agent_hindered': agent_hindered,
+            'hinder_type': 'HinderOneAll',
+            'converged': summary['converged']
+        })
+    return rows
+
+
+def run_timelines_lockstep(env, agent_nets, device, timelines, feed_concentrations, traces=None, settings=EVALUATION_SETTINGS, seeds=None):
+    """
+    Run N episodes in lockstep: at every control step, the observations and hidden states of the episodes still running
+    are stacked into (N_alive, ·) tensors and each agent network runs one forward for all of them. Hindering (the
+    `timelines`, as in run_timeline) is applied as a batched mask (DistributedActionController.take_action_batched).
+    Episodes ending early (process invalid, divergence) are dropped from the batch through an alive-mask.
+
+    Args:
+        env (TwoStageROProcessEnvironment): Environment whose Julia runtime is shared by the N episodes.
+        timelines (list[dict]): Hindering timeline of each episode.
+        feed_concentrations (list[float]): Feed concentration of each episode.
+        traces (list[ScenarioTrace]): Recorder of each episode (optional).
+        seeds (list[int]): Seed of the numpy global generator before each reset, i.e. of the sampled feed scenario
+                           (optional).
 
-    device = 'cuda:0'
+    Returns:
+        list: Summary of each episode (see run_timeline), or None if the process became invalid.
+    """
+    agents = env.agents
+    n_scenarios = len(timelines)
+    # reset() rebinds every state attribute, so shallow copies are independent environments sharing the Julia runtime.
+    envs = [env] + [copy(env) for _ in range(n_scenarios - 1)]
+
+    action_controller = DistributedActionController({a: np.stack([timeline[a] for timeline in timelines]) for a in agents})
+    summaries = [None] * n_scenarios
+
+    # 2.0. Reset environments and store observations.
+    initial_action = {"influent_flowrate": 1000.0, "1st_stage_pump": 10.0, "2nd_stage_pump":0.5}
+    previous_observations = []
+    for i, (e, feed_concentration) in enumerate(zip(envs, feed_concentrations)):
+        if seeds is not None:
+            np.random.seed(seeds[i] % 2**32)
+        previous_observations.append(e.reset(hard=False, len_scenario=int(24 * settings['days'] * 60.0 / settings['dt'])+1, initial_action=initial_action, feed_concentration=feed_concentration, reward_ws=settings['reward_weight'], production_term=settings['production_term'])[0])
+    alive = np.ones(n_scenarios, dtype=bool)
+    agent_hiddens = {a: agent_nets[a].init_hidden().repeat(n_scenarios, 1) for a in agents}
+    # Last action masks of every episode. Rows of finished episodes are only used to keep the batch shape.
+    action_masks = {a: np.stack([o[a]['action_mask'] for o in previous_observations]) for a in agents}
+
+    for step in range(1, env.max_control_timestep):
+        if not alive.any():
+            break
+        alive_index = np.flatnonzero(alive)
+        previous_observations_scaled = {i: envs[i].scale_observation(previous_observations[i]) for i in alive_index}
+
+        # 2.1.0. Keep the hiddens fed to the networks. (For explainability analysis)
+        previous_hiddens = dict(agent_hiddens)
+
+        # 2.1.1. One forward per agent for every alive episode.
+        agent_qs = {}
+        alive_rows = torch.from_numpy(alive_index).to(device)
+        with torch.no_grad():
+            for a in agents:
+                inputs = torch.from_numpy(np.stack([previous_observations_scaled[i][a]['observation'] for i in alive_index])).to(device)
+                action_masks[a][alive_index] = np.stack([previous_observations_scaled[i][a]['action_mask'] for i in alive_index])
+                q_alive, h_alive = _batched_agent_forward(agent_nets[a], inputs, agent_hiddens[a][alive_rows])
+                agent_hiddens[a] = agent_hiddens[a].index_copy(0, alive_rows, h_alive)
+                q = torch.zeros(n_scenarios, q_alive.shape[-1], device=q_alive.device)
+                q[alive_rows] = q_alive
+                agent_qs[a] = q.masked_fill(torch.as_tensor(action_masks[a], device=q.device) == 0, -torch.inf)
+
+        # 2.1.2. Greedy actions with the batched hinder mask (the controller advances for every row).
+        actions = action_controller.take_action_batched(agent_qs, action_masks)
+
+        # 2.1.3. Step the alive environments.
+        for i in alive_index:
+            e = envs[i]
+            previous_state = e.previous_state
+            scenario_actions = {a: int(actions[a][i]) for a in agents}
+            observations, rewards, truncated, terminated, _, transition = e.step(actions=scenario_actions, terminate_if_diverge=True)
+
+            # 2.1.4. Record the step. (For explainability analysis)
+            if traces is not None:
+                traces[i].record(step, previous_observations_scaled[i], {a: previous_hiddens[a][i] for a in agents},
+                                 {a: agent_qs[a][i] for a in agents}, scenario_actions, e.reward_total, previous_state)
+
+            if not e.process_valid:
+                alive[i] = False
+                continue
+
+            previous_observations[i] = deepcopy(observations)
+
+            if any(terminated[a] or truncated[a] for a in agents):
+                summaries[i] = _episode_summary(e, any(truncated.values()))
+                if traces is not None:
+                    traces[i].completed = True
+                alive[i] = False
+    return summaries
+
+
+def init_evaluation_worker(worker_id, save_dir, parameters_path, device, rollout_cache_dir=None, snapshot_interval=24):
+    """
+    Per-worker state of the evaluation sweep (utils.sweep.SweepEngine): one environment (and Julia runtime) and one set
+    of agent networks, kept for every scenario the worker runs. Checkpoints are loaded when a job needs another one.
+    With `rollout_cache_dir`, the worker reads and extends the rollout cache of that directory (shared by the workers).
+    """
+    env = TwoStageROProcessEnvironment(render_mode='silent', len_scenario=None, save_dir=save_dir)
     agent_nets = {
-        a: RNNAgent(input_shape=env.observation_space(a).shape[0], n_hidden_dim=64, n_actions=env.action_space(a).n).to(device) for a in agents
+        a: RNNAgent(input_shape=env.observation_space(a).shape[0], n_hidden_dim=64, n_actions=env.action_space(a).n).to(device) for a in env.agents
     }
+    # The index was refreshed by the main process. Workers only read it.
+    index = CheckpointIndex(parameters_path, cache_size=2, refresh=False)
+    cache = RolloutCache(rollout_cache_dir, snapshot_interval=snapshot_interval) if rollout_cache_dir is not None else None
+    return {'env': env, 'agent_nets': agent_nets, 'index': index, 'device': device, 'loaded': None, 'cache': cache, 'checkpoint_hash': None}
+
+
+def _load_checkpoint(state, episode):
+    if state['loaded'] == episode:
+        return
+    parameters = state['index'].load(episode, map_location=torch.device(state['device']))
+    read_state_dict(state['agent_nets'], parameters)
+    state['loaded'] = episode
+    if state['cache'] is not None:
+        state['checkpoint_hash'] = RolloutCache.checkpoint_hash({f"agent_{a}_params": parameters[f"agent_{a}_params"] for a in state['env'].agents})
+
+
+def evaluate_job(state, params, seed):
+    """
+    Returns:
+        list[dict]: Per scenario of the job: its hindered agent and feed concentration, its evaluation log row (None if
+                    the process became invalid) and its ScenarioTrace, written to the trace store by the main process.
+    """
+    env = state['env']
+    _load_checkpoint(state, params['episode'])
+    feed_concentrations = params['feed_concentrations'] if 'feed_concentrations' in params else [params['feed_concentration']]
+    scenarios = [(params['agent_hindered'], feed_concentration) for feed_concentration in feed_concentrations]
+    traces = [ScenarioTrace(env.agents, max_steps=env.max_control_timestep) for _ in scenarios]
+    if 'feed_concentrations' in params:
+        rows = run_hinder_one_all_lockstep(env, state['agent_nets'], state['device'], params['episode'], scenarios, traces=traces)
+    else:
+        rows = [run_hinder_one_all(env, state['agent_nets'], state['device'], params['episode'], params['agent_hindered'],
+                                   params['feed_concentration'], trace=traces[0], cache=state['cache'], checkpoint_hash=state['checkpoint_hash'])]
+        if state['cache'] is not None:
+            state['cache'].flush()
+    return [{'agent_hindered': agent_hindered, 'feed_concentration': feed_concentration, 'row': row, 'trace': trace}
+            for (agent_hindered, feed_concentration), row, trace in zip(scenarios, rows, traces)]
+
+
+# Outcomes of the HinderOneGivenPeriod episodes tracked by the adaptive Monte Carlo evaluation.
+MONTE_CARLO_METRICS = ('Reward sum', 'mean SEC', 'mean production')
+
+
+def evaluate_adaptive_job(state, params, seed):
+    """
+    Adaptive Monte Carlo evaluation of one (checkpoint, feed concentration, period) configuration: HinderOneGivenPeriod
+    episodes are run in lockstep batches of `batch` replicates until the confidence intervals of MONTE_CARLO_METRICS are
+    narrower than the target (utils.monte_carlo.ConfidenceStopping), or the replicate budget is spent.
+
+    Replicate r of a configuration draws its hindering timeline and feed scenario from a seed that depends on the feed
+    concentration, the period and r, but not on the checkpoint: checkpoints are compared on common random numbers.
+
+    Returns:
+        dict: 'summary' (the running statistics of the configuration) and 'replicates' (one row per episode run).
+    """
+    env = state['env']
+    _load_checkpoint(state, params['episode'])
+    stopping = ConfidenceStopping(relative=params['relative'], confidence=params['confidence'],
+                                  min_replicates=params['min_replicates'], max_replicates=params['max_replicates'])
+    running = RunningStats(MONTE_CARLO_METRICS)
+    replicates = []
+    while not stopping.done(running, len(replicates)):
+        indices = range(len(replicates), min(len(replicates) + params['batch'], stopping.max_replicates))
+        seeds = [job_seed(params['crn_seed'], {'feed_concentration': params['feed_concentration'], 'period': params['period'], 'replicate': r})
+                 for r in indices]
+        timelines = []
+        for replicate_seed in seeds:
+            np.random.seed(replicate_seed % 2**32)
+            timelines.append(generate_distributed_control_scenario(agents=env.agents, max_control_timestep=env.max_control_timestep+1,
+                                                                   test_type='HinderOneGivenPeriod', period=params['period']))
+        # The feed scenarios are seeded with the seed of the replicate as well (shifted, not to reuse the timeline draws).
+        summaries = run_timelines_lockstep(env, state['agent_nets'], state['device'], timelines, [params['feed_concentration']] * len(seeds),
+                                           seeds=[replicate_seed + 1 for replicate_seed in seeds])
+        for r, replicate_seed, summary in zip(indices, seeds, summaries):
+            row = {'episode number': params['episode'], 'feed concentration': params['feed_concentration'], 'period': params['period'],
+                   'replicate': r, 'seed': replicate_seed, 'valid': summary is not None}
+            if summary is not None:
+                running.update(summary)
+                row.update({metric: summary[metric] for metric in MONTE_CARLO_METRICS})
+            replicates.append(row)
+
+    summary = {'episode number': params['episode'], 'feed concentration': params['feed_concentration'], 'period': params['period'],
+               'episodes run': len(replicates), 'invalid episodes': sum(not row['valid'] for row in replicates),
+               'ci converged': stopping.converged(running)}
+    summary.update(running.summary(stopping.confidence))
+    return {'summary': summary, 'replicates': replicates}
+
+
+def run_adaptive_evaluation(save_dir, parameters_path, device, episodes, n_workers=1, seed=0, feed_concentrations=(300.0, 500.0, 700.0),
+                            periods=(4,), relative=0.02, confidence=0.95, batch=8, min_replicates=16, max_replicates=256):
+    """
+    Adaptive Monte Carlo HinderOneGivenPeriod evaluation of every (checkpoint, feed concentration, period) configuration
+    (see evaluate_adaptive_job). Writes HinderOneGivenPeriod/adaptive_summary.csv (one row per configuration) and
+    HinderOneGivenPeriod/adaptive_replicates.csv (one row per episode, with its seed, for paired comparisons).
+    """
+    jobs = expand_grid(root_seed=seed, episode=episodes, feed_concentration=[float(c) for c in feed_concentrations], period=list(periods),
+                       crn_seed=[seed], relative=[relative], confidence=[confidence], batch=[batch], min_replicates=[min_replicates],
+                       max_replicates=[max_replicates])
+    engine = SweepEngine(init_evaluation_worker, evaluate_adaptive_job, n_workers=n_workers, initializer_args=(save_dir, parameters_path, device))
+    results = engine.run(jobs, description='HinderOneGivenPeriod (adaptive)')
+
+    summaries = [result.value['summary'] for result in results if result.ok]
+    replicates = [row for result in results if result.ok for row in result.value['replicates']]
+    pd.DataFrame(summaries).to_csv(os.path.join(save_dir, 'HinderOneGivenPeriod', 'adaptive_summary.csv'))
+    pd.DataFrame(replicates).to_csv(os.path.join(save_dir, 'HinderOneGivenPeriod', 'adaptive_replicates.csv'))
+
+    episodes_run = sum(summary['episodes run'] for summary in summaries)
+    print(f"Adaptive evaluation: {episodes_run} episodes for {len(summaries)} configurations "
+          f"({episodes_run / max(1, len(summaries) * max_replicates):.0%} of the fixed budget of {max_replicates} replicates), "
+          f"{sum(not summary['ci converged'] for summary in summaries)} configuration(s) stopped by the budget.")
+    failed = [result for result in results if not result.ok]
+    if failed:
+        print(f"{len(failed)} configuration(s) failed after retries: {[result.job.params for result in failed]}")
+    return summaries
+
+
+def spread_order(values) -> list:
+    """
+    Order of `values` whose every prefix is spread over their range: the median first, then repeatedly the value
+    farthest from the ones already taken. Prefixes are nested, so a larger subset contains the smaller ones.
+    """
+    values = np.asarray(values, dtype=float)
+    order = [int(np.argsort(values)[len(values) // 2])]
+    distance = np.abs(values - values[order[0]])
+    while len(order) < len(values):
+        index = int(np.argmax(distance))
+        order.append(index)
+        distance = np.minimum(distance, np.abs(values - values[index]))
+    return [values[i].item() for i in order]
+
+
+def evaluate_tournament_job(state, params, seed):
+    """HinderOneAll scenario of the checkpoint tournament: same jobs (and seeds) as the HinderOneAll sweep, without trace."""
+    env = state['env']
+    _load_checkpoint(state, params['episode'])
+    row = run_hinder_one_all(env, state['agent_nets'], state['device'], params['episode'], params['agent_hindered'], params['feed_concentration'],
+                             cache=state['cache'], checkpoint_hash=state['checkpoint_hash'])
+    if state['cache'] is not None:
+        state['cache'].flush()
+    return row
+
+
+def run_tournament(save_dir, parameters_path, device, checkpoints, feed_concentrations, n_workers=1, seed=0, initial_scenarios=5,
+                   growth=2.0, discard=0.5, top_k=1, rollout_cache_dir=None, snapshot_interval=24):
+    """
+    Successive-halving selection of the best checkpoint. Every round evaluates the surviving checkpoints on a subset of
+    the feed concentrations (HinderOneAll, nobody hindered), ranks them and discards the bottom `discard` fraction. The
+    subset starts with `initial_scenarios` concentrations spread over the grid and grows by `growth` each round, until
+    `top_k` checkpoints remain or the subset is the whole grid.
+
+    Subsets are nested, so the scenarios of the previous rounds are not run again. Checkpoints are ranked by the fraction
+    of scenarios ending with a valid process, then by the mean reward sum of the valid ones. Writes
+    Tournament/ranking.csv (one row per checkpoint), Tournament/rounds.csv (one row per checkpoint and round) and
+    Tournament/report.md.
+
+    Returns:
+        list: Steps of the remaining checkpoints, best first.
+    """
+    tournament_dir = os.path.join(save_dir, 'Tournament')
+    os.makedirs(tournament_dir, exist_ok=True)
+    order = spread_order(feed_concentrations)
+    rows = {}               # (checkpoint, feed concentration) -> evaluation log row (None if the process became invalid)
+    survivors = list(checkpoints)
+    eliminated = {}         # checkpoint -> round in which it was discarded
+    round_records = []
+    n_scenarios = min(initial_scenarios, len(order))
+    round_index = 0
+    # One worker pool (and one environment per worker) for all the rounds.
+    engine = SweepEngine(init_evaluation_worker, evaluate_tournament_job, n_workers=n_workers,
+                         initializer_args=(save_dir, parameters_path, device, rollout_cache_dir, snapshot_interval))
+    with engine:
+        while True:
+            subset = order[:n_scenarios]
+            new_jobs = [job for job in expand_grid(root_seed=seed, episode=survivors, agent_hindered=[None], feed_concentration=subset)
+                        if (job.params['episode'], job.params['feed_concentration']) not in rows]
+            for result in engine.run(new_jobs, description=f'Tournament round {round_index} ({len(survivors)} checkpoints, {n_scenarios} scenarios)'):
+                # A failed job (after retries) counts as an invalid process.
+                rows[(result.job.params['episode'], result.job.params['feed_concentration'])] = result.value if result.ok else None
+
+            scores = {}
+            for checkpoint in survivors:
+                rewards = [rows[(checkpoint, c)]['Reward sum'] for c in subset if rows[(checkpoint, c)] is not None]
+                scores[checkpoint] = (len(rewards) / len(subset), np.mean(rewards) if rewards else -np.inf)
+            ranking = sorted(survivors, key=lambda checkpoint: scores[checkpoint], reverse=True)
+            for rank, checkpoint in enumerate(ranking):
+                round_records.append({'round': round_index, 'checkpoint': checkpoint, 'scenarios': n_scenarios, 'rank': rank + 1,
+                                      'valid fraction': scores[checkpoint][0], 'mean reward sum': scores[checkpoint][1]})
+
+            last_round = n_scenarios >= len(order)
+            n_keep = top_k if last_round else max(top_k, int(np.ceil(len(ranking) * (1.0 - discard))))
+            survivors = ranking[:n_keep]
+            for checkpoint in ranking[n_keep:]:
+                eliminated[checkpoint] = round_index
+            if last_round or n_keep <= top_k:
+                break
+            n_scenarios = min(len(order), int(np.ceil(n_scenarios * growth)))
+            round_index += 1
+
+    # Ranking: survivors first, then by elimination round (later is better) and rank in that round.
+    rounds = pd.DataFrame(round_records)
+    last = rounds.sort_values('round').groupby('checkpoint').tail(1).set_index('checkpoint')
+    ranking = sorted(checkpoints, key=lambda checkpoint: (checkpoint not in survivors, -last.loc[checkpoint, 'round'], last.loc[checkpoint, 'rank']))
+    ranking_table = pd.DataFrame([{
+        'rank': i + 1, 'checkpoint': checkpoint, 'survivor': checkpoint in survivors, 'eliminated in round': eliminated.get(checkpoint),
+        'scenarios evaluated': last.loc[checkpoint, 'scenarios'], 'valid fraction': last.loc[checkpoint, 'valid fraction'],
+        'mean reward sum': last.loc[checkpoint, 'mean reward sum'],
+    } for i, checkpoint in enumerate(ranking)])
+    ranking_table.to_csv(os.path.join(tournament_dir, 'ranking.csv'), index=False)
+    rounds.to_csv(os.path.join(tournament_dir, 'rounds.csv'), index=False)
+
+    full_budget = len(checkpoints) * len(order)
+    lines = ['# Checkpoint tournament', '',
+             f"{len(checkpoints)} checkpoints, {len(order)} feed concentrations, start with {initial_scenarios} scenarios, "
+             f"growth {growth}, discard {discard:.0%} per round, top {top_k}.", '',
+             f"Simulated scenarios: {len(rows)} of {full_budget} for the full grid ({len(rows) / full_budget:.1%}).", '',
+             '## Rounds', '', '| round | checkpoints | scenarios | best checkpoint | valid fraction | mean reward sum |', '|---|---|---|---|---|---|']
+    for round_index, group in rounds.groupby('round'):
+        best = group.sort_values('rank').iloc[0]
+        lines.append(f"| {round_index} | {len(group)} | {int(best['scenarios'])} | {int(best['checkpoint'])} | {best['valid fraction']:.2f} | {best['mean reward sum']:.2f} |")
+    lines += ['', '## Ranking', '', '| rank | checkpoint | eliminated in round | scenarios | valid fraction | mean reward sum |', '|---|---|---|---|---|---|']
+    for _, row in ranking_table.iterrows():
+        eliminated_in = '-' if row['survivor'] else int(row['eliminated in round'])
+        lines.append(f"| {row['rank']} | {row['checkpoint']} | {eliminated_in} | {row['scenarios evaluated']} | {row['valid fraction']:.2f} | {row['mean reward sum']:.2f} |")
+    with open(os.path.join(tournament_dir, 'report.md'), 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    print(f"Tournament winner(s): {survivors} ({len(rows)} of {full_budget} scenarios simulated)")
+    return survivors
+
+
+def main(alg_name, exp_path, n_workers=1, seed=0, lockstep=0, trace_compression='gzip', rollout_cache_dir=None, snapshot_interval=24,
+         adaptive=None, tournament=None, julia_rollout=False):
+    save_dir = os.path.join('/home/ybang-eai/research/2024/ROMARL/ROMARL/evaluation', alg_name, datetime.now().strftime("%y.%m.%d.%H.%M"))
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    # Workers evaluate on CPU: one process per core scales better than sharing one GPU for batch-1 forwards.
+    device = 'cuda:0' if n_workers == 1 and torch.cuda.is_available() else 'cpu'
 
     # Load experimental information
     episode_log_path    = os.path.join(exp_path, 'episode_log.csv')
@@ -153,101 +697,71 @@ def main(alg_name, exp_path):
         if not os.path.exists(os.path.join(save_dir, t_type)):
             os.makedirs(os.path.join(save_dir, t_type))
     
-    days = 120.0
-    dt   = 60.0 * 6
-    gamma = 0.99
-    reward_weight = [0.5, 0.5]
-    production_term = False
-    
+    # Checkpoint tournament: select the best checkpoint(s) by successive halving instead of evaluating the last one.
+    if tournament is not None:
+        candidates = list(load_parameters_at_intervals_sequential(root_path=parameters_path, interval=tournament.pop('interval', 1), device=device).keys())
+        run_tournament(save_dir, parameters_path, device, candidates, np.linspace(300.0, 700.0, 100), n_workers=n_workers, seed=seed,
+                       rollout_cache_dir=rollout_cache_dir, snapshot_interval=snapshot_interval, **tournament)
+        return
+
     # Only evaluate the last episode
-    episode = list(parameters_dict.keys())[-1]
-    parameters_dict = {episode: parameters_dict[episode]}
+    episodes_to_evaluate = [list(parameters_dict.keys())[-1]]
+    agents_to_hinder = [None]
 
     # HinderOneAll
     # Designed to evaluate the robustness in the presence of a single agent's failure. Used in the paper (Decentralized control evaluation + Data generation for SHAP analysis).
-    for episode in (parameters_dict.keys()):
-        read_state_dict(agent_nets, parameters_dict[episode])
-        agents_to_hinder = [None]
-        
-        for agent_hindered in agents_to_hinder:
-            hindered_scenario   = generate_distributed_control_scenario(agents=agents, max_control_timestep=env.max_control_timestep+1, test_type='HinderOneAll', hindered_agent=agent_hindered)
-            action_controller   = DistributedActionController(hindered_scenario)
-            evaluation_log      = pd.DataFrame(columns=['episode number', 'Reward sum', 'mean concentration', 'mean concentration', 'agent_hindered', 'hinder_type','converged'])
-            
-            for i, feed_concentration in tqdm(enumerate(np.linspace(300.0, 700.0, 100))):
-                evaluation_log_dict = {
-                        'episode number': episode,
-                        'Reward sum': 0,
-                        'mean concentration': 0,
-                        'agent_hindered': agent_hindered,
-                        'hinder_type': 'HinderOneAll',
-                        'converged': None
-                }
-                for step in range(env.max_control_timestep):
-                    # 1. Initialize agent Q (action-value) dictionary.
-                    agent_qs = {}
-
-                    # 2. Get the observation from the environment. RESET or STEP depending on the timestep.
-                    if step == 0:
-                        # 2.0. Reset environment and store observation.
-                        initial_action = {"influent_flowrate": 1000.0, "1st_stage_pump": 10.0, "2nd_stage_pump":0.5}
-                        previous_observations, _ = env.reset(hard=False, len_scenario=int(24 * days * 60.0 / dt)+1, initial_action=initial_action, feed_concentration=feed_concentration, reward_ws=reward_weight, production_term=production_term)
-                        # previous_observations = env.scale_observation(previous_observations)
-                        agent_hiddens = {a: agent_nets[a].init_hidden() for a in agents}
-                    else:
-                        # 2.1. Using the observation from the last timestep, decide which action to take.
-                        previous_observations_scaled = env.scale_observation(previous_observations)
-                        
-                        # 2.1.0. Save the previous observations and hiddens. (For explainability analysis)
-                        with open(os.path.join(save_dir, 'HinderOneAll', f'{episode}_{agent_hindered}_{feed_concentration}ppm_previous_observations_scaled_{step}.pkl'), 'wb') as f:
-                            pkl.dump(previous_observations_scaled, f)
-                        with open(os.path.join(save_dir, 'HinderOneAll', f'{episode}_{agent_hindered}_{feed_concentration}ppm_hiddens_{step}.pkl'), 'wb') as f:
-                            pkl.dump(agent_hiddens, f)
-                        
-                        # 2.1.1. Estimate action-value function with agent networks and observation.
-                        for a in agents:
-                            q, h = agent_nets[a](torch.from_numpy(previous_observations_scaled[a]['observation']).to(device), agent_hiddens[a])
-                            q = mask_and_nothing(action_mask=previous_observations_scaled[a]['action_mask'], Q=q)
-
-                            agent_qs[a] = q
-                            agent_hiddens[a] = h
-
-                        # 2.1.1.1 Save the agent Qs. (For explainability analysis)
-                        with open(os.path.join(save_dir, 'HinderOneAll', f'{episode}_{agent_hindered}_{feed_concentration}ppm_agent_qs_{step}.pkl'), 'wb') as f:
-                            pkl.dump(agent_qs, f)
-
-                        # 2.1.2. Decide actions to take with action policy (epsilon-greedy, Boltzmann, pure greedy).
-                        # actions = {
-                        #     a: policy(agent_qs[a], previous_observations_scaled[a]['action_mask']) for a in agents
-                        # }
-                        actions = action_controller.take_action(agent_qs, {a: previous_observations_scaled[a]['action_mask'] for a in agents})
-
-                        # 2.1.3. Take STEP on the environment with the decided actions.
-                        observations, rewards, truncated, terminated, _, transition = env.step(actions=actions, terminate_if_diverge=True)
-
-                        if not env.process_valid:
-                            break
-
-                        if any(truncated.values()):
-                            evaluation_log_dict['converged'] = True
-                            evaluation_log_dict['mean concentration'] = np.mean(env.operational_var_1st_stage['C'])
-
-                        previous_observations = deepcopy(observations)
-
-                        done = {a: terminated[a] or truncated[a] for a in agents}
-
-                        if any(done.values()):
-                            evaluation_log_dict['Reward sum'] = copy(env.reward_sum_log[-1])
-                            if i == 0:
-                                evaluation_log = pd.DataFrame([evaluation_log_dict])
-                            else:
-                                evaluation_log = pd.concat([evaluation_log, pd.DataFrame([evaluation_log_dict])], ignore_index=True)
-                            evaluation_log.to_csv(os.path.join(save_dir, 'HinderOneAll', f'{episode}_{agent_hindered}_hindered.csv'))
-                            action_controller.reset_action_count()
-                            break
+    # Every (checkpoint, hindered agent, feed concentration) scenario is an independent job of the sweep engine.
+    # With lockstep > 0, a job runs `lockstep` feed concentrations at once with batched agent forwards.
+    # With julia_rollout, the scenarios of a checkpoint run in Julia instead (utils/julia_rollout.py), without traces.
+    feed_concentrations = np.linspace(300.0, 700.0, 100)
+    if julia_rollout:
+        env = TwoStageROProcessEnvironment(render_mode='silent', len_scenario=None, save_dir=save_dir)
+        for episode in episodes_to_evaluate:
+            outcomes = run_hinder_one_all_julia(env, parameters_dict[episode], episode, agents_to_hinder, feed_concentrations)
+            for agent_hindered in agents_to_hinder:
+                rows = [outcome['row'] for outcome in outcomes if outcome['agent_hindered'] == agent_hindered and outcome['row'] is not None]
+                pd.DataFrame(rows).to_csv(os.path.join(save_dir, 'HinderOneAll', f'{episode}_{agent_hindered}_hindered.csv'))
+    else:
+        if lockstep > 0:
+            chunks = [tuple(float(c) for c in feed_concentrations[i:i + lockstep]) for i in range(0, len(feed_concentrations), lockstep)]
+            jobs = expand_grid(root_seed=seed, episode=episodes_to_evaluate, agent_hindered=agents_to_hinder, feed_concentrations=chunks)
+        else:
+            jobs = expand_grid(root_seed=seed, episode=episodes_to_evaluate, agent_hindered=agents_to_hinder,
+                               feed_concentration=feed_concentrations)
+
+        # Traces of every scenario go to one trace store (utils/trace_store.py), written here as the jobs finish.
+        trace_writer = TraceWriter(trace_store_path(save_dir, 'HinderOneAll'), n_scenarios=len(episodes_to_evaluate) * len(agents_to_hinder) * len(feed_concentrations),
+                                   compression=trace_compression)
+
+        def write_traces(result):
+            if not result.ok:
+                return
+            for scenario in result.value:
+                trace_writer.write_scenario(result.job.params['episode'], scenario['agent_hindered'], scenario['feed_concentration'], scenario['trace'])
+                scenario['trace'] = None    # Written, no need to keep it in memory.
+            trace_writer.flush()
+
+        engine = SweepEngine(init_evaluation_worker, evaluate_job, n_workers=n_workers, initializer_args=(save_dir, parameters_path, device, rollout_cache_dir, snapshot_interval))
+        try:
+            results = engine.run(jobs, on_result=write_traces, description='HinderOneAll')
+        finally:
+            trace_writer.close()
+
+        for (episode, agent_hindered), scenarios in aggregate(results, by=['episode', 'agent_hindered']).items():
+            rows = [scenario['row'] for job_scenarios in scenarios for scenario in job_scenarios if scenario['row'] is not None]
+            evaluation_log = pd.DataFrame(rows)
+            evaluation_log.to_csv(os.path.join(save_dir, 'HinderOneAll', f'{episode}_{agent_hindered}_hindered.csv'))
+        failed = [result for result in results if not result.ok]
+        if failed:
+            print(f"{len(failed)} scenario(s) failed after retries: {[result.job.params for result in failed]}")
 
     # HinderOneGivenPeriod
     # Designed to evaluate the robustness in the presence of a given period of random hindrance. Not used in the paper.
+    # With `adaptive` (keyword arguments of run_adaptive_evaluation), each configuration runs until its confidence
+    # intervals are narrow enough.
+    if adaptive is not None:
+        run_adaptive_evaluation(save_dir, parameters_path, device, episodes_to_evaluate, n_workers=n_workers, seed=seed, **adaptive)
+
     # for do_not_hinder in [False]:
     #     for episode in (parameters_dict.keys()):
     #         read_state_dict(agent_nets, parameters_dict[episode])
@@ -343,6 +857,36 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Set algorithm and experiment path')
     parser.add_argument('--algorithm', type=str, help='Name of the algorithm', required=True)
     parser.add_argument('--exp_path', type=str, help='Path to the experiment directory', required=True)
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes (one environment each) running the scenarios in parallel')
+    parser.add_argument('--seed', type=int, default=0, help='Root seed of the per-scenario seeds')
+    parser.add_argument('--lockstep', type=int, default=0, help='Scenarios advanced in lockstep with batched agent forwards per job (0: one scenario per job)')
+    parser.add_argument('--trace_compression', type=str, default='gzip', choices=['gzip', 'lzf', 'none'],
+                        help="Compression of the trace store ('none' makes it memory-mappable)")
+    parser.add_argument('--rollout_cache', type=str, default=None,
+                        help='Directory of the rollout cache, kept across runs (scenarios run one per job only; not used with --lockstep)')
+    parser.add_argument('--snapshot_interval', type=int, default=24, help='Control steps between two cached environment snapshots')
+    parser.add_argument('--adaptive', action='store_true', help='Run the adaptive Monte Carlo HinderOneGivenPeriod evaluation as well')
+    parser.add_argument('--ci_relative', type=float, default=0.02, help='Target confidence interval half width, relative to the mean')
+    parser.add_argument('--ci_confidence', type=float, default=0.95, help='Confidence level of the intervals')
+    parser.add_argument('--mc_batch', type=int, default=8, help='Replicates run in lockstep between two stopping checks')
+    parser.add_argument('--mc_min', type=int, default=16, help='Minimum replicates per configuration')
+    parser.add_argument('--mc_max', type=int, default=256, help='Maximum replicates per configuration')
+    parser.add_argument('--julia_rollout', action='store_true',
+                        help='Run the HinderOneAll scenarios in Julia, threaded across scenarios (no traces)')
+    parser.add_argument('--tournament', action='store_true', help='Select the best checkpoint by successive halving (instead of evaluating the last one)')
+    parser.add_argument('--tournament_interval', type=int, default=1, help='Candidate checkpoints: every N-th checkpoint')
+    parser.add_argument('--tournament_initial', type=int, default=5, help='Feed concentrations of the first round')
+    parser.add_argument('--tournament_growth', type=float, default=2.0, help='Growth of the scenario subset per round')
+    parser.add_argument('--tournament_discard', type=float, default=0.5, help='Fraction of the checkpoints discarded per round')
+    parser.add_argument('--tournament_top_k', type=int, default=1, help='Checkpoints remaining at the end of the tournament')
     args = parser.parse_args()
 
-    main(alg_name=args.algorithm, exp_path=args.exp_path)
\ No newline at end of file
+    adaptive = dict(relative=args.ci_relative, confidence=args.ci_confidence, batch=args.mc_batch, min_replicates=args.mc_min,
+                    max_replicates=args.mc_max) if args.adaptive else None
+    tournament = dict(interval=args.tournament_interval, initial_scenarios=args.tournament_initial, growth=args.tournament_growth,
+                      discard=args.tournament_discard, top_k=args.tournament_top_k) if args.tournament else None
+
+    main(alg_name=args.algorithm, exp_path=args.exp_path, n_workers=args.workers, seed=args.seed, lockstep=args.lockstep,
+         trace_compression=None if args.trace_compression == 'none' else args.trace_compression,
+         rollout_cache_dir=args.rollout_cache, snapshot_interval=args.snapshot_interval, adaptive=adaptive,
+         tournament=tournament, julia_rollout=args.julia_rollout)
\ No newline at end of file
@@ -0,0 +1,225 @@
+"""
+ Exact Shapley values of the agent networks (RNNAgent), replacing shap.KernelExplainer for the observation features.
+
+ The agents observe 6, 10 and 11 features, i.e. at most 2^11 = 2048 coalitions: instead of sampling coalitions
+(KernelSHAP), every coalition is evaluated. For a sample x with hidden state h, the value of a coalition S is the mean
+Q-values of the network fed with the features of S taken from x and the others from each background row:
+    v(S) = mean_b Q([x_S, b_~S], h)
+and the Shapley values of all features are one matrix product φ = W @ F, with F the (2^d, n_actions) coalition values and
+W the (d, 2^d) Shapley weights:
+    W[i, S] = (|S|-1)! (d-|S|)! / d!  if i in S
+            = -|S|! (d-|S|-1)! / d!   if i not in S
+ The hidden state is held fixed (the hidden state fed to the network at that step, as recorded in the trace store), so
+that the attributions are those of the current observation. The coalitions of a chunk of samples x background rows run as
+one batched forward. Attributions are exact and sum to Q(x, h) - v(∅) (the base value).
+"""
+import argparse
+import json
+import os
+from math import factorial
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+
+# Observation features of each agent, in the order of TwoStageROProcessEnvironment.
+OBSERVATION_FEATURES = {
+    'influent_flowrate': ['feed_flowrate', '1st_permeate_flowrate', '2nd_feed_flowrate', '2nd_permeate_flowrate', '2nd_brine_flowrate', 'temperature'],
+    '1st_stage_pump': ['temperature', 'feed_concentration', 'feed_flowrate', '1st_brine_concentration',
+                       '1st_brine_flowrate', '1st_permeate_concentration', '1st_permeate_flowrate', '1st_brine_pressure',
+                       '1st_pressure_applied', '1st_recovery'],
+    '2nd_stage_pump': ['temperature', '2nd_feed_concentration', '2nd_feed_flowrate', '1st_brine_pressure', '2nd_brine_concentration', '2nd_brine_flowrate',
+                       '2nd_permeate_concentration', '2nd_permeate_flowrate', '2nd_brine_pressure', '2nd_pressure_applied', '1st_recovery'],
+}
+
+
+def feature_names(agent, n_features) -> list:
+    """
+    Returns:
+        list: Names of the observation features of the agent (OBSERVATION_FEATURES), or 'feature_<i>' if the agent or
+              its number of features is not the one of TwoStageROProcessEnvironment.
+    """
+    names = OBSERVATION_FEATURES.get(agent)
+    if names is None or len(names) != n_features:
+        return [f'feature_{i}' for i in range(n_features)]
+    return list(names)
+
+
+def coalitions(n_features) -> np.ndarray:
+    """
+    Returns:
+        np.ndarray: (2^d, d) boolean membership of every coalition, coalition k holding the features of the bits of k.
+    """
+    return ((np.arange(2 ** n_features)[:, None] >> np.arange(n_features)[None, :]) & 1).astype(bool)
+
+
+def shapley_matrix(n_features) -> np.ndarray:
+    """
+    Returns:
+        np.ndarray: (d, 2^d) Shapley weights W, such that the Shapley values are W @ F for the coalition values F.
+    """
+    members = coalitions(n_features)
+    sizes = members.sum(axis=1)
+    d = n_features
+    weight = np.array([factorial(s) * factorial(d - s - 1) / factorial(d) for s in range(d)])
+    # Feature i in S: marginal contribution against S \ {i} (size |S|-1). Feature i not in S: S is the "without" term.
+    matrix = np.where(members.T, weight[np.maximum(sizes - 1, 0)][None, :], -weight[np.minimum(sizes, d - 1)][None, :])
+    return matrix
+
+
+class ExactShapleyExplainer:
+    """
+    Exact Shapley values of the Q-values of an RNNAgent with respect to its observation features, at fixed hidden state.
+
+    Usage:
+        explainer = ExactShapleyExplainer(agent_net, background_observations)
+        shap_values, base_values = explainer.shap_values(observations, hiddens)      # (n, d, n_actions), (n, n_actions)
+    """
+    def __init__(self, agent_net, background, device='cpu', max_batch_rows=2**18):
+        """
+        Args:
+            agent_net (RNNAgent): Agent network, in evaluation mode.
+            background (np.ndarray): (m, d) scaled observations replacing the features out of a coalition.
+            device (str): Device of the forwards.
+            max_batch_rows (int): Maximum rows of one batched forward (samples x coalitions x background rows).
+        """
+        self.agent_net = agent_net.to(device)
+        self.device = device
+        self.background = torch.as_tensor(np.asarray(background), dtype=torch.float32, device=device)
+        self.n_features = self.background.shape[1]
+        self.members = torch.as_tensor(coalitions(self.n_features), device=device)
+        self.weights = torch.as_tensor(shapley_matrix(self.n_features), dtype=torch.float32, device=device)
+        self.max_batch_rows = max_batch_rows
+
+    @property
+    def chunk_size(self) -> int:
+        """Samples explained per batched forward."""
+        return max(1, self.max_batch_rows // (self.members.shape[0] * self.background.shape[0]))
+
+    @torch.no_grad()
+    def coalition_values(self, observations, hiddens) -> torch.Tensor:
+        """
+        Returns:
+            torch.Tensor: (n, 2^d, n_actions) values v(S) of every coalition of every sample.
+        """
+        x = torch.as_tensor(np.asarray(observations), dtype=torch.float32, device=self.device)
+        h = torch.as_tensor(np.asarray(hiddens), dtype=torch.float32, device=self.device).reshape(x.shape[0], -1)
+        n, n_coalitions, n_background = x.shape[0], self.members.shape[0], self.background.shape[0]
+        # (n, 2^d, m, d): features of the coalition from the sample, the others from the background rows.
+        inputs = torch.where(self.members[None, :, None, :], x[:, None, None, :], self.background[None, None, :, :])
+
+        # RNNAgent forward (fc1, GRU cell, fc2), with the hidden-to-hidden term of the GRU computed once per sample (the
+        # hidden state is the same for all its coalitions), and fc2 applied after the background mean (fc2 is affine).
+        net = self.agent_net
+        hidden_dim = h.shape[-1]
+        x_embedded = F.relu(net.fc1(inputs))
+        gate_inputs = F.linear(x_embedded, net.rnn.weight_ih, net.rnn.bias_ih)
+        gate_hiddens = F.linear(h, net.rnn.weight_hh, net.rnn.bias_hh)[:, None, None, :]
+        reset = torch.sigmoid(gate_inputs[..., :hidden_dim] + gate_hiddens[..., :hidden_dim])
+        update = torch.sigmoid(gate_inputs[..., hidden_dim:2 * hidden_dim] + gate_hiddens[..., hidden_dim:2 * hidden_dim])
+        candidate = torch.tanh(gate_inputs[..., 2 * hidden_dim:] + reset * gate_hiddens[..., 2 * hidden_dim:])
+        h_next = (1 - update) * candidate + update * h[:, None, None, :]
+        return net.fc2(h_next.mean(dim=2))
+
+    def shap_values(self, observations, hiddens):
+        """
+        Args:
+            observations (np.ndarray): (n, d) scaled observations to explain.
+            hiddens (np.ndarray): (n, hidden dim) hidden states fed to the network with them.
+
+        Returns:
+            tuple: Shapley values (n, d, n_actions) and base values v(∅) (n, n_actions), as numpy arrays.
+        """
+        shap_values, base_values = [], []
+        for chunk_shap_values, chunk_base_values in self.iter_shap_values(observations, hiddens):
+            shap_values.append(chunk_shap_values)
+            base_values.append(chunk_base_values)
+        return np.concatenate(shap_values), np.concatenate(base_values)
+
+    def iter_shap_values(self, observations, hiddens):
+        """Shapley values and base values of successive chunks of samples (see shap_values), for large sample sets."""
+        for start in range(0, len(observations), self.chunk_size):
+            values = self.coalition_values(observations[start:start + self.chunk_size], hiddens[start:start + self.chunk_size])
+            shap_values = torch.einsum('ds,nsa->nda', self.weights, values)
+            yield shap_values.cpu().numpy(), values[:, 0].cpu().numpy()
+
+
+def explain_trace(reader, agent_net, agent, output_dir, n_background=64, rows=None, device='cpu', max_batch_rows=2**18, seed=0):
+    """
+    Exact Shapley values of every row of an evaluation trace store (utils.trace_store.TraceReader) for one agent,
+    streamed to <output_dir>/<agent>_shap_values.npy (n, d, n_actions) and <agent>_base_values.npy (n, n_actions). The
+    names of the d features (axis 1) are written to <agent>_features.json. The background is `n_background`
+    observations drawn from the explained rows.
+
+    Returns:
+        tuple: The two (memory-mapped) arrays.
+    """
+    observations = reader.field('observation', agent, rows=rows)
+    hiddens = reader.field('hidden', agent, rows=rows)
+    rng = np.random.default_rng(seed)
+    background = observations[np.sort(rng.choice(len(observations), size=min(n_background, len(observations)), replace=False))]
+    explainer = ExactShapleyExplainer(agent_net, background, device=device, max_batch_rows=max_batch_rows)
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, f'{agent}_features.json'), 'w') as file:
+        json.dump(feature_names(agent, explainer.n_features), file, indent=1)
+    n_actions = reader.field('q', agent, rows=slice(0, 1)).shape[-1]
+    shap_values = np.lib.format.open_memmap(os.path.join(output_dir, f'{agent}_shap_values.npy'), mode='w+', dtype=np.float32,
+                                            shape=(len(observations), explainer.n_features, n_actions))
+    base_values = np.lib.format.open_memmap(os.path.join(output_dir, f'{agent}_base_values.npy'), mode='w+', dtype=np.float32,
+                                            shape=(len(observations), n_actions))
+    start = 0
+    with tqdm(total=len(observations), desc=f'Exact Shapley values ({agent})') as progress:
+        for chunk_shap_values, chunk_base_values in explainer.iter_shap_values(observations, hiddens):
+            stop = start + len(chunk_shap_values)
+            shap_values[start:stop] = chunk_shap_values
+            base_values[start:stop] = chunk_base_values
+            start = stop
+            progress.update(len(chunk_shap_values))
+    shap_values.flush()
+    base_values.flush()
+    return shap_values, base_values
+
+
+def mean_absolute_attributions(shap_values, chunk_size=65536) -> np.ndarray:
+    """
+    Returns:
+        np.ndarray: (d,) mean |Shapley value| of each feature over the rows and actions, read `chunk_size` rows at a time.
+    """
+    total = np.zeros(shap_values.shape[1])
+    for start in range(0, len(shap_values), chunk_size):
+        total += np.abs(shap_values[start:start + chunk_size]).sum(axis=(0, 2))
+    return total / max(shap_values.shape[0] * shap_values.shape[2], 1)
+
+
+if __name__ == '__main__':
+    from algorithms.mixer.QMIX import RNNAgent
+    from utils.checkpoint import load_state_dicts
+    from utils.trace_store import TraceReader
+
+    parser = argparse.ArgumentParser(description='Exact Shapley values of the agent networks over an evaluation trace store')
+    parser.add_argument('traces', type=str, help='Trace store (traces.h5) written by evaluate_intended_failure.py')
+    parser.add_argument('checkpoint', type=str, help='Checkpoint of the traces (packed file or parameter directory)')
+    parser.add_argument('--output', type=str, required=True, help='Directory of the Shapley values')
+    parser.add_argument('--checkpoint_step', type=int, default=None, help='Only explain the scenarios of this checkpoint step')
+    parser.add_argument('--background', type=int, default=64, help='Background observations')
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    parameters = load_state_dicts(args.checkpoint, map_location=torch.device(args.device))
+    with TraceReader(args.traces) as reader:
+        rows = reader.scenario_rows(checkpoint=args.checkpoint_step, hindered_agent='*') if args.checkpoint_step is not None else None
+        for agent in reader.agents:
+            state_dict = parameters[f'agent_{agent}_params']
+            agent_net = RNNAgent(input_shape=state_dict['fc1.weight'].shape[1], n_hidden_dim=state_dict['fc1.weight'].shape[0],
+                                 n_actions=state_dict['fc2.weight'].shape[0])
+            agent_net.load_state_dict(state_dict)
+            agent_net.eval()
+            shap_values, _ = explain_trace(reader, agent_net, agent, args.output, n_background=args.background, rows=rows, device=args.device)
+
+            importance = mean_absolute_attributions(shap_values)
+            print(f"{agent}: mean |Shapley value| over {len(shap_values)} steps")
+            for name, value in sorted(zip(feature_names(agent, len(importance)), importance), key=lambda item: -item[1]):
+                print(f"    {name:<28} {value:.4f}")
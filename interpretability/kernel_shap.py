@@ -0,0 +1,249 @@
+"""
+ Parallel, resumable KernelSHAP of the mixing network (QMixerRevised) over the 15 state features, read from the trace
+store of an evaluation run (utils/trace_store.py) instead of per-step pickles.
+
+ The explained function of a sample is Q_tot(state) with the agent Qs held at the Qs of the actions the agents took at
+that step. The pipeline:
+    1. Summarizes the states of the checkpoint into a weighted k-means background, once: it is cached per checkpoint
+       (and source data) in the background cache directory.
+    2. Splits the explained samples into shards, run on a pool of worker processes (utils.sweep.SweepEngine, which
+       retries the shards of crashed workers).
+    3. Writes every shard to its own file as soon as it is done. A run restarted with the same settings only computes
+       the missing shards, then the shards are merged into state_shap_values.npy and base_values.npy.
+
+ shap is only imported where it is used, so that this module (and its background cache) can be imported without it.
+"""
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+from utils.checkpoint import load_state_dicts
+from utils.sweep import SweepEngine, SweepJob, job_seed
+from utils.trace_store import TraceReader
+
+
+# Features of TwoStageROProcessEnvironment.state(), in order.
+STATE_FEATURES = ['feed_flowrate', 'feed_concentration', 'temperature', 'HPP_pressure', 'IBP_pressure',
+                  '1st_brine_flowrate', '1st_brine_pressure', '1st_brine_concentration',
+                  '2nd_brine_flowrate', '2nd_brine_pressure', '2nd_brine_concentration',
+                  '1st_permeate_flowrate', '1st_permeate_concentration', '2nd_permeate_flowrate', '2nd_permeate_concentration']
+
+
+def _dense_data(data, weights):
+    try:
+        from shap.utils._legacy import DenseData
+    except ImportError:     # shap < 0.42
+        from shap.common import DenseData
+    return DenseData(data, [str(i) for i in range(data.shape[1])], None, np.array(weights, dtype=np.float64))
+
+
+def load_mixer(parameters, device='cpu'):
+    """QMixerRevised of a checkpoint (packed state dicts), with its dimensions read from the state dict."""
+    from algorithms.mixer.QMIX import QMixerRevised
+
+    state_dict = parameters['mixer_params']
+    n_embedding_dim, n_state_dim = state_dict['hyper_W2.weight'].shape
+    n_agents = state_dict['hyper_W1.weight'].shape[0] // n_embedding_dim
+    mixer = QMixerRevised(n_state_dim=n_state_dim, n_agents=n_agents, n_embedding_dim=n_embedding_dim, device=device).to(device)
+    mixer.load_state_dict(state_dict)
+    mixer.eval()
+    return mixer
+
+
+def chosen_agent_qs(reader, agents, rows) -> np.ndarray:
+    """
+    Returns:
+        np.ndarray: (n, n_agents) Q of the action each agent took at each row, the input of the mixer.
+    """
+    columns = []
+    for a in agents:
+        q = reader.field('q', a, rows=rows)
+        action = reader.field('action', a, rows=rows).astype(np.int64)
+        columns.append(np.take_along_axis(q, action[:, None], axis=1)[:, 0])
+    return np.stack(columns, axis=1).astype(np.float32)
+
+
+def kmeans_background(states, k, cache_dir, checkpoint) -> tuple:
+    """
+    Weighted k-means summary of the states (shap.kmeans), cached in `cache_dir` under the checkpoint, k and a digest of
+    the states, so that it is computed once per checkpoint whatever the number of runs or workers.
+
+    Returns:
+        tuple: Cluster centers (k, n_features) and their weights (k,).
+    """
+    digest = hashlib.sha256(np.ascontiguousarray(states).tobytes()).hexdigest()[:16]
+    path = os.path.join(cache_dir, f'background_{checkpoint}_k{k}_{digest}.npz')
+    if os.path.exists(path):
+        cached = np.load(path)
+        return cached['data'], cached['weights']
+
+    import shap
+
+    summary = shap.kmeans(states, k)
+    os.makedirs(cache_dir, exist_ok=True)
+    temporary_path = path + '.tmp.npz'
+    np.savez(temporary_path, data=summary.data, weights=summary.weights)
+    os.replace(temporary_path, path)
+    return summary.data, summary.weights
+
+
+class MixerFunction:
+    """Q_tot of a batch of states, with the agent Qs of the explained sample (set before explaining it)."""
+    def __init__(self, mixer, device='cpu'):
+        self.mixer = mixer
+        self.device = device
+        self.agent_qs = None
+
+    @torch.no_grad()
+    def __call__(self, states):
+        states = torch.as_tensor(np.asarray(states), dtype=torch.float32, device=self.device)
+        agent_qs = torch.as_tensor(self.agent_qs, device=self.device).reshape(1, -1).expand(states.shape[0], -1)
+        return self.mixer(agent_qs, states).reshape(-1).cpu().numpy()
+
+
+def init_shap_worker(worker_id, traces_path, checkpoint_path, background_path, output_dir, nsamples, device):
+    torch.set_num_threads(1)
+    reader = TraceReader(traces_path)
+    background = np.load(background_path)
+    mixer = load_mixer(load_state_dicts(checkpoint_path, map_location=torch.device(device)), device=device)
+    return {'reader': reader, 'function': MixerFunction(mixer, device=device), 'data': _dense_data(background['data'], background['weights']),
+            'rows': np.load(os.path.join(output_dir, 'rows.npy')), 'output_dir': output_dir, 'nsamples': nsamples}
+
+
+def explain_shard(state, params, seed):
+    """
+    KernelSHAP values of one shard of the explained rows, written to shards/shard_<index>.npz.
+
+    Returns:
+        str: Path of the shard file.
+    """
+    import shap
+
+    rows = state['rows'][params['start']:params['stop']]
+    reader = state['reader']
+    states = reader.field('state', rows=rows)
+    agent_qs = chosen_agent_qs(reader, reader.agents, rows)
+    function = state['function']
+    shap_values = np.empty(states.shape, dtype=np.float32)
+    base_values = np.empty(len(rows), dtype=np.float32)
+    for i in range(len(rows)):
+        # The base value depends on the agent Qs: one explainer per sample (its background forward is cheap).
+        function.agent_qs = agent_qs[i]
+        explainer = shap.KernelExplainer(function, state['data'])
+        shap_values[i] = np.asarray(explainer.shap_values(states[i:i + 1], nsamples=state['nsamples'], silent=True)).reshape(-1)
+        base_values[i] = np.asarray(explainer.expected_value).reshape(-1)[0]
+
+    path = shard_path(state['output_dir'], params['shard'])
+    temporary_path = path + '.tmp.npz'
+    np.savez(temporary_path, rows=rows, shap_values=shap_values, base_values=base_values)
+    os.replace(temporary_path, path)
+    return path
+
+
+def shard_path(output_dir, shard):
+    return os.path.join(output_dir, 'shards', f'shard_{shard:05d}.npz')
+
+
+def run_kernel_shap(traces_path, checkpoint_path, output_dir, checkpoint=None, n_samples=1000, k=50, shard_size=25, n_workers=1,
+                    nsamples='auto', background_cache=None, device='cpu', seed=0):
+    """
+    KernelSHAP values of the mixer state features for `n_samples` rows of a trace store (every row if None), drawn from
+    the scenarios of `checkpoint` (every scenario if None). Resumes the run of `output_dir` if its settings match.
+
+    Args:
+        traces_path (str): Trace store (traces.h5) of the evaluation run.
+        checkpoint_path (str): Checkpoint of the traces (packed file or parameter directory).
+        output_dir (str): Directory of the shards and merged results.
+        checkpoint (int): Checkpoint step of the scenarios to explain.
+        n_samples (int): Explained rows, drawn at random.
+        k (int): Clusters of the background summary.
+        shard_size (int): Rows per shard (the unit of work and of resumption).
+        n_workers (int): Worker processes.
+        nsamples (int | str): Coalitions sampled per explained row (KernelExplainer).
+        background_cache (str): Directory of the cached backgrounds (next to the trace store if None).
+
+    Returns:
+        tuple: SHAP values (n, n_features) and base values (n,), in the order of rows.npy.
+    """
+    os.makedirs(os.path.join(output_dir, 'shards'), exist_ok=True)
+    settings = {'traces': os.path.abspath(traces_path), 'checkpoint_path': os.path.abspath(checkpoint_path), 'checkpoint': checkpoint,
+                'n_samples': n_samples, 'k': k, 'shard_size': shard_size, 'nsamples': nsamples, 'seed': seed}
+    settings_path = os.path.join(output_dir, 'settings.json')
+    if os.path.exists(settings_path):
+        with open(settings_path) as file:
+            previous = json.load(file)
+        if previous != settings:
+            raise ValueError(f"{output_dir} holds a run with other settings ({previous}). Use another output directory.")
+    else:
+        with open(settings_path, 'w') as file:
+            json.dump(settings, file, indent=2)
+
+    # 1. Explained rows (drawn once, kept for the resumed runs) and background summary (cached per checkpoint).
+    rows_path = os.path.join(output_dir, 'rows.npy')
+    with TraceReader(traces_path) as reader:
+        if checkpoint is not None:
+            candidates = reader.scenario_rows(checkpoint=checkpoint, hindered_agent='*')
+        else:
+            candidates = np.arange(reader.n_rows)
+        if not os.path.exists(rows_path):
+            rng = np.random.default_rng(seed)
+            rows = candidates if n_samples is None or n_samples >= len(candidates) else np.sort(rng.choice(candidates, size=n_samples, replace=False))
+            np.save(rows_path, rows)
+        rows = np.load(rows_path)
+        states = reader.field('state', rows=candidates if checkpoint is not None else None)
+    cache_dir = background_cache or os.path.join(os.path.dirname(os.path.abspath(traces_path)), 'shap_background')
+    data, weights = kmeans_background(states, k, cache_dir, 'all' if checkpoint is None else checkpoint)
+    background_path = os.path.join(output_dir, 'background.npz')
+    np.savez(background_path, data=data, weights=weights)
+
+    # 2. Shards not written yet.
+    n_shards = int(np.ceil(len(rows) / shard_size))
+    jobs = []
+    for shard in range(n_shards):
+        if os.path.exists(shard_path(output_dir, shard)):
+            continue
+        params = {'shard': shard, 'start': shard * shard_size, 'stop': min(len(rows), (shard + 1) * shard_size)}
+        jobs.append(SweepJob(len(jobs), params, job_seed(seed, params)))
+    print(f"KernelSHAP: {n_shards - len(jobs)} of {n_shards} shard(s) already done.")
+    if jobs:
+        engine = SweepEngine(init_shap_worker, explain_shard, n_workers=n_workers,
+                             initializer_args=(traces_path, checkpoint_path, background_path, output_dir, nsamples, device))
+        results = engine.run(jobs, description='KernelSHAP shards')
+        failed = [result for result in results if not result.ok]
+        if failed:
+            raise RuntimeError(f"{len(failed)} shard(s) failed, run again to resume:\n{failed[0].error}")
+
+    # 3. Merge.
+    shap_values = np.empty((len(rows), data.shape[1]), dtype=np.float32)
+    base_values = np.empty(len(rows), dtype=np.float32)
+    for shard in range(n_shards):
+        written = np.load(shard_path(output_dir, shard))
+        shap_values[shard * shard_size:shard * shard_size + len(written['rows'])] = written['shap_values']
+        base_values[shard * shard_size:shard * shard_size + len(written['rows'])] = written['base_values']
+    np.save(os.path.join(output_dir, 'state_shap_values.npy'), shap_values)
+    np.save(os.path.join(output_dir, 'base_values.npy'), base_values)
+    return shap_values, base_values
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parallel, resumable KernelSHAP of the mixer state features over an evaluation trace store')
+    parser.add_argument('traces', type=str, help='Trace store (traces.h5) written by evaluate_intended_failure.py')
+    parser.add_argument('checkpoint', type=str, help='Checkpoint of the traces (packed file or parameter directory)')
+    parser.add_argument('--output', type=str, required=True, help='Directory of the shards and results (resumed if it exists)')
+    parser.add_argument('--checkpoint_step', type=int, default=None, help='Only explain the scenarios of this checkpoint step')
+    parser.add_argument('--samples', type=int, default=1000, help='Explained rows')
+    parser.add_argument('--k', type=int, default=50, help='Clusters of the background summary')
+    parser.add_argument('--shard_size', type=int, default=25)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--nsamples', type=str, default='auto', help="Coalitions sampled per row ('auto' or an integer)")
+    parser.add_argument('--background_cache', type=str, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    run_kernel_shap(args.traces, args.checkpoint, args.output, checkpoint=args.checkpoint_step, n_samples=args.samples, k=args.k,
+                    shard_size=args.shard_size, n_workers=args.workers, nsamples=args.nsamples if args.nsamples == 'auto' else int(args.nsamples),
+                    background_cache=args.background_cache, seed=args.seed)
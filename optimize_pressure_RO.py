@@ -1,13 +1,19 @@
 from TwoStageROProcessEnvironment.env.PressureControlledTwoStageROProcess_simple import TwoStageROProcessEnvironment
-from algorithms.mixer.QMIX import QMixer, QMixerRevised, VDN, ReplayBuffer, PrioritizedExperienceReplay, RNNAgent, mask_and_softmax, softmax_and_mask, mask_and_nothing
+from algorithms.mixer.QMIX import QMixer, QMixerRevised, VDN, ReplayBuffer, PrioritizedExperienceReplay, RNNAgent, FusedRNNAgents, agent_modules, mask_and_softmax, softmax_and_mask, mask_and_nothing
 import numpy as np
 import torch
 from copy import copy, deepcopy
-from utils.epsilon_greedy import epsilon_greedy, EpsilonManager, boltzmann_policy
+from utils.epsilon_greedy import epsilon_greedy, EpsilonManager, boltzmann_policy, select_actions
 from utils.descript import save_as_markdown
+from utils.run_log import TrainingLogs
+from utils.profiling import profiler, enable_profiling
+from utils.metrics import metrics
+from utils.checkpoint import CheckpointStore, RetentionPolicy, load_packed
 from matplotlib import pyplot as plt
 import pandas as pd
 import os
+import json
+import time
 from datetime import datetime
 import questionary
 import argparse
@@ -73,13 +79,17 @@ def save_model_parameters(mixer, agent_nets, directory):
 
     Args:
         mixer (torch.nn.Module): The mixing network.
-        agent_nets (dict): Dictionary of agent networks.
+        agent_nets (dict | FusedRNNAgents): Dictionary of agent networks, or the fused agent networks.
         directory (str): The directory where the model parameters should be saved.
         episode (int): The current episode number for naming the files.
     """
     os.makedirs(directory, exist_ok=True)  # Ensure the directory exists
     torch.save(mixer.state_dict(), os.path.join(directory, f'mixer_params.pt'))
 
+    if isinstance(agent_nets, FusedRNNAgents):
+        agent_nets.save(directory)
+        return
+
     for agent_id, agent in agent_nets.items():
         torch.save(agent.state_dict(), os.path.join(directory, f'agent_{agent_id}_params.pt'))
 
@@ -90,13 +100,29 @@ def load_model_parameters(mixer, agent_nets, directory):
 
     Args:
         mixer (torch.nn.Module): The mixing network to which parameters will be loaded.
-        agent_nets (dict): Dictionary of agent networks to which parameters will be loaded.
-        directory (str): The directory from where the model parameters should be loaded.
+        agent_nets (dict | FusedRNNAgents): Dictionary of agent networks (or the fused agent networks) to which parameters will be loaded.
+        directory (str): The directory from where the model parameters should be loaded, or a packed checkpoint file
+                         written by utils.checkpoint.CheckpointStore.
     """
+    if os.path.isfile(directory):
+        packed = load_packed(directory)
+        mixer.load_state_dict(packed['mixer_params'])
+        if isinstance(agent_nets, FusedRNNAgents):
+            for agent_id in agent_nets.agents:
+                agent_nets.load_agent_state_dict(agent_id, packed[f'agent_{agent_id}_params'])
+        else:
+            for agent_id, agent in agent_nets.items():
+                agent.load_state_dict(packed[f'agent_{agent_id}_params'])
+        return
+
     # Load mixer parameters
     mixer_state_dict = torch.load(os.path.join(directory, 'mixer_params.pt'))
     mixer.load_state_dict(mixer_state_dict)
 
+    if isinstance(agent_nets, FusedRNNAgents):
+        agent_nets.load(directory)
+        return
+
     # Load parameters for each agent network
     for agent_id, agent in agent_nets.items():
         agent_state_dict = torch.load(os.path.join(directory, f'agent_{agent_id}_params.pt'))
@@ -212,6 +238,25 @@ def main(config_file=None, additional_description=None):
             batch_size = None
         else:
             batch_size = int(batch_size)
+
+        episodic        = True
+        len_samples     = 60
+        burn_in         = 0
+        store_hidden    = False
+        hidden_interval = 1
+        fused_agents    = False
+        use_checkpoint_store    = False
+        checkpoint_keep_every   = 100
+        checkpoint_keep_best    = 5
+        checkpoint_keep_recent  = 5
+        profile                 = False
+        metrics_interval        = 30.0
+        save_dir                = None
+        n_segments              = None
+        control_dt              = None
+        torch_threads           = None
+        replay_batch_size       = None
+        time_budget             = None
         
         
     # Configure experiment with yaml config file. Preferred.
@@ -234,6 +279,31 @@ def main(config_file=None, additional_description=None):
         tau                     = config.get("tau")
         batch_size              = config.get("batch_size")
         pretrained_parameters   = config.get("pretrained_parameters")
+        episodic                = config.get("episodic", True)
+        len_samples             = config.get("len_samples", 60)
+        burn_in                 = config.get("burn_in", 0)
+        store_hidden            = config.get("store_hidden", False)
+        hidden_interval         = config.get("hidden_interval", 1)
+        fused_agents            = config.get("fused_agents", False)
+        use_checkpoint_store    = config.get("checkpoint_store", False)
+        checkpoint_keep_every   = config.get("checkpoint_keep_every", 100)
+        checkpoint_keep_best    = config.get("checkpoint_keep_best", 5)
+        checkpoint_keep_recent  = config.get("checkpoint_keep_recent", 5)
+        profile                 = config.get("profile", False)
+        metrics_interval        = config.get("metrics_interval", 30.0)
+        save_dir                = config.get("save_dir", None)
+        n_segments              = config.get("n_segments", None)
+        control_dt              = config.get("control_dt", None)
+        torch_threads           = config.get("torch_threads", None)
+        replay_batch_size       = config.get("replay_batch_size", None)
+        time_budget             = config.get("time_budget", None)
+
+    # Explicit run directory (e.g. set by benchmarks/scaling.py), instead of the timestamped one.
+    if save_dir is not None:
+        save_dir_root = save_dir
+
+    if torch_threads is not None:
+        torch.set_num_threads(int(torch_threads))
 
     device_number = int(device_number)
 
@@ -246,21 +316,26 @@ def main(config_file=None, additional_description=None):
     print("Using device:", device)
 
     print("Setting environment ...")
-    render_mode = 'silent'
-    env = TwoStageROProcessEnvironment(render_mode=render_mode, len_scenario=None, save_dir = save_dir_root)
+    # 'metrics': the environment reports through utils.metrics instead of printing every step.
+    render_mode = 'metrics'
+    env = TwoStageROProcessEnvironment(render_mode=render_mode, len_scenario=None, save_dir = save_dir_root,
+                                       n_segments=n_segments, control_dt=control_dt)
     print("Done.")
     agents = env.agents
     
     # Select action policy.
     if action_policy == 'epsilon-greedy':
         policy = epsilon_greedy
+        policy_mode = 'epsilon-greedy'
     elif action_policy == 'Boltzmann':
         policy = boltzmann_policy   # It did not work as intended, but still deserve more trials.
+        policy_mode = 'boltzmann'
 
     last_parameter = "Random"
 
     # Initialize the replay buffer. Although it's PER, if mode is UNIFORM, it works as same as normal replay buffer.
-    buffer = PrioritizedExperienceReplay(agents=agents, prioritize=True, device=device, capacity=450000)
+    # If store_hidden, agent hidden states are stored every hidden_interval transitions for burn-in (non-episodic training).
+    buffer = PrioritizedExperienceReplay(agents=agents, prioritize=True, device=device, capacity=450000, store_hidden=store_hidden, hidden_interval=hidden_interval)
 
     experiment_description_dict = {}
 
@@ -290,9 +365,15 @@ def main(config_file=None, additional_description=None):
     experiment_description_dict['gamma'] = gamma
     dt = 60.0 * 6
 
-    agent_nets = {
-        a: RNNAgent(input_shape=env.observation_space(a).shape[0], n_hidden_dim=64, n_actions=env.action_space(a).n).to(device) for a in agents
-    }
+    if fused_agents:
+        # All agents in one module, one batched forward per timestep. Only the episodic training supports it.
+        assert episodic, "Fused agent networks are only supported with episodic training."
+        agent_nets = FusedRNNAgents(agents, input_shapes={a: env.observation_space(a).shape[0] for a in agents}, n_hidden_dim=64,
+                                    n_actions={a: env.action_space(a).n for a in agents}).to(device)
+    else:
+        agent_nets = {
+            a: RNNAgent(input_shape=env.observation_space(a).shape[0], n_hidden_dim=64, n_actions=env.action_space(a).n).to(device) for a in agents
+        }
 
     if pretrained_parameters is not None:
         load_model_parameters(mixer, agent_nets, directory=pretrained_parameters)
@@ -301,12 +382,12 @@ def main(config_file=None, additional_description=None):
     print("Check model devices ...")
     for param in mixer.parameters():
         print(f"mixer | {param.device = }")
-    for a in agents:
-        for param in agent_nets[a].parameters():
-            print(f"{a = } | {param.device = }")
+    for agent_net in agent_modules(agent_nets):
+        for param in agent_net.parameters():
+            print(f"{type(agent_net).__name__} | {param.device = }")
 
     # Combine parameters from all relevant parts of the model
-    all_params = list(mixer.parameters()) + [p for a in agents for p in agent_nets[a].parameters()]
+    all_params = list(mixer.parameters()) + [p for agent_net in agent_modules(agent_nets) for p in agent_net.parameters()]
 
     # Create the optimizer
     lr = 5e-4
@@ -338,7 +419,10 @@ def main(config_file=None, additional_description=None):
 
     # Copy the mixing network and agent networks to use as target networks.
     target_mixer = deepcopy(mixer).to(device)
-    target_agent_nets = {a: deepcopy(agent_net).to(device) for a, agent_net in agent_nets.items()}
+    if fused_agents:
+        target_agent_nets = deepcopy(agent_nets).to(device)
+    else:
+        target_agent_nets = {a: deepcopy(agent_net).to(device) for a, agent_net in agent_nets.items()}
 
     agent_hiddens = {}
     agent_qs = {}
@@ -364,6 +448,15 @@ def main(config_file=None, additional_description=None):
         'PER prioritization mode': PER_mode,
         'Action policy': action_policy,
         'Epsilon': f"From {epsilon_start} with decay rate {epsilon_decay}",
+        'Episodic training': episodic,
+        'Fused agent networks': fused_agents,
+        'Checkpoint store (keep every / best / recent)': f"{use_checkpoint_store} ({checkpoint_keep_every} / {checkpoint_keep_best} / {checkpoint_keep_recent})" if use_checkpoint_store else False,
+        'Sequence length / burn-in (non-episodic)': f"{len_samples} / {burn_in} (stored hidden: {store_hidden}, every {hidden_interval})",
+        'Profiling': profile,
+        'Model segments / control interval (s)': f"{env.jl.PressureControlledRO.RO_Element_Simple.n_segments} / {env.control_dt}",
+        'Torch threads': torch.get_num_threads(),
+        'Replay batch size': replay_batch_size if replay_batch_size is not None else ('32 episodes' if episodic else '8 sequences'),
+        'Time budget (s)': time_budget,
     })
 
     # # Format the directory name with the current datetime
@@ -377,28 +470,49 @@ def main(config_file=None, additional_description=None):
 
     save_as_markdown(experiment_description_dict, os.path.join(save_dir_root, 'Experiment description'))
 
+    # Progress as metrics: a rate-limited console summary plus Prometheus text and CSV exports.
+    metrics.configure(report_interval=metrics_interval, prometheus_path=os.path.join(save_dir_root, 'metrics.prom'),
+                      csv_path=os.path.join(save_dir_root, 'metrics.csv'))
+
+    # Timing spans of the environment, the replay buffer and this loop. Free when disabled.
+    if profile:
+        enable_profiling()
+
+    # Packed checkpoints written on a background thread, with retention (instead of one parameters/<step> directory per step).
+    if use_checkpoint_store:
+        checkpoint_store = CheckpointStore(os.path.join(save_dir_root, 'checkpoints'),
+                                           retention=RetentionPolicy(keep_every=checkpoint_keep_every, keep_best=checkpoint_keep_best, keep_recent=checkpoint_keep_recent))
+    else:
+        checkpoint_store = None
+    last_parameter_step = None
+
+    # 'times trained' is counted in memory by run_logs and merged back by utils.run_log.read_episode_log.
     episode_terms_to_log = ['episode number', 'reward sum (without convergence correction)',
-                            'times trained', 'epsilon', 'converged']
-    train_terms_to_log = ['episode number', 'training number', 'final loss']
-    episode_log = pd.DataFrame(columns=episode_terms_to_log)
-    train_log = pd.DataFrame(columns=train_terms_to_log)
+                            'epsilon', 'converged', 'Reward sum', 'Parameter used last', 'wall time (s)']
+    train_terms_to_log = ['target episodes', 'training number', 'final loss']
+    run_logs = TrainingLogs(save_dir_root, episode_columns=episode_terms_to_log, train_columns=train_terms_to_log, n_episodes=max_episodes)
     reward_sum_log_over_episodes = []
     train_step = 0
     first_train = True
     episode_trained_last = 0
-    episodic = True
+    run_start = time.monotonic()
+    episodes_run = 0
         
     for episode in range(max_episodes):
+        if time_budget is not None and time.monotonic() - run_start > time_budget:
+            print(f"Time budget of {time_budget} s exhausted after {episode} episodes.")
+            break
+        episodes_run = episode + 1
         # Update and get the epislon.
         epsilon_manager.update_epsilon()
         epsilon = epsilon_manager.get_epsilon()
         episode_log_dictionary = {
             'episode number': episode,
             'reward sum (without convergence correction)': 0,
-            'times trained': 0,
             'epsilon': epsilon,
             'converged': None
         }
+        metrics.gauge('epsilon', 'Exploration rate (epsilon or temperature)').set(epsilon)
         for step in range(env.max_control_timestep):
             # 1. Initialize agent Q (action-value) dictionary.
             agent_qs = {}
@@ -406,36 +520,55 @@ def main(config_file=None, additional_description=None):
             # 2. Get the observation from the environment. RESET or STEP depending on the timestep.
             if step == 0:
                 # 2.0. Reset environment and store observation.
-                if not render_mode == 'silent':
+                if render_mode == 'text':
                     print(f"epsilon = None", end=' | ')
                 initial_action = {"influent_flowrate": 1000.0, "1st_stage_pump": 10.0, "2nd_stage_pump":0.5}
                 previous_observations, _ = env.reset(hard=False, len_scenario=int(24 * days * 60.0 / dt)+1, initial_action=initial_action, reward_ws=reward_weight, production_term=production_term)
                 # previous_observations = env.scale_observation(previous_observations)
-                agent_hiddens = {a: agent_nets[a].init_hidden() for a in agents}
+                if fused_agents:
+                    agent_hiddens = agent_nets.init_hidden()
+                else:
+                    agent_hiddens = {a: agent_nets[a].init_hidden() for a in agents}
             else:
-                if not render_mode == 'silent':
+                if render_mode == 'text':
                     print(f"epsilon = {epsilon:.2f}", end=' | ')
 
                 # 2.1. Using the observation from the last timestep, decide which action to take.
                 previous_observations_scaled = env.scale_observation(previous_observations)
 
                 # 2.1.1. Estimate action-value function with agent networks and observation.
-                for a in agents:
-                    q, h = agent_nets[a](torch.from_numpy(previous_observations_scaled[a]['observation']).to(device), agent_hiddens[a])
-
-                    if mask_before_softmax:
-                        # q = mask_and_softmax(action_mask=previous_observations_scaled[a]['action_mask'], Q=q)
-                        q = mask_and_nothing(action_mask=previous_observations_scaled[a]['action_mask'], Q=q)
+                # Keep the hidden states fed with the previous observations. Stored in the buffer for burn-in.
+                with profiler.span('agent forward'):
+                    if fused_agents:
+                        previous_agent_hiddens = agent_nets.split_hidden(agent_hiddens)
+                        with torch.no_grad():
+                            q, agent_hiddens = agent_nets(agent_nets.pack_inputs({a: previous_observations_scaled[a]['observation'] for a in agents}), agent_hiddens)
+                        action_masks = agent_nets.pack_action_masks({a: previous_observations_scaled[a]['action_mask'] for a in agents})
+                        q = agent_nets.mask_q(q, action_masks, mask_before_softmax=mask_before_softmax)
                     else:
-                        q = softmax_and_mask(action_mask=previous_observations_scaled[a]['action_mask'], Q=q)
+                        previous_agent_hiddens = copy(agent_hiddens)
+                        for a in agents:
+                            q, h = agent_nets[a](torch.from_numpy(previous_observations_scaled[a]['observation']).to(device), agent_hiddens[a])
+
+                            if mask_before_softmax:
+                                # q = mask_and_softmax(action_mask=previous_observations_scaled[a]['action_mask'], Q=q)
+                                q = mask_and_nothing(action_mask=previous_observations_scaled[a]['action_mask'], Q=q)
+                            else:
+                                q = softmax_and_mask(action_mask=previous_observations_scaled[a]['action_mask'], Q=q)
 
-                    agent_qs[a] = q
-                    agent_hiddens[a] = h
+                            agent_qs[a] = q
+                            agent_hiddens[a] = h
 
                 # 2.1.2. Decide actions to take with action policy (epsilon-greedy, Boltzmann, pure greedy).
-                actions = {
-                    a: policy(agent_qs[a], previous_observations_scaled[a]['action_mask'], epsilon) for a in agents
-                }
+                with profiler.span('action selection'):
+                    if fused_agents:
+                        # One batched selection for every agent (agents as rows), exploring with np.random as the per-agent policies.
+                        batch_actions = select_actions(q[:, 0], action_masks, mode=policy_mode, epsilon=epsilon, temperature=epsilon, generator=np.random).tolist()
+                        actions = {a: batch_actions[i] for i, a in enumerate(agents)}
+                    else:
+                        actions = {
+                            a: policy(agent_qs[a], previous_observations_scaled[a]['action_mask'], epsilon) for a in agents
+                        }
 
                 # 2.1.3. Take STEP on the environment with the decided actions.
                 observations, rewards, truncated, terminated, _, transition = env.step(actions=actions, terminate_if_diverge=True)
@@ -448,12 +581,11 @@ def main(config_file=None, additional_description=None):
 
                 if not any(terminated.values()) and not any(truncated.values()):
                     # transition = env.transition
-                    # transition["hidden"] = copy(agent_hiddens)
-                    buffer.push(transition, env)
+                    buffer.push(transition, env, hiddens=previous_agent_hiddens)
                     
                 else:
                     if any(truncated.values()):
-                        buffer.push(transition, env)
+                        buffer.push(transition, env, hiddens=previous_agent_hiddens)
                         episode_log_dictionary['converged'] = 'True'
 
                 # assert episode_log_dictionary['converged'] is None
@@ -469,8 +601,14 @@ def main(config_file=None, additional_description=None):
                     reward_sum_log_over_episodes.append(copy(env.reward_sum_log[-1]))
                     episode_log_dictionary['Reward sum']            = copy(env.reward_sum_log[-1]) #  + credit
                     episode_log_dictionary['Parameter used last']   = last_parameter
-                    episode_log = pd.concat([episode_log, pd.DataFrame([episode_log_dictionary])], ignore_index=True)
-                    episode_log.to_csv(os.path.join(save_dir_root, 'episode_log.csv'))
+                    episode_log_dictionary['wall time (s)']         = time.monotonic() - run_start
+                    if checkpoint_store is not None and last_parameter_step is not None:
+                        # The episode evaluates the parameters it was played with. The store ranks a checkpoint by the
+                        # mean reward sum of all (epsilon-greedy) episodes reported for it, not by the last one.
+                        checkpoint_store.report_reward(last_parameter_step, float(env.reward_sum_log[-1]))
+                    run_logs.log_episode(episode_log_dictionary)
+                    metrics.counter('episodes', 'Finished episodes').inc()
+                    metrics.gauge('episode_reward_sum', 'Reward sum of the last episode').set(env.reward_sum_log[-1])
                     print(f"Episode {episode} done at timestep {step}!")
                     break
 
@@ -480,21 +618,21 @@ def main(config_file=None, additional_description=None):
                     if (episode % hard_update_frequency == 0) and step == 0:
                         print("Update target networks (HARD).")
                         target_mixer.load_state_dict(mixer.state_dict())
-                        for a in agents:
-                            target_agent_nets[a].load_state_dict(agent_nets[a].state_dict())
+                        for target_agent_net, agent_net in zip(agent_modules(target_agent_nets), agent_modules(agent_nets)):
+                            target_agent_net.load_state_dict(agent_net.state_dict())
 
                         buffer.prioritize(mixer, target_mixer, agent_nets, target_agent_nets, device, env, gamma=gamma, mode=PER_mode, calculate_for_all=True)
                 else:
                     if (episode * env.max_control_timestep + step) % hard_update_frequency == 0:
                         print("Update target networks (HARD).")
                         target_mixer.load_state_dict(mixer.state_dict())
-                        for a in agents:
-                            target_agent_nets[a].load_state_dict(agent_nets[a].state_dict())
+                        for target_agent_net, agent_net in zip(agent_modules(target_agent_nets), agent_modules(agent_nets)):
+                            target_agent_net.load_state_dict(agent_net.state_dict())
             # Update target networks (soft update)
             else:
                 soft_update(target_mixer, mixer, tau=tau)
-                for a in agents:
-                    soft_update(target_agent_nets[a], agent_nets[a], tau=tau)
+                for target_agent_net, agent_net in zip(agent_modules(target_agent_nets), agent_modules(agent_nets)):
+                    soft_update(target_agent_net, agent_net, tau=tau)
 
             non_episodic_condition = ((episode * env.max_control_timestep + step) % train_frequency == 0) & ((episode * env.max_control_timestep + step) > begin_train)
             episodic_condition = ((episode_trained_last == 0) or ((episode - episode_trained_last)/train_frequency >= 1.0)) and (episode > begin_train) and step==0
@@ -513,8 +651,7 @@ def main(config_file=None, additional_description=None):
                         'final loss': None
                 }
 
-                num_samples = 8
-                len_samples = 60
+                num_samples = replay_batch_size if replay_batch_size is not None else 8
                 episode_lengths = [len(ep) for _, ep in buffer.memory.items()]
 
                 if np.sum(episode_lengths) > buffer.memory_cap:
@@ -530,10 +667,10 @@ def main(config_file=None, additional_description=None):
                         calculate_for_all = False
 
                     buffer.prioritize(mixer, target_mixer, agent_nets, target_agent_nets, device, env, gamma=gamma, mode=PER_mode, calculate_for_all=calculate_for_all)
-                    episodes_to_train = buffer.select_episodes(num_samples=32)
+                    episodes_to_train = buffer.select_episodes(num_samples=replay_batch_size if replay_batch_size is not None else 32)
                 else:
                     first_train = False
-                    episodes_to_train, starting_points = sample_episodes_and_start_points(episode_lengths, len_batch=len_samples, batch_size=num_samples)
+                    episodes_to_train, starting_points, burn_in_points = buffer.sample_sequences(num_samples=num_samples, len_samples=len_samples, burn_in=burn_in)
                 
 
                 for i in range(n_epoch):
@@ -543,55 +680,63 @@ def main(config_file=None, additional_description=None):
 
                     if episodic:
                         max_isweight = 0
+                        episode_losses = []
                         for j, train_episode_id in enumerate(episodes_to_train):
                             buffer.calculate_loss(mixer=mixer, target_mixer=target_mixer, agent_nets=agent_nets, target_agent_nets=target_agent_nets,
                                                 episode_id=train_episode_id, device=device, env=env, gamma=gamma, weighted=True)
                             loss, isweight = buffer.sample(train_episode_id)
-                            print(f"Episode {train_episode_id:>6} loss: {loss.item():.4f} / isweight: {isweight:.2f}")
+                            episode_losses.append(loss.detach())
                             if torch.isnan(loss):
                                 # raise "Nan loss detected. Terminate training ..."
                                 loss = None
-                                print(f'Nan loss is detected in episode {train_episode_id}. Continuing...')
+                                metrics.counter('train_nan_losses', 'Episodes skipped because of a NaN loss').inc()
                                 continue
                             batch_loss += loss * isweight
                             if max_isweight < isweight:
                                 max_isweight = isweight
                             # loss_sum.append(loss.item())
                         batch_loss /= max_isweight
+                        metrics.histogram('train_episode_loss', 'Loss of the trained episodes').observe_many(torch.stack(episode_losses).float().cpu().numpy())
 
                     else:
                         for j, train_episode_id in enumerate(episodes_to_train):
                             loss = buffer.calculate_batch_loss(mixer=mixer, target_mixer=target_mixer, agent_nets=agent_nets, target_agent_nets=target_agent_nets,
-                                                episode_id=train_episode_id, device=device, env=env, gamma=gamma, starting_index=starting_points[j], batch_size=len_samples)
+                                                episode_id=train_episode_id, device=device, env=env, gamma=gamma, starting_index=starting_points[j], batch_size=len_samples,
+                                                burn_in_index=burn_in_points[j])
                             batch_loss += loss
                             if torch.isnan(loss):
                                 loss = None
-                                print(f'Nan loss is detected in episode {train_episode_id}. Continuing...')
+                                metrics.counter('train_nan_losses', 'Episodes skipped because of a NaN loss').inc()
                                 continue
 
                     batch_loss /= len(episodes_to_train)
-                    batch_loss.backward()
+                    with profiler.span('backward'):
+                        batch_loss.backward()
 
-                    torch.nn.utils.clip_grad_norm_(all_params, max_norm=10.0)
-                    optimizer.step()
+                    with profiler.span('optimizer step'):
+                        torch.nn.utils.clip_grad_norm_(all_params, max_norm=10.0)
+                        optimizer.step()
 
                     loss_mean = batch_loss.item()
-                    print(f"Training step {train_step:<5} | Epoch [{i:<2}] | Weighted mean loss : {loss_mean:.2f}")
+                    metrics.counter('gradient_steps', 'Optimizer steps').inc()
+                    metrics.gauge('train_loss', 'Weighted mean loss of the last optimizer step').set(loss_mean)
                     batch_loss = torch.tensor(0.0).to(device)
                     optimizer.zero_grad()
 
             
                 train_log_dictionary['final loss'] = loss_mean
-                train_log = pd.concat([train_log, pd.DataFrame([train_log_dictionary])], ignore_index=True)
-                for training_episode in episodes_to_train:
-                    episode_log.loc[episode_log['episode number'] == training_episode, 'times trained'] += 1
-                train_log.to_csv(os.path.join(save_dir_root, 'train_log.csv'))
-                episode_log.to_csv(os.path.join(save_dir_root, 'episode_log.csv'))
-                param_dir = os.path.join(save_dir_root, f'parameters/{train_step}')
-                if episodic:
-                    save_model_parameters(mixer, agent_nets, directory=param_dir)
-                elif train_step % (500/train_frequency) == 0:
-                    save_model_parameters(mixer, agent_nets, directory=param_dir)
+                with profiler.span('log and checkpoint I/O'):
+                    run_logs.log_training(train_log_dictionary, trained_episodes=episodes_to_train)
+                    param_dir = os.path.join(save_dir_root, f'parameters/{train_step}')
+                    if checkpoint_store is not None:
+                        if episodic or train_step % (500/train_frequency) == 0:
+                            checkpoint_store.save(train_step, mixer, agent_nets)
+                            last_parameter_step = train_step
+                        param_dir = checkpoint_store.path(train_step)
+                    elif episodic:
+                        save_model_parameters(mixer, agent_nets, directory=param_dir)
+                    elif train_step % (500/train_frequency) == 0:
+                        save_model_parameters(mixer, agent_nets, directory=param_dir)
                 last_parameter = copy(param_dir)
                 train_step += 1
 
@@ -606,9 +751,29 @@ def main(config_file=None, additional_description=None):
         else:
             env.plot_environment(save_dir=save_dir, plot_state=False)
 
+        profiler.end_episode(episode, save_path=os.path.join(save_dir_root, 'profile_episodes.csv'), verbose=True)
+
         if mode == 'inference':
             continue
 
+    run_logs.close()
+    profiler.save(save_dir_root)
+    metrics.report(force=True)
+
+    # Throughput of the whole run, read by benchmarks/scaling.py.
+    wall_time = time.monotonic() - run_start
+    run_summary = {
+        'wall time (s)': wall_time,
+        'episodes': episodes_run,
+        'env steps': metrics.counter('env_steps').value,
+        'gradient steps': metrics.counter('gradient_steps').value,
+    }
+    run_summary['env steps / s'] = run_summary['env steps'] / max(wall_time, 1e-9)
+    run_summary['gradient steps / s'] = run_summary['gradient steps'] / max(wall_time, 1e-9)
+    with open(os.path.join(save_dir_root, 'run_summary.json'), 'w') as file:
+        json.dump(run_summary, file, indent=2)
+    if checkpoint_store is not None:
+        checkpoint_store.close()
         
 
 if __name__ == "__main__":
@@ -0,0 +1,553 @@
+"""
+ Decoupled actor / learner training of the QMIX agents (Ape-X / R2D2 style, on a single CPU machine).
+
+ M actor processes own one TwoStageROProcessEnvironment each (and thus one Julia runtime each), act with a local copy of the
+agent networks and push every finished episode to a bounded queue. The learner (main process) owns the PER buffer, the mixer,
+the target networks and the optimizer. It ingests episodes, trains with the same episodic update as optimize_pressure_RO.py
+and broadcasts the agent parameters through shared memory every `broadcast_interval` training rounds.
+
+ The learner never simulates the process, so it does not import the environment (and does not start Julia).
+
+ Throughput is bounded from both sides: the learner does not train more than `max_replay_ratio` training rounds per
+received episode, and actors block on the bounded queue (`queue_size` episodes) if the learner falls behind.
+
+ Usage: python optimize_pressure_RO_actor_learner.py --yaml_file config/episodic_conf/<config>.yaml
+ Extra YAML keys (all optional): n_actors, broadcast_interval, actor_refresh_interval, max_replay_ratio, queue_size,
+                                 metrics_interval, learner_threads, seed, checkpoint_interval.
+ Shared with optimize_pressure_RO.py: save_dir, n_segments, control_dt, torch_threads (learner_threads falls back to it),
+                                      replay_batch_size, time_budget, checkpoint_keep_every / _best / _recent.
+
+ Parameters are saved every `checkpoint_interval` training rounds (and at the end of the run) through
+utils.checkpoint.CheckpointStore, as packed files in <run>/checkpoints with the retention policy of the checkpoint_keep_*
+keys. The reward sums of the actors' episodes are reported for the checkpoint they acted with, if the broadcast version
+was checkpointed; 'keep best' ranks checkpoints by the mean of these reward sums.
+"""
+from algorithms.mixer.QMIX import QMixerRevised, PrioritizedExperienceReplay, RNNAgent, FusedRNNAgents, agent_modules, mask_and_nothing
+from TwoStageROProcessEnvironment.env.observation_bounds import AGENTS, N_ACTIONS, observation_shapes
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from copy import copy, deepcopy
+from utils.epsilon_greedy import epsilon_greedy, EpsilonManager, boltzmann_policy
+from utils.descript import save_as_markdown
+from utils.run_log import TrainingLogs
+from utils.checkpoint import CheckpointStore, RetentionPolicy, load_state_dicts
+import pandas as pd
+import os
+import json
+import queue
+import time
+from datetime import datetime
+import argparse
+import shutil
+
+# Episodes carry a few thousand small tensors. Share them through files rather than file descriptors (avoids fd limits).
+# Set at import, so that the spawned actors use the same strategy.
+mp.set_sharing_strategy('file_system')
+
+
+def parse_yaml(file_path):
+    import yaml
+    with open(file_path, 'r') as file:
+        return yaml.safe_load(file)
+
+
+def agent_state_dicts(agent_nets):
+    # Per-agent state dicts (RNNAgent layout) of either a dictionary of RNNAgent or FusedRNNAgents.
+    if isinstance(agent_nets, FusedRNNAgents):
+        return {a: agent_nets.agent_state_dict(a) for a in agent_nets.agents}
+    return {a: agent_net.state_dict() for a, agent_net in agent_nets.items()}
+
+
+def broadcast_parameters(agent_nets, shared_agent_nets, parameter_version, parameter_lock):
+    """
+    Copy the learner's agent parameters into the shared-memory agent networks and bump the parameter version.
+
+    Args:
+        agent_nets (dict | FusedRNNAgents): The learner's agent networks.
+        shared_agent_nets (dict): Dictionary of RNNAgent whose parameters live in shared memory.
+        parameter_version (mp.Value): Version counter read by the actors.
+        parameter_lock (mp.Lock): Lock guarding the shared parameters while they are written or read.
+    """
+    state_dicts = agent_state_dicts(agent_nets)
+    with parameter_lock:
+        for a, shared_agent_net in shared_agent_nets.items():
+            shared_agent_net.load_state_dict({k: v.detach().cpu() for k, v in state_dicts[a].items()})
+        parameter_version.value += 1
+
+
+def actor_process(actor_id, config, save_dir_root, shared_agent_nets, parameter_version, parameter_lock, episode_queue, stop_event, seed):
+    """
+    Actor loop. Runs episodes with the latest broadcast parameters and puts them on the episode queue.
+
+    Each message is a dictionary with the transitions (already scaled and converted to CPU tensors with
+    PrioritizedExperienceReplay.to_device), the episode statistics and the actor's timings.
+    """
+    # Imported here so that only actors start a Julia runtime.
+    from TwoStageROProcessEnvironment.env.PressureControlledTwoStageROProcess_simple import TwoStageROProcessEnvironment
+
+    torch.set_num_threads(1)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    n_actors                = config.get("n_actors", 2)
+    days                    = config.get("days")
+    reward_weight           = config.get("reward_weight")
+    production_term         = config.get("total_production")
+    action_policy           = config.get("action_policy")
+    epsilon_start           = config.get("epsilon_start")
+    epsilon_decay           = config.get("epsilon_decay")
+    refresh_interval        = config.get("actor_refresh_interval", 1)
+    n_segments              = config.get("n_segments", None)
+    control_dt              = config.get("control_dt", None)
+
+    env = TwoStageROProcessEnvironment(render_mode='silent', len_scenario=None, save_dir=os.path.join(save_dir_root, f'actor {actor_id}'),
+                                       n_segments=n_segments, control_dt=control_dt)
+    agents = env.agents
+    dt = 60.0 * 6
+
+    # Only used to convert transitions (scaling, tensors) before they are sent to the learner.
+    converter = PrioritizedExperienceReplay(agents=agents, prioritize=False, device="cpu", capacity=0)
+
+    agent_nets = {
+        a: RNNAgent(input_shape=env.observation_space(a).shape[0], n_hidden_dim=64, n_actions=env.action_space(a).n) for a in agents
+    }
+    local_version = -1
+
+    if action_policy == 'Boltzmann':
+        policy = boltzmann_policy
+        epsilon_min = 0.1
+    else:
+        policy = epsilon_greedy
+        epsilon_min = 0.05
+    # The (linear) anneal time is given in total episodes, which are shared among the actors.
+    epsilon_decay = epsilon_decay / n_actors
+    epsilon_manager = EpsilonManager(epsilon_start=epsilon_start, epsilon_min=epsilon_min, decay_rate=epsilon_decay, decay_type='linear')
+
+    episodes_done = 0
+    while not stop_event.is_set():
+        # Refresh the local networks if the learner broadcast new parameters.
+        if episodes_done % refresh_interval == 0 and parameter_version.value != local_version:
+            with parameter_lock:
+                for a in agents:
+                    agent_nets[a].load_state_dict(shared_agent_nets[a].state_dict())
+                local_version = parameter_version.value
+
+        epsilon_manager.update_epsilon()
+        epsilon = epsilon_manager.get_epsilon()
+
+        episode_start = time.perf_counter()
+        simulation_time = 0.0
+        transitions = []
+        reward_sum = None
+        converged = None
+
+        initial_action = {"influent_flowrate": 1000.0, "1st_stage_pump": 10.0, "2nd_stage_pump":0.5}
+        previous_observations, _ = env.reset(hard=False, len_scenario=int(24 * days * 60.0 / dt)+1, initial_action=initial_action, reward_ws=reward_weight, production_term=production_term)
+        agent_hiddens = {a: agent_nets[a].init_hidden() for a in agents}
+
+        for step in range(1, env.max_control_timestep):
+            previous_observations_scaled = env.scale_observation(previous_observations)
+            agent_qs = {}
+            with torch.no_grad():
+                for a in agents:
+                    q, agent_hiddens[a] = agent_nets[a](torch.from_numpy(previous_observations_scaled[a]['observation']), agent_hiddens[a])
+                    agent_qs[a] = mask_and_nothing(action_mask=previous_observations_scaled[a]['action_mask'], Q=q)
+            actions = {a: policy(agent_qs[a], previous_observations_scaled[a]['action_mask'], epsilon) for a in agents}
+
+            simulation_start = time.perf_counter()
+            observations, rewards, truncated, terminated, _, transition = env.step(actions=actions, terminate_if_diverge=True)
+            simulation_time += time.perf_counter() - simulation_start
+
+            if not env.process_valid:
+                break
+
+            if not any(terminated.values()) or any(truncated.values()):
+                transitions.append(converter.to_device(transition, env))
+            if any(truncated.values()):
+                converged = 'True'
+
+            previous_observations = deepcopy(observations)
+
+            if any(terminated[a] or truncated[a] for a in agents):
+                reward_sum = copy(env.reward_sum_log[-1])
+                break
+
+        episodes_done += 1
+        message = {
+            'actor': actor_id,
+            'transitions': transitions,
+            'reward sum': reward_sum,
+            'epsilon': epsilon,
+            'converged': converged,
+            'parameter version': local_version,
+            'env steps': step,
+            'wall time': time.perf_counter() - episode_start,
+            'simulation time': simulation_time,
+        }
+
+        # Block while the learner is behind (bounded queue), but keep watching the stop signal.
+        while not stop_event.is_set():
+            try:
+                episode_queue.put(message, timeout=1.0)
+                break
+            except queue.Full:
+                continue
+
+
+class ThroughputMeter:
+    """
+    Per-role throughput counters of the actor / learner run. Written as one row per role to throughput_log.csv.
+    """
+    def __init__(self, n_actors):
+        self.start = time.perf_counter()
+        self.actors = {i: {'episodes': 0, 'env steps': 0, 'wall time': 0.0, 'simulation time': 0.0} for i in range(n_actors)}
+        self.learner = {'episodes ingested': 0, 'training rounds': 0, 'gradient steps': 0, 'training time': 0.0, 'waiting time': 0.0, 'broadcasts': 0}
+
+    def record_episode(self, message):
+        stats = self.actors[message['actor']]
+        stats['episodes']           += 1
+        stats['env steps']          += message['env steps']
+        stats['wall time']          += message['wall time']
+        stats['simulation time']    += message['simulation time']
+        self.learner['episodes ingested'] += 1
+
+    def rows(self, queue_size):
+        elapsed = time.perf_counter() - self.start
+        rows = []
+        for actor_id, stats in self.actors.items():
+            rows.append({
+                'elapsed time [s]': elapsed,
+                'role': f'actor {actor_id}',
+                'episodes': stats['episodes'],
+                'env steps': stats['env steps'],
+                'env steps / s': stats['env steps'] / max(stats['wall time'], 1e-9),
+                'simulation share': stats['simulation time'] / max(stats['wall time'], 1e-9),
+            })
+        total_env_steps = sum(stats['env steps'] for stats in self.actors.values())
+        rows.append({
+            'elapsed time [s]': elapsed,
+            'role': 'learner',
+            'episodes': self.learner['episodes ingested'],
+            'env steps': total_env_steps,
+            'env steps / s': total_env_steps / max(elapsed, 1e-9),
+            'gradient steps': self.learner['gradient steps'],
+            'gradient steps / s': self.learner['gradient steps'] / max(self.learner['training time'], 1e-9),
+            'replay ratio': self.learner['training rounds'] / max(self.learner['episodes ingested'], 1),
+            'idle share': self.learner['waiting time'] / max(elapsed, 1e-9),
+            'broadcasts': self.learner['broadcasts'],
+            'queue size': queue_size,
+        })
+        return rows
+
+
+def main(config_file, additional_description=None):
+    base_dir = r"./figures"
+    save_dir_root = os.path.join(base_dir, datetime.now().strftime("%y.%m.%d.%H.%M"))
+
+    print("Reading configuration from config file ...")
+    config                  = parse_yaml(config_file)
+    device_number           = config.get("device_number", 0)
+    description_experiment  = config.get("description_experiment")
+    max_episodes            = config.get("max_episodes")
+    train_frequency         = config.get("train_frequency")
+    PER_mode                = config.get("PER_mode")
+    n_epoch                 = config.get("n_epoch")
+    action_policy           = config.get("action_policy")
+    epsilon_start           = config.get("epsilon_start")
+    epsilon_decay           = config.get("epsilon_decay")
+    pretrained_parameters   = config.get("pretrained_parameters")
+    fused_agents            = config.get("fused_agents", False)
+    n_actors                = config.get("n_actors", 2)
+    broadcast_interval      = config.get("broadcast_interval", 1)
+    refresh_interval        = config.get("actor_refresh_interval", 1)
+    max_replay_ratio        = config.get("max_replay_ratio", 1.0 / train_frequency)
+    queue_size              = config.get("queue_size", 2 * n_actors)
+    metrics_interval        = config.get("metrics_interval", 30.0)
+    learner_threads         = config.get("learner_threads", config.get("torch_threads", None))
+    seed                    = config.get("seed", None)
+    replay_batch_size       = config.get("replay_batch_size", None)
+    time_budget             = config.get("time_budget", None)
+    save_dir                = config.get("save_dir", None)
+    checkpoint_interval     = config.get("checkpoint_interval", 1)
+    checkpoint_keep_every   = config.get("checkpoint_keep_every", 100)
+    checkpoint_keep_best    = config.get("checkpoint_keep_best", 5)
+    checkpoint_keep_recent  = config.get("checkpoint_keep_recent", 5)
+
+    # Explicit run directory (e.g. set by benchmarks/scaling.py), instead of the timestamped one.
+    if save_dir is not None:
+        save_dir_root = save_dir
+
+    device = torch.device(f"cuda:{int(device_number)}" if torch.cuda.is_available() else "cpu")
+    print("Using device:", device)
+    if learner_threads is not None:
+        torch.set_num_threads(int(learner_threads))
+
+    agents = AGENTS
+    input_shapes = observation_shapes()
+
+    buffer = PrioritizedExperienceReplay(agents=agents, prioritize=True, device=device, capacity=450000)
+
+    mixer = QMixerRevised(n_state_dim=15, n_agents=len(agents), n_embedding_dim=64, device=device).to(device)
+    if fused_agents:
+        agent_nets = FusedRNNAgents(agents, input_shapes=input_shapes, n_hidden_dim=64, n_actions=N_ACTIONS).to(device)
+    else:
+        agent_nets = {a: RNNAgent(input_shape=input_shapes[a], n_hidden_dim=64, n_actions=N_ACTIONS[a]).to(device) for a in agents}
+
+    if pretrained_parameters not in (None, 'None'):
+        # A parameter directory or a packed checkpoint file (e.g. <run>/checkpoints/step_<step>.pt of an earlier run).
+        state_dicts = load_state_dicts(pretrained_parameters, map_location=device)
+        mixer.load_state_dict(state_dicts['mixer_params'])
+        for a in agents:
+            if fused_agents:
+                agent_nets.load_agent_state_dict(a, state_dicts[f'agent_{a}_params'])
+            else:
+                agent_nets[a].load_state_dict(state_dicts[f'agent_{a}_params'])
+        print("Pretrained parameters successfully loaded.")
+
+    all_params = list(mixer.parameters()) + [p for agent_net in agent_modules(agent_nets) for p in agent_net.parameters()]
+    lr = 5e-4
+    optimizer = torch.optim.RAdam(params=all_params, lr=lr)
+
+    gamma = 0.99
+    begin_train = 10
+    hard_update_frequency = 200     # In received episodes. Only the hard update is used, as in optimize_pressure_RO.py.
+    target_mixer = deepcopy(mixer).to(device)
+    target_agent_nets = deepcopy(agent_nets).to(device) if fused_agents else {a: deepcopy(agent_net).to(device) for a, agent_net in agent_nets.items()}
+
+    # Parameters seen by the actors. Always per-agent RNNAgent on CPU, in shared memory.
+    shared_agent_nets = {a: RNNAgent(input_shape=input_shapes[a], n_hidden_dim=64, n_actions=N_ACTIONS[a]) for a in agents}
+    for shared_agent_net in shared_agent_nets.values():
+        shared_agent_net.share_memory()
+
+    experiment_description_dict = {}
+    if additional_description is not None:
+        description_experiment += "\n"+additional_description
+    experiment_description_dict.update({
+        'Experiment description': description_experiment,
+        'Pretrained parameters': pretrained_parameters,
+        'gamma': gamma,
+        'Learning rate': lr,
+        'Maximum episodes': max_episodes,
+        'Number of epochs': n_epoch,
+        'PER prioritization mode': PER_mode,
+        'Action policy': action_policy,
+        'Epsilon': f"From {epsilon_start} with decay rate {epsilon_decay}",
+        'Fused agent networks': fused_agents,
+        'Actors': n_actors,
+        'Parameter broadcast interval (training rounds)': broadcast_interval,
+        'Actor refresh interval (episodes)': refresh_interval,
+        'Maximum replay ratio (training rounds per episode)': max_replay_ratio,
+        'Episode queue size': queue_size,
+        'Model segments / control interval (s)': f"{config.get('n_segments') or 'default'} / {config.get('control_dt') or 'default'}",
+        'Learner threads': learner_threads,
+        'Replay batch size': replay_batch_size if replay_batch_size is not None else 32,
+        'Time budget (s)': time_budget,
+        'Checkpoint interval (training rounds) / keep every / best / recent': f"{checkpoint_interval} / {checkpoint_keep_every} / {checkpoint_keep_best} / {checkpoint_keep_recent}",
+    })
+
+    os.makedirs(save_dir_root, exist_ok=True)
+    shutil.copy(config_file, os.path.join(save_dir_root, "configuration_used.yaml"))
+    save_as_markdown(experiment_description_dict, os.path.join(save_dir_root, 'Experiment description'))
+
+    # Spawn (not fork), as every actor starts its own Julia runtime.
+    context = mp.get_context('spawn')
+    episode_queue = context.Queue(maxsize=queue_size)
+    stop_event = context.Event()
+    parameter_version = context.Value('i', 0)
+    parameter_lock = context.Lock()
+    broadcast_parameters(agent_nets, shared_agent_nets, parameter_version, parameter_lock)
+
+    seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(n_actors)]
+    actors = [
+        context.Process(target=actor_process, args=(i, config, save_dir_root, shared_agent_nets, parameter_version, parameter_lock,
+                                                    episode_queue, stop_event, seeds[i]), daemon=True)
+        for i in range(n_actors)
+    ]
+    for actor in actors:
+        actor.start()
+    print(f"Started {n_actors} actors.")
+
+    run_logs = TrainingLogs(save_dir_root,
+                            episode_columns=['episode number', 'actor', 'Reward sum',
+                                             'epsilon', 'converged', 'parameter version', 'wall time (s)'],
+                            train_columns=['target episodes', 'training number', 'final loss'], n_episodes=max_episodes)
+    throughput_log = pd.DataFrame()
+    meter = ThroughputMeter(n_actors)
+    last_metrics = time.perf_counter()
+    checkpoint_store = CheckpointStore(os.path.join(save_dir_root, 'checkpoints'),
+                                       retention=RetentionPolicy(keep_every=checkpoint_keep_every, keep_best=checkpoint_keep_best, keep_recent=checkpoint_keep_recent))
+    # Training step of each broadcast version whose parameters were checkpointed, to credit the actors' rewards to it.
+    # The store averages the rewards of all actors' episodes reported for the same step.
+    version_steps = {}
+
+    episodes_received = 0
+    stored_episode = 0
+    train_step = 0
+    first_train = True
+    try:
+        while episodes_received < max_episodes:
+            if time_budget is not None and time.perf_counter() - meter.start > time_budget:
+                print(f"Time budget of {time_budget} s exhausted after {episodes_received} episodes.")
+                break
+            can_train = (stored_episode > begin_train) and (train_step < max_replay_ratio * episodes_received)
+
+            # 1. Ingest finished episodes. Wait for one only if there is nothing to train on.
+            messages = []
+            try:
+                if can_train:
+                    messages.append(episode_queue.get_nowait())
+                else:
+                    waiting_start = time.perf_counter()
+                    messages.append(episode_queue.get(timeout=1.0))
+                    meter.learner['waiting time'] += time.perf_counter() - waiting_start
+                while True:
+                    messages.append(episode_queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            dead_actors = [i for i, actor in enumerate(actors) if not actor.is_alive()]
+            if dead_actors:
+                raise RuntimeError(f"Actor(s) {dead_actors} exited unexpectedly (exit codes {[actors[i].exitcode for i in dead_actors]}).")
+
+            for message in messages:
+                meter.record_episode(message)
+                episodes_received += 1
+
+                if (episodes_received - 1) % hard_update_frequency == 0:
+                    print("Update target networks (HARD).")
+                    target_mixer.load_state_dict(mixer.state_dict())
+                    for target_agent_net, agent_net in zip(agent_modules(target_agent_nets), agent_modules(agent_nets)):
+                        target_agent_net.load_state_dict(agent_net.state_dict())
+                    if stored_episode > 0:
+                        buffer.prioritize(mixer, target_mixer, agent_nets, target_agent_nets, device, None, gamma=gamma, mode=PER_mode, calculate_for_all=True)
+
+                # Episode ids of the actors overlap. Re-number them in the order the learner stores them.
+                if len(message['transitions']) > 0:
+                    for transition in message['transitions']:
+                        transition['episode_id'] = stored_episode + 1
+                        buffer.push(transition)
+                    buffer.calculate_loss(mixer=mixer, target_mixer=target_mixer, agent_nets=agent_nets, target_agent_nets=target_agent_nets,
+                                          episode_id=stored_episode, device=device, env=None, gamma=gamma)
+                    episode_number = stored_episode
+                    stored_episode += 1
+
+                    if np.sum([len(ep) for ep in buffer.memory.values()]) > buffer.memory_cap:
+                        print("Buffer full! Emptying the memory ...")
+                        buffer.empty_head()
+                else:
+                    episode_number = None
+
+                acted_step = version_steps.get(message['parameter version'])
+                if acted_step is not None and message['reward sum'] is not None:
+                    checkpoint_store.report_reward(acted_step, float(message['reward sum']))
+
+                run_logs.log_episode({
+                    'episode number': episode_number,
+                    'actor': message['actor'],
+                    'Reward sum': message['reward sum'],
+                    'epsilon': message['epsilon'],
+                    'converged': message['converged'],
+                    'parameter version': message['parameter version'],
+                    'wall time (s)': time.perf_counter() - meter.start,
+                })
+
+            # 2. Train, as long as the replay ratio allows.
+            can_train = (stored_episode > begin_train) and (train_step < max_replay_ratio * episodes_received)
+            if can_train:
+                training_start = time.perf_counter()
+                buffer.prioritize(mixer, target_mixer, agent_nets, target_agent_nets, device, None, gamma=gamma, mode=PER_mode, calculate_for_all=first_train)
+                first_train = False
+                episodes_to_train = buffer.select_episodes(num_samples=replay_batch_size if replay_batch_size is not None else 32)
+
+                for i in range(n_epoch):
+                    optimizer.zero_grad()
+                    batch_loss = torch.tensor(0.0).to(device)
+                    max_isweight = 0
+                    for train_episode_id in episodes_to_train:
+                        buffer.calculate_loss(mixer=mixer, target_mixer=target_mixer, agent_nets=agent_nets, target_agent_nets=target_agent_nets,
+                                              episode_id=train_episode_id, device=device, env=None, gamma=gamma, weighted=True)
+                        loss, isweight = buffer.sample(train_episode_id)
+                        if torch.isnan(loss):
+                            print(f'Nan loss is detected in episode {train_episode_id}. Continuing...')
+                            continue
+                        batch_loss += loss * isweight
+                        max_isweight = max(max_isweight, isweight)
+                    batch_loss /= max_isweight
+                    batch_loss /= len(episodes_to_train)
+                    batch_loss.backward()
+
+                    torch.nn.utils.clip_grad_norm_(all_params, max_norm=10.0)
+                    optimizer.step()
+                    loss_mean = batch_loss.item()
+                    meter.learner['gradient steps'] += 1
+                    print(f"Training step {train_step:<5} | Epoch [{i:<2}] | Weighted mean loss : {loss_mean:.2f}")
+
+                meter.learner['training rounds'] += 1
+                meter.learner['training time'] += time.perf_counter() - training_start
+
+                run_logs.log_training({'target episodes': list(episodes_to_train), 'training number': train_step, 'final loss': loss_mean},
+                                      trained_episodes=episodes_to_train)
+                saved = train_step % checkpoint_interval == 0
+                if saved:
+                    checkpoint_store.save(train_step, mixer, agent_nets)
+                parameter_step = train_step
+                train_step += 1
+
+                # 3. Broadcast the new parameters to the actors.
+                if train_step % broadcast_interval == 0:
+                    broadcast_parameters(agent_nets, shared_agent_nets, parameter_version, parameter_lock)
+                    if saved:
+                        # Versions of unsaved steps have no checkpoint to credit.
+                        version_steps[parameter_version.value] = parameter_step
+                    meter.learner['broadcasts'] += 1
+
+            # 4. Per-role throughput.
+            if time.perf_counter() - last_metrics >= metrics_interval:
+                last_metrics = time.perf_counter()
+                rows = meter.rows(queue_size=episode_queue.qsize())
+                throughput_log = pd.concat([throughput_log, pd.DataFrame(rows)], ignore_index=True)
+                throughput_log.to_csv(os.path.join(save_dir_root, 'throughput_log.csv'))
+                learner_row = rows[-1]
+                print(f"[Throughput] env steps/s: {learner_row['env steps / s']:.2f} | gradient steps/s: {learner_row['gradient steps / s']:.2f} "
+                      f"| replay ratio: {learner_row['replay ratio']:.3f} | learner idle: {learner_row['idle share']:.0%} | queue: {learner_row['queue size']}")
+    finally:
+        # Stop the actors. Drain the queue so that no actor stays blocked on put.
+        stop_event.set()
+        for actor in actors:
+            while actor.is_alive():
+                try:
+                    episode_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+                actor.join(timeout=0.1)
+
+    run_logs.close()
+    throughput_log = pd.concat([throughput_log, pd.DataFrame(meter.rows(queue_size=0))], ignore_index=True)
+    throughput_log.to_csv(os.path.join(save_dir_root, 'throughput_log.csv'))
+    checkpoint_store.save(train_step, mixer, agent_nets)
+    checkpoint_store.close()
+
+    # Throughput of the whole run (wall-clock rates), read by benchmarks/scaling.py.
+    wall_time = time.perf_counter() - meter.start
+    learner_row = meter.rows(queue_size=0)[-1]
+    run_summary = {
+        'wall time (s)': wall_time,
+        'episodes': episodes_received,
+        'env steps': learner_row['env steps'],
+        'gradient steps': meter.learner['gradient steps'],
+        'env steps / s': learner_row['env steps'] / max(wall_time, 1e-9),
+        'gradient steps / s': meter.learner['gradient steps'] / max(wall_time, 1e-9),
+    }
+    with open(os.path.join(save_dir_root, 'run_summary.json'), 'w') as file:
+        json.dump(run_summary, file, indent=2)
+    print(f"Done. {episodes_received} episodes, {train_step} training rounds.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Decoupled actor / learner training. Set from a YAML configuration file.')
+    parser.add_argument('--yaml_file', type=str, help='Path to the YAML file', required=True)
+    parser.add_argument('--description', type=str, help='Additional description about the experiment', required=False)
+    args = parser.parse_args()
+
+    main(config_file=args.yaml_file, additional_description=args.description)
@@ -5,6 +5,7 @@ import torch
 from copy import copy, deepcopy
 from utils.epsilon_greedy import epsilon_greedy, EpsilonManager, boltzmann_policy, get_action_from_q, centralized_epsilon_greedy
 from utils.descript import save_as_markdown
+from utils.run_log import TrainingLogs
 from matplotlib import pyplot as plt
 import pandas as pd
 import os
@@ -366,11 +367,11 @@ def main(config_file=None, additional_description=None):
 
     save_as_markdown(experiment_description_dict, os.path.join(save_dir_root, 'Experiment description'))
 
+    # 'times trained' is counted in memory by run_logs and merged back by utils.run_log.read_episode_log.
     episode_terms_to_log = ['episode number', 'reward sum (without convergence correction)',
-                            'times trained', 'epsilon', 'converged']
-    train_terms_to_log = ['episode number', 'training number', 'final loss']
-    episode_log = pd.DataFrame(columns=episode_terms_to_log)
-    train_log = pd.DataFrame(columns=train_terms_to_log)
+                            'epsilon', 'converged', 'Reward sum', 'Parameter used last']
+    train_terms_to_log = ['target episodes', 'training number', 'final loss']
+    run_logs = TrainingLogs(save_dir_root, episode_columns=episode_terms_to_log, train_columns=train_terms_to_log, n_episodes=max_episodes)
     reward_sum_log_over_episodes = []
     train_step = 0
     first_train = True
@@ -384,7 +385,6 @@ def main(config_file=None, additional_description=None):
         episode_log_dictionary = {
             'episode number': episode,
             'reward sum (without convergence correction)': 0,
-            'times trained': 0,
             'epsilon': epsilon,
             'converged': None
         }
@@ -443,8 +443,7 @@ def main(config_file=None, additional_description=None):
                     reward_sum_log_over_episodes.append(copy(env.reward_sum_log[-1]))
                     episode_log_dictionary['Reward sum']            = copy(env.reward_sum_log[-1]) #  + credit
                     episode_log_dictionary['Parameter used last']   = last_parameter
-                    episode_log = pd.concat([episode_log, pd.DataFrame([episode_log_dictionary])], ignore_index=True)
-                    episode_log.to_csv(os.path.join(save_dir_root, 'episode_log.csv'))
+                    run_logs.log_episode(episode_log_dictionary)
                     print(f"Episode {episode} done at timestep {step}!")
                     break
 
@@ -540,11 +539,7 @@ def main(config_file=None, additional_description=None):
 
             
                 train_log_dictionary['final loss'] = loss_mean
-                train_log = pd.concat([train_log, pd.DataFrame([train_log_dictionary])], ignore_index=True)
-                for training_episode in episodes_to_train:
-                    episode_log.loc[episode_log['episode number'] == training_episode, 'times trained'] += 1
-                train_log.to_csv(os.path.join(save_dir_root, 'train_log.csv'))
-                episode_log.to_csv(os.path.join(save_dir_root, 'episode_log.csv'))
+                run_logs.log_training(train_log_dictionary, trained_episodes=episodes_to_train)
                 param_dir = os.path.join(save_dir_root, f'parameters/{train_step}')
                 if episodic:
                     save_model_parameters_centralized(agent_net, directory=param_dir)
@@ -567,7 +562,8 @@ def main(config_file=None, additional_description=None):
         if mode == 'inference':
             continue
 
-        
+    run_logs.close()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Set from a YAML configuration file.')
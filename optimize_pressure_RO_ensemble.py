@@ -0,0 +1,263 @@
+"""
+ Ensemble training. E independent QMIX (or VDN) runs, differing by seed, learning rate and reward weights, trained in one
+process (one Julia runtime) instead of E separate runs of optimize_pressure_RO.py.
+
+ Every member has its own environment and replay buffer (independent replay streams). The members act in lockstep and are
+trained together with EnsembleQMIX (torch.func.stack_module_state + vmap), i.e. one batched forward / backward per
+gradient step for the whole ensemble.
+
+ Checkpoints of member e are written to <save dir>/member e/parameters/<train step>/ with the same files as
+save_model_parameters, so that they load with load_model_parameters.
+
+ Usage: python optimize_pressure_RO_ensemble.py --yaml_file config/episodic_conf/<config>.yaml
+ Extra YAML keys (all optional): ensemble_size, ensemble_seeds, ensemble_lrs, ensemble_reward_weights, mixer ('QMixerRevised' or 'VDN').
+"""
+from TwoStageROProcessEnvironment.env.PressureControlledTwoStageROProcess_simple import TwoStageROProcessEnvironment
+from algorithms.mixer.QMIX import PrioritizedExperienceReplay
+from algorithms.mixer.ensemble import EnsembleQMIX, build_members, stack_batch
+from optimize_pressure_RO import parse_yaml
+from utils.epsilon_greedy import EpsilonManager, select_actions
+from utils.descript import save_as_markdown
+from utils.run_log import TrainingLogs
+import numpy as np
+import torch
+from copy import copy, deepcopy
+import pandas as pd
+import os
+from datetime import datetime
+import argparse
+import shutil
+
+
+def refresh_td_errors(ensemble, buffers, agents, device, gamma, episode_ids=None, chunk_size=32):
+    """
+    Recalculate the TD errors (per-episode losses) of the given episodes of every member, chunk by chunk.
+
+    Args:
+        ensemble (EnsembleQMIX): The ensemble.
+        buffers (list): PrioritizedExperienceReplay of each member.
+        episode_ids (list | None): List (one per member) of episode ids. All stored episodes if None.
+        chunk_size (int): The number of episodes per member evaluated at once.
+    """
+    if episode_ids is None:
+        episode_ids = [list(buffer.memory.keys()) for buffer in buffers]
+    if any(len(ids) == 0 for ids in episode_ids):
+        return
+
+    max_episodes = max(len(ids) for ids in episode_ids)
+    for start in range(0, max_episodes, chunk_size):
+        size = min(chunk_size, max_episodes - start)
+        # Members with fewer episodes repeat their last episode, so that every member has the same batch size.
+        chunk_ids = []
+        for ids in episode_ids:
+            chunk = list(ids[start: start + size]) or [ids[-1]]
+            chunk_ids.append(chunk + [chunk[-1]] * (size - len(chunk)))
+        td_errors = ensemble.td_errors(stack_batch(buffers, chunk_ids, agents, device), gamma)
+        for buffer, ids, errors in zip(buffers, chunk_ids, td_errors):
+            for episode_id, error in zip(ids, errors):
+                buffer.td_error[int(episode_id)] = error
+
+
+def main(config_file, additional_description=None):
+    base_dir = r"./figures"
+    save_dir_root = os.path.join(base_dir, datetime.now().strftime("%y.%m.%d.%H.%M"))
+
+    print("Reading configuration from config file ...")
+    config                  = parse_yaml(config_file)
+    device_number           = config.get("device_number", 0)
+    description_experiment  = config.get("description_experiment")
+    max_episodes            = config.get("max_episodes")
+    train_frequency         = config.get("train_frequency")
+    PER_mode                = config.get("PER_mode")
+    n_epoch                 = config.get("n_epoch")
+    action_policy           = config.get("action_policy")
+    epsilon_start           = config.get("epsilon_start")
+    epsilon_decay           = config.get("epsilon_decay")
+    days                    = config.get("days")
+    reward_weight           = config.get("reward_weight")
+    production_term         = config.get("total_production")
+    pretrained_parameters   = config.get("pretrained_parameters")
+    n_members               = config.get("ensemble_size", 4)
+    seeds                   = config.get("ensemble_seeds", list(range(n_members)))
+    lrs                     = config.get("ensemble_lrs", 5e-4)
+    reward_weights          = config.get("ensemble_reward_weights", [reward_weight] * n_members)
+    mixer_type              = config.get("mixer", "QMixerRevised")
+
+    assert len(seeds) == n_members, "ensemble_seeds must have ensemble_size entries."
+    assert len(reward_weights) == n_members, "ensemble_reward_weights must have ensemble_size entries."
+    if isinstance(lrs, (int, float)):
+        lrs = [lrs] * n_members
+
+    device = torch.device(f"cuda:{int(device_number)}" if torch.cuda.is_available() else "cpu")
+    print("Using device:", device)
+
+    print("Setting environments ...")
+    envs = [TwoStageROProcessEnvironment(render_mode='silent', len_scenario=None, save_dir=os.path.join(save_dir_root, f'member {e}')) for e in range(n_members)]
+    print("Done.")
+    agents = envs[0].agents
+    input_shapes = {a: envs[0].observation_space(a).shape[0] for a in agents}
+    n_actions = {a: envs[0].action_space(a).n for a in agents}
+    dt = 60.0 * 6
+
+    buffers = [PrioritizedExperienceReplay(agents=agents, prioritize=True, device=device, capacity=450000) for _ in range(n_members)]
+    members = build_members(n_members, agents, input_shapes, n_actions, seeds=seeds, mixer=mixer_type)
+    ensemble = EnsembleQMIX(members, lrs=lrs, device=device, max_grad_norm=10.0)
+    if pretrained_parameters not in (None, 'None'):
+        for e in range(n_members):
+            ensemble.load(e, pretrained_parameters, map_location=device)
+        print("Pretrained parameters successfully loaded.")
+
+    # Scenario sampling of the environment uses the global NumPy generator. Reseed it from each member's own generator.
+    scenario_generators = [np.random.default_rng(seed) for seed in seeds]
+    action_generator = torch.Generator().manual_seed(int(seeds[0]))
+
+    policy_mode = 'boltzmann' if action_policy == 'Boltzmann' else 'epsilon-greedy'
+    epsilon_min = 0.1 if action_policy == 'Boltzmann' else 0.05
+    epsilon_manager = EpsilonManager(epsilon_start=epsilon_start, epsilon_min=epsilon_min, decay_rate=epsilon_decay, decay_type='linear')
+
+    gamma = 0.99
+    begin_train = 10
+    hard_update_frequency = 200
+
+    experiment_description_dict = {}
+    if additional_description is not None:
+        description_experiment += "\n"+additional_description
+    experiment_description_dict.update({
+        'Experiment description': description_experiment,
+        'Pretrained parameters': pretrained_parameters,
+        'gamma': gamma,
+        'Mixer': mixer_type,
+        'Maximum episodes': max_episodes,
+        'Training frequency': train_frequency,
+        'Number of epochs': n_epoch,
+        'PER prioritization mode': PER_mode,
+        'Action policy': action_policy,
+        'Epsilon': f"From {epsilon_start} with decay rate {epsilon_decay}",
+        'Ensemble size': n_members,
+        'Seeds': seeds,
+        'Learning rates': lrs,
+        'Reward weights': reward_weights,
+    })
+
+    for e in range(n_members):
+        os.makedirs(os.path.join(save_dir_root, f'member {e}'), exist_ok=True)
+    shutil.copy(config_file, os.path.join(save_dir_root, "configuration_used.yaml"))
+    save_as_markdown(experiment_description_dict, os.path.join(save_dir_root, 'Experiment description'))
+
+    run_logs = [TrainingLogs(os.path.join(save_dir_root, f'member {e}'),
+                             episode_columns=['episode number', 'reward sum (without convergence correction)', 'epsilon', 'converged'],
+                             train_columns=['target episodes', 'training number', 'final loss'], n_episodes=max_episodes) for e in range(n_members)]
+    train_step = 0
+    first_train = True
+    episode_trained_last = 0
+
+    for episode in range(max_episodes):
+        epsilon_manager.update_epsilon()
+        epsilon = epsilon_manager.get_epsilon()
+
+        # Update target networks (hard update), as in optimize_pressure_RO.py.
+        if episode % hard_update_frequency == 0:
+            print("Update target networks (HARD).")
+            ensemble.update_targets()
+            if episode > 0 and PER_mode != "UNIFORM":
+                refresh_td_errors(ensemble, buffers, agents, device, gamma)
+
+        # Train every member at once.
+        if ((episode_trained_last == 0) or ((episode - episode_trained_last)/train_frequency >= 1.0)) and (episode > begin_train):
+            episode_trained_last = episode
+            for buffer in buffers:
+                if np.sum([len(ep) for ep in buffer.memory.values()]) > buffer.memory_cap:
+                    print("Buffer full! Emptying the memory ...")
+                    buffer.empty_head()
+            if first_train and PER_mode != "UNIFORM":
+                refresh_td_errors(ensemble, buffers, agents, device, gamma)
+            first_train = False
+            # The TD errors are kept up to date by the ensemble itself, so the buffers never call calculate_loss here.
+            for buffer in buffers:
+                buffer.prioritize(None, None, None, None, device, None, gamma=gamma, mode=PER_mode, calculate_for_all=False)
+
+            num_samples = min(32, min(len(buffer.memory) for buffer in buffers))
+            episodes_to_train = [buffer.select_episodes(num_samples=num_samples) for buffer in buffers]
+            batch = stack_batch(buffers, episodes_to_train, agents, device)
+
+            for i in range(n_epoch):
+                losses, episode_losses = ensemble.train_step(batch, gamma)
+                print(f"Training step {train_step:<5} | Epoch [{i:<2}] | Weighted mean loss : " + " / ".join(f"{l:.2f}" for l in losses.tolist()))
+            for e, buffer in enumerate(buffers):
+                for episode_id, error in zip(episodes_to_train[e], episode_losses[e]):
+                    buffer.td_error[int(episode_id)] = error
+
+                run_logs[e].log_training({'target episodes': list(episodes_to_train[e]), 'training number': train_step, 'final loss': losses[e].item()},
+                                         trained_episodes=episodes_to_train[e])
+                member_dir = os.path.join(save_dir_root, f'member {e}')
+                ensemble.save(e, os.path.join(member_dir, f'parameters/{train_step}'))
+            train_step += 1
+
+        # Run one episode per member, in lockstep.
+        initial_action = {"influent_flowrate": 1000.0, "1st_stage_pump": 10.0, "2nd_stage_pump":0.5}
+        previous_observations = []
+        for e, env in enumerate(envs):
+            np.random.seed(int(scenario_generators[e].integers(2**31)))
+            observations, _ = env.reset(hard=False, len_scenario=int(24 * days * 60.0 / dt)+1, initial_action=initial_action, reward_ws=reward_weights[e], production_term=production_term)
+            previous_observations.append(observations)
+        agent_hiddens = ensemble.init_hidden()
+        active = [True] * n_members
+        episode_log_dictionaries = [{'episode number': None, 'reward sum (without convergence correction)': None,
+                                     'epsilon': epsilon, 'converged': None} for _ in range(n_members)]
+        stored_episode_ids = [None] * n_members
+
+        for step in range(1, envs[0].max_control_timestep):
+            scaled = [env.scale_observation(obs) for env, obs in zip(envs, previous_observations)]
+            inputs = {a: torch.from_numpy(np.stack([s[a]['observation'] for s in scaled])).float().to(device) for a in agents}
+            # Finished members keep acting on their last observation (ignored), with every action available.
+            masks = {a: torch.as_tensor(np.stack([s[a]['action_mask'] if active[e] else np.ones(n_actions[a]) for e, s in enumerate(scaled)]), device=device).bool() for a in agents}
+            agent_qs, agent_hiddens = ensemble.act(inputs, agent_hiddens)
+            batch_actions = {a: select_actions(agent_qs[a], masks[a], mode=policy_mode, epsilon=epsilon, temperature=epsilon, generator=action_generator).tolist() for a in agents}
+
+            for e, env in enumerate(envs):
+                if not active[e]:
+                    continue
+                actions = {a: batch_actions[a][e] for a in agents}
+                observations, rewards, truncated, terminated, _, transition = env.step(actions=actions, terminate_if_diverge=True)
+
+                if not env.process_valid:
+                    active[e] = False
+                    continue
+
+                if not any(terminated.values()) or any(truncated.values()):
+                    buffers[e].push(transition, env)
+                    stored_episode_ids[e] = transition["episode_id"] - 1
+                if any(truncated.values()):
+                    episode_log_dictionaries[e]['converged'] = 'True'
+
+                previous_observations[e] = deepcopy(observations)
+
+                if any(terminated[a] or truncated[a] for a in agents):
+                    episode_log_dictionaries[e]['reward sum (without convergence correction)'] = copy(env.reward_sum_log[-1])
+                    active[e] = False
+
+            if not any(active):
+                break
+
+        for e in range(n_members):
+            episode_log_dictionaries[e]['episode number'] = stored_episode_ids[e]
+            run_logs[e].log_episode(episode_log_dictionaries[e])
+        print(f"Episode {episode} done. Reward sums: " + " / ".join(str(d['reward sum (without convergence correction)']) for d in episode_log_dictionaries))
+
+        # TD errors of the new episodes (the last stored episode of each member), as calculate_loss does in optimize_pressure_RO.py.
+        if all(len(buffer.memory) > 0 for buffer in buffers):
+            refresh_td_errors(ensemble, buffers, agents, device, gamma, episode_ids=[[max(buffer.memory.keys())] for buffer in buffers])
+
+    for e in range(n_members):
+        member_dir = os.path.join(save_dir_root, f'member {e}')
+        run_logs[e].close()
+        ensemble.save(e, os.path.join(member_dir, f'parameters/{train_step}'))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Ensemble training. Set from a YAML configuration file.')
+    parser.add_argument('--yaml_file', type=str, help='Path to the YAML file', required=True)
+    parser.add_argument('--description', type=str, help='Additional description about the experiment', required=False)
+    args = parser.parse_args()
+
+    main(config_file=args.yaml_file, additional_description=args.description)
@@ -0,0 +1,18 @@
+import importlib
+import os
+import sys
+import types
+from collections import namedtuple
+
+# The repository has no package metadata: import its modules from the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# algorithms/mixer/QMIX.py only needs the Transition type of the environment module, which is not part of this tree (and
+# needs Julia and PettingZoo). Provide it in memory when the module cannot be imported, so that the QMIX tests run.
+TRANSITION_MODULE = 'TwoStageROProcessEnvironment.env.RecoveryControlledTwoStageROProcess'
+try:
+    importlib.import_module(TRANSITION_MODULE)
+except ImportError:
+    stub = types.ModuleType(TRANSITION_MODULE)
+    stub.Transition = namedtuple('Transition', 'x')
+    sys.modules[TRANSITION_MODULE] = stub
@@ -0,0 +1,62 @@
+import os
+import shutil
+
+import pytest
+import torch
+
+from utils.checkpoint import CheckpointIndex, CheckpointStore, RetentionPolicy
+
+
+def state_dicts(step):
+    return {'mixer_params': {'weight': torch.full((2, 3), float(step))},
+            'agent_a_params': {'fc1.weight': torch.arange(4.0) + step}}
+
+
+def write_checkpoint(root, step, layout):
+    if layout == 'directory':
+        # parameters/<step>/*.pt, as save_model_parameters writes them.
+        directory = os.path.join(root, str(step))
+        os.makedirs(directory)
+        for name, state_dict in state_dicts(step).items():
+            torch.save(state_dict, os.path.join(directory, f'{name}.pt'))
+        return directory
+    path = os.path.join(root, f'step_{step:08d}.pt')
+    torch.save(state_dicts(step), path)
+    return path
+
+
+@pytest.mark.parametrize("layout", ['directory', 'packed'])
+def test_consolidated_steps_survive_deleting_their_files(tmp_path, layout):
+    root = str(tmp_path)
+    paths = [write_checkpoint(root, step, layout) for step in range(3)]
+    CheckpointIndex(root).consolidate()
+
+    for path in paths:
+        shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+    write_checkpoint(root, 3, layout)
+
+    index = CheckpointIndex(root)
+    assert index.steps() == [0, 1, 2, 3]
+    for step in (1, 3):
+        loaded = index.load(step)
+        for name, state_dict in state_dicts(step).items():
+            for key, value in state_dict.items():
+                assert torch.equal(loaded[name][key], value)
+
+
+def test_reported_rewards_are_averaged_per_step(tmp_path):
+    mixer, agent_nets = torch.nn.Linear(2, 1), {'a': torch.nn.Linear(3, 2)}
+    store = CheckpointStore(str(tmp_path), RetentionPolicy(keep_every=0, keep_best=1, keep_recent=2, logarithmic=False))
+    store.save(0, mixer, agent_nets)
+    store.save(1, mixer, agent_nets, reward=2.0)
+    for reward in (-4.0, -3.0, 10.0):
+        store.report_reward(0, reward)
+    store.report_reward(1, 3.0)
+    store.save(2, mixer, agent_nets)
+    store.close()
+
+    # Step 0 had the best last episode (10.0), but step 1 has the better mean (2.5 against 1.0).
+    entries = store.entries()
+    assert [entry['step'] for entry in entries] == [1, 2]
+    assert (entries[0]['reward'], entries[0]['reward count']) == (2.5, 2)
+    assert not os.path.exists(store.path(0))
@@ -0,0 +1,172 @@
+import threading
+
+import numpy as np
+import pytest
+import torch
+
+from algorithms.mixer.QMIX import RNNAgent
+from deployment.controller import (NO_OP_ACTION, ControllerClient, HiddenStateStore, PlantController, make_server,
+                                   parse_request)
+from deployment.runtime import DecentralizedPolicy, RNNAgentRuntime
+from TwoStageROProcessEnvironment.env.observation_bounds import AGENTS, N_ACTIONS, observation_bounds, observation_shapes
+
+
+N_HIDDEN_DIM = 8
+CHECKPOINT_HASH = 'checkpoint-a'
+
+
+def make_policy():
+    torch.manual_seed(0)
+    agent_nets = {a: RNNAgentRuntime({k: v.numpy() for k, v in RNNAgent(n, N_HIDDEN_DIM, N_ACTIONS[a]).state_dict().items()})
+                  for a, n in observation_shapes().items()}
+    return DecentralizedPolicy(agent_nets, manifest={'checkpoint_hash': CHECKPOINT_HASH})
+
+
+def make_store(path=None, checkpoint_hash=CHECKPOINT_HASH):
+    return HiddenStateStore(path, AGENTS, N_HIDDEN_DIM, checkpoint_hash=checkpoint_hash)
+
+
+def random_observations(rng):
+    observations = {}
+    for a, (low, high) in observation_bounds().items():
+        action_mask = (rng.random(N_ACTIONS[a]) < 0.6).astype(np.int8)
+        action_mask[rng.integers(N_ACTIONS[a])] = 1
+        observations[a] = {'observation': rng.uniform(low, high).tolist(), 'action_mask': action_mask.tolist()}
+    return observations
+
+
+def test_later_requests_of_a_plant_wait_for_the_next_batch():
+    rng = np.random.default_rng(0)
+    policy = make_policy()
+    controller = PlantController(policy, make_store(), latency_budget=0.0)
+    messages = [{'id': i, 'plant': plant, 'observations': random_observations(rng)}
+                for i, plant in enumerate(['p1', 'p2', 'p1', 'p3', 'p1'])]
+    for message in messages:
+        controller.submit(parse_request(message, policy))
+
+    batches = []
+    while True:
+        batch = controller._collect()
+        if not batch:
+            break
+        batches.append([request['id'] for _, request, _ in batch])
+        controller.decide([request for _, request, _ in batch])
+    assert batches == [[0, 1, 3], [2], [4]]
+
+    # Same hidden states as deciding the requests one at a time.
+    reference = PlantController(policy, make_store())
+    for message in messages:
+        reference.decide([parse_request(message, policy)])
+    for plant in ('p1', 'p2', 'p3'):
+        for a in AGENTS:
+            np.testing.assert_allclose(controller.store.get(plant)[a], reference.store.get(plant)[a], rtol=1e-6, atol=1e-7)
+        assert controller.store.decisions[plant] == reference.store.decisions[plant]
+
+
+def test_no_op_agents_are_held_at_the_no_op_action():
+    rng = np.random.default_rng(1)
+    policy = make_policy()
+    controller = PlantController(policy, make_store())
+    for _ in range(5):
+        message = {'plant': 'p1', 'observations': random_observations(rng), 'no_op': ['2nd_stage_pump']}
+        actions = controller.decide([parse_request(message, policy)])[0]
+        assert actions['2nd_stage_pump'] == NO_OP_ACTION
+
+
+@pytest.mark.parametrize("change", ['no plant', 'missing agent', 'observation size', 'not finite', 'no valid action',
+                                    'unknown no-op agent'])
+def test_invalid_requests_are_answered_with_an_error(change):
+    policy = make_policy()
+    message = {'id': 3, 'plant': 'p1', 'observations': random_observations(np.random.default_rng(2))}
+    if change == 'no plant':
+        del message['plant']
+    elif change == 'missing agent':
+        del message['observations'][AGENTS[0]]
+    elif change == 'observation size':
+        message['observations'][AGENTS[0]]['observation'].append(0.0)
+    elif change == 'not finite':
+        message['observations'][AGENTS[1]]['observation'][0] = float('nan')
+    elif change == 'no valid action':
+        message['observations'][AGENTS[2]]['action_mask'] = [0] * N_ACTIONS[AGENTS[2]]
+    else:
+        message['no_op'] = ['3rd_stage_pump']
+    with pytest.raises(ValueError):
+        parse_request(message, policy)
+
+    controller = PlantController(policy, make_store())
+    response = controller.handle(message)
+    assert 'error' in response and response['id'] == 3
+    assert controller.stats.summary()['errors'] == 1
+
+
+def test_hidden_states_are_reloaded_for_the_same_checkpoint_only(tmp_path):
+    path = str(tmp_path / 'hidden_states.npz')
+    store = make_store(path)
+    store.set('p1', {a: np.full(N_HIDDEN_DIM, i, dtype=np.float32) for i, a in enumerate(AGENTS)})
+    store.set('p1', {a: np.full(N_HIDDEN_DIM, i + 0.5, dtype=np.float32) for i, a in enumerate(AGENTS)})
+    store.reset('p2')
+    store.save()
+
+    reloaded = make_store(path)
+    assert sorted(reloaded.hidden) == ['p1', 'p2']
+    assert reloaded.decisions == {'p1': 2, 'p2': 0}
+    for i, a in enumerate(AGENTS):
+        np.testing.assert_array_equal(reloaded.get('p1')[a], np.full(N_HIDDEN_DIM, i + 0.5, dtype=np.float32))
+
+    assert make_store(path, checkpoint_hash='checkpoint-b').hidden == {}
+
+
+def serve(policy, path):
+    controller = PlantController(policy, make_store(path), latency_budget=0.001, report_interval=0)
+    server = make_server(controller, port=0)
+    controller.start()
+    threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True).start()
+    return controller, server
+
+
+def shutdown(controller, server):
+    server.shutdown()
+    server.server_close()
+    controller.stop()
+
+
+def test_tcp_round_trip_and_restart(tmp_path):
+    path = str(tmp_path / 'hidden_states.npz')
+    policy = make_policy()
+    plants = [f'train-{i}' for i in range(4)]
+    rng = np.random.default_rng(3)
+    observations = {plant: [random_observations(rng) for _ in range(6)] for plant in plants}
+    # Each plant acted alone, with its own hidden states.
+    expected = {}
+    for plant in plants:
+        reference = DecentralizedPolicy(policy.agent_nets)
+        expected[plant] = [reference.act(o) for o in observations[plant]]
+
+    controller, server = serve(policy, path)
+    responses = {}
+
+    def run_plant(plant):
+        client = ControllerClient(port=server.server_address[1])
+        responses[plant] = [client.act(plant, o, reset=(i == 0), request_id=i) for i, o in enumerate(observations[plant][:4])]
+        client.close()
+
+    threads = [threading.Thread(target=run_plant, args=(plant,)) for plant in plants]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    shutdown(controller, server)
+    for plant in plants:
+        assert [response['actions'] for response in responses[plant]] == expected[plant][:4]
+        assert [response['id'] for response in responses[plant]] == [0, 1, 2, 3]
+
+    # The restarted service continues from the saved hidden states.
+    controller, server = serve(policy, path)
+    assert controller.store.decisions == {plant: 4 for plant in plants}
+    client = ControllerClient(port=server.server_address[1])
+    for plant in plants:
+        for i in (4, 5):
+            assert client.act(plant, observations[plant][i], request_id=i)['actions'] == expected[plant][i]
+    assert client.request({'command': 'stats'})['plants'] == len(plants)
+    client.close()
+    shutdown(controller, server)
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+import torch
+
+from algorithms.mixer.QMIX import (CentralizedRNNAgent, QMixerRevised, RNNAgent, VDN, centralized_mask_and_nothing,
+                                   get_action_from_q, mask_and_nothing)
+from deployment.export import export_checkpoint
+from deployment.runtime import CentralizedPolicy, DecentralizedPolicy, load_policy
+from TwoStageROProcessEnvironment.env.observation_bounds import AGENTS, N_ACTIONS, observation_bounds, observation_shapes, scale_observation
+from utils.checkpoint import pack_state_dicts
+
+
+N_HIDDEN_DIM = 16
+N_STATE_DIM = 12
+N_STEPS = 10
+
+
+def random_observations(rng):
+    observations = {}
+    for a, (low, high) in observation_bounds().items():
+        action_mask = (rng.random(N_ACTIONS[a]) < 0.6).astype(np.int8)
+        action_mask[rng.integers(N_ACTIONS[a])] = 1
+        observations[a] = {'observation': rng.uniform(low, high).astype(np.float32), 'action_mask': action_mask}
+    return observations
+
+
+@pytest.mark.parametrize("mixer_kind", ['QMixerRevised', 'VDN'])
+def test_decentralized_export_matches_torch(tmp_path, mixer_kind):
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    agent_nets = {a: RNNAgent(n, N_HIDDEN_DIM, N_ACTIONS[a]).eval() for a, n in observation_shapes().items()}
+    mixer = QMixerRevised(N_STATE_DIM, len(AGENTS), N_HIDDEN_DIM, 'cpu').eval() if mixer_kind == 'QMixerRevised' else VDN()
+    checkpoint_path = str(tmp_path / 'checkpoint.pt')
+    torch.save(pack_state_dicts(mixer, agent_nets), checkpoint_path)
+    manifest = export_checkpoint(checkpoint_path, str(tmp_path / 'policy.npz'))
+    assert manifest['networks']['mixer_params']['kind'] == mixer_kind
+
+    policy = load_policy(str(tmp_path / 'policy.npz'))
+    assert isinstance(policy, DecentralizedPolicy)
+    hiddens = {a: agent_nets[a].init_hidden() for a in AGENTS}
+    for _ in range(N_STEPS):
+        observations = random_observations(rng)
+        state = rng.uniform(0.0, 1.0, size=(1, N_STATE_DIM)).astype(np.float32)
+        actions = policy.act(observations)
+
+        with torch.no_grad():
+            torch_actions, agent_qs = {}, []
+            for a in AGENTS:
+                inputs = torch.from_numpy(scale_observation(a, observations[a]['observation']))
+                q, hiddens[a] = agent_nets[a](inputs, hiddens[a])
+                np.testing.assert_allclose(policy.last_q[a].reshape(-1), q.numpy(), rtol=1e-5, atol=1e-6)
+                torch_actions[a] = int(mask_and_nothing(observations[a]['action_mask'], q.clone()).argmax())
+                agent_qs.append(q[torch_actions[a]])
+            agent_qs = torch.stack(agent_qs).view(1, -1)
+            if mixer_kind == 'QMixerRevised':
+                q_total = mixer(agent_qs, torch.from_numpy(state))
+            else:
+                q_total = mixer(agent_qs.view(1, 1, -1))
+        assert actions == torch_actions
+        np.testing.assert_allclose(policy.q_total(actions, state), float(q_total.reshape(-1)[0]), rtol=1e-5, atol=1e-6)
+
+
+def test_centralized_export_matches_torch(tmp_path):
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    n_actions_list = [N_ACTIONS[a] for a in AGENTS]
+    agent_net = CentralizedRNNAgent(N_STATE_DIM, N_HIDDEN_DIM, n_actions_list).eval()
+    torch.save({'centralized_agent_params': agent_net.state_dict()}, str(tmp_path / 'checkpoint.pt'))
+    export_checkpoint(str(tmp_path / 'checkpoint.pt'), str(tmp_path / 'policy.npz'))
+
+    policy = load_policy(str(tmp_path / 'policy.npz'))
+    assert isinstance(policy, CentralizedPolicy)
+    hidden = agent_net.init_hidden()
+    for _ in range(N_STEPS):
+        observations = random_observations(rng)
+        state = rng.uniform(0.0, 1.0, size=N_STATE_DIM).astype(np.float32)
+        actions = policy.act(observations, state)
+
+        with torch.no_grad():
+            q, hidden = agent_net(torch.from_numpy(state), hidden)
+        np.testing.assert_allclose(policy.last_q, q.numpy(), rtol=1e-5, atol=1e-6)
+        joint_action = get_action_from_q(centralized_mask_and_nothing(observations, q.clone()), n_actions_list, batch_size=1)
+        assert actions == {a: int(joint_action[i]) for i, a in enumerate(AGENTS)}
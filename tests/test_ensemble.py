@@ -0,0 +1,37 @@
+from copy import deepcopy
+
+import torch
+
+from algorithms.mixer.QMIX import QMixerRevised, RNNAgent
+from algorithms.mixer.ensemble import EnsembleMember, EnsembleQMIX
+
+
+AGENTS = ["a", "b"]
+INPUT_SHAPES = {"a": 3, "b": 4}
+
+
+def make_member():
+    agent_nets = {a: RNNAgent(INPUT_SHAPES[a], 8, 5) for a in AGENTS}
+    return EnsembleMember(agent_nets, QMixerRevised(n_state_dim=6, n_agents=len(AGENTS), n_embedding_dim=8, device='cpu'))
+
+
+def test_stacked_update_matches_single_model_radam():
+    torch.manual_seed(0)
+    members = [make_member() for _ in range(3)]
+    lrs = [5e-4, 1e-3, 2e-3]
+    reference = deepcopy(members[1])
+    ensemble = EnsembleQMIX(members, lrs, device='cpu', max_grad_norm=1.0)
+    optimizer = torch.optim.RAdam(reference.parameters(), lr=lrs[1])
+
+    # Enough steps to cover both the unrectified (rho_t <= 5) and the rectified updates of RAdam.
+    for step in range(12):
+        for k, p in ensemble.params.items():
+            p.grad = torch.randn_like(p) * (step + 1)
+        for k, p in reference.named_parameters():
+            p.grad = ensemble.params[k].grad[1].clone()
+        ensemble.optimizer_step()
+        torch.nn.utils.clip_grad_norm_(reference.parameters(), max_norm=1.0)
+        optimizer.step()
+
+        for k, p in reference.named_parameters():
+            torch.testing.assert_close(ensemble.params[k][1], p, rtol=1e-5, atol=1e-6)
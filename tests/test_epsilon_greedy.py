@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+import torch
+
+from utils.epsilon_greedy import batched_epsilon_greedy, batched_greedy, epsilon_greedy, select_actions
+
+
+def test_all_masked_rows_exploit_the_masked_argmax():
+    q = torch.tensor([[1.0, 3.0, 2.0], [0.5, 0.1, 0.2]])
+    masks = np.array([[1, 0, 1], [0, 0, 0]])
+    assert batched_greedy(q, masks).tolist() == [2, 0]
+    assert batched_epsilon_greedy(q, masks, epsilon=0.0).tolist() == [2, 0]
+    assert epsilon_greedy(q[1], masks[1], epsilon=0.0) == 0
+    with pytest.raises(ValueError):
+        batched_epsilon_greedy(q, masks, epsilon=1.0)
+
+
+def test_numpy_exploration_follows_the_global_seed():
+    q = torch.zeros(64, 5)
+    masks = np.ones((64, 5), dtype=np.int8)
+    np.random.seed(3)
+    first = select_actions(q, masks, mode='epsilon-greedy', epsilon=1.0, generator=np.random)
+    np.random.seed(3)
+    second = select_actions(q, masks, mode='epsilon-greedy', epsilon=1.0, generator=np.random)
+    assert torch.equal(first, second)
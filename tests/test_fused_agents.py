@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import torch
+
+from algorithms.mixer.QMIX import FusedRNNAgents, RNNAgent, mask_and_nothing, softmax_and_mask
+from utils.epsilon_greedy import greedy_action_policy, select_actions
+
+
+AGENTS = ["a", "b", "c"]
+INPUT_SHAPES = {"a": 3, "b": 5, "c": 4}
+N_ACTIONS = {"a": 5, "b": 3, "c": 5}
+N_HIDDEN_DIM = 8
+
+
+@pytest.mark.parametrize("mask_before_softmax", [True, False])
+def test_fused_and_per_agent_paths_pick_the_same_actions(mask_before_softmax):
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    agent_nets = {a: RNNAgent(INPUT_SHAPES[a], N_HIDDEN_DIM, N_ACTIONS[a]) for a in AGENTS}
+    fused = FusedRNNAgents.from_agents(agent_nets)
+    hiddens = {a: agent_nets[a].init_hidden() for a in AGENTS}
+    fused_hiddens = fused.init_hidden()
+
+    for _ in range(20):
+        observations = {a: rng.standard_normal(INPUT_SHAPES[a]).astype(np.float32) for a in AGENTS}
+        action_masks = {a: (rng.random(N_ACTIONS[a]) < 0.6).astype(np.int8) for a in AGENTS}
+        for a in AGENTS:
+            action_masks[a][rng.integers(N_ACTIONS[a])] = 1
+
+        # Per-agent path of optimize_pressure_RO.
+        actions = {}
+        with torch.no_grad():
+            for a in AGENTS:
+                q, hiddens[a] = agent_nets[a](torch.from_numpy(observations[a]), hiddens[a])
+                if mask_before_softmax:
+                    q = mask_and_nothing(action_mask=action_masks[a], Q=q)
+                else:
+                    q = softmax_and_mask(action_mask=action_masks[a], Q=q)
+                actions[a] = greedy_action_policy(q, action_masks[a])
+
+        # Fused path.
+        with torch.no_grad():
+            q, fused_hiddens = fused(fused.pack_inputs(observations), fused_hiddens)
+        packed_masks = fused.pack_action_masks(action_masks)
+        q = fused.mask_q(q, packed_masks, mask_before_softmax=mask_before_softmax)
+        fused_actions = select_actions(q[:, 0], packed_masks, mode='greedy').tolist()
+
+        assert fused_actions == [actions[a] for a in AGENTS]
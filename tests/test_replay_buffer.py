@@ -0,0 +1,72 @@
+from copy import deepcopy
+
+import numpy as np
+import pytest
+import torch
+
+from algorithms.mixer.QMIX import PrioritizedExperienceReplay, RNNAgent
+
+
+AGENTS = ["a", "b"]
+INPUT_SHAPES = {"a": 3, "b": 4}
+N_HIDDEN_DIM = 8
+N_ACTIONS = 5
+
+
+def observations(rng):
+    return {a: {'observation': torch.from_numpy(rng.random(INPUT_SHAPES[a]).astype(np.float32)),
+                'action_mask': np.ones(N_ACTIONS, dtype=np.int8)} for a in AGENTS}
+
+
+def fill_episode(buffer, agent_nets, length, seed=0):
+    """
+    Push one episode collected step by step with agent_nets (as the trainers do), and return the hidden states fed with
+    each previous_observations.
+    """
+    rng = np.random.default_rng(seed)
+    hiddens = {a: agent_nets[a].init_hidden() for a in AGENTS}
+    fed_hiddens = []
+    previous_observations = observations(rng)
+    for _ in range(length):
+        current_observations = observations(rng)
+        transition = {
+            'episode_id': 1,
+            'previous_observations': previous_observations,
+            'observations': current_observations,
+            'actions': {a: 2 for a in AGENTS},
+            'rewards': torch.tensor(0.0),
+            'previous_state': torch.zeros(1, 2),
+            'state': torch.zeros(1, 2),
+        }
+        buffer.push(transition, hiddens=hiddens)
+        fed_hiddens.append(hiddens)
+        with torch.no_grad():
+            hiddens = {a: agent_nets[a](previous_observations[a]['observation'], hiddens[a])[1] for a in AGENTS}
+        previous_observations = current_observations
+    return fed_hiddens
+
+
+@pytest.mark.parametrize("burn_in_index, starting_index", [(0, 0), (4, 7), (4, 4), (2, 9)])
+def test_burn_in_follows_stored_state_rollout(burn_in_index, starting_index):
+    torch.manual_seed(0)
+    agent_nets = {a: RNNAgent(INPUT_SHAPES[a], N_HIDDEN_DIM, N_ACTIONS) for a in AGENTS}
+    buffer = PrioritizedExperienceReplay(agents=AGENTS, device='cpu', store_hidden=True, hidden_interval=2)
+    fed_hiddens = fill_episode(buffer, agent_nets, length=12)
+    episode = buffer.memory[0]
+
+    # With identical target networks, the target state before observations[t] is the collected state one step later.
+    target_agent_nets = deepcopy(agent_nets)
+    agent_hiddens, target_agent_hiddens = buffer.burn_in_hiddens(agent_nets, target_agent_nets, 0, burn_in_index, starting_index)
+    for a in AGENTS:
+        torch.testing.assert_close(agent_hiddens[a].reshape(-1), fed_hiddens[starting_index][a].reshape(-1))
+        torch.testing.assert_close(target_agent_hiddens[a].reshape(-1), fed_hiddens[starting_index + 1][a].reshape(-1))
+
+    # With a different target network: step-by-step target rollout from the stored state over the observation path.
+    target_agent_nets = {a: RNNAgent(INPUT_SHAPES[a], N_HIDDEN_DIM, N_ACTIONS) for a in AGENTS}
+    _, target_agent_hiddens = buffer.burn_in_hiddens(agent_nets, target_agent_nets, 0, burn_in_index, starting_index)
+    for a in AGENTS:
+        h = episode[burn_in_index]['hidden'][a]
+        with torch.no_grad():
+            for t in range(burn_in_index, starting_index + 1):
+                _, h = target_agent_nets[a](episode[t]['previous_observations'][a]['observation'], h)
+        torch.testing.assert_close(target_agent_hiddens[a].reshape(-1), h.reshape(-1))
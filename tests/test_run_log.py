@@ -0,0 +1,22 @@
+import pytest
+
+from utils.run_log import RunLogWriter, read_episode_log
+
+
+def test_resumed_log_appends_under_the_same_header(tmp_path):
+    path = str(tmp_path / 'episode_log.csv')
+    writer = RunLogWriter(path, ['episode number', 'Reward sum'], flush_rows=2)
+    writer.append({'episode number': 0, 'Reward sum': 1.5})
+    assert writer.pending == 1
+    writer.append({'episode number': 1})
+    assert writer.pending == 0
+    writer.close()
+
+    resumed = RunLogWriter(path, ['episode number', 'Reward sum'])
+    resumed.append({'episode number': 2, 'Reward sum': -0.5})
+    resumed.close()
+    log = read_episode_log(str(tmp_path))
+    assert log['episode number'].tolist() == [0, 1, 2]
+
+    with pytest.raises(ValueError):
+        RunLogWriter(path, ['episode number', 'wall time (s)'])
@@ -0,0 +1,29 @@
+import os
+
+from utils.sweep import SweepEngine, expand_grid
+
+
+def init_worker(worker_id):
+    return {'pid': os.getpid()}
+
+
+def worker_pid(state, params, seed):
+    return state['pid']
+
+
+def test_session_keeps_the_workers_across_runs():
+    jobs = expand_grid(root_seed=0, x=list(range(8)))
+    with SweepEngine(init_worker, worker_pid, n_workers=2) as engine:
+        first = {result.value for result in engine.run(jobs[:4], description='first')}
+        second = {result.value for result in engine.run(jobs[4:], description='second')}
+        workers = engine._pool['workers']
+        assert len(workers) == 2
+        assert (first | second) <= {process.pid for process, _ in workers.values()}
+    assert engine._pool is None
+
+
+def test_run_without_session_stops_its_workers():
+    engine = SweepEngine(init_worker, worker_pid, n_workers=2)
+    results = engine.run(expand_grid(root_seed=0, x=list(range(4))))
+    assert all(result.ok for result in results)
+    assert engine._pool is None
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from utils.trace_store import ScenarioTrace, TraceReader, TraceWriter
+
+
+AGENTS = ['a', 'b']
+N_ACTIONS = 3
+MAX_STEPS = 5
+# (checkpoint, hindered agent, concentration, steps)
+SCENARIOS = [(100, None, 500.0, 5), (100, 'a', 500.0, 3), (200, None, 500.0, 4), (200, None, 800.0, 0)]
+
+
+def make_trace(seed, n_steps):
+    rng = np.random.default_rng(seed)
+    trace = ScenarioTrace(AGENTS, max_steps=MAX_STEPS)
+    for step in range(n_steps):
+        observations = {a: {'observation': rng.random(2 + i), 'action_mask': rng.integers(0, 2, N_ACTIONS)}
+                        for i, a in enumerate(AGENTS)}
+        trace.record(step, observations, hiddens={a: rng.random((1, 4)) for a in AGENTS},
+                     agent_qs={a: rng.random(N_ACTIONS) for a in AGENTS}, actions={a: rng.integers(N_ACTIONS) for a in AGENTS},
+                     reward=float(rng.random()), state=rng.random(6))
+    trace.completed = n_steps == MAX_STEPS
+    return trace
+
+
+def write_store(path, **kwargs):
+    traces = [make_trace(seed, n_steps) for seed, (_, _, _, n_steps) in enumerate(SCENARIOS)]
+    with TraceWriter(path, **kwargs) as writer:
+        for (checkpoint, hindered_agent, concentration, _), trace in zip(SCENARIOS, traces):
+            writer.write_scenario(checkpoint, hindered_agent, concentration, trace)
+    return traces
+
+
+@pytest.mark.parametrize("layout", ['chunked', 'contiguous'])
+def test_written_traces_read_back(tmp_path, layout):
+    path = str(tmp_path / 'traces.h5')
+    kwargs = {'compression': 'gzip', 'chunk_rows': 4} if layout == 'chunked' else {'compression': None, 'n_scenarios': len(SCENARIOS)}
+    traces = write_store(path, **kwargs)
+
+    with TraceReader(path) as reader:
+        assert reader.agents == AGENTS
+        assert reader.n_rows == sum(n_steps for *_, n_steps in SCENARIOS)
+        table = reader.scenarios()
+        assert table['hindered agent'].tolist() == ['None', 'a', 'None', 'None']
+        assert table['completed'].tolist() == [True, False, False, False]
+        assert isinstance(reader.field('reward'), np.memmap) == (layout == 'contiguous')
+
+        # One scenario: a contiguous slice of the store.
+        arrays = traces[1].arrays()
+        np.testing.assert_array_equal(reader.scenario_rows(100, 'a', 500.0), np.arange(5, 8))
+        for a in AGENTS:
+            for field in ('observation', 'action_mask', 'hidden', 'q', 'action'):
+                np.testing.assert_array_equal(reader.get(field, a, 100, 'a', 500.0), arrays[f'agents/{a}/{field}'])
+        np.testing.assert_array_equal(reader.get('state', checkpoint=100, hindered_agent='a'), arrays['state'])
+
+        # Several scenarios, and selected control steps.
+        np.testing.assert_array_equal(reader.scenario_rows(concentration=500.0), np.r_[0:5, 8:12])
+        np.testing.assert_array_equal(reader.scenario_rows(hindered_agent='*', checkpoint=100), np.arange(0, 8))
+        assert reader.scenario_rows(300).size == 0
+        expected = np.concatenate([traces[0].arrays()['reward'][[1, 3]], traces[2].arrays()['reward'][[1, 3]]])
+        np.testing.assert_array_equal(reader.get('reward', concentration=500.0, steps=[1, 3]), expected)
+        np.testing.assert_array_equal(reader.get('step', checkpoint=200, concentration=500.0, steps=[2, 3]), [2, 3])
+
+        observations, hiddens, agent_qs = reader.step_dicts(200, None, 500.0, step=2)
+        arrays = traces[2].arrays()
+        for a in AGENTS:
+            np.testing.assert_array_equal(observations[a]['observation'], arrays[f'agents/{a}/observation'][2])
+            np.testing.assert_array_equal(observations[a]['action_mask'], arrays[f'agents/{a}/action_mask'][2])
+            np.testing.assert_array_equal(hiddens[a], arrays[f'agents/{a}/hidden'][2])
+            np.testing.assert_array_equal(agent_qs[a], arrays[f'agents/{a}/q'][2])
+        with pytest.raises(KeyError):
+            reader.step_dicts(200, None, 800.0, step=0)
+
+
+def test_contiguous_store_refuses_rows_past_its_size(tmp_path):
+    path = str(tmp_path / 'traces.h5')
+    with TraceWriter(path, n_scenarios=1, compression=None) as writer:
+        writer.write_scenario(100, None, 500.0, make_trace(0, MAX_STEPS))
+        with pytest.raises(ValueError, match="full"):
+            writer.write_scenario(100, 'a', 500.0, make_trace(1, 1))
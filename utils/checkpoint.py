@@ -0,0 +1,425 @@
+import io
+import json
+import math
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import torch
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def pack_state_dicts(mixer, agent_nets) -> dict:
+    """
+    Snapshot the parameters of the mixing network and agent networks into one dictionary (copied to CPU).
+    Keys are the file names used by save_model_parameters without '.pt' (e.g. 'mixer_params', 'agent_<name>_params'),
+    which is also the layout returned by load_parameters_at_intervals_sequential.
+
+    Args:
+        mixer (torch.nn.Module): The mixing network.
+        agent_nets (dict | FusedRNNAgents): Dictionary of agent networks, or the fused agent networks.
+
+    Returns:
+        dict: Packed state dicts.
+    """
+    def snapshot(state_dict):
+        return {k: v.detach().to('cpu', copy=True) for k, v in state_dict.items()}
+
+    packed = {'mixer_params': snapshot(mixer.state_dict())}
+    if isinstance(agent_nets, dict):
+        for agent_id, agent in agent_nets.items():
+            packed[f'agent_{agent_id}_params'] = snapshot(agent.state_dict())
+    else:
+        # FusedRNNAgents. Stored per agent, in the RNNAgent layout.
+        for agent_id in agent_nets.agents:
+            packed[f'agent_{agent_id}_params'] = snapshot(agent_nets.agent_state_dict(agent_id))
+    return packed
+
+
+def load_packed(path, map_location=None) -> dict:
+    """
+    Load a packed checkpoint file written by CheckpointStore.
+    """
+    return torch.load(path, map_location=map_location)
+
+
+def load_state_dicts(path, map_location=None) -> dict:
+    """
+    Load the state dicts of one checkpoint, either a packed checkpoint file or a directory written by save_model_parameters.
+
+    Returns:
+        dict: Packed state dicts (see pack_state_dicts).
+    """
+    if os.path.isfile(path):
+        return load_packed(path, map_location=map_location)
+    return {
+        os.path.splitext(f)[0]: torch.load(os.path.join(path, f), map_location=map_location)
+        for f in os.listdir(path) if f.endswith('.pt')
+    }
+
+
+def _write_atomic(path, write):
+    # Write to a temporary file first, so that readers never see a partially written file.
+    temporary_path = path + '.tmp'
+    write(temporary_path)
+    os.replace(temporary_path, path)
+
+
+class RetentionPolicy:
+    """
+    Which checkpoints to keep on disk. A checkpoint is kept if any of the following holds:
+    - It is one of the `keep_recent` latest checkpoints.
+    - Its step is a multiple of `keep_every`.
+    - It is one of the `keep_best` checkpoints with the highest evaluation reward. Several rewards can be reported for
+      the same step (one per episode played with its parameters); a checkpoint is ranked by their running mean, which
+      the manifest stores under 'reward' together with their number under 'reward count'.
+    - Logarithmic thinning: with age = latest step - step, its step is a multiple of 2 ** floor(log2(age)) / per_octave,
+      i.e. about `per_octave` checkpoints are kept per doubling of age. The stride only grows with age, so a checkpoint
+      dropped once would never have been kept later.
+    """
+    def __init__(self, keep_every=100, keep_best=5, keep_recent=5, logarithmic=True, per_octave=2):
+        self.keep_every = keep_every
+        self.keep_best = keep_best
+        self.keep_recent = keep_recent
+        self.logarithmic = logarithmic
+        self.per_octave = per_octave    # Power of two.
+
+    def select(self, entries: list) -> set:
+        """
+        Args:
+            entries (list): Manifest entries (dictionaries with 'step' and 'reward').
+
+        Returns:
+            set: Steps to keep.
+        """
+        if not entries:
+            return set()
+        steps = sorted(entry['step'] for entry in entries)
+        latest = steps[-1]
+        keep = set(steps[-self.keep_recent:]) if self.keep_recent > 0 else set()
+
+        if self.keep_every:
+            keep.update(step for step in steps if step % self.keep_every == 0)
+
+        rewarded = [entry for entry in entries if entry.get('reward') is not None]
+        rewarded.sort(key=lambda entry: entry['reward'], reverse=True)
+        keep.update(entry['step'] for entry in rewarded[:self.keep_best])
+
+        if self.logarithmic:
+            for step in steps:
+                age = latest - step
+                stride = 1 if age == 0 else max(1, 2 ** int(math.log2(age)) // self.per_octave)
+                if step % stride == 0:
+                    keep.add(step)
+        return keep
+
+
+class CheckpointStore:
+    """
+    Asynchronous checkpoint store.
+
+    save() only snapshots the state dicts in memory. A background thread writes one packed file per step
+    (<directory>/step_<step>.pt), keeps <directory>/manifest.json up to date and deletes the checkpoints the retention
+    policy drops. Packed files load with load_model_parameters (pass the file path instead of a directory).
+    """
+    def __init__(self, directory, retention: RetentionPolicy = None, max_pending=8):
+        """
+        Args:
+            directory (str): Directory of the packed checkpoints and the manifest.
+            retention (RetentionPolicy): Retention policy. Keeps everything if None.
+            max_pending (int): Maximum number of snapshots waiting to be written. save() blocks beyond it.
+        """
+        self.directory = directory
+        self.retention = retention
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        manifest_path = os.path.join(directory, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as file:
+                for entry in json.load(file)['checkpoints']:
+                    self._entries[entry['step']] = entry
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, name='CheckpointStore', daemon=True)
+        self._thread.start()
+
+    def save(self, step, mixer, agent_nets, reward=None):
+        """
+        Snapshot the parameters of a training step and schedule the write.
+
+        Args:
+            step (int): Training step.
+            mixer (torch.nn.Module): The mixing network.
+            agent_nets (dict | FusedRNNAgents): The agent networks.
+            reward (float): Evaluation reward of the parameters, if already known (see report_reward).
+        """
+        self._raise_if_failed()
+        self._queue.put(('save', step, pack_state_dicts(mixer, agent_nets), reward))
+
+    def report_reward(self, step, reward):
+        """
+        Attach an evaluation reward to a checkpoint (e.g. the reward sum of an episode played with it). Rewards reported
+        for the same step are averaged, so a single lucky episode does not decide the 'keep best' rule of the retention
+        policy. Ignored if the checkpoint was already dropped.
+        """
+        self._raise_if_failed()
+        self._queue.put(('reward', step, None, reward))
+
+    def path(self, step):
+        return os.path.join(self.directory, f'step_{int(step):08d}.pt')
+
+    def entries(self) -> list:
+        # Manifest entries of the checkpoints written so far, sorted by step.
+        with self._lock:
+            return sorted((dict(entry) for entry in self._entries.values()), key=lambda entry: entry['step'])
+
+    def best(self):
+        # Manifest entry of the best checkpoint by reward, or None.
+        rewarded = [entry for entry in self.entries() if entry.get('reward') is not None]
+        return max(rewarded, key=lambda entry: entry['reward']) if rewarded else None
+
+    def flush(self):
+        # Block until every scheduled snapshot is written.
+        self._queue.join()
+        self._raise_if_failed()
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError("Checkpoint writer failed.") from self._error
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                kind, step, packed, reward = item
+                if kind == 'save':
+                    _write_atomic(self.path(step), lambda p: torch.save(packed, p))
+                    with self._lock:
+                        self._entries[step] = {'step': step, 'file': os.path.basename(self.path(step)), 'reward': reward,
+                                               'reward count': int(reward is not None), 'time': time.time()}
+                elif kind == 'reward':
+                    with self._lock:
+                        if step not in self._entries:
+                            continue
+                        entry = self._entries[step]
+                        count = entry.get('reward count', int(entry['reward'] is not None)) + 1
+                        mean = entry['reward'] if count > 1 else 0.0
+                        entry['reward'] = mean + (reward - mean) / count
+                        entry['reward count'] = count
+                self._apply_retention()
+                self._write_manifest()
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _apply_retention(self):
+        if self.retention is None:
+            return
+        with self._lock:
+            keep = self.retention.select(list(self._entries.values()))
+            dropped = [step for step in self._entries if step not in keep]
+            for step in dropped:
+                del self._entries[step]
+        for step in dropped:
+            if os.path.exists(self.path(step)):
+                os.remove(self.path(step))
+
+    def _write_manifest(self):
+        manifest = {'format': 1, 'checkpoints': self.entries()}
+
+        def write(path):
+            with open(path, 'w') as file:
+                json.dump(manifest, file, indent=1)
+        _write_atomic(os.path.join(self.directory, MANIFEST_NAME), write)
+
+
+INDEX_NAME = 'checkpoint_index.json'
+
+
+class CheckpointIndex:
+    """
+    Index of the checkpoints of a run: one JSON file (<root>/checkpoint_index.json) mapping each training step to the
+    byte ranges (file, offset, length) holding its state dicts. Works with both layouts:
+    - parameters/<step>/*.pt directories written by save_model_parameters (one record per file),
+    - packed step_<step>.pt files written by CheckpointStore (one record per step).
+
+    The index is built once and only extended with new steps afterwards, so opening a long run does not list or load
+    every checkpoint. State dicts are loaded on demand and kept in a bounded LRU cache.
+    """
+    def __init__(self, root, cache_size=8, refresh=True):
+        """
+        Args:
+            root (str): The "parameters" directory, or the directory of a CheckpointStore.
+            cache_size (int): Maximum number of checkpoints kept in memory.
+            refresh (bool): Add the steps written since the index was last saved.
+        """
+        self.root = os.path.abspath(root)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._records = {}
+        self._packs = []
+        index_path = os.path.join(self.root, INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as file:
+                index = json.load(file)
+            self._records = {int(step): records for step, records in index['steps'].items()}
+            self._packs = index.get('packs', [])
+        if refresh:
+            self.refresh()
+
+    def refresh(self):
+        """
+        Index the steps not indexed yet, and forget the ones deleted since (e.g. by a retention policy). Steps moved into
+        a pack file by consolidate are kept as long as the pack holds their byte ranges, whether or not their original
+        files still exist.
+        """
+        present = {}
+        manifest_path = os.path.join(self.root, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as file:
+                for entry in json.load(file)['checkpoints']:
+                    present[int(entry['step'])] = entry['file']
+        else:
+            for name in os.listdir(self.root):
+                if name.isdigit():
+                    present[int(name)] = name
+                elif name.startswith('step_') and name.endswith('.pt'):
+                    present[int(name[len('step_'):-len('.pt')])] = name
+
+        changed = False
+        for step in [step for step in self._records if step not in present and not self._in_pack(step)]:
+            del self._records[step]
+            changed = True
+        latest = max(present) if present else None
+        for step, name in present.items():
+            path = os.path.join(self.root, name)
+            # The latest step directory may still be being written by a running trainer. Always index it again.
+            if step in self._records and (self._in_pack(step) or not (step == latest and os.path.isdir(path))):
+                continue
+            if os.path.isdir(path):
+                records = [[os.path.splitext(f)[0], os.path.join(name, f), 0, os.path.getsize(os.path.join(path, f))]
+                           for f in sorted(os.listdir(path)) if f.endswith('.pt')]
+            else:
+                # Packed file. The record name is None, the file holds every state dict of the step.
+                records = [[None, name, 0, os.path.getsize(path)]]
+            changed = changed or self._records.get(step) != records
+            self._records[step] = records
+        if changed:
+            self._write()
+
+    def _in_pack(self, step):
+        # Whether every record of the step lies within a pack file written by consolidate.
+        for _, relative_path, offset, length in self._records[step]:
+            path = os.path.join(self.root, relative_path)
+            if relative_path not in self._packs or not os.path.isfile(path) or os.path.getsize(path) < offset + length:
+                return False
+        return True
+
+    def _write(self):
+        index = {'format': 1, 'steps': {str(step): self._records[step] for step in sorted(self._records)}, 'packs': self._packs}
+
+        def write(path):
+            with open(path, 'w') as file:
+                json.dump(index, file)
+        _write_atomic(os.path.join(self.root, INDEX_NAME), write)
+
+    def steps(self) -> list:
+        return sorted(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, step):
+        return step in self._records
+
+    def load(self, step, map_location=None) -> dict:
+        """
+        State dicts of one step, in the packed layout ({'mixer_params': ..., 'agent_<name>_params': ...}).
+        Served from the LRU cache if recently loaded.
+        """
+        key = (step, str(map_location))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        state_dicts = {}
+        for name, relative_path, offset, length in self._records[step]:
+            with open(os.path.join(self.root, relative_path), 'rb') as file:
+                file.seek(offset)
+                data = torch.load(io.BytesIO(file.read(length)), map_location=map_location)
+            if name is None:
+                state_dicts.update(data)
+            else:
+                state_dicts[name] = data
+
+        self._cache[key] = state_dicts
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return state_dicts
+
+    def consolidate(self, pack_name='checkpoints.pack'):
+        """
+        Append every indexed record into one pack file and point the index at it (offsets within the pack file).
+        The original files are left untouched and can be removed afterwards: refresh keeps the steps held by the pack.
+        """
+        if pack_name not in self._packs:
+            self._packs.append(pack_name)
+        pack_path = os.path.join(self.root, pack_name)
+        offset = os.path.getsize(pack_path) if os.path.exists(pack_path) else 0
+        with open(pack_path, 'ab') as pack:
+            for step in self.steps():
+                new_records = []
+                for name, relative_path, record_offset, length in self._records[step]:
+                    if relative_path == pack_name:
+                        new_records.append([name, relative_path, record_offset, length])
+                        continue
+                    with open(os.path.join(self.root, relative_path), 'rb') as file:
+                        file.seek(record_offset)
+                        pack.write(file.read(length))
+                    new_records.append([name, pack_name, offset, length])
+                    offset += length
+                self._records[step] = new_records
+        self._write()
+
+    def lazy(self, steps=None, map_location=None):
+        """
+        Read-only mapping {step: state dicts} over the given steps (all indexed steps if None), loading on access.
+        """
+        return LazyCheckpoints(self, self.steps() if steps is None else steps, map_location=map_location)
+
+
+class LazyCheckpoints(Mapping):
+    """
+    Mapping {training step: packed state dicts} backed by a CheckpointIndex. Nothing is loaded before it is accessed.
+    """
+    def __init__(self, index: CheckpointIndex, steps, map_location=None):
+        self.index = index
+        self._steps = list(steps)
+        self.map_location = map_location
+
+    def __getitem__(self, step):
+        if step not in self._steps:
+            raise KeyError(step)
+        return self.index.load(step, map_location=self.map_location)
+
+    def __iter__(self):
+        return iter(self._steps)
+
+    def __len__(self):
+        return len(self._steps)
@@ -2,6 +2,161 @@ import torch
 import numpy as np
 from copy import deepcopy
 
+
+# Batched masked action-selection kernels.
+# Q-values are given as Tensor(N, n_actions) for N environments (or agents) and action masks as Tensor(N, n_actions),
+# where nonzero / True marks a valid action. epsilon and temperature are either a float or Tensor(N) (per environment).
+# generator is the source of the random draws: a torch.Generator (on the device of q), None for the global torch RNG, or
+# np.random / a NumPy Generator to draw from NumPy as epsilon_greedy does.
+
+
+def _per_row(value, q):
+    # Broadcast a float or a Tensor(N) to Tensor(N) on the device of q.
+    value = torch.as_tensor(value, dtype=torch.float32, device=q.device)
+    return value.expand(q.shape[0]) if value.dim() == 0 else value.reshape(q.shape[0])
+
+
+def _uniform(shape, q, generator=None):
+    # Uniform samples in [0, 1) on the device of q, from torch (generator None or a torch.Generator) or from NumPy.
+    if generator is None or isinstance(generator, torch.Generator):
+        return torch.rand(shape, device=q.device, generator=generator)
+    return torch.as_tensor(generator.random(tuple(shape)), dtype=torch.float32, device=q.device)
+
+
+def _as_mask(action_mask, q, rows=None):
+    # Boolean mask on the device of q. Raises if one of the rows (all rows if None) has no valid action.
+    mask = torch.as_tensor(action_mask, device=q.device) != 0
+    valid = mask.any(dim=-1)
+    if rows is not None:
+        valid = valid | ~rows
+    if not bool(valid.all()):
+        raise ValueError("No valid actions available.")
+    return mask
+
+
+def _masked_argmax(q: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    # Rows without valid action return the argmax of a row of -inf (action 0), as epsilon_greedy does.
+    return torch.argmax(q.detach().masked_fill(~mask, -torch.inf), dim=-1)
+
+
+def batched_greedy(q: torch.Tensor, action_mask) -> torch.Tensor:
+    """
+    Greedy action among the valid actions for each row (action 0 for a row without valid action).
+
+    Args:
+    q (torch.Tensor): Q-values of shape (N, n_actions).
+    action_mask: Action masks of shape (N, n_actions).
+
+    Returns:
+    torch.Tensor: Selected actions of shape (N,).
+    """
+    return _masked_argmax(q, torch.as_tensor(action_mask, device=q.device) != 0)
+
+
+def batched_random(action_mask, q: torch.Tensor, generator=None) -> torch.Tensor:
+    # Uniformly random action among the valid actions for each row.
+    mask = _as_mask(action_mask, q)
+    scores = _uniform(mask.shape, q, generator)
+    return torch.argmax(scores.masked_fill(~mask, -1.0), dim=-1)
+
+
+def batched_epsilon_greedy(q: torch.Tensor, action_mask, epsilon, generator=None) -> torch.Tensor:
+    """
+    Epsilon-greedy action selection for each row, with per-row epsilon. Only the exploring rows need a valid action;
+    the exploiting ones return the masked argmax (see batched_greedy).
+
+    Args:
+    q (torch.Tensor): Q-values of shape (N, n_actions).
+    action_mask: Action masks of shape (N, n_actions).
+    epsilon (float | torch.Tensor): The probability of choosing a random action, a float or of shape (N,).
+    generator: Optional source of the random draws (see the top of the section).
+
+    Returns:
+    torch.Tensor: Selected actions of shape (N,).
+    """
+    explore = _uniform((q.shape[0],), q, generator) < _per_row(epsilon, q)
+    mask = _as_mask(action_mask, q, rows=explore)
+    scores = _uniform(mask.shape, q, generator)
+    random_actions = torch.argmax(scores.masked_fill(~mask, -1.0), dim=-1)
+    return torch.where(explore, random_actions, _masked_argmax(q, mask))
+
+
+def batched_boltzmann(q: torch.Tensor, action_mask, temperature, generator=None) -> torch.Tensor:
+    """
+    Boltzmann (softmax) action sampling among the valid actions for each row, with per-row temperature.
+
+    Args:
+    q (torch.Tensor): Q-values of shape (N, n_actions).
+    action_mask: Action masks of shape (N, n_actions).
+    temperature (float | torch.Tensor): Softmax temperature, a float or of shape (N,). Clipped at 1e-5.
+    generator: Optional source of the random draws (see the top of the section).
+
+    Returns:
+    torch.Tensor: Selected actions of shape (N,).
+    """
+    mask = _as_mask(action_mask, q)
+    temperature = torch.clamp(_per_row(temperature, q), min=1e-5).unsqueeze(-1)
+    logits = (q.detach().masked_fill(~mask, -torch.inf) / temperature)
+    probabilities = torch.softmax(logits, dim=-1)
+    if generator is None or isinstance(generator, torch.Generator):
+        return torch.multinomial(probabilities, 1, generator=generator).squeeze(-1)
+    # Inverse-CDF sampling from NumPy uniforms.
+    cdf = torch.cumsum(probabilities, dim=-1)
+    u = _uniform((q.shape[0], 1), q, generator) * cdf[:, -1:]
+    return (cdf <= u).sum(dim=-1)
+
+
+def select_actions(q: torch.Tensor, action_mask, mode='greedy', epsilon=0.0, temperature=1.0, generator=None) -> torch.Tensor:
+    """
+    Select actions for N rows in one call. mode is one of 'greedy', 'epsilon-greedy' and 'boltzmann'.
+    """
+    if mode == 'greedy':
+        return batched_greedy(q, action_mask)
+    elif mode == 'epsilon-greedy':
+        return batched_epsilon_greedy(q, action_mask, epsilon, generator=generator)
+    elif mode == 'boltzmann':
+        return batched_boltzmann(q, action_mask, temperature, generator=generator)
+    else:
+        raise ValueError(f"Invalid action selection mode: '{mode}'. Expected 'greedy', 'epsilon-greedy' or 'boltzmann'.")
+
+
+def joint_action_mask(action_masks) -> torch.Tensor:
+    """
+    Joint action mask of centralized policies.
+
+    Args:
+    action_masks: Per-agent action masks of shape (N, n_agents, n_actions).
+
+    Returns:
+    torch.Tensor: Boolean mask of shape (N, n_actions, ..., n_actions), True if every agent's action is valid.
+    """
+    action_masks = torch.as_tensor(action_masks) != 0
+    N, n_agents, n_actions = action_masks.shape
+    joint = torch.ones((N,) + (n_actions,) * n_agents, dtype=torch.bool, device=action_masks.device)
+    for i in range(n_agents):
+        shape = [N] + [1] * n_agents
+        shape[i + 1] = n_actions
+        joint = joint & action_masks[:, i].view(shape)
+    return joint
+
+
+def centralized_select_actions(q: torch.Tensor, action_masks, mode='greedy', epsilon=0.0, temperature=1.0, generator=None) -> torch.Tensor:
+    """
+    Select joint actions of centralized policies for N environments in one call.
+
+    Args:
+    q (torch.Tensor): Joint Q-values of shape (N, n_actions, ..., n_actions), e.g. (N, 5, 5, 5).
+    action_masks: Per-agent action masks of shape (N, n_agents, n_actions).
+
+    Returns:
+    torch.Tensor: Selected actions of shape (N, n_agents).
+    """
+    n_actions_list = list(q.shape[1:])
+    mask = joint_action_mask(torch.as_tensor(action_masks, device=q.device)).reshape(q.shape[0], -1)
+    flat_actions = select_actions(q.reshape(q.shape[0], -1), mask, mode=mode, epsilon=epsilon, temperature=temperature, generator=generator)
+    return torch.stack(torch.unravel_index(flat_actions, n_actions_list), dim=-1)
+
+
 def epsilon_greedy(agent_q: torch.Tensor, action_mask: np.ndarray, epsilon: float):
     """
     Performs epsilon-greedy action selection based on the given Q-values and action mask.
@@ -110,22 +265,12 @@ def greedy_action_policy(q_values: torch.Tensor, action_mask) -> int:
     return sampled_action
 
 def get_action_from_q(q_values, n_actions_list, batch_size):
-    # Flatten the Q-values to find the max
-    q_values_flat = q_values.view(batch_size, -1)  # Shape: (batch_size, total_joint_actions)
-    max_q_values, max_indices = q_values_flat.max(dim=1)  # Shape: (batch_size,)
-
-    # Convert flat indices back to action indices for each agent
-    joint_action_indices = []
-    for idx in max_indices:
-        idx = idx.item()
-        actions = []
-        for n_actions in reversed(n_actions_list):
-            actions.append(idx % n_actions)
-            idx = idx // n_actions
-        joint_action_indices.append(list(reversed(actions)))
-
-    # joint_action_indices: List of lists, each containing the action indices for each agent
-    return np.array(joint_action_indices).squeeze()
+    # Flatten the Q-values to find the max, and convert flat indices back to action indices for each agent
+    max_indices = q_values.reshape(batch_size, -1).argmax(dim=1)  # Shape: (batch_size,)
+    joint_action_indices = torch.stack(torch.unravel_index(max_indices, list(n_actions_list)), dim=-1)
+
+    # joint_action_indices: (batch_size, n_agents), each row containing the action indices for each agent
+    return joint_action_indices.cpu().numpy().squeeze()
 
 def centralized_epsilon_greedy(agent_q: torch.Tensor, observation, epsilon: float, n_actions_list):
     mask = []
@@ -157,6 +302,31 @@ class DistributedActionController():
         self.action_count += 1
         
         return sampled_action
+
+    def take_action_batched(self, agent_qs, action_mask):
+        """
+        Greedy actions for N environments in lockstep. Hindered agents are forced to take action 2 (No-Op) with a batched mask.
+
+        Args:
+        agent_qs (dict): Q-values of each agent, of shape (N, n_actions).
+        action_mask (dict): Action masks of each agent, of shape (N, n_actions).
+        The timeline of each agent is either (len_episode,) (shared by the N environments) or (N, len_episode).
+
+        Returns:
+        dict: Selected actions of each agent, of shape (N,).
+        """
+        sampled_action = {}
+        for a in self.timeline.keys():
+            q = agent_qs[a]
+            mask = torch.as_tensor(action_mask[a], device=q.device) != 0
+            active = torch.as_tensor(np.asarray(self.timeline[a])[..., self.action_count], device=q.device).bool()
+            no_op = torch.zeros_like(mask)
+            no_op[..., 2] = True
+            mask = torch.where(active.reshape(-1, 1), mask, no_op)
+            sampled_action[a] = batched_greedy(q, mask)
+        self.action_count += 1
+
+        return sampled_action
     
     def reset_action_count(self):
         self.action_count = 0
@@ -0,0 +1,185 @@
+"""
+ Evaluation rollouts of frozen agent networks run entirely in Julia ("julia modules/policy_rollout.jl").
+
+ In the evaluation loop of evaluate_intended_failure.run_timeline, every control step crosses the Python-Julia boundary
+twice (model call, then the conversion of its logs) and runs three batch-1 torch forwards. For frozen policies, the
+agent networks (Linear-ReLU-GRUCell-Linear) are small enough to run in Julia as well: the weights are handed over once,
+and the whole episode (observations, action masks, hindered greedy actions, process model, reward) runs in Julia. The
+scenarios of a batch run on the Julia threads, each with its own process state, and the summaries of the batch come back
+to Python in one call.
+
+ Julia threads are fixed when juliacall is first imported: call configure_julia_threads() before importing juliacall
+(or the environment), or set PYTHON_JULIACALL_THREADS. Traces (utils.trace_store) are not recorded in Julia.
+
+ Usage:
+    rollout = JuliaRollout(parameters, control_interval=env.control_interval, max_control_timestep=env.max_control_timestep)
+    feed_scenarios = sample_feed_scenarios(env, feed_concentrations, len_scenario)
+    results = rollout.run(feed_scenarios, timelines)
+"""
+import os
+
+import numpy as np
+
+from TwoStageROProcessEnvironment.env.observation_bounds import AGENTS, observation_bounds
+
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+POLICY_ROLLOUT_PATH = os.path.join(REPOSITORY_ROOT, "TwoStageROProcessEnvironment", "julia modules", "policy_rollout.jl")
+AGENT_PARAMETERS = ['fc1.weight', 'fc1.bias', 'rnn.weight_ih', 'rnn.weight_hh', 'rnn.bias_ih', 'rnn.bias_hh', 'fc2.weight', 'fc2.bias']
+# Columns of the summary matrix of PolicyRollout.rollout_episodes.
+SUMMARY_COLUMNS = ['valid', 'Reward sum', 'mean concentration', 'converged', 'mean SEC', 'mean production', 'steps']
+INITIAL_ACTION = {"influent_flowrate": 1000.0, "1st_stage_pump": 10.0, "2nd_stage_pump": 0.5}
+
+
+def configure_julia_threads(threads='auto'):
+    """
+    Let the Julia runtime of this process start with `threads` threads (unless PYTHON_JULIACALL_THREADS is set).
+    Threaded Julia code called from Python needs the Julia signal handling, enabled as well. No effect once juliacall
+    has been imported.
+    """
+    os.environ.setdefault('PYTHON_JULIACALL_THREADS', str(threads))
+    os.environ.setdefault('PYTHON_JULIACALL_HANDLE_SIGNALS', 'yes')
+
+
+def agent_weights(parameters, agents=AGENTS) -> dict:
+    """
+    Returns:
+        dict: Float32 arrays of the AGENT_PARAMETERS of each agent, from torch state dicts ({'agent_<a>_params': state
+              dict}), a parameter directory / packed checkpoint, or a weight file of deployment/export.py (.npz).
+    """
+    if isinstance(parameters, str) and parameters.endswith('.npz'):
+        from deployment.runtime import load_weights
+        manifest, weights = load_weights(parameters)
+        kinds = {name: spec['kind'] for name, spec in manifest['networks'].items()}
+    else:
+        if isinstance(parameters, str):
+            from utils.checkpoint import load_state_dicts
+            parameters = load_state_dicts(parameters, 'cpu')
+        weights = {name: {key: value.detach().cpu().numpy() for key, value in state_dict.items()} for name, state_dict in parameters.items()}
+        kinds = {name: 'RNNAgent' if 'rnn.weight_ih' in state_dict and name.startswith('agent_') else None for name, state_dict in weights.items()}
+
+    arrays = {}
+    for a in agents:
+        name = f'agent_{a}_params'
+        if kinds.get(name) != 'RNNAgent':
+            raise ValueError(f"Julia rollouts need one RNNAgent per agent: no RNNAgent {name} in the checkpoint.")
+        arrays[a] = {key: np.ascontiguousarray(weights[name][key], dtype=np.float32) for key in AGENT_PARAMETERS}
+    return arrays
+
+
+def sample_feed_scenarios(env, feed_concentrations, len_scenario) -> np.ndarray:
+    """
+    Feed scenarios sampled as TwoStageROProcessEnvironment.reset samples them (random start point, fixed concentration
+    with noise), from the global NumPy random state.
+
+    Returns:
+        np.ndarray: (len(feed_concentrations), len_scenario, 3) feed scenarios (T, C, P_in).
+    """
+    return np.stack([env.sample_scenario(len_scenario=len_scenario, concentration=concentration, range=200.0, noise=True)[0]
+                     for concentration in feed_concentrations])
+
+
+def stack_timelines(timelines, agents=AGENTS) -> np.ndarray:
+    """
+    Returns:
+        np.ndarray: (N, n_agents, n_steps) boolean array of N timelines, each an array (n_agents, n_steps) or a dict of
+                    per-agent arrays (generate_distributed_control_scenario).
+    """
+    return np.stack([np.stack([timeline[a] for a in agents]) if isinstance(timeline, dict) else np.asarray(timeline)
+                     for timeline in timelines]).astype(bool)
+
+
+class JuliaRollout:
+    def __init__(self, parameters, agents=AGENTS, bounds=None, control_interval=1, max_control_timestep=120):
+        """
+        Args:
+            parameters: Checkpoint of the agent networks (see agent_weights).
+            agents (list): Agents, in the order of the environment.
+            bounds (dict): Observation (low, high) of each agent (observation_bounds() if None).
+            control_interval (int): Model timesteps per control step (TwoStageROProcessEnvironment.control_interval).
+            max_control_timestep (int): Episode length in control steps (TwoStageROProcessEnvironment.max_control_timestep).
+        """
+        import juliacall
+        from juliacall import convert as jlconvert
+
+        self.agents = list(agents)
+        self.control_interval = int(control_interval)
+        self.max_control_timestep = int(max_control_timestep)
+        self.jl = juliacall.Main
+        self.jlconvert = jlconvert
+        if not bool(self.jl.seval("isdefined(Main, :PolicyRollout)")):
+            self.jl.seval(f'include(raw"{POLICY_ROLLOUT_PATH}")')
+        self.module = self.jl.PolicyRollout
+        self.drain_julia_events = self.jl.PressureControlledRO.drain_events_b
+
+        bounds = bounds or observation_bounds()
+        weights = agent_weights(parameters, self.agents)
+        self.julia_agents = self.jl.seval("PolicyRollout.GRUAgent[]")
+        for a in self.agents:
+            w = weights[a]
+            low, high = bounds[a]
+            arguments = [w[key] for key in AGENT_PARAMETERS] + [np.asarray(low, dtype=np.float32), np.asarray(high, dtype=np.float32)]
+            self.jl.push_b(self.julia_agents, self.module.GRUAgent(*[jlconvert(T=self.jl.Array, x=array) for array in arguments]))
+
+    @property
+    def threads(self) -> int:
+        return int(self.jl.seval("Threads.nthreads()"))
+
+    def run(self, feed_scenarios, timelines, reward_weight=(0.5, 0.5), production_term=False, initial_action=INITIAL_ACTION) -> dict:
+        """
+        Run one greedy episode per scenario in Julia (evaluate_intended_failure.run_timeline without trace and cache).
+
+        Args:
+            feed_scenarios (np.ndarray): (N, len_scenario, 3) feed scenarios (see sample_feed_scenarios).
+            timelines: N hindering timelines (see stack_timelines), False where the agent is forced to No-Op.
+            reward_weight (tuple): (w_SEC, w_eff) of the reward.
+            production_term (bool): Add the production credit at the episode end.
+            initial_action (dict): Action of the reset.
+
+        Returns:
+            dict: Arrays of the N scenarios: the SUMMARY_COLUMNS ('valid' and 'converged' boolean, 'steps' int) and
+                  'actions' (N, n_agents, max_control_timestep), -1 after the episode end.
+        """
+        feed_scenarios = np.ascontiguousarray(feed_scenarios, dtype=np.float64)
+        timelines = stack_timelines(timelines, self.agents)
+        if timelines.shape[0] != feed_scenarios.shape[0] or timelines.shape[2] < self.max_control_timestep - 1:
+            raise ValueError(f"Expected {feed_scenarios.shape[0]} timelines of at least {self.max_control_timestep - 1} steps, got {timelines.shape}.")
+
+        summaries, actions = self.module.rollout_episodes(
+            self.julia_agents, self.jlconvert(T=self.jl.Array, x=feed_scenarios), self.jlconvert(T=self.jl.Array, x=timelines),
+            initial_action=tuple(float(initial_action[a]) for a in self.agents), control_interval=self.control_interval,
+            max_control_timestep=self.max_control_timestep, reward_weight=tuple(float(w) for w in reward_weight),
+            production_term=bool(production_term))
+
+        # Divergence and iteration-cap events of the model are counted in Julia, as in the environment.
+        from utils.metrics import metrics
+        metrics.record_julia_events(self.drain_julia_events())
+
+        summaries = np.array(summaries)
+        results = {column: summaries[:, i] for i, column in enumerate(SUMMARY_COLUMNS)}
+        results['valid'] = results['valid'] > 0.5
+        results['converged'] = results['converged'] > 0.5
+        results['steps'] = results['steps'].astype(np.int64)
+        results['actions'] = np.array(actions)
+        return results
+
+
+def episode_summaries(results) -> list:
+    """
+    Returns:
+        list: Per scenario, the summary of evaluate_intended_failure.run_timeline ('Reward sum', 'mean concentration',
+              'converged', 'mean SEC', 'mean production'), or None if the process became invalid before the episode end.
+    """
+    summaries = []
+    for i, valid in enumerate(results['valid']):
+        if not valid:
+            summaries.append(None)
+            continue
+        summaries.append({
+            'Reward sum': float(results['Reward sum'][i]),
+            'mean concentration': float(results['mean concentration'][i]),
+            'converged': True if results['converged'][i] else None,
+            'mean SEC': float(results['mean SEC'][i]),
+            'mean production': float(results['mean production'][i]),
+        })
+    return summaries
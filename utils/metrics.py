@@ -0,0 +1,244 @@
+import bisect
+import csv
+import os
+import time
+
+import numpy as np
+
+
+# Log-spaced default histogram buckets (upper bounds), wide enough for losses and TD errors.
+DEFAULT_BUCKETS = tuple(float(b) for b in np.logspace(-4, 4, 17))
+
+
+class Counter:
+    """Monotonically increasing value (e.g. environment steps, divergences)."""
+    kind = 'counter'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0.0
+
+    def inc(self, value=1):
+        self.value += value
+
+
+class Gauge:
+    """Value which can go up and down (e.g. loss, buffer fill, epsilon)."""
+    kind = 'gauge'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = float('nan')
+
+    def set(self, value):
+        self.value = float(value)
+
+
+class Histogram:
+    """Distribution of observed values in fixed buckets (e.g. TD errors, per-episode losses)."""
+    kind = 'histogram'
+
+    def __init__(self, name, help='', buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_counts = [0] * (len(self.buckets) + 1)  # Last bucket is +Inf.
+        self.count = 0
+        self.sum = 0.0
+
+    def reset(self):
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        value = float(value)
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def observe_many(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if values.size == 0:
+            return
+        indices = np.searchsorted(self.buckets, values, side='left')
+        counts = np.bincount(indices, minlength=len(self.bucket_counts))
+        self.bucket_counts = [c + int(n) for c, n in zip(self.bucket_counts, counts)]
+        self.count += int(values.size)
+        self.sum += float(values.sum())
+
+    def quantile(self, q):
+        """
+        Quantile estimated from the buckets (linear interpolation inside the bucket, as Prometheus' histogram_quantile).
+        """
+        if self.count == 0:
+            return float('nan')
+        rank = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.bucket_counts):
+            if cumulative + bucket_count >= rank and bucket_count > 0:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else float('nan')
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms of a run, replacing per-step prints.
+    report() prints a one-line summary at most every `report_interval` seconds (with per-second rates of the counters)
+    and writes the configured exporters: a Prometheus text file (node-exporter textfile format) and a long-format CSV.
+    """
+    def __init__(self, prefix='romarl', report_interval=30.0):
+        self.prefix = prefix
+        self.report_interval = report_interval
+        self.prometheus_path = None
+        self.csv_path = None
+        self.console = True
+        self._metrics = {}
+        self._last_report = time.monotonic()
+        self._last_counter_values = {}
+
+    def configure(self, report_interval=None, prometheus_path=None, csv_path=None, console=None):
+        """
+        Args:
+            report_interval (float): Minimum seconds between two reports.
+            prometheus_path (str): Prometheus text file rewritten at each report.
+            csv_path (str): CSV file (timestamp, metric, value) appended at each report.
+            console (bool): Print the summary line at each report.
+        """
+        if report_interval is not None:
+            self.report_interval = report_interval
+        if prometheus_path is not None:
+            self.prometheus_path = prometheus_path
+        if csv_path is not None:
+            self.csv_path = csv_path
+        if console is not None:
+            self.console = console
+        return self
+
+    def _get(self, metric_class, name, help, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = metric_class(name, help, **kwargs)
+            self._metrics[name] = metric
+        elif not isinstance(metric, metric_class):
+            raise TypeError(f"Metric '{name}' is already registered as a {metric.kind}.")
+        return metric
+
+    def counter(self, name, help='') -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help='') -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def record_julia_events(self, events):
+        """
+        Add the event counts drained from the Julia model (drain_events! of RO_Utils_Module) to counters named
+        julia_<event>.
+        """
+        for name, count in events.items():
+            self.counter(f"julia_{name}", f"Julia model event '{name}'").inc(int(count))
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: {metric name: value}. Histograms give count, mean, p50 and p90.
+        """
+        values = {}
+        for name, metric in self._metrics.items():
+            if metric.kind == 'histogram':
+                values[f"{name} count"] = metric.count
+                values[f"{name} mean"] = metric.mean
+                values[f"{name} p50"] = metric.quantile(0.5)
+                values[f"{name} p90"] = metric.quantile(0.9)
+            else:
+                values[name] = metric.value
+        return values
+
+    def report(self, force=False):
+        """
+        Print the summary and write the exporters, if `report_interval` seconds passed since the last report.
+
+        Returns:
+            bool: Whether a report was made.
+        """
+        now = time.monotonic()
+        elapsed = now - self._last_report
+        if not force and elapsed < self.report_interval:
+            return False
+        if self.console:
+            print(self.summary_line(elapsed))
+        if self.prometheus_path is not None:
+            self.export_prometheus(self.prometheus_path)
+        if self.csv_path is not None:
+            self.export_csv(self.csv_path)
+        self._last_counter_values = {name: metric.value for name, metric in self._metrics.items() if metric.kind == 'counter'}
+        self._last_report = now
+        return True
+
+    def summary_line(self, elapsed=None):
+        if elapsed is None:
+            elapsed = time.monotonic() - self._last_report
+        terms = []
+        for name, metric in self._metrics.items():
+            if metric.kind == 'counter':
+                rate = (metric.value - self._last_counter_values.get(name, 0.0)) / max(elapsed, 1e-9)
+                terms.append(f"{name}: {metric.value:.0f} ({rate:.2f}/s)")
+            elif metric.kind == 'gauge':
+                terms.append(f"{name}: {metric.value:.4g}")
+            elif metric.count > 0:
+                terms.append(f"{name}: p50 {metric.quantile(0.5):.3g} / p90 {metric.quantile(0.9):.3g} (n={metric.count})")
+        return "[Metrics] " + " | ".join(terms)
+
+    def _exported_name(self, name):
+        name = ''.join(c if c.isalnum() or c == '_' else '_' for c in name)
+        return f"{self.prefix}_{name}" if self.prefix else name
+
+    def export_prometheus(self, path):
+        lines = []
+        for name, metric in self._metrics.items():
+            exported = self._exported_name(name)
+            if metric.help:
+                lines.append(f"# HELP {exported} {metric.help}")
+            lines.append(f"# TYPE {exported} {metric.kind}")
+            if metric.kind == 'histogram':
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets, metric.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f'{exported}_bucket{{le="{bound:g}"}} {cumulative}')
+                lines.append(f'{exported}_bucket{{le="+Inf"}} {metric.count}')
+                lines.append(f"{exported}_sum {metric.sum:g}")
+                lines.append(f"{exported}_count {metric.count}")
+            else:
+                lines.append(f"{exported} {metric.value:g}")
+        # Written atomically, so that a scraper never reads a half-written file.
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temporary_path, path)
+
+    def export_csv(self, path):
+        # Long format (one row per metric), so that metrics registered later do not change the columns.
+        timestamp = time.time()
+        new_file = not os.path.exists(path)
+        with open(path, 'a', newline='') as file:
+            writer = csv.writer(file)
+            if new_file:
+                writer.writerow(['timestamp', 'metric', 'value'])
+            writer.writerows((timestamp, name, value) for name, value in self.snapshot().items())
+
+
+# Process-wide registry used by the environment, the replay buffer and the training scripts.
+metrics = MetricsRegistry()
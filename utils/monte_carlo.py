@@ -0,0 +1,85 @@
+"""
+ Running statistics and confidence-interval stopping of Monte Carlo evaluations.
+
+ Every configuration (e.g. checkpoint x feed concentration x hindering period) accumulates the outcomes of its
+replicates with Welford's algorithm, and stops as soon as the Student-t confidence interval of every tracked metric is
+narrower than its target, instead of running a fixed number of replicates.
+"""
+import numpy as np
+from scipy import stats
+
+
+class RunningStats:
+    """Welford's running mean and variance of several metrics, updated one replicate at a time."""
+    def __init__(self, metrics):
+        self.metrics = list(metrics)
+        self.count = 0
+        self.mean = np.zeros(len(self.metrics))
+        self.m2 = np.zeros(len(self.metrics))
+
+    def update(self, values: dict):
+        x = np.array([values[m] for m in self.metrics], dtype=np.float64)
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    @property
+    def variance(self) -> np.ndarray:
+        """Unbiased sample variance (NaN with less than 2 replicates)."""
+        if self.count < 2:
+            return np.full(len(self.metrics), np.nan)
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.variance)
+
+    def half_width(self, confidence=0.95) -> np.ndarray:
+        """Half width of the Student-t confidence interval of the mean (inf with less than 2 replicates)."""
+        if self.count < 2:
+            return np.full(len(self.metrics), np.inf)
+        return stats.t.ppf(0.5 + confidence / 2, self.count - 1) * self.std / np.sqrt(self.count)
+
+    def summary(self, confidence=0.95) -> dict:
+        half_width = self.half_width(confidence)
+        summary = {'replicates': self.count}
+        for i, metric in enumerate(self.metrics):
+            summary[f'{metric} mean'] = self.mean[i]
+            summary[f'{metric} std'] = self.std[i]
+            summary[f'{metric} ci half width'] = half_width[i]
+        return summary
+
+
+class ConfidenceStopping:
+    """
+    Stopping rule of a configuration: its confidence interval is narrower than the target for every metric, i.e. its
+    half width is below `absolute[metric]` if given, else below `relative` x |mean|.
+    """
+    def __init__(self, relative=0.02, absolute=None, confidence=0.95, min_replicates=8, max_replicates=256):
+        """
+        Args:
+            relative (float): Target half width, relative to the absolute mean.
+            absolute (dict): Target half width of some metrics, in their unit (takes precedence over `relative`).
+            confidence (float): Confidence level of the intervals.
+            min_replicates (int): Replicates run before the rule applies (the variance estimate of a few replicates is
+                                  unreliable).
+            max_replicates (int): Budget of a configuration, stopped even if its intervals are still too wide.
+        """
+        self.relative = relative
+        self.absolute = absolute or {}
+        self.confidence = confidence
+        self.min_replicates = min_replicates
+        self.max_replicates = max_replicates
+
+    def targets(self, running: RunningStats) -> np.ndarray:
+        return np.array([self.absolute.get(m, self.relative * abs(running.mean[i])) for i, m in enumerate(running.metrics)])
+
+    def converged(self, running: RunningStats) -> bool:
+        if running.count < max(self.min_replicates, 2):
+            return False
+        return bool(np.all(running.half_width(self.confidence) <= self.targets(running)))
+
+    def done(self, running: RunningStats, attempts: int) -> bool:
+        """`attempts` counts every replicate run, including those without outcome (e.g. an invalid process)."""
+        return attempts >= self.max_replicates or self.converged(running)
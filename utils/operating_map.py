@@ -0,0 +1,248 @@
+"""
+ Constant-setpoint operating map of the two-stage RO process.
+
+ The steady SEC, production and permeate quality over a grid of setpoints (influent flowrate, 1st stage pressure,
+2nd stage pressure) × feed (temperature, concentration), for baselines, sanity checks of policies, action-mask tuning and
+reward calibration. Instead of one reset / step of the environment per grid point, the whole grid is simulated by
+pressure_controlled_2stage_ro_simple in Julia ("julia modules/operating_map.jl"), the grid points running on the Julia
+threads. Each point runs from a clean membrane; with a fouling horizon, its quantities are recorded at several times of
+one constant-setpoint run.
+
+ Maps are cached as .npz files (uncompressed arrays and a JSON manifest), keyed by the grid, the model fidelity and the
+source of the Julia model, so that a map is only simulated once. Lookups interpolate the map linearly (NaN outside the
+grid and next to diverged points).
+
+ Usage:
+    operating_map = generate_operating_map(flowrates, pressures_1st, pressures_2nd, [20.0], concentrations,
+                                           hours=[0.0, 24.0 * 30], cache_dir='operating_maps')
+    operating_map.lookup('SEC', flowrate=1000.0, pressure_1st=10.0, pressure_2nd=0.5, temperature=20.0, concentration=500.0)
+"""
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+from tqdm import tqdm
+
+from utils.julia_rollout import REPOSITORY_ROOT, configure_julia_threads
+
+
+JULIA_MODULES_PATH = os.path.join(REPOSITORY_ROOT, "TwoStageROProcessEnvironment", "julia modules")
+OPERATING_MAP_PATH = os.path.join(JULIA_MODULES_PATH, "operating_map.jl")
+# Julia sources of the model: a change invalidates the cached maps.
+MODEL_SOURCES = ['RO_Utils_Module.jl', 'ro_basic.jl', 'pressure_controlled_ro_simple.jl', 'operating_map.jl']
+# Quantities of the map (QUANTITIES of operating_map.jl), in the order of the Julia array.
+QUANTITIES = ['SEC', 'production', 'permeate concentration', 'recovery', 'recovery 1st', 'brine concentration',
+              'brine pressure', 'feed pressure 1st', 'feed pressure 2nd']
+AXES = ('flowrate', 'pressure_1st', 'pressure_2nd', 'temperature', 'concentration')
+MODEL_DT = 60.0 * 6
+MANIFEST_KEY = '__manifest__'
+# Reward of TwoStageROProcessEnvironment._calculate_reward.
+P_DIVERGE = 1.0
+PRODUCTION_CRITERIA = 1000.0
+PRODUCTION_LOWER_LIMIT = 700.0
+
+
+def model_hash() -> str:
+    digest = hashlib.sha256()
+    for source in MODEL_SOURCES:
+        with open(os.path.join(JULIA_MODULES_PATH, source), 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def horizon_steps(hours, dt=MODEL_DT) -> np.ndarray:
+    """
+    Returns:
+        np.ndarray: Sorted unique model steps (1-based) at `hours` of operation, hour 0 being the first step.
+    """
+    return np.unique(np.round(np.asarray(hours, dtype=np.float64) * 3600.0 / dt).astype(np.int64) + 1)
+
+
+class OperatingMap:
+    QUANTITIES = QUANTITIES
+
+    def __init__(self, axes, steps, values, manifest=None):
+        """
+        Args:
+            axes (dict): Ascending grid values of each of the AXES.
+            steps (np.ndarray): Model steps at which the quantities were recorded.
+            values (np.ndarray): (len(QUANTITIES), *grid shape, len(steps)) quantities, NaN where the process diverged.
+            manifest (dict): Grid, fidelity and model hash of the map.
+        """
+        self.axes = {name: np.asarray(axes[name], dtype=np.float64) for name in AXES}
+        self.steps = np.asarray(steps, dtype=np.int64)
+        self.hours = (self.steps - 1) * MODEL_DT / 3600.0
+        self.values = np.asarray(values, dtype=np.float64)
+        self.manifest = manifest or {}
+        self._interpolators = {}
+
+    @property
+    def shape(self) -> tuple:
+        return tuple(len(self.axes[name]) for name in AXES) + (len(self.steps),)
+
+    def quantity(self, name) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: (*grid shape, len(steps)) values of a quantity of QUANTITIES, or 'reward' (see reward).
+        """
+        if name == 'reward':
+            return self.reward()
+        return self.values[QUANTITIES.index(name)]
+
+    def reward(self, reward_weight=(0.5, 0.5)) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: Step reward of the environment (_calculate_reward) at every grid point, -P_DIVERGE where the
+                        process diverged.
+        """
+        w_SEC, w_eff = reward_weight
+        production = self.quantity('production')
+        production_term = np.minimum(1.0, (production - PRODUCTION_LOWER_LIMIT) / (PRODUCTION_CRITERIA - PRODUCTION_LOWER_LIMIT))
+        reward = w_SEC * (-3.0 * self.quantity('SEC')) + w_eff * production_term
+        return np.where(np.isnan(reward), -P_DIVERGE, reward)
+
+    def best_setpoints(self, values=None, constraint=None) -> dict:
+        """
+        Setpoint maximizing `values` (the reward if None) for each feed and time of the map, among the converged points
+        where `constraint` (boolean array of the map shape) holds.
+
+        Returns:
+            dict: (n_temperatures, n_concentrations, n_steps) arrays of the best 'flowrate', 'pressure_1st',
+                  'pressure_2nd' and its 'value' (NaN where no setpoint is admissible).
+        """
+        values = self.reward() if values is None else np.asarray(values, dtype=np.float64)
+        admissible = ~np.isnan(self.quantity('SEC'))
+        if constraint is not None:
+            admissible &= constraint
+        values = np.where(admissible, values, -np.inf)
+        n_setpoints = int(np.prod(self.shape[:3]))
+        flat = values.reshape(n_setpoints, *self.shape[3:])
+        best = flat.argmax(axis=0)
+        indices = np.unravel_index(best, self.shape[:3])
+        found = np.isfinite(flat.max(axis=0))
+        best_setpoints = {name: np.where(found, self.axes[name][index], np.nan) for name, index in zip(AXES[:3], indices)}
+        best_setpoints['value'] = np.where(found, flat.max(axis=0), np.nan)
+        return best_setpoints
+
+    def _interpolator(self, name):
+        # Axes with a single grid value cannot be interpolated along: they are dropped (and ignored by lookup).
+        if name not in self._interpolators:
+            values = self.quantity(name)
+            grid_axes = [self.axes[axis] for axis in AXES] + [self.hours]
+            kept = [i for i, axis in enumerate(grid_axes) if len(axis) > 1]
+            values = values.reshape([len(grid_axes[i]) for i in kept])
+            interpolator = RegularGridInterpolator([grid_axes[i] for i in kept], values, bounds_error=False, fill_value=np.nan) if kept else None
+            self._interpolators[name] = (kept, interpolator, values)
+        return self._interpolators[name]
+
+    def lookup(self, name, flowrate, pressure_1st, pressure_2nd, temperature, concentration, hours=0.0) -> np.ndarray:
+        """
+        Linear interpolation of a quantity (of QUANTITIES, or 'reward') at setpoints and feeds (broadcast arrays), after
+        `hours` of constant operation. NaN outside the grid and next to diverged points.
+        """
+        kept, interpolator, values = self._interpolator(name)
+        points = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) for x in (flowrate, pressure_1st, pressure_2nd, temperature, concentration, hours)])
+        if interpolator is None:
+            return np.full(points[0].shape, values.item())
+        return interpolator(np.stack([points[i] for i in kept], axis=-1))
+
+    def save(self, path):
+        # Written with a file object, so that np.savez does not append '.npz' to the temporary name.
+        arrays = {f'axis/{name}': self.axes[name] for name in AXES}
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            np.savez(file, steps=self.steps, values=self.values, **arrays, **{MANIFEST_KEY: np.array(json.dumps(self.manifest))})
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            manifest = json.loads(str(data[MANIFEST_KEY]))
+            return cls({name: data[f'axis/{name}'] for name in AXES}, data['steps'], data['values'], manifest)
+
+
+def map_key(manifest) -> str:
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def generate_operating_map(flowrates, pressures_1st, pressures_2nd, temperatures, concentrations, hours=(0.0,),
+                           cache_dir=None, n_segments=None, feed_pressure=1e-5, batch=1) -> OperatingMap:
+    """
+    Simulate (or read from the cache) the operating map of a grid.
+
+    Args:
+        flowrates, pressures_1st, pressures_2nd, temperatures, concentrations: Grid values of the AXES.
+        hours (list): Times of operation at which the quantities are recorded (see horizon_steps).
+        cache_dir (str): Directory of the cached maps (no cache if None).
+        n_segments (int): Fidelity of the vessel model (the current Julia setting if None). Julia-global.
+        feed_pressure (float): Inlet pressure of the feed [bar].
+        batch (int): Flowrates simulated per Julia call (one progress update each).
+
+    Returns:
+        OperatingMap: The map.
+    """
+    axes = {name: np.unique(np.asarray(values, dtype=np.float64)) for name, values in
+            zip(AXES, (flowrates, pressures_1st, pressures_2nd, temperatures, concentrations))}
+    steps = horizon_steps(hours)
+
+    configure_julia_threads()
+    import juliacall
+    jl = juliacall.Main
+    if not bool(jl.seval("isdefined(Main, :OperatingMap)")):
+        jl.seval(f'include(raw"{OPERATING_MAP_PATH}")')
+    ro_element = jl.PressureControlledRO.RO_Element_Simple
+    if n_segments is not None:
+        ro_element.set_n_segments_b(int(n_segments))
+
+    manifest = {'axes': {name: values.tolist() for name, values in axes.items()}, 'steps': steps.tolist(),
+                'n_segments': int(ro_element.n_segments), 'feed_pressure': float(feed_pressure), 'model_hash': model_hash()}
+    path = os.path.join(cache_dir, f'operating_map_{map_key(manifest)}.npz') if cache_dir is not None else None
+    if path is not None and os.path.exists(path):
+        return OperatingMap.load(path)
+
+    values = []
+    flowrates = axes['flowrate']
+    for start in tqdm(range(0, len(flowrates), batch), desc=f'Operating map ({int(jl.seval("Threads.nthreads()"))} Julia threads)'):
+        values.append(np.array(jl.OperatingMap.operating_map(
+            flowrates[start:start + batch], axes['pressure_1st'], axes['pressure_2nd'], axes['temperature'],
+            axes['concentration'], steps=steps, feed_pressure=float(feed_pressure))))
+    # Model divergences are counted in Julia: not needed for the map.
+    jl.PressureControlledRO.drain_events_b()
+
+    operating_map = OperatingMap(axes, steps, np.concatenate(values, axis=1), manifest)
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        operating_map.save(path)
+    return operating_map
+
+
+if __name__ == '__main__':
+    def grid(values):
+        # Three values are read as 'start stop num' (np.linspace), other counts as the grid values.
+        return np.linspace(values[0], values[1], int(values[2])) if len(values) == 3 else np.asarray(values)
+
+    parser = argparse.ArgumentParser(description='Generate the constant-setpoint operating map of the two-stage RO process')
+    parser.add_argument('--flowrates', type=float, nargs='+', default=[750.0, 1394.0, 17], help='Influent flowrates [m3/h]: start stop num, or values')
+    parser.add_argument('--pressures_1st', type=float, nargs='+', default=[5.0, 15.0, 21], help='1st stage pump pressures [bar]')
+    parser.add_argument('--pressures_2nd', type=float, nargs='+', default=[0.25, 2.5, 10], help='2nd stage pump pressures [bar]')
+    parser.add_argument('--temperatures', type=float, nargs='+', default=[20.0], help='Feed temperatures [°C]')
+    parser.add_argument('--concentrations', type=float, nargs='+', default=[300.0, 700.0, 5], help='Feed concentrations [ppm]')
+    parser.add_argument('--hours', type=float, nargs='+', default=[0.0], help='Times of constant operation recorded (fouling horizon)')
+    parser.add_argument('--cache_dir', type=str, default='operating_maps', help='Directory of the cached maps')
+    parser.add_argument('--n_segments', type=int, default=None, help='Fidelity of the vessel model')
+    parser.add_argument('--batch', type=int, default=1, help='Flowrates simulated per Julia call')
+    args = parser.parse_args()
+
+    operating_map = generate_operating_map(grid(args.flowrates), grid(args.pressures_1st), grid(args.pressures_2nd),
+                                           grid(args.temperatures), grid(args.concentrations), hours=args.hours,
+                                           cache_dir=args.cache_dir, n_segments=args.n_segments, batch=args.batch)
+    converged = ~np.isnan(operating_map.quantity('SEC'))
+    print(f"{converged.sum()} / {converged.size} points converged.")
+    best = operating_map.best_setpoints()
+    for i, j, k in np.ndindex(best['value'].shape):
+        print(f"{operating_map.hours[k]:7.1f} h, {operating_map.axes['temperature'][i]:4.1f} °C, {operating_map.axes['concentration'][j]:6.1f} ppm: "
+              f"best reward {best['value'][i, j, k]:.4f} at flowrate {best['flowrate'][i, j, k]:.1f}, "
+              f"pressures {best['pressure_1st'][i, j, k]:.3f} / {best['pressure_2nd'][i, j, k]:.3f}")
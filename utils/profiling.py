@@ -0,0 +1,207 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+
+import pandas as pd
+
+
+class Profiler:
+    """
+    Named timing spans for finding out where the wall time of a run goes (Julia model, post-processing, agent forward,
+    replay buffer, loss, optimizer, log and plot writing ...).
+
+    When disabled, span() returns one shared no-op context manager, so instrumented code only pays a function call.
+    When enabled, every span is accumulated per episode and cumulatively, and stored as a Chrome trace event
+    (open the saved JSON with chrome://tracing or https://ui.perfetto.dev).
+    """
+    _null_span = nullcontext()
+
+    def __init__(self, enabled=False, max_trace_events=1_000_000):
+        """
+        Args:
+            enabled (bool): Record spans. If False, every method is a no-op.
+            max_trace_events (int): Maximum number of trace events kept in memory. Later events are only accumulated.
+        """
+        self.enabled = enabled
+        self.max_trace_events = max_trace_events
+        self._origin = time.perf_counter()
+        self._episode = defaultdict(lambda: [0.0, 0])
+        self._cumulative = defaultdict(lambda: [0.0, 0])
+        self._episode_counters = defaultdict(float)
+        self._cumulative_counters = defaultdict(float)
+        self._trace_events = []
+        self._lock = threading.Lock()
+
+    def span(self, name, **args):
+        """
+        Time the enclosed block under `name`. Keyword arguments are stored with the trace event.
+
+        Usage:
+            with profiler.span('agent forward'):
+                ...
+        """
+        if not self.enabled:
+            return self._null_span
+        return _Span(self, name, args)
+
+    def add(self, name, duration, start=None, **args):
+        """
+        Record a span measured elsewhere (e.g. the time Julia reports for a model call).
+
+        Args:
+            name (str): Span name.
+            duration (float): Duration in seconds.
+            start (float): time.perf_counter() value at the start of the span. Defaults to `duration` before now.
+        """
+        if not self.enabled:
+            return
+        if start is None:
+            start = time.perf_counter() - duration
+        self._record(name, start, duration, args)
+
+    def count(self, name, value=1):
+        """
+        Accumulate a counter (e.g. Julia allocation counts) into the per-episode and cumulative breakdowns.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._episode_counters[name] += value
+            self._cumulative_counters[name] += value
+
+    def _record(self, name, start, duration, args):
+        with self._lock:
+            episode_entry = self._episode[name]
+            episode_entry[0] += duration
+            episode_entry[1] += 1
+            cumulative_entry = self._cumulative[name]
+            cumulative_entry[0] += duration
+            cumulative_entry[1] += 1
+            if len(self._trace_events) < self.max_trace_events:
+                event = {'name': name, 'ph': 'X', 'ts': (start - self._origin) * 1e6, 'dur': duration * 1e6,
+                         'pid': os.getpid(), 'tid': threading.get_ident()}
+                if args:
+                    event['args'] = args
+                self._trace_events.append(event)
+
+    @staticmethod
+    def _breakdown(spans, counters):
+        rows = [{'span': name, 'total time (s)': total, 'calls': calls, 'mean time (ms)': 1e3 * total / calls}
+                for name, (total, calls) in spans.items()]
+        rows += [{'span': name, 'count': value} for name, value in counters.items()]
+        # Fixed columns, so that the per-episode breakdowns can be appended to one CSV file.
+        return pd.DataFrame(rows, columns=['span', 'total time (s)', 'calls', 'mean time (ms)', 'count'])
+
+    def end_episode(self, episode, save_path=None, verbose=True):
+        """
+        Close the per-episode breakdown.
+
+        Args:
+            episode (int): Episode number, written as a column.
+            save_path (str): CSV file the breakdown is appended to.
+            verbose (bool): Print the breakdown.
+
+        Returns:
+            pd.DataFrame: Breakdown of the episode (inclusive times: nested spans are counted in their parents too).
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            breakdown = self._breakdown(self._episode, self._episode_counters)
+            self._episode.clear()
+            self._episode_counters.clear()
+        if breakdown.empty:
+            return breakdown
+        breakdown.insert(0, 'episode', episode)
+        if save_path is not None:
+            breakdown.to_csv(save_path, mode='a', header=not os.path.exists(save_path), index=False)
+        if verbose:
+            self._print(f"Profile of episode {episode}", breakdown)
+        return breakdown
+
+    def summary(self):
+        """
+        Returns:
+            pd.DataFrame: Cumulative breakdown since the profiler was created.
+        """
+        with self._lock:
+            return self._breakdown(self._cumulative, self._cumulative_counters)
+
+    def total(self, name):
+        """
+        Returns:
+            float: Cumulative seconds recorded under `name` (0.0 if never recorded).
+        """
+        with self._lock:
+            entry = self._cumulative.get(name)
+            return entry[0] if entry is not None else 0.0
+
+    def save(self, directory):
+        """
+        Save the cumulative breakdown (profile_summary.csv) and the Chrome trace (profile_trace.json) to `directory`.
+        """
+        if not self.enabled:
+            return
+        summary = self.summary()
+        summary.to_csv(os.path.join(directory, 'profile_summary.csv'), index=False)
+        with self._lock:
+            trace = {'traceEvents': list(self._trace_events), 'displayTimeUnit': 'ms'}
+        with open(os.path.join(directory, 'profile_trace.json'), 'w') as file:
+            json.dump(trace, file)
+        self._print("Cumulative profile", summary)
+
+    @staticmethod
+    def _print(title, breakdown):
+        print(f"[{title}]")
+        for _, row in breakdown.iterrows():
+            if 'calls' in row and not pd.isna(row['calls']):
+                print(f"  {row['span']:<28} {row['total time (s)']:>10.3f} s | {int(row['calls']):>7} calls | {row['mean time (ms)']:>9.3f} ms/call")
+            else:
+                print(f"  {row['span']:<28} {row['count']:>10.0f}")
+
+
+class _Span:
+    __slots__ = ('profiler', 'name', 'args', 'start')
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler._record(self.name, self.start, time.perf_counter() - self.start, self.args)
+        return False
+
+
+# Process-wide profiler used by the environment, the replay buffer and the training scripts. Disabled by default.
+profiler = Profiler(enabled=False)
+
+
+def enable_profiling(enabled=True, max_trace_events=1_000_000):
+    profiler.enabled = enabled
+    profiler.max_trace_events = max_trace_events
+    return profiler
+
+
+def profiled(name):
+    """
+    Decorator timing every call of the decorated function as a span of the process-wide profiler.
+    Costs one attribute check per call while profiling is disabled.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            with _Span(profiler, name, None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,161 @@
+"""
+ Prefix-sharing cache of evaluation rollouts.
+
+ Given the feed scenario, the environment is deterministic: its state after k control steps only depends on the
+actions taken so far. Rollouts of the same checkpoint and feed scenario therefore share the steps of their common action
+prefix (e.g. HinderOneGivenPeriod timelines agree until their first differently hindered step, and re-runs of a sweep
+repeat every step). The cache keeps one entry per action prefix:
+    observations, action masks  Observations after the step (the input of the next agent forwards).
+    reward, state               Reward of the step and normalized state after it.
+    truncated, terminated, valid
+    summary                     Evaluation values of the episode end (only at the last step).
+    snapshot                    TwoStageROProcessEnvironment.snapshot(), including the Julia fouling state (only at
+                                branch points, every `snapshot_interval` steps and at the last step).
+
+ The key of a prefix chains the key of its parent with the actions of the step, so that the key of
+(model version, checkpoint hash, feed scenario hash, action prefix) is updated in O(1) per step. The model version
+hashes the sources of the process model and of the environment (MODEL_SOURCES): editing them invalidates every entry. A rollout follows the cached entries as
+long as its actions match, and resumes the simulation from the deepest cached snapshot where it branches off.
+
+ Entries are pickled once. They are kept in a bounded in-memory LRU tier and written to a SQLite file (the disk tier),
+shared by the sweep workers and kept across runs, so that a repeated sweep is mostly hits. The disk tier is emptied when
+it was written with another model version.
+"""
+import glob
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Sources that determine the simulated rollouts: the Julia process model and the Python environment (observations, reward).
+MODEL_SOURCES = [os.path.join('TwoStageROProcessEnvironment', 'julia modules', '*.jl'),
+                 os.path.join('TwoStageROProcessEnvironment', 'env', '*.py')]
+
+
+def model_version() -> str:
+    """Hash of the MODEL_SOURCES files (names and contents)."""
+    digest = hashlib.sha256()
+    for pattern in MODEL_SOURCES:
+        for path in sorted(glob.glob(os.path.join(REPOSITORY_ROOT, pattern))):
+            digest.update(os.path.relpath(path, REPOSITORY_ROOT).replace(os.sep, '/').encode())
+            with open(path, 'rb') as file:
+                digest.update(hashlib.sha256(file.read()).digest())
+    return digest.hexdigest()
+
+
+class RolloutCache:
+    def __init__(self, directory=None, memory_bytes=256 * 2**20, snapshot_interval=24, commit_every=256, version=None):
+        """
+        Args:
+            directory (str): Directory of the disk tier (rollout_cache.sqlite). Memory tier only if None.
+            memory_bytes (int): Budget of the in-memory tier (pickled size of the entries).
+            snapshot_interval (int): Control steps between two environment snapshots of a simulated rollout.
+            commit_every (int): Disk writes committed at once.
+            version (str): Model version of the entries (model_version() if None).
+        """
+        self.directory = directory
+        self.version = model_version() if version is None else version
+        self.memory_bytes = memory_bytes
+        self.snapshot_interval = snapshot_interval
+        self.commit_every = commit_every
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            # Several sweep workers share the file: wait for the lock instead of failing.
+            self.connection = sqlite3.connect(os.path.join(directory, 'rollout_cache.sqlite'), timeout=120.0)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            # Entries of another model version can no longer be reached (see root_key): drop them.
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if row is None or row[0] != self.version:
+                self.connection.execute('DELETE FROM entries')
+                self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (self.version,))
+            self.connection.commit()
+
+    @staticmethod
+    def checkpoint_hash(parameters: dict) -> str:
+        """Hash of a checkpoint (dictionary of state dicts, as loaded by utils.checkpoint), from the parameter values."""
+        digest = hashlib.sha256()
+        for name in sorted(parameters):
+            for key, tensor in parameters[name].items():
+                digest.update(f"{name}/{key}".encode())
+                digest.update(tensor.detach().cpu().numpy().tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def scenario_hash(feed_scenario: np.ndarray, settings: dict) -> str:
+        """Hash of a feed scenario (the array actually sampled by the environment) and the evaluation settings."""
+        digest = hashlib.sha256(np.ascontiguousarray(feed_scenario, dtype=np.float64).tobytes())
+        digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def root_key(self, checkpoint_hash: str, scenario_hash: str) -> str:
+        """Key of the empty action prefix, i.e. of the environment just after reset, for the model version of the cache."""
+        return hashlib.sha256(f"{self.version}:{checkpoint_hash}:{scenario_hash}".encode()).hexdigest()
+
+    @staticmethod
+    def child_key(key: str, actions) -> str:
+        """Key of the prefix `key` extended with the actions of one step (in the order of the agents)."""
+        return hashlib.sha256(f"{key}:{','.join(str(int(action)) for action in actions)}".encode()).hexdigest()
+
+    def get(self, key):
+        """The entry of a prefix, or None. Disk hits are promoted to the memory tier."""
+        blob = self._memory.get(key)
+        if blob is not None:
+            self._memory.move_to_end(key)
+        elif self.connection is not None:
+            row = self.connection.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                blob = bytes(row[0])
+                self._remember(key, blob)
+        if blob is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(blob)
+
+    def put(self, key, entry: dict):
+        blob = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+        self._remember(key, blob)
+        if self.connection is not None:
+            self.connection.execute('INSERT OR REPLACE INTO entries (key, value) VALUES (?, ?)', (key, blob))
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self.flush()
+
+    def _remember(self, key, blob):
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = blob
+        self._memory_size += len(blob)
+        while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def flush(self):
+        if self.connection is not None and self._uncommitted:
+            self.connection.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit rate': self.hits / lookups if lookups else 0.0,
+                'memory entries': len(self._memory), 'memory bytes': self._memory_size}
@@ -0,0 +1,168 @@
+import csv
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+
+TIMES_TRAINED_NAME = 'times_trained.npy'
+
+
+class RunLogWriter:
+    """
+    Append-only log file. Rows are buffered column by column and appended to the CSV file in batches, every `flush_rows`
+    rows or `flush_interval` seconds, so that logging costs O(1) per row instead of rewriting the whole file.
+
+    The file is row-oriented CSV with a header, not a columnar format (e.g. Parquet): appending a batch is a single write
+    at the end of the file, a crashed run loses at most the unflushed rows, a resumed run appends to the same file, and
+    the file stays readable (read_csv, iter_log) by the existing analysis scripts while the run is going on. A columnar
+    file would need a rewrite or a new row group per batch and an extra dependency for the same logs.
+    """
+    def __init__(self, path, columns, flush_rows=200, flush_interval=30.0):
+        """
+        Args:
+            path (str): Path of the CSV file. Appended to if it already exists (e.g. resumed run), in which case its
+                header must match `columns` (ValueError otherwise).
+            columns (list): Column names. Keys of the appended rows which are not in columns raise a ValueError.
+            flush_rows (int): Number of buffered rows triggering a flush.
+            flush_interval (float): Seconds since the last flush triggering a flush.
+        """
+        self.path = path
+        self.columns = list(columns)
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._buffer = {column: [] for column in self.columns}
+        self._n_buffered = 0
+        self._last_flush = time.monotonic()
+
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, 'w', newline='') as file:
+                csv.writer(file).writerow(self.columns)
+        else:
+            with open(path, 'r', newline='') as file:
+                header = next(csv.reader(file), [])
+            if header != self.columns:
+                raise ValueError(f"Cannot append to {path}: its header {header} does not match the columns {self.columns}.")
+
+    def append(self, row: dict):
+        unknown = set(row) - set(self.columns)
+        if unknown:
+            raise ValueError(f"Unknown log column(s) {sorted(unknown)}. Expected a subset of {self.columns}.")
+        for column in self.columns:
+            self._buffer[column].append(row.get(column))
+        self._n_buffered += 1
+        if self._n_buffered >= self.flush_rows or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    @property
+    def pending(self) -> int:
+        # Number of appended rows not written to the file yet.
+        return self._n_buffered
+
+    def flush(self):
+        if self._n_buffered > 0:
+            with open(self.path, 'a', newline='') as file:
+                csv.writer(file).writerows(zip(*(self._buffer[column] for column in self.columns)))
+            self._buffer = {column: [] for column in self.columns}
+            self._n_buffered = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+
+class TimesTrainedCounter:
+    """
+    In-memory counter of how many times each episode was trained on (replaces updating the 'times trained' column of
+    the episode log). Saved as an int array (index = episode number) next to the logs.
+    """
+    def __init__(self, n_episodes=1024):
+        self.counts = np.zeros(n_episodes, dtype=np.int32)
+
+    def increment(self, episode_ids):
+        episode_ids = np.asarray(episode_ids, dtype=np.int64)
+        if episode_ids.size == 0:
+            return
+        if episode_ids.max() >= self.counts.shape[0]:
+            grown = np.zeros(max(episode_ids.max() + 1, 2 * self.counts.shape[0]), dtype=np.int32)
+            grown[:self.counts.shape[0]] = self.counts
+            self.counts = grown
+        # np.add.at counts repeated ids (e.g. an episode sampled twice) correctly.
+        np.add.at(self.counts, episode_ids, 1)
+
+    def save(self, path):
+        temporary_path = path + '.tmp.npy'
+        np.save(temporary_path, self.counts)
+        os.replace(temporary_path, path)
+
+
+class TrainingLogs:
+    """
+    Episode log, training log and times-trained counter of one run, written to <save_dir>/episode_log.csv,
+    <save_dir>/train_log.csv and <save_dir>/times_trained.npy. Read back with read_episode_log / read_train_log.
+    """
+    def __init__(self, save_dir, episode_columns, train_columns, n_episodes=1024, flush_rows=200, flush_interval=30.0):
+        self.save_dir = save_dir
+        self.episode_log = RunLogWriter(os.path.join(save_dir, 'episode_log.csv'), episode_columns, flush_rows=flush_rows, flush_interval=flush_interval)
+        self.train_log = RunLogWriter(os.path.join(save_dir, 'train_log.csv'), train_columns, flush_rows=flush_rows, flush_interval=flush_interval)
+        self.times_trained = TimesTrainedCounter(n_episodes)
+
+    def log_episode(self, row: dict):
+        self.episode_log.append(row)
+        self._save_counter_if_flushed(self.episode_log)
+
+    def log_training(self, row: dict, trained_episodes):
+        self.times_trained.increment(trained_episodes)
+        self.train_log.append(row)
+        self._save_counter_if_flushed(self.train_log)
+
+    def _save_counter_if_flushed(self, writer):
+        # Save the counter whenever rows reach the disk, so that the files on disk stay consistent with each other.
+        if writer.pending == 0:
+            self.times_trained.save(os.path.join(self.save_dir, TIMES_TRAINED_NAME))
+
+    def flush(self):
+        self.episode_log.flush()
+        self.train_log.flush()
+        self.times_trained.save(os.path.join(self.save_dir, TIMES_TRAINED_NAME))
+
+    def close(self):
+        self.flush()
+
+
+def read_episode_log(exp_path) -> pd.DataFrame:
+    """
+    Read the episode log of a run. Works with logs written by TrainingLogs (the 'times trained' column is filled from
+    times_trained.npy) and with the older logs written with DataFrame.to_csv.
+
+    Args:
+        exp_path (str): Directory of the run.
+
+    Returns:
+        pd.DataFrame: The episode log.
+    """
+    episode_log = pd.read_csv(os.path.join(exp_path, 'episode_log.csv'))
+    counter_path = os.path.join(exp_path, TIMES_TRAINED_NAME)
+    if os.path.exists(counter_path) and 'episode number' in episode_log.columns:
+        counts = np.load(counter_path)
+        episode_numbers = pd.to_numeric(episode_log['episode number'], errors='coerce').to_numpy()
+        known = ~np.isnan(episode_numbers) & (episode_numbers >= 0) & (episode_numbers < counts.shape[0])
+        times_trained = np.zeros(len(episode_log), dtype=np.int64)
+        times_trained[known] = counts[episode_numbers[known].astype(np.int64)]
+        episode_log['times trained'] = times_trained
+    return episode_log
+
+
+def read_train_log(exp_path) -> pd.DataFrame:
+    """
+    Read the training log of a run (both the TrainingLogs and the older DataFrame.to_csv format).
+    """
+    return pd.read_csv(os.path.join(exp_path, 'train_log.csv'))
+
+
+def iter_log(path, chunksize=10000):
+    """
+    Iterate over a (possibly still growing) log file in DataFrame chunks, without loading the whole file.
+    """
+    return pd.read_csv(path, chunksize=chunksize)
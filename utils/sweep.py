@@ -0,0 +1,325 @@
+import hashlib
+import itertools
+import json
+import multiprocessing as mp
+import queue
+import random
+import time
+import traceback
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+def job_seed(root_seed, params) -> int:
+    """
+    Seed of one job, derived from the root seed and the job parameters only (not from the job order or the worker),
+    so that a job gives the same result whichever worker runs it, and whether it is retried or not.
+    """
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).digest()
+    entropy = [int(root_seed)] + [int.from_bytes(digest[i:i + 4], 'little') for i in range(0, 16, 4)]
+    return int(np.random.SeedSequence(entropy).generate_state(1)[0])
+
+
+def expand_grid(root_seed=0, **axes) -> list:
+    """
+    Cartesian product of the axes as a list of jobs, in the order of the axes (the last axis varies fastest).
+
+    Usage:
+        jobs = expand_grid(checkpoint=[1000, 2000], hindered_agent=[None, '1st_stage_pump'], feed_concentration=np.linspace(300, 700, 100))
+
+    Returns:
+        list[SweepJob]: Jobs with their index and deterministic seed.
+    """
+    names = list(axes)
+    jobs = []
+    for index, values in enumerate(itertools.product(*(axes[name] for name in names))):
+        params = {name: (value.item() if isinstance(value, np.generic) else value) for name, value in zip(names, values)}
+        jobs.append(SweepJob(index, params, job_seed(root_seed, params)))
+    return jobs
+
+
+class SweepJob:
+    """One point of a sweep: its position in the sweep, its parameters and its seed."""
+    __slots__ = ('index', 'params', 'seed')
+
+    def __init__(self, index, params, seed):
+        self.index = index
+        self.params = params
+        self.seed = seed
+
+    def __repr__(self):
+        return f"SweepJob({self.index}, {self.params})"
+
+
+class SweepResult:
+    """Outcome of a job: its value (None if it failed), the error of the last attempt and the number of attempts."""
+    __slots__ = ('job', 'value', 'error', 'attempts', 'duration')
+
+    def __init__(self, job, value=None, error=None, attempts=1, duration=0.0):
+        self.job = job
+        self.value = value
+        self.error = error
+        self.attempts = attempts
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+    torch.manual_seed(seed)
+
+
+def _worker_loop(worker_id, initializer, initializer_args, job_function, task_queue, result_queue):
+    torch.set_num_threads(1)
+    try:
+        state = initializer(worker_id, *initializer_args)
+    except Exception:
+        result_queue.put(('init_error', worker_id, None, traceback.format_exc(), 0.0))
+        return
+    result_queue.put(('ready', worker_id, None, None, 0.0))
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        index, params, seed = task
+        start = time.perf_counter()
+        try:
+            seed_everything(seed)
+            value = job_function(state, params, seed)
+            result_queue.put(('done', worker_id, (index, value), None, time.perf_counter() - start))
+        except Exception:
+            # The worker (and its environment) stays alive: a Python exception does not corrupt the process.
+            result_queue.put(('error', worker_id, (index, None), traceback.format_exc(), time.perf_counter() - start))
+
+
+class SweepEngine:
+    """
+    Runs the independent jobs of a sweep on a pool of worker processes. Every worker builds its (expensive) state once
+    with `initializer` (e.g. an environment with its own Julia runtime, and the agent networks) and keeps it for all the
+    jobs it runs. Jobs are handed out one at a time, so the workers stay busy whatever the job durations.
+
+    A job raising an exception, or whose worker dies (e.g. a crash of the Julia runtime), is retried up to
+    `max_retries` times. Dead workers are replaced. Each job is seeded from its parameters (see job_seed) before it runs,
+    so results do not depend on the number of workers or on retries.
+
+    By default, every run() starts the workers and stops them at the end. Used as a context manager (or between
+    open() and close()), the engine keeps its workers and their states for all the runs of the session, e.g. the
+    rounds of a tournament:
+        with SweepEngine(initializer, job_function, n_workers=8) as engine:
+            for jobs in rounds:
+                results = engine.run(jobs)
+
+    `initializer(worker_id, *initializer_args)` and `job_function(state, params, seed)` must be module-level functions,
+    as workers are spawned (a forked Julia runtime is not usable).
+    """
+    def __init__(self, initializer, job_function, n_workers=1, initializer_args=(), max_retries=2, start_method='spawn'):
+        """
+        Args:
+            initializer (callable): Builds the per-worker state.
+            job_function (callable): Runs one job on the worker state and returns a picklable value.
+            n_workers (int): Number of worker processes. With 1 worker, jobs run in the calling process.
+            initializer_args (tuple): Extra (picklable) arguments of the initializer.
+            max_retries (int): Retries of a failed job before it is reported as failed.
+            start_method (str): multiprocessing start method.
+        """
+        self.initializer = initializer
+        self.job_function = job_function
+        self.n_workers = max(1, int(n_workers))
+        self.initializer_args = tuple(initializer_args)
+        self.max_retries = max_retries
+        self.context = mp.get_context(start_method)
+        self._session = False
+        self._state = None      # State of the in-process worker (1 worker), built once per session.
+        self._pool = None       # Worker processes (several workers).
+
+    def open(self):
+        """Start a session: the workers started by the next runs are kept until close()."""
+        self._session = True
+        return self
+
+    def close(self):
+        """End the session and stop its workers."""
+        self._session = False
+        self._state = None
+        self._stop_pool()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def run(self, jobs, on_result=None, description='Sweep') -> list:
+        """
+        Run the jobs and gather their results in the calling process.
+
+        Args:
+            jobs (list[SweepJob]): Jobs to run (see expand_grid).
+            on_result (callable): Called as on_result(result) in the calling process as soon as a job finishes (e.g. to
+                                  write partial results). Not called for failed attempts that are retried.
+            description (str): Label of the progress bar.
+
+        Returns:
+            list[SweepResult]: One result per job, in the order of `jobs`.
+        """
+        jobs = list(jobs)
+        if self.n_workers == 1:
+            return self._run_in_process(jobs, on_result, description)
+        try:
+            return self._run_pool(jobs, on_result, description)
+        except BaseException:
+            # Workers may still be running jobs of the interrupted run: do not reuse them.
+            self._stop_pool()
+            raise
+        finally:
+            if not self._session:
+                self._stop_pool()
+
+    def _run_in_process(self, jobs, on_result, description):
+        state = self._state if self._state is not None else self.initializer(0, *self.initializer_args)
+        if self._session:
+            self._state = state
+        results = []
+        for job in tqdm(jobs, desc=description):
+            attempts = 0
+            while True:
+                attempts += 1
+                start = time.perf_counter()
+                try:
+                    seed_everything(job.seed)
+                    result = SweepResult(job, self.job_function(state, job.params, job.seed), attempts=attempts, duration=time.perf_counter() - start)
+                    break
+                except Exception:
+                    if attempts > self.max_retries:
+                        result = SweepResult(job, error=traceback.format_exc(), attempts=attempts, duration=time.perf_counter() - start)
+                        break
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+        return results
+
+    def _start_worker(self):
+        pool = self._pool
+        worker_id = pool['next worker id']
+        pool['next worker id'] += 1
+        task_queue = self.context.Queue()
+        process = self.context.Process(target=_worker_loop, daemon=True,
+                                       args=(worker_id, self.initializer, self.initializer_args, self.job_function, task_queue, pool['result queue']))
+        process.start()
+        pool['workers'][worker_id] = (process, task_queue)
+
+    def _stop_pool(self):
+        if self._pool is None:
+            return
+        workers = self._pool['workers']
+        self._pool = None
+        for process, task_queue in workers.values():
+            task_queue.put(None)
+        for process, _ in workers.values():
+            process.join(timeout=10.0)
+            if process.is_alive():
+                process.terminate()
+
+    def _run_pool(self, jobs, on_result, description):
+        if self._pool is None:
+            self._pool = {'result queue': self.context.Queue(),
+                          'workers': {},            # worker id -> (process, task queue)
+                          'ready': set(),
+                          'startup failures': 0,
+                          'next worker id': 0}
+        pool = self._pool
+        workers, ready, result_queue = pool['workers'], pool['ready'], pool['result queue']
+        # Within a session, start every worker at once: later runs may have more jobs.
+        while len(workers) < (self.n_workers if self._session else min(self.n_workers, len(jobs))):
+            self._start_worker()
+
+        by_index = {job.index: job for job in jobs}
+        pending = list(reversed(jobs))     # Popped from the end: jobs start in order.
+        attempts = {job.index: 0 for job in jobs}
+        results = {}
+        assigned = {}       # worker id -> job index
+
+        progress = tqdm(total=len(jobs), desc=description)
+
+        def finish(job_index, value, error, duration):
+            job = by_index[job_index]
+            if error is not None and attempts[job_index] <= self.max_retries:
+                pending.append(job)
+                return
+            result = SweepResult(job, value=value, error=error, attempts=attempts[job_index], duration=duration)
+            results[job_index] = result
+            progress.update(1)
+            if on_result is not None:
+                on_result(result)
+
+        try:
+            while len(results) < len(jobs):
+                # 1. Hand out jobs to the idle workers.
+                for worker_id in list(ready):
+                    if worker_id in assigned or not pending:
+                        continue
+                    job = pending.pop()
+                    attempts[job.index] += 1
+                    assigned[worker_id] = job.index
+                    workers[worker_id][1].put((job.index, job.params, job.seed))
+
+                # 2. Collect a finished job (or a worker becoming ready).
+                try:
+                    kind, worker_id, payload, error, duration = result_queue.get(timeout=1.0)
+                except queue.Empty:
+                    kind = None
+                if kind == 'ready':
+                    ready.add(worker_id)
+                elif kind == 'init_error':
+                    raise RuntimeError(f"Sweep worker {worker_id} failed to initialize:\n{error}")
+                elif kind in ('done', 'error'):
+                    assigned.pop(worker_id, None)
+                    job_index, value = payload
+                    finish(job_index, value, error, duration)
+
+                # 3. Replace the dead workers, and retry the job they were running.
+                for worker_id, (process, _) in list(workers.items()):
+                    if process.is_alive():
+                        continue
+                    del workers[worker_id]
+                    if worker_id not in ready:
+                        pool['startup failures'] += 1
+                        if pool['startup failures'] > self.max_retries:
+                            raise RuntimeError(f"Sweep workers keep dying while initializing (last exit code {process.exitcode}).")
+                    ready.discard(worker_id)
+                    job_index = assigned.pop(worker_id, None)
+                    if job_index is not None:
+                        finish(job_index, None, f"Worker {worker_id} exited with code {process.exitcode}.", 0.0)
+                    if pending or assigned or self._session:
+                        self._start_worker()
+                progress.set_postfix(workers=len(ready), failed=sum(not r.ok for r in results.values()))
+        finally:
+            progress.close()
+        return [results[job.index] for job in jobs]
+
+
+def aggregate(results, by, value=None):
+    """
+    Group the values of successful results by some job parameters.
+
+    Args:
+        results (list[SweepResult]): Results of SweepEngine.run.
+        by (list[str]): Job parameters to group by.
+        value (callable): Applied to each result value (identity if None).
+
+    Returns:
+        dict: {tuple of the `by` parameters: list of values, in job order}
+    """
+    groups = {}
+    for result in results:
+        if not result.ok or result.value is None:
+            continue
+        key = tuple(result.job.params[name] for name in by)
+        groups.setdefault(key, []).append(result.value if value is None else value(result.value))
+    return groups
@@ -0,0 +1,314 @@
+"""
+ Columnar store of evaluation traces (one HDF5 file per evaluation run), replacing the per-step pickles of the
+observations, hidden states and agent Qs.
+
+ Every control step of every scenario is one row. Rows of a scenario are contiguous, and the scenario table maps
+(checkpoint, hindered agent, feed concentration) to its row range. Layout of the file:
+    agents/<agent>/observation  (rows, observation dim)  float32   Scaled observation the agent acted on.
+    agents/<agent>/action_mask  (rows, n_actions)        int8
+    agents/<agent>/hidden       (rows, hidden dim)       float32   Hidden state fed to the agent network.
+    agents/<agent>/q            (rows, n_actions)        float32   Masked Q-values (-inf for invalid actions).
+    agents/<agent>/action       (rows,)                  int8
+    state                       (rows, state dim)        float32   Normalized mixer state before the step.
+    reward                      (rows,)                  float32   Reward of the step.
+    step                        (rows,)                  int32     Control step.
+    scenarios/<column>          (scenarios,)                       checkpoint, hindered agent, concentration, row start,
+                                                                   row stop, completed.
+
+ Datasets are chunked and compressed by default. With compression=None and the number of scenarios known up front,
+they are allocated contiguous, and TraceReader returns numpy memory maps of the file (no copy at all).
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+
+NO_AGENT = 'None'     # Hindered agent of the scenarios without hindrance.
+AGENT_FIELDS = ('observation', 'action_mask', 'hidden', 'q', 'action')
+SCENARIO_COLUMNS = ('checkpoint', 'hindered agent', 'concentration', 'row start', 'row stop', 'completed')
+
+
+class ScenarioTrace:
+    """
+    Per-step recorder of one evaluation scenario, filled by the rollout and written with TraceWriter.write_scenario.
+    Picklable, so that sweep workers can return it to the process owning the store.
+    """
+    def __init__(self, agents, max_steps=None):
+        self.agents = list(agents)
+        self.max_steps = max_steps
+        self.steps = []
+        self.states = []
+        self.rewards = []
+        self.fields = {a: {field: [] for field in AGENT_FIELDS} for a in self.agents}
+        self.completed = False
+
+    def record(self, step, observations_scaled, hiddens, agent_qs, actions, reward, state):
+        """
+        Args:
+            step (int): Control step.
+            observations_scaled (dict): {agent: {'observation', 'action_mask'}} the agents acted on.
+            hiddens (dict): {agent: hidden state fed to the network}.
+            agent_qs (dict): {agent: masked Q-values}.
+            actions (dict): {agent: action taken}.
+            reward (float): Reward of the step.
+            state (np.ndarray): Normalized state before the step.
+        """
+        self.steps.append(step)
+        self.states.append(np.asarray(state, dtype=np.float32))
+        self.rewards.append(reward)
+        for a in self.agents:
+            fields = self.fields[a]
+            fields['observation'].append(np.asarray(observations_scaled[a]['observation'], dtype=np.float32))
+            fields['action_mask'].append(np.asarray(observations_scaled[a]['action_mask'], dtype=np.int8))
+            fields['hidden'].append(_to_numpy(hiddens[a]).reshape(-1))
+            fields['q'].append(_to_numpy(agent_qs[a]).reshape(-1))
+            fields['action'].append(int(actions[a]))
+
+    def __len__(self):
+        return len(self.steps)
+
+    def arrays(self) -> dict:
+        """
+        Returns:
+            dict: {dataset path: array of shape (len(self), ...)}, with the layout of the store.
+        """
+        arrays = {
+            'step': np.asarray(self.steps, dtype=np.int32),
+            'state': np.stack(self.states).astype(np.float32),
+            'reward': np.asarray(self.rewards, dtype=np.float32),
+        }
+        for a in self.agents:
+            for field, values in self.fields[a].items():
+                dtype = np.int8 if field in ('action_mask', 'action') else np.float32
+                arrays[f'agents/{a}/{field}'] = np.asarray(np.stack(values) if field != 'action' else values, dtype=dtype)
+        return arrays
+
+
+def _to_numpy(value):
+    if hasattr(value, 'detach'):
+        value = value.detach().cpu().numpy()
+    return np.asarray(value, dtype=np.float32)
+
+
+class TraceWriter:
+    """
+    Appends scenario traces to the HDF5 trace store of an evaluation run. Single writer: in a parallel sweep, the
+    workers return their ScenarioTrace and the main process writes them.
+    """
+    def __init__(self, path, n_scenarios=None, compression='gzip', chunk_rows=1024):
+        """
+        Args:
+            path (str): HDF5 file. Appended to if it exists.
+            n_scenarios (int): Scenarios the run will write. Together with compression=None, allocates contiguous
+                               (memory-mappable) datasets of n_scenarios x max_steps rows.
+            compression (str): 'gzip', 'lzf' or None.
+            chunk_rows (int): Rows per chunk of the chunked datasets.
+        """
+        import h5py
+
+        self.path = path
+        self.n_scenarios = n_scenarios
+        self.compression = compression
+        self.chunk_rows = chunk_rows
+        self.file = h5py.File(path, 'a')
+        self.n_rows = int(self.file.attrs.get('n_rows', 0))
+
+    def _dataset(self, name, shape, dtype, max_steps):
+        if name in self.file:
+            return self.file[name]
+        if self.compression is None and self.n_scenarios is not None and max_steps is not None:
+            # Fixed size, contiguous: readable as a memory map. Rows past n_rows are unused.
+            return self.file.create_dataset(name, shape=(self.n_scenarios * max_steps,) + shape, dtype=dtype)
+        return self.file.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape, dtype=dtype,
+                                        chunks=(self.chunk_rows,) + shape, compression=self.compression,
+                                        shuffle=self.compression is not None)
+
+    def write_scenario(self, checkpoint, hindered_agent, concentration, trace: ScenarioTrace):
+        """
+        Append the rows of one scenario and its entry of the scenario table.
+        """
+        start = self.n_rows
+        if len(trace) > 0:
+            arrays = trace.arrays()
+            stop = start + len(trace)
+            for name, values in arrays.items():
+                dataset = self._dataset(name, values.shape[1:], values.dtype, trace.max_steps)
+                if dataset.shape[0] < stop:
+                    if dataset.maxshape[0] is not None:
+                        raise ValueError(f"Trace store {self.path} is full ({dataset.shape[0]} rows).")
+                    dataset.resize(stop, axis=0)
+                dataset[start:stop] = values
+            self.n_rows = stop
+            self.file.attrs['n_rows'] = self.n_rows
+        self._append_scenario({
+            'checkpoint': np.int64(checkpoint),
+            'hindered agent': NO_AGENT if hindered_agent is None else str(hindered_agent),
+            'concentration': np.float64(concentration),
+            'row start': np.int64(start),
+            'row stop': np.int64(self.n_rows),
+            'completed': bool(trace.completed),
+        })
+
+    def _append_scenario(self, row):
+        import h5py
+
+        for column, value in row.items():
+            name = f'scenarios/{column}'
+            if name not in self.file:
+                dtype = h5py.string_dtype() if isinstance(value, str) else np.asarray(value).dtype
+                self.file.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(256,))
+            dataset = self.file[name]
+            dataset.resize(dataset.shape[0] + 1, axis=0)
+            dataset[-1] = value
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class TraceReader:
+    """
+    Reads the trace store of an evaluation run. Slices of contiguous (uncompressed) datasets are numpy memory maps
+    of the file; those of chunked datasets are read directly into one array (only the chunks covering the rows).
+
+    Usage:
+        reader = TraceReader(os.path.join(save_dir, 'HinderOneAll', 'traces.h5'))
+        observations = reader.get('observation', agent='1st_stage_pump', checkpoint=12000, hindered_agent=None, concentration=500.0)
+        all_hiddens = reader.field('hidden', agent='1st_stage_pump')     # Every row, e.g. for SHAP backgrounds.
+    """
+    def __init__(self, path):
+        import h5py
+
+        self.path = path
+        self.file = h5py.File(path, 'r')
+        self.n_rows = int(self.file.attrs.get('n_rows', 0))
+        self._maps = {}
+        self._scenarios = None
+
+    @property
+    def agents(self) -> list:
+        return list(self.file['agents'].keys()) if 'agents' in self.file else []
+
+    def scenarios(self) -> pd.DataFrame:
+        """
+        Returns:
+            pd.DataFrame: One row per scenario (checkpoint, hindered agent, concentration, row start, row stop, completed).
+        """
+        if self._scenarios is None:
+            if 'scenarios' not in self.file:
+                self._scenarios = pd.DataFrame(columns=list(SCENARIO_COLUMNS))
+            else:
+                group = self.file['scenarios']
+                columns = {}
+                for column in SCENARIO_COLUMNS:
+                    dataset = group[column]
+                    columns[column] = dataset.asstr()[:] if dataset.dtype == object else dataset[:]
+                self._scenarios = pd.DataFrame(columns)
+        return self._scenarios
+
+    def _dataset_path(self, field, agent=None):
+        return f'agents/{agent}/{field}' if agent is not None else field
+
+    def _array(self, path):
+        """
+        The dataset as a memory map if it is contiguous and uncompressed, else the h5py dataset (sliced lazily).
+        """
+        if path not in self._maps:
+            dataset = self.file[path]
+            offset = dataset.id.get_offset()
+            if offset is not None and dataset.chunks is None and dataset.compression is None:
+                self._maps[path] = np.memmap(self.path, mode='r', dtype=dataset.dtype, offset=offset, shape=dataset.shape)
+            else:
+                self._maps[path] = dataset
+        return self._maps[path]
+
+    def field(self, field, agent=None, rows=None):
+        """
+        Rows of one field (every written row if `rows` is None).
+
+        Args:
+            field (str): 'observation', 'action_mask', 'hidden', 'q' or 'action' (with `agent`), or 'state', 'reward', 'step'.
+            agent (str): Agent of the agent fields.
+            rows (slice | np.ndarray): Row slice or sorted row indices.
+        """
+        array = self._array(self._dataset_path(field, agent))
+        if rows is None:
+            rows = slice(0, self.n_rows)
+        if isinstance(array, np.memmap):
+            return array[rows]
+        if isinstance(rows, slice):
+            start, stop, _ = rows.indices(self.n_rows)
+            out = np.empty((max(stop - start, 0),) + array.shape[1:], dtype=array.dtype)
+            if out.shape[0] > 0:
+                array.read_direct(out, source_sel=np.s_[start:stop])
+            return out
+        return array[np.asarray(rows)]
+
+    def scenario_rows(self, checkpoint=None, hindered_agent=NO_AGENT, concentration=None) -> np.ndarray:
+        """
+        Row indices of the matching scenarios, in store order. A criterion left to None is not filtered on, except the
+        hindered agent, for which None means "no hindrance" (use hindered_agent='*' for any).
+        """
+        table = self.scenarios()
+        selected = np.ones(len(table), dtype=bool)
+        if checkpoint is not None:
+            selected &= table['checkpoint'].to_numpy() == checkpoint
+        if hindered_agent != '*':
+            selected &= table['hindered agent'].to_numpy() == (NO_AGENT if hindered_agent is None else hindered_agent)
+        if concentration is not None:
+            selected &= np.isclose(table['concentration'].to_numpy(), concentration)
+        ranges = table.loc[selected, ['row start', 'row stop']].to_numpy()
+        if len(ranges) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(start, stop) for start, stop in ranges])
+
+    def get(self, field, agent=None, checkpoint=None, hindered_agent=NO_AGENT, concentration=None, steps=None):
+        """
+        Rows of `field` for the matching scenarios (and control steps, if given). A single scenario is returned as a
+        slice of the store (a memory map view for contiguous stores).
+        """
+        rows = self.scenario_rows(checkpoint, hindered_agent, concentration)
+        if steps is not None:
+            rows = rows[np.isin(self.field('step', rows=rows), steps)]
+        if rows.size > 0 and rows[-1] - rows[0] + 1 == rows.size:
+            return self.field(field, agent, rows=slice(int(rows[0]), int(rows[-1]) + 1))
+        return self.field(field, agent, rows=rows)
+
+    def step_dicts(self, checkpoint, hindered_agent, concentration, step):
+        """
+        One step in the layout of the former pickles: (previous_observations_scaled, hiddens, agent_qs).
+        """
+        row = self.scenario_rows(checkpoint, hindered_agent, concentration)
+        row = row[self.field('step', rows=row) == step]
+        if row.size == 0:
+            raise KeyError((checkpoint, hindered_agent, concentration, step))
+        row = slice(int(row[0]), int(row[0]) + 1)
+        observations = {a: {'observation': self.field('observation', a, row)[0], 'action_mask': self.field('action_mask', a, row)[0]} for a in self.agents}
+        hiddens = {a: self.field('hidden', a, row)[0] for a in self.agents}
+        agent_qs = {a: self.field('q', a, row)[0] for a in self.agents}
+        return observations, hiddens, agent_qs
+
+    def close(self):
+        self._maps.clear()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def trace_store_path(save_dir, test_type='HinderOneAll'):
+    return os.path.join(save_dir, test_type, 'traces.h5')
@@ -78,6 +78,9 @@ def plot_moving_avg(data, column_name, window_size, ax=None, average_color = Non
 from matplotlib.ticker import MultipleLocator as ML
 from matplotlib.ticker import ScalarFormatter as SF
 import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.run_log import read_episode_log, read_train_log
 
 # plt.style.use("default")
 style = 'fast'
@@ -90,12 +93,10 @@ exp_paths = {
     'DRQN'      :'/home/ybang4/research/ROMARL/config/central_DDQN/figures/24.09.27.15.07',
 }
 
-episode_paths = {exps: os.path.join(exp_paths[exps], 'episode_log.csv') for exps in exp_paths.keys()}
-training_paths = {exps: os.path.join(exp_paths[exps], 'train_log.csv') for exps in exp_paths.keys()}
 reward_name = 'Reward sum'
 loss_name = 'final loss'
-episodes_data = {exps: pd.read_csv(episode_paths[exps]) for exps in exp_paths.keys()}
-training_data = {exps: pd.read_csv(training_paths[exps]) for exps in exp_paths.keys()}
+episodes_data = {exps: read_episode_log(exp_paths[exps]) for exps in exp_paths.keys()}
+training_data = {exps: read_train_log(exp_paths[exps]) for exps in exp_paths.keys()}
 
 fig_exps, ax_exps = plt.subplots(figsize = (12,6))
 